@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+"""Compares saving and reopening a vistrail through the XML path and
+through a SQLite repository file, on a synthetic vistrail.
+
+Usage: benchmark_db_sqlite.py [operations]
+
+"""
+from __future__ import division
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vistrails.db.domain import DBAction, DBAdd, DBFunction, DBModule, \
+    DBParameter, DBVistrail
+from vistrails.db.services import io
+from vistrails.db.versions import currentVersion, getVersionDAO
+
+def build_vistrail(n):
+    """Builds a vistrail whose actions each add a module with one
+    function and one parameter; every add counts as three operations
+    (module, function, parameter rows).
+
+    """
+    vistrail = DBVistrail(id=None, version=currentVersion, name='benchmark')
+    for i in xrange(1, n // 3 + 1):
+        parameter = DBParameter(id=i, pos=0, name='<no description>',
+                                type='org.vistrails.vistrails.basic:String',
+                                val='value %d' % i, alias='')
+        function = DBFunction(id=i, pos=0, name='value',
+                              parameters=[parameter])
+        module = DBModule(id=i, cache=1, name='String',
+                          namespace='', package='org.vistrails.vistrails.basic',
+                          version='2.1.1', functions=[function])
+        add = DBAdd(id=i, what=DBModule.vtType, objectId=i,
+                    data=module)
+        vistrail.db_add_action(DBAction(id=i, prevId=i - 1,
+                                        date=io.get_current_time(),
+                                        user='benchmark',
+                                        operations=[add]))
+    return vistrail
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+def main(n):
+    # import the DAOs up front so neither path pays for it
+    getVersionDAO(currentVersion)
+    vistrail = build_vistrail(n)
+    print "built %d actions (%d rows)" % (len(vistrail.db_actions), n)
+    tmp_dir = tempfile.mkdtemp(prefix='vt_bench')
+    try:
+        fname = os.path.join(tmp_dir, 'vistrail.xml')
+        xml_save, _ = timed(lambda: io.save_vistrail_to_xml(vistrail, fname))
+        xml_open, _ = timed(lambda: io.open_vistrail_from_xml(fname))
+
+        io.set_db_lib(sqlite3)
+        db_connection = io.open_db_connection(
+                {'db': os.path.join(tmp_dir, 'repository.db')})
+        io.setup_db_tables(db_connection)
+        db_save, saved = timed(lambda: io.save_vistrail_to_db(
+                vistrail, db_connection, True))
+        db_open, opened = timed(lambda: io.open_vistrail_from_db(
+                db_connection, saved.db_id))
+        assert len(opened.db_actions) == len(vistrail.db_actions)
+        io.close_db_connection(db_connection)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print "%-8s %10s %10s" % ('', 'xml', 'sqlite')
+    print "%-8s %9.2fs %9.2fs" % ('save', xml_save, db_save)
+    print "%-8s %9.2fs %9.2fs" % ('open', xml_open, db_open)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(100000)
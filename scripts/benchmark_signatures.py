@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+"""Compares full and incremental re-signing of a pipeline after a
+single parameter change, as happens during a parameter sweep.
+
+"""
+from __future__ import division
+
+import os
+import random
+import sys
+import timeit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vistrails.core.api
+from vistrails.core.system import get_vistrails_basic_pkg_id
+from vistrails.core.vistrail.connection import Connection
+from vistrails.core.vistrail.module import Module
+from vistrails.core.vistrail.module_function import ModuleFunction
+from vistrails.core.vistrail.module_param import ModuleParam
+from vistrails.core.vistrail.operation import ChangeOp
+from vistrails.core.vistrail.pipeline import Pipeline
+from vistrails.core.vistrail.port import Port
+from vistrails.db.domain import IdScope
+
+def build_pipeline(n, id_scope):
+    """Builds a tree of n Integer modules, module i getting its value
+    from module (i - 1) // 2."""
+    basic_pkg = get_vistrails_basic_pkg_id()
+    pipeline = Pipeline()
+    for i in xrange(n):
+        param = ModuleParam(id=id_scope.getNewId(ModuleParam.vtType),
+                            type='Integer', val=str(i))
+        function = ModuleFunction(id=id_scope.getNewId(ModuleFunction.vtType),
+                                  name='value', parameters=[param])
+        pipeline.add_module(Module(id=i, name='Integer', package=basic_pkg,
+                                   functions=[function]))
+    for i in xrange(1, n):
+        source = Port(id=id_scope.getNewId(Port.vtType), type='source',
+                      moduleId=(i - 1) // 2, moduleName='Integer',
+                      name='value')
+        destination = Port(id=id_scope.getNewId(Port.vtType),
+                           type='destination', moduleId=i,
+                           moduleName='Integer', name='value')
+        pipeline.add_connection(Connection(
+                id=id_scope.getNewId(Connection.vtType),
+                ports=[source, destination]))
+    pipeline.build_index()
+    return pipeline
+
+def change_random_parameter(pipeline, id_scope):
+    module = random.choice(pipeline.module_list)
+    function = module.functions[0]
+    old_param = function.params[0]
+    new_param = ModuleParam(id=id_scope.getNewId(ModuleParam.vtType),
+                            type='Integer', val=str(random.randint(0, 1000)))
+    pipeline.perform_operation(ChangeOp(id=-1,
+                                        what=ModuleParam.vtType,
+                                        oldObjId=old_param.real_id,
+                                        newObjId=new_param.real_id,
+                                        parentObjId=function.real_id,
+                                        parentObjType=ModuleFunction.vtType,
+                                        data=new_param))
+
+def main(n=500, repeat=50):
+    vistrails.core.api.initialize()
+    id_scope = IdScope()
+    pipeline = build_pipeline(n, id_scope)
+    pipeline.refresh_signatures(full=True)
+
+    def full():
+        change_random_parameter(pipeline, id_scope)
+        pipeline.refresh_signatures(full=True)
+
+    def incremental():
+        change_random_parameter(pipeline, id_scope)
+        pipeline.refresh_signatures()
+
+    t_full = timeit.timeit(full, number=repeat) / repeat
+    t_incr = timeit.timeit(incremental, number=repeat) / repeat
+    print "%d modules, %d parameter changes" % (n, repeat)
+    print "full re-signing:        %8.2f ms" % (t_full * 1000.0)
+    print "incremental re-signing: %8.2f ms" % (t_incr * 1000.0)
+    print "speedup:                %8.1fx" % (t_full / t_incr)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(*[int(a) for a in sys.argv[1:]])
+    else:
+        main()
@@ -0,0 +1,114 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+
+"""Times the tabledata join, select and aggregate operations on the same
+data stored as numpy arrays, as lists of numbers (both use the vectorized
+code) and as text (row by row).
+
+Usage: benchmark_tabledata.py [rows ...]
+The text versions are only run up to 10^6 rows.
+
+"""
+from __future__ import division
+
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+
+import vistrails.core.api
+from vistrails.packages.tabledata.common import TableObject
+from vistrails.packages.tabledata.operations import AggregatedTable, \
+    JoinedTables, SelectFromTable
+
+MAX_TEXT_ROWS = 10 ** 6
+
+def make_tables(n, kind):
+    rng = numpy.random.RandomState(42)
+    keys = rng.permutation(n)
+    groups = rng.randint(0, 1000, n)
+    values = rng.random_sample(n) * 100.0
+    other_keys = rng.randint(0, 2 * n, n)
+    if kind == 'text':
+        convert = lambda a: [str(e) for e in a.tolist()]
+    elif kind == 'list':
+        convert = lambda a: a.tolist()
+    else:
+        convert = lambda a: a
+    left = TableObject([convert(keys), convert(groups), convert(values)], n,
+                       ['key', 'group', 'value'])
+    right = TableObject([convert(other_keys), convert(values)], n,
+                        ['key', 'value'])
+    return left, right
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+def run(n, kind):
+    left, right = make_tables(n, kind)
+    results = []
+    results.append(timed(lambda: JoinedTables(left, right, 0, 0)))
+    results.append(timed(lambda: SelectFromTable.select_rows(
+            left, 2, '<', 50.0)))
+    def aggregate():
+        table = AggregatedTable(left, 'average', 2, 1)
+        table.get_column(0)
+        table.get_column(1, True)
+    results.append(timed(aggregate))
+    return results
+
+def main(sizes):
+    vistrails.core.api.initialize()
+    print "%10s  %-8s %10s %10s %10s" % ('rows', 'columns',
+                                         'join', 'select', 'aggregate')
+    for n in sizes:
+        for kind in ('array', 'list', 'text'):
+            if kind == 'text' and n > MAX_TEXT_ROWS:
+                continue
+            results = run(n, kind)
+            print "%10d  %-8s %9.3fs %9.3fs %9.3fs" % (
+                    (n, kind) + tuple(results))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main([int(a) for a in sys.argv[1:]])
+    else:
+        main([10 ** 5, 10 ** 6, 10 ** 7])
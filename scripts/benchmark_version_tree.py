@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+"""Compares walking parent pointers with the version tree index, on a
+synthetic vistrail with long branches.
+
+Usage: benchmark_version_tree.py [versions]
+
+"""
+from __future__ import division
+
+import os
+import random
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vistrails.core.vistrail.action import Action
+from vistrails.core.vistrail.vistrail import Vistrail
+
+def build_vistrail(n, rng):
+    """Builds a vistrail with n empty actions. Most versions are children of
+    the previous one; one in fifty starts a new branch somewhere.
+
+    """
+    vistrail = Vistrail()
+    for version in xrange(1, n + 1):
+        if version > 1 and rng.random() < 0.02:
+            parent = rng.randrange(version)
+        else:
+            parent = version - 1
+        vistrail.addVersion(Action(id=version, prevId=parent,
+                                   operations=[]))
+    return vistrail
+
+def walk_common_version(vistrail, v1, v2):
+    """The parent-walking version of Vistrail.getFirstCommonVersion().
+    """
+    t1 = set([v1])
+    t = vistrail.actionMap[v1].parent
+    while t != 0:
+        t1.add(t)
+        t = vistrail.actionMap[t].parent
+    t = v2
+    while t != 0:
+        if t in t1:
+            return t
+        t = vistrail.actionMap[t].parent
+    return 0
+
+def walk_switch_cost(vistrail, descendant, ancestor):
+    cost = 0
+    while descendant != ancestor:
+        descendant = vistrail.actionMap[descendant].parent
+        cost += 1
+    return cost
+
+def timed(func, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        result = func(i)
+    return (time.time() - start) / repeat, result
+
+def main(n):
+    rng = random.Random(42)
+    start = time.time()
+    vistrail = build_vistrail(n, rng)
+    print "built %d versions (max depth %d) in %.2fs" % (
+            n, max(vistrail.tree.index.depth(v) for v in xrange(n + 1)),
+            time.time() - start)
+    pairs = [(rng.randrange(1, n + 1), rng.randrange(1, n + 1))
+             for _ in xrange(100)]
+    cached = [0] + rng.sample(xrange(1, n + 1), 20)
+    graph = vistrail.tree.getVersionTree()
+    index = vistrail.tree.index
+
+    rows = [
+        ('common ancestor',
+         lambda i: walk_common_version(vistrail, *pairs[i]),
+         lambda i: vistrail.getFirstCommonVersion(*pairs[i]), 100),
+        ('closest cached version',
+         lambda i: graph.inverse_immutable().closest_vertex(pairs[i][0],
+                                                             cached),
+         lambda i: index.closest_ancestor(pairs[i][0], cached), 5),
+        ('switch cost',
+         lambda i: walk_switch_cost(vistrail, pairs[i][0], 0),
+         lambda i: index.depth(pairs[i][0]) - index.depth(0), 100),
+    ]
+    print "%-24s %12s %12s %9s" % ('query', 'walk', 'index', 'speedup')
+    for name, walk, indexed, repeat in rows:
+        walk_time, walk_result = timed(walk, repeat)
+        index_time, index_result = timed(indexed, repeat)
+        assert walk_result == index_result
+        print "%-24s %10.3fms %10.3fms %8.0fx" % (
+                name, walk_time * 1000, index_time * 1000,
+                walk_time / index_time)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(100000)
@@ -90,6 +90,17 @@ def init(options_dict={}, args=[]):
     app.init(options_dict=options_dict, args=args)
     return app
 
+def init_worker():
+    """init_worker() -> None
+    Initializer for multiprocessing worker processes. Workers forked from
+    VisTrails already have everything they need; VisTrails is only
+    initialized when the platform starts new interpreters instead
+    (Windows).
+
+    """
+    if get_vistrails_application() is None:
+        init({'spawned': True}, args=[])
+
 class VistrailsApplicationInterface(object):
     def __init__(self):
         self._initialized = False
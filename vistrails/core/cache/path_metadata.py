@@ -0,0 +1,371 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Cache of file system metadata used to hash File and Directory values.
+
+The signature of a path depends on its modification time and, for
+directories, on the modification times of all the subdirectories.
+PathMetadataCache remembers, for each directory, its own mtime and the
+list of its subdirectories, so that checking a tree again only needs a
+stat() per directory instead of listing and testing every entry. The
+result for a path is then trusted until pyinotify reports a change
+below it, or, when pyinotify is not available, for a few seconds.
+
+"""
+from __future__ import division
+
+import os
+import stat
+import threading
+import time
+import unittest
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from vistrails.core import debug
+
+
+class PathMetadataCache(object):
+    """Caches the latest modification time of directory trees.
+
+    tree_mtime() returns the same value as walking the tree each time.
+    ttl is the number of seconds a result is trusted for without
+    notifications; use 0 to check the tree (with stat() only) every time.
+
+    """
+    # Largest timestamp granularity of the supported file systems (FAT)
+    MTIME_GRANULARITY = 2.0
+
+    def __init__(self, ttl=1.0, use_inotify=True):
+        self.ttl = ttl
+        # directory -> (mtime, subdirectory names, time it was listed)
+        self._dirs = {}
+        # path -> (tree mtime, time it was computed, notified)
+        self._trees = {}
+        self._lock = threading.RLock()
+        self._watch_manager = None
+        if use_inotify and pyinotify is not None:
+            try:
+                self._watch_manager = pyinotify.WatchManager()
+                notifier = pyinotify.ThreadedNotifier(self._watch_manager,
+                                                      self._notified)
+                notifier.daemon = True
+                notifier.start()
+            except Exception, e:
+                debug.warning("Can't watch files with inotify, checking "
+                              "modification times instead", e)
+                self._watch_manager = None
+
+    def tree_mtime(self, path):
+        """tree_mtime(path: str) -> int
+
+        Returns the latest modification time (in seconds) of path and,
+        if it is a directory, of all its subdirectories. Raises OSError if
+        the tree can't be read.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._trees.get(path)
+            if entry is not None:
+                t, checked, notified = entry
+                if notified or time.time() - checked < self.ttl:
+                    return t
+            # Watch first, so that a change made during the scan is
+            # notified rather than missed
+            notified = self._watch(path)
+            try:
+                t = self._scan(path)
+            except OSError:
+                self._unwatch([path])
+                raise
+            self._trees[path] = (t, time.time(), notified)
+            return t
+
+    def invalidate(self, path=None):
+        """invalidate(path: str) -> None
+
+        Forgets what is known about path and the trees containing it, or
+        about everything if path is None.
+        """
+        with self._lock:
+            if path is None:
+                self._dirs.clear()
+                self._forget_all_trees()
+                return
+            path = os.path.abspath(path)
+            self._dirs.pop(path, None)
+            self._forget_trees(path)
+
+    @staticmethod
+    def _is_in_tree(path, tree):
+        return path == tree or path.startswith(os.path.join(tree, ''))
+
+    def _forget_trees(self, path):
+        dropped = [tree for tree in self._trees
+                   if self._is_in_tree(path, tree)]
+        for tree in dropped:
+            del self._trees[tree]
+        self._unwatch(dropped)
+
+    def _forget_all_trees(self):
+        dropped = self._trees.keys()
+        self._trees.clear()
+        self._unwatch(dropped)
+
+    def _scan(self, path):
+        st = os.stat(path)
+        t = int(st.st_mtime)
+        if not stat.S_ISDIR(st.st_mode):
+            return t
+        entry = self._dirs.get(path)
+        # Only list the directory when its entries might have changed; a
+        # change in the same clock tick as the listing doesn't change the
+        # mtime, so listings that recent are not trusted
+        if (entry is not None and entry[0] == st.st_mtime and
+                entry[2] - st.st_mtime > self.MTIME_GRANULARITY):
+            subdirs = entry[1]
+        else:
+            listed = time.time()
+            subdirs = [name for name in os.listdir(path)
+                       if os.path.isdir(os.path.join(path, name))]
+            self._dirs[path] = (st.st_mtime, subdirs, listed)
+        for name in subdirs:
+            t = max(t, self._scan(os.path.join(path, name)))
+        return t
+
+    def _watch(self, path):
+        if self._watch_manager is None:
+            return False
+        mask = (pyinotify.IN_ATTRIB | pyinotify.IN_CREATE |
+                pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE_SELF |
+                pyinotify.IN_MOVE_SELF | pyinotify.IN_MODIFY |
+                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_Q_OVERFLOW)
+        try:
+            wdd = self._watch_manager.add_watch(path, mask, rec=True,
+                                                auto_add=True, quiet=True)
+        except Exception:
+            return False
+        # Can fail for part of the tree, e.g. when running out of watches
+        return all(wd >= 0 for wd in wdd.itervalues())
+
+    def _unwatch(self, dropped):
+        """Removes the watches below the dropped trees, except those that
+        the remaining trees still need (trees can be nested).
+        """
+        if self._watch_manager is None or not dropped:
+            return
+        wds = [wd
+               for wd, watch in self._watch_manager.watches.items()
+               if (any(self._is_in_tree(watch.path, tree)
+                       for tree in dropped) and
+                   not any(self._is_in_tree(watch.path, tree)
+                           for tree in self._trees))]
+        if wds:
+            self._watch_manager.rm_watch(wds, quiet=True)
+
+    def _notified(self, event):
+        with self._lock:
+            if event.mask & pyinotify.IN_IGNORED:
+                # a watch was removed, by _unwatch() or after IN_DELETE_SELF
+                return
+            elif event.mask & pyinotify.IN_Q_OVERFLOW:
+                self._forget_all_trees()
+            else:
+                self._forget_trees(event.path)
+
+
+_path_metadata_cache = None
+
+def get_path_metadata_cache():
+    global _path_metadata_cache
+    if _path_metadata_cache is None:
+        _path_metadata_cache = PathMetadataCache()
+    return _path_metadata_cache
+
+##############################################################################
+
+class TestPathMetadataCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.root = tempfile.mkdtemp(prefix='vt_pathcache_')
+        for d in ('a', 'a/b', 'a/b/c', 'd'):
+            os.mkdir(os.path.join(self.root, d))
+        with open(os.path.join(self.root, 'a', 'file'), 'w'):
+            pass
+        self.set_mtime('', 1000)
+        self.set_mtime('a', 1000)
+        self.set_mtime('a/b', 1000)
+        self.set_mtime('a/b/c', 3000)
+        self.set_mtime('d', 2000)
+        self.set_mtime('a/file', 5000)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+
+    def set_mtime(self, path, t):
+        os.utime(os.path.join(self.root, path), (t, t))
+
+    def test_tree_mtime(self):
+        cache = PathMetadataCache(ttl=0, use_inotify=False)
+        self.assertEqual(cache.tree_mtime(self.root), 3000)
+        self.assertEqual(cache.tree_mtime(os.path.join(self.root, 'd')),
+                         2000)
+        self.assertEqual(cache.tree_mtime(os.path.join(self.root, 'a',
+                                                       'file')),
+                         5000)
+        self.set_mtime('a/b/c', 1000)
+        self.assertEqual(cache.tree_mtime(self.root), 2000)
+        os.mkdir(os.path.join(self.root, 'd', 'e'))
+        self.set_mtime('d/e', 4000)
+        self.set_mtime('d', 1000)
+        self.assertEqual(cache.tree_mtime(self.root), 4000)
+        self.assertRaises(OSError, cache.tree_mtime,
+                          os.path.join(self.root, 'missing'))
+
+    def test_same_second(self):
+        """Lists directories again if they changed when they were listed.
+        """
+        cache = PathMetadataCache(ttl=0, use_inotify=False)
+        now = int(time.time())
+        self.set_mtime('d', now)
+        self.assertEqual(cache.tree_mtime(os.path.join(self.root, 'd')), now)
+        # created in the same second as the listing: mtime doesn't change
+        os.mkdir(os.path.join(self.root, 'd', 'e'))
+        self.set_mtime('d/e', now + 4000)
+        self.set_mtime('d', now)
+        self.assertEqual(cache.tree_mtime(os.path.join(self.root, 'd')),
+                         now + 4000)
+
+    def test_ttl(self):
+        cache = PathMetadataCache(ttl=3600, use_inotify=False)
+        self.assertEqual(cache.tree_mtime(self.root), 3000)
+        self.set_mtime('a/b/c', 1000)
+        self.assertEqual(cache.tree_mtime(self.root), 3000)
+        cache.invalidate(os.path.join(self.root, 'a', 'b', 'c'))
+        self.assertEqual(cache.tree_mtime(self.root), 2000)
+
+    def test_inotify(self):
+        """Trusts watched trees until notified, using a fake pyinotify.
+        """
+        global pyinotify
+        test = self
+
+        class Watch(object):
+            def __init__(self, path):
+                self.path = path
+
+        class WatchManager(object):
+            def __init__(self):
+                self.watches = {}
+
+            def add_watch(self, path, mask, rec, auto_add, quiet):
+                # A change made while the tree is being watched and scanned
+                test.set_mtime('a/b/c', 4000)
+                wdd = {}
+                for dirpath, dirnames, filenames in os.walk(path):
+                    # like inotify, gives the same wd for the same path
+                    for wd, watch in self.watches.iteritems():
+                        if watch.path == dirpath:
+                            break
+                    else:
+                        wd = max(self.watches.keys() + [0]) + 1
+                        self.watches[wd] = Watch(dirpath)
+                    wdd[dirpath] = wd
+                return wdd
+
+            def rm_watch(self, wds, quiet):
+                for wd in wds:
+                    del self.watches[wd]
+
+        class ThreadedNotifier(object):
+            def __init__(self, watch_manager, callback):
+                self.callback = callback
+
+            def start(self):
+                notifiers.append(self)
+
+        class Event(object):
+            def __init__(self, path, mask=0x4):
+                self.path = path
+                self.mask = mask
+
+        class FakePyinotify(object):
+            IN_ATTRIB, IN_CREATE, IN_DELETE = 0x4, 0x100, 0x200
+            IN_MOVED_FROM, IN_MOVED_TO = 0x40, 0x80
+            IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+            IN_MODIFY, IN_CLOSE_WRITE = 0x2, 0x8
+            IN_Q_OVERFLOW, IN_IGNORED = 0x4000, 0x8000
+
+        FakePyinotify.WatchManager = WatchManager
+        FakePyinotify.ThreadedNotifier = ThreadedNotifier
+
+        notifiers = []
+        old_pyinotify = pyinotify
+        pyinotify = FakePyinotify
+        try:
+            cache = PathMetadataCache(ttl=0)
+            notify = notifiers[0].callback
+            watches = cache._watch_manager.watches
+            sub = os.path.join(self.root, 'a')
+            self.assertEqual(cache.tree_mtime(self.root), 4000)
+            self.assertEqual(cache.tree_mtime(sub), 4000)
+            self.assertEqual(len(watches), 5)
+
+            # watched trees are trusted until notified, even with ttl=0
+            self.set_mtime('a/b/c', 1000)
+            self.assertEqual(cache.tree_mtime(self.root), 4000)
+            # the watches of the root that a is not using are removed
+            notify(Event(os.path.join(self.root, 'd')))
+            self.assertEqual(sorted(w.path for w in watches.itervalues()),
+                             [sub, os.path.join(sub, 'b'),
+                              os.path.join(sub, 'b', 'c')])
+            self.assertEqual(cache.tree_mtime(sub), 4000)
+            notify(Event(None, FakePyinotify.IN_IGNORED))
+            self.assertEqual(cache.tree_mtime(sub), 4000)
+            notify(Event(os.path.join(sub, 'b')))
+            self.assertEqual(watches, {})
+
+            notify(Event(None, FakePyinotify.IN_Q_OVERFLOW))
+            self.assertRaises(OSError, cache.tree_mtime,
+                              os.path.join(self.root, 'missing'))
+            self.assertEqual(watches, {})
+        finally:
+            pyinotify = old_pyinotify
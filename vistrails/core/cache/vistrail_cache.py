@@ -0,0 +1,346 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Caches used by the application server to answer concurrent requests.
+
+RequestCoalescer lets identical requests that run at the same time share
+one execution, and VistrailCache keeps the vistrails loaded from the
+database, along with the pipelines materialized from them.
+
+"""
+from __future__ import division
+
+import sys
+import threading
+import unittest
+
+from vistrails.core.db import io
+
+
+class _InFlightCall(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+class RequestCoalescer(object):
+    """Lets concurrent identical requests share a single execution: a
+    thread asking for a key that is already being computed waits for
+    that computation and gets its result (or exception) instead of
+    running it again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.coalesced = 0
+
+    def run(self, key, func, *args):
+        with self.lock:
+            call = self.in_flight.get(key)
+            if call is None:
+                call = self.in_flight[key] = _InFlightCall()
+                is_owner = True
+            else:
+                self.coalesced += 1
+                is_owner = False
+        if not is_owner:
+            return call.wait()
+        try:
+            call.result = func(*args)
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call.done.set()
+        return call.result
+
+class _VistrailCacheEntry(object):
+    def __init__(self, last_modified, loaded):
+        self.last_modified = last_modified
+        self.loaded = loaded
+        self.last_used = 0
+        self.pipelines = {}
+        # getPipeline() updates the workflow cache of the vistrail, so
+        # pipelines of the same vistrail are materialized one at a time
+        self.lock = threading.Lock()
+
+class VistrailCache(object):
+    """Vistrails loaded from the database by the request threads, and
+    the pipelines materialized from them. Entries are keyed by database
+    and vistrail id, and are checked against the modification time of
+    the vistrail in the database so that a vistrail saved in the
+    meantime is loaded again. Concurrent loads of the same vistrail are
+    coalesced. Loads bypass DBLocator.cache, so that max_vistrails bounds
+    the vistrails kept in memory. The cached objects are shared between
+    threads: callers
+    must not modify them, and should get pipelines through
+    get_pipeline() rather than from the vistrail.
+    """
+    def __init__(self, max_vistrails=16):
+        self.max_vistrails = max_vistrails
+        self.lock = threading.Lock()
+        self.entries = {}
+        self._tick = 0
+        self.coalescer = RequestCoalescer()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _get_entry(self, locator):
+        key = (locator.host, locator.port, locator.db, locator.obj_id)
+        last_modified = locator.get_db_modification_time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry.last_modified == last_modified:
+                    self.hits += 1
+                    self._touch(entry)
+                    return entry
+                del self.entries[key]
+                self.invalidations += 1
+            self.misses += 1
+        return self.coalescer.run((key, last_modified), self._load,
+                                  key, locator, last_modified)
+
+    def _touch(self, entry):
+        self._tick += 1
+        entry.last_used = self._tick
+
+    def _load(self, key, locator, last_modified):
+        entry = _VistrailCacheEntry(last_modified,
+                                    io.load_vistrail(locator,
+                                                     use_cache=False))
+        with self.lock:
+            self._touch(entry)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_vistrails:
+                oldest = min(self.entries,
+                             key=lambda k: self.entries[k].last_used)
+                del self.entries[oldest]
+        return entry
+
+    def _materialize(self, entry, version):
+        with entry.lock:
+            pipeline = entry.loaded[0].getPipeline(version)
+        with self.lock:
+            entry.pipelines[version] = pipeline
+        return pipeline
+
+    def load_vistrail(self, locator):
+        """load_vistrail(locator: DBLocator) -> (vistrail, abstractions,
+                                                 thumbnails, mashups)
+        Same as io.load_vistrail(locator), from the cache if possible.
+        """
+        return self._get_entry(locator).loaded
+
+    def get_pipeline(self, locator, version):
+        """get_pipeline(locator: DBLocator, version: long) -> Pipeline
+        Same as getPipeline(version) on the loaded vistrail.
+        """
+        entry = self._get_entry(locator)
+        with self.lock:
+            pipeline = entry.pipelines.get(version)
+        if pipeline is None:
+            pipeline = self.coalescer.run((entry, version), self._materialize,
+                                          entry, version)
+        return pipeline
+
+    def stats(self):
+        with self.lock:
+            return {'vistrails': len(self.entries),
+                    'pipelines': sum(len(entry.pipelines)
+                                     for entry in self.entries.itervalues()),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'coalesced': self.coalescer.coalesced}
+
+
+##############################################################################
+
+class TestRequestCoalescer(unittest.TestCase):
+    def run_concurrently(self, coalescer, func, nb_threads=4):
+        """Calls func with the same key from several threads, letting it
+        return once all the threads are waiting on it."""
+        started = threading.Event()
+        release = threading.Event()
+        outcomes = []
+
+        def call():
+            started.set()
+            release.wait()
+            return func()
+
+        def thread():
+            try:
+                outcomes.append(('result', coalescer.run('key', call)))
+            except Exception, e:
+                outcomes.append(('error', e))
+
+        threads = [threading.Thread(target=thread) for i in xrange(nb_threads)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        while coalescer.coalesced < nb_threads - 1:
+            threading.Event().wait(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+        return outcomes
+
+    def test_shared_result(self):
+        coalescer = RequestCoalescer()
+        calls = []
+        def func():
+            calls.append(1)
+            return 42
+        outcomes = self.run_concurrently(coalescer, func)
+        self.assertEqual(outcomes, [('result', 42)] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(coalescer.in_flight, {})
+
+    def test_shared_exception(self):
+        coalescer = RequestCoalescer()
+        error = ValueError("failed")
+        def func():
+            raise error
+        outcomes = self.run_concurrently(coalescer, func)
+        self.assertEqual(outcomes, [('error', error)] * 4)
+        self.assertEqual(coalescer.in_flight, {})
+
+    def test_sequential_calls(self):
+        coalescer = RequestCoalescer()
+        results = iter([1, 2])
+        self.assertEqual(coalescer.run('key', lambda: next(results)), 1)
+        self.assertEqual(coalescer.run('key', lambda: next(results)), 2)
+        self.assertEqual(coalescer.coalesced, 0)
+
+
+class TestVistrailCache(unittest.TestCase):
+    class Locator(object):
+        host, port, db = 'localhost', 3306, 'vistrails'
+
+        def __init__(self, obj_id, last_modified=1):
+            self.obj_id = obj_id
+            self.last_modified = last_modified
+
+        def get_db_modification_time(self):
+            return self.last_modified
+
+    class Vistrail(object):
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.calls = []
+
+        def getPipeline(self, version):
+            # Fails if called from two threads at the same time
+            if not self.lock.acquire(False):
+                raise RuntimeError("concurrent getPipeline()")
+            try:
+                threading.Event().wait(0.01)
+                self.calls.append(version)
+                return ('pipeline', version)
+            finally:
+                self.lock.release()
+
+    def setUp(self):
+        self.loads = []
+        self.old_load_vistrail = io.load_vistrail
+        def load_vistrail(locator, use_cache=True):
+            self.assertFalse(use_cache)
+            self.loads.append(locator.obj_id)
+            return (self.Vistrail(), [], [], [])
+        io.load_vistrail = load_vistrail
+
+    def tearDown(self):
+        io.load_vistrail = self.old_load_vistrail
+
+    def test_load(self):
+        cache = VistrailCache()
+        locator = self.Locator(1)
+        loaded = cache.load_vistrail(locator)
+        self.assertIs(cache.load_vistrail(self.Locator(1)), loaded)
+        self.assertEqual(self.loads, [1])
+        locator.last_modified = 2
+        self.assertIsNot(cache.load_vistrail(locator), loaded)
+        self.assertEqual(self.loads, [1, 1])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'],
+                          stats['invalidations']), (1, 2, 1))
+
+    def test_eviction(self):
+        cache = VistrailCache(max_vistrails=2)
+        for obj_id in (1, 2, 1, 3, 1, 2):
+            cache.load_vistrail(self.Locator(obj_id))
+        self.assertEqual(self.loads, [1, 2, 3, 2])
+        self.assertEqual(cache.stats()['vistrails'], 2)
+
+    def test_get_pipeline(self):
+        cache = VistrailCache()
+        locator = self.Locator(1)
+        self.assertEqual(cache.get_pipeline(locator, 5), ('pipeline', 5))
+        self.assertEqual(cache.get_pipeline(locator, 5), ('pipeline', 5))
+        vistrail = cache.load_vistrail(locator)[0]
+        self.assertEqual(vistrail.calls, [5])
+
+    def test_concurrent_pipelines(self):
+        cache = VistrailCache()
+        locator = self.Locator(1)
+        errors = []
+        def thread(version):
+            try:
+                cache.get_pipeline(locator, version)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=thread, args=(version,))
+                   for version in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        vistrail = cache.load_vistrail(locator)[0]
+        self.assertEqual(sorted(vistrail.calls), range(8))
+        self.assertEqual(self.loads, [1])
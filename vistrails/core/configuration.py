@@ -63,6 +63,7 @@ _simple_documentation = """
 autoConnect: Automatically connect dragged in modules
 autoSave: Automatically save backup vistrails every two minutes
 batch: Run in batch mode instead of interactive mode
+batchWorkers: Number of processes used to run the vistrails of a batch
 cache: Cache previous results so they may be used in future computations
 customVersionColors: Allow setting custom colors for versions
 dataDir: Default data directory
@@ -76,6 +77,7 @@ enablePackagesSilently: Automatically enable packages when needed
 errorLog: Write errors to a log file
 NoExecute: Do not execute specified workflows
 executionLog: Track execution provenance when running workflows
+executionThreads: Number of threads used to run thread-safe modules
 fileDir: Default vistrail directory
 fixedCustomVersionColorSaturation: Don't vary custom color with age
 fixedSpreadsheetCells: Draw spreadsheet cells at a fixed size
@@ -83,6 +85,7 @@ graphsAsPdf: Generate graphs in PDF format instead of images
 handlerDontAsk: Do not ask about extension handling at startup
 hideUpgrades: Don't show upgrade nodes in the version tree
 host: The hostname for the database to load the vistrail from
+incrementalSave: Append changes to .vt files instead of rewriting them
 installBundles: Install missing Python dependencies
 installBundlesWithPip: Use pip to install missing Python dependencies
 isInServerMode: Indicates whether VisTrails is being run as a server
@@ -101,6 +104,7 @@ outputDirectory: Directory in which to place output files
 outputPipelineGraph: Output the workflow graph as an image
 outputVersionTree: Output the version tree as an image
 parameterExploration: Run parameter exploration instead of workflow
+parameterExplorationWorkers: Number of processes used to run parameter explorations without the GUI
 parameters: List of parameters to use when running workflow
 port: The port for the database to load the vistrail from
 remoteShutdown: If connecting to single instance, make that instance exit
@@ -109,6 +113,9 @@ enableUsage: Enable sending anonymous usage statistics
 disableUsage: Disable sending anonymous usage statistics
 repositoryHTTPURL: Remote package repository URL
 repositoryLocalPath: Local package repository directory
+resultCache: Store module results on disk so other sessions can reuse them
+resultCacheDir: Persistent result cache directory
+resultCacheSize: Maximum size of the persistent result cache (in MB)
 rootDirectory: Directory that contains the VisTrails source code
 rpcConfig: Config file for server connection options
 rpcInstances: Number of other instances that vistrails should start
@@ -163,6 +170,14 @@ batch: Boolean
 
     Run vistrails in batch mode instead of interactive mode.
 
+batchWorkers: Integer
+
+    If greater than 1, batch runs that involve several vistrails are
+    dispatched to that many worker processes, one vistrail at a time.
+    The versions of a vistrail always run in the same process, so
+    they share its loaded vistrail and its cache. The default, 0, runs
+    everything in the VisTrails process.
+
 cache: Boolean
 
     Cache previous results so they may be used in future computations.
@@ -220,6 +235,13 @@ executionLog: Boolean
 
     Track execution provenance when running workflows.
 
+executionThreads: Integer
+
+    If greater than 1, the modules of a workflow are scheduled in
+    dependency order and those that are thread-safe are run
+    concurrently on that many worker threads. Other modules still run
+    one at a time. The default, 0, runs the workflow serially.
+
 fileDir: Path
 
     The location that VisTrails uses as a default directory for
@@ -250,6 +272,14 @@ host: URL
 
     The hostname for the database to load the vistrail from.
 
+incrementalSave: Boolean
+
+    When saving a .vt file that was already saved, append the new
+    actions, annotations and log entries to it instead of rewriting the
+    whole archive. If other changes were made, a full save is done
+    instead. Saving with this option off rewrites the file in the
+    regular layout.
+
 installBundles: Boolean
 
     Automatically try to install missing Python dependencies.
@@ -352,6 +382,13 @@ parameterExploration: Boolean
     Open and execute parameter exploration specified by the
     version argument after the .vt file.
 
+parameterExplorationWorkers: Integer
+
+    If greater than 1, parameter explorations run without the GUI are
+    dispatched to that many worker processes, and their results are
+    reported as they complete. The default, 0, executes the points one
+    after the other in the VisTrails process.
+
 parameters: String
 
     List of parameters to use when running workflow.
@@ -392,6 +429,24 @@ repositoryLocalPath: Path
 
     Path used to locate packages available to be installed.
 
+resultCache: Boolean
+
+    Also store the results of cacheable modules on disk, keyed by the
+    signature of their upstream pipeline, so that other VisTrails
+    sessions and processes (batch runs, servers, parallel workers) can
+    reuse them instead of recomputing them. Only outputs that can be
+    pickled are stored.
+
+resultCacheDir: Path
+
+    The directory where the persistent result cache is stored. It can
+    be shared by several processes.
+
+resultCacheSize: Integer
+
+    The maximum size of the persistent result cache, in megabytes. The
+    least recently used results are removed first.
+
 reviewMode: Boolean
 
     *Deprecated* Used to interactively export a pipeline.
@@ -698,6 +753,12 @@ base_config = {
      ConfigField('cache', True, bool, ConfigType.ON_OFF),
      ConfigField('stopOnError', True, bool, ConfigType.ON_OFF),
      ConfigField('executionLog', True, bool, ConfigType.ON_OFF),
+     ConfigField('incrementalSave', False, bool, ConfigType.ON_OFF),
+     ConfigField('executionThreads', 0, int),
+     ConfigField('parameterExplorationWorkers', 0, int),
+     ConfigField('batchWorkers', 0, int),
+     ConfigField('resultCache', False, bool, ConfigType.ON_OFF),
+     ConfigField('resultCacheSize', 1024, int),
      ConfigField('errorLog', True, bool, ConfigType.ON_OFF),
      ConfigField('defaultFileType', system.vistrails_default_file_type(), str,
                  widget_type="combo",
@@ -778,6 +839,7 @@ base_config = {
      ConfigField('userPackageDir', "userpackages", ConfigPath),
      ConfigField('fileDir', None, ConfigPath),
      ConfigField('logDir', "logs", ConfigPath),
+     ConfigField('resultCacheDir', "resultcache", ConfigPath),
      ConfigField('temporaryDir', None,  ConfigPath)],
     "Advanced":
     [ConfigField('singleInstance', True, bool, ConfigType.ON_OFF),
@@ -35,6 +35,7 @@
 ###############################################################################
 """ Module used when running  vistrails uninteractively """
 from __future__ import absolute_import, division
+import multiprocessing
 import os.path
 import unittest
 
@@ -58,104 +59,188 @@ import vistrails.db
 
 ################################################################################
 
+def _run_vistrail(locator, workflows, parameters, update_vistrail,
+                  extra_info, reason):
+    """_run_vistrail(locator, workflows: list of (index, version),
+                     parameters: str, update_vistrail: boolean,
+                     extra_info: dict, reason: str)
+          -> list of (index, result)
+    Runs several versions of the vistrail at locator. The vistrail is
+    loaded once, its versions are run one after the other by the same
+    controller, and it is written once at the end, even if a version
+    fails.
+
+    """
+    elements = parameters.split("$&$")
+    aliases = {}
+    params = []
+    result = []
+    (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
+    controller = VistrailController(v, locator, abstractions, thumbnails,
+                                    mashups, auto_save=update_vistrail)
+    if not update_vistrail:
+        conf = get_vistrails_configuration()
+        if conf.has('thumbs'):
+            conf.thumbs.autoSave = False
+
+    try:
+        for index, workflow in workflows:
+            if isinstance(workflow, basestring):
+                version = v.get_version_number(workflow)
+            elif isinstance(workflow, (int, long)):
+                version = workflow
+            elif workflow is None:
+                version = controller.get_latest_version_in_graph()
+            else:
+                msg = "Invalid version tag or number: %s" % workflow
+                raise VistrailsInternalError(msg)
+            controller.change_selected_version(version)
+
+            for e in elements:
+                pos = e.find("=")
+                if pos != -1:
+                    key = e[:pos].strip()
+                    value = e[pos+1:].strip()
+            
+                    if controller.current_pipeline.has_alias(key):
+                        aliases[key] = value
+                    elif extra_info and 'mashup_id' in extra_info:
+                        # new-style mashups can have aliases not existing in pipeline
+                        for mashuptrail in mashups:
+                            if mashuptrail.vtVersion == version:
+                                mashup = mashuptrail.getMashup(extra_info['mashup_id'])
+                                c = mashup.getAliasByName(key).component
+                                params.append((c.vttype, c.vtid, value))
+
+            jobMonitor = controller.jobMonitor
+            current_workflow = jobMonitor.currentWorkflow()
+            if not current_workflow:
+                for job in jobMonitor.workflows.itervalues():
+                    try:
+                        job_version = int(job.version)
+                    except ValueError:
+                        try:
+                            job_version =  v.get_version_number(job.version)
+                        except KeyError:
+                            # this is a PE or mashup
+                            continue
+                    if version == job_version:
+                        current_workflow = job
+                        jobMonitor.startWorkflow(job)
+                if not current_workflow:
+                    current_workflow = JobWorkflow(version)
+                    jobMonitor.startWorkflow(current_workflow)
+
+            try:
+                (results, _) = \
+                controller.execute_current_workflow(custom_aliases=aliases,
+                                                    custom_params=params,
+                                                    extra_info=extra_info,
+                                                    reason=reason)
+            finally:
+                jobMonitor.finishWorkflow()
+            new_version = controller.current_version
+            if new_version != version:
+                debug.log("Version '%s' (%s) was upgraded. The actual "
+                          "version executed was %s" % (
+                          workflow, version, new_version))
+            run = results[0]
+            run.workflow_info = (locator.name, new_version)
+            run.pipeline = controller.current_pipeline
+
+            result.append((index, run))
+            if current_workflow.jobs:
+                if current_workflow.completed():
+                    run.job = "COMPLETED"
+                else:
+                    run.job = "RUNNING: %s" % current_workflow.id
+                    for job in current_workflow.jobs.itervalues():
+                        if not job.finished:
+                            run.job += "\n  %s %s %s" % (job.start, job.name, job.description())
+                print run.job
+    finally:
+        if update_vistrail:
+            controller.write_vistrail(locator)
+    return result
+
+def _run_vistrail_in_worker(args):
+    """_run_vistrail_in_worker(args: tuple) -> list of (index, dict)
+    Runs _run_vistrail() in a worker process. Only the parts of the
+    results that can be sent back are returned: the module instances
+    are not, and errors are turned into strings.
+
+    """
+    from vistrails.core.db.io import serialize
+
+    results = []
+    for index, run in _run_vistrail(*args):
+        run_info = {'objects': dict.fromkeys(run.objects),
+                    'errors': dict((module_id, str(error))
+                                   for module_id, error
+                                   in run.errors.iteritems()),
+                    'executed': dict(run.executed),
+                    'workflow_info': run.workflow_info,
+                    'pipeline': serialize(run.pipeline)}
+        if hasattr(run, 'job'):
+            run_info['job'] = run.job
+        results.append((index, run_info))
+    return results
+
 def run_and_get_results(w_list, parameters='',
                         update_vistrail=True, extra_info=None,
-                        reason='Console Mode Execution'):
+                        reason='Console Mode Execution', workers=None):
     """run_and_get_results(w_list: list of (locator, version), parameters: str,
                            output_dir:str, update_vistrail: boolean,
-                           extra_info:dict)
+                           extra_info:dict, workers: int)
     Run all workflows in w_list, and returns an interpreter result object.
     version can be a tag name or a version id.
+
+    The workflows are grouped by locator, so that each vistrail is
+    loaded and written once. If workers is greater than 1 (it is read
+    from the batchWorkers configuration option if None), the vistrails
+    are dispatched to that many worker processes; the module instances
+    are not returned in that case.
     
     """
-    elements = parameters.split("$&$")
-    aliases = {}
-    params = []
-    result = []
-    for locator, workflow in w_list:
-        (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
-        controller = VistrailController(v, locator, abstractions, thumbnails,
-                                        mashups, auto_save=update_vistrail)
-        if isinstance(workflow, basestring):
-            version = v.get_version_number(workflow)
-        elif isinstance(workflow, (int, long)):
-            version = workflow
-        elif workflow is None:
-            version = controller.get_latest_version_in_graph()
+    groups = []
+    for index, (locator, workflow) in enumerate(w_list):
+        for group_locator, workflows in groups:
+            if group_locator == locator:
+                workflows.append((index, workflow))
+                break
         else:
-            msg = "Invalid version tag or number: %s" % workflow
-            raise VistrailsInternalError(msg)
-        controller.change_selected_version(version)
-
-        for e in elements:
-            pos = e.find("=")
-            if pos != -1:
-                key = e[:pos].strip()
-                value = e[pos+1:].strip()
-            
-                if controller.current_pipeline.has_alias(key):
-                    aliases[key] = value
-                elif extra_info and 'mashup_id' in extra_info:
-                    # new-style mashups can have aliases not existing in pipeline
-                    for mashuptrail in mashups:
-                        if mashuptrail.vtVersion == version:
-                            mashup = mashuptrail.getMashup(extra_info['mashup_id'])
-                            c = mashup.getAliasByName(key).component
-                            params.append((c.vttype, c.vtid, value))
-
-        if not update_vistrail:
-            conf = get_vistrails_configuration()
-            if conf.has('thumbs'):
-                conf.thumbs.autoSave = False
-        
-        jobMonitor = controller.jobMonitor
-        current_workflow = jobMonitor.currentWorkflow()
-        if not current_workflow:
-            for job in jobMonitor.workflows.itervalues():
-                try:
-                    job_version = int(job.version)
-                except ValueError:
-                    try:
-                        job_version =  v.get_version_number(job.version)
-                    except KeyError:
-                        # this is a PE or mashup
-                        continue
-                if version == job_version:
-                    current_workflow = job
-                    jobMonitor.startWorkflow(job)
-            if not current_workflow:
-                current_workflow = JobWorkflow(version)
-                jobMonitor.startWorkflow(current_workflow)
+            groups.append((locator, [(index, workflow)]))
 
+    if workers is None:
+        workers = getattr(get_vistrails_configuration(), 'batchWorkers', 0)
+    result = [None] * len(w_list)
+    if workers > 1 and len(groups) > 1:
+        from vistrails.core.db.io import unserialize
+        from vistrails.core.application import init_worker
+        from vistrails.core.utils import InstanceObject
+
+        pool = multiprocessing.Pool(min(workers, len(groups)), init_worker)
         try:
-            (results, _) = \
-            controller.execute_current_workflow(custom_aliases=aliases,
-                                                custom_params=params,
-                                                extra_info=extra_info,
-                                                reason=reason)
+            tasks = [pool.apply_async(_run_vistrail_in_worker,
+                                      ((locator, workflows, parameters,
+                                        update_vistrail, extra_info,
+                                        reason),))
+                     for locator, workflows in groups]
+            for task in tasks:
+                for index, run_info in task.get():
+                    run_info['pipeline'] = unserialize(
+                        run_info['pipeline'],
+                        vistrails.core.vistrail.pipeline.Pipeline)
+                    result[index] = InstanceObject(**run_info)
         finally:
-            jobMonitor.finishWorkflow()
-        new_version = controller.current_version
-        if new_version != version:
-            debug.log("Version '%s' (%s) was upgraded. The actual "
-                      "version executed was %s" % (
-                      workflow, version, new_version))
-        run = results[0]
-        run.workflow_info = (locator.name, new_version)
-        run.pipeline = controller.current_pipeline
-
-        if update_vistrail:
-            controller.write_vistrail(locator)
-        result.append(run)
-        if current_workflow.jobs:
-            if current_workflow.completed():
-                run.job = "COMPLETED"
-            else:
-                run.job = "RUNNING: %s" % current_workflow.id
-                for job in current_workflow.jobs.itervalues():
-                    if not job.finished:
-                        run.job += "\n  %s %s %s" % (job.start, job.name, job.description())
-            print run.job
+            pool.terminate()
+            pool.join()
+    else:
+        for locator, workflows in groups:
+            for index, run in _run_vistrail(locator, workflows, parameters,
+                                            update_vistrail, extra_info,
+                                            reason):
+                result[index] = run
     return result
 
 ################################################################################
@@ -278,6 +363,9 @@ def run_parameter_exploration(locator, pe_id, extra_info = {},
                                  reason: str) -> (pe_id, [error msg])
     Run parameter exploration in w, and returns an interpreter result object.
     version can be a tag name or a version id.
+
+    Without the GUI, the exploration is run by a ParameterExplorationRunner
+    and the errors of all its points are reported together.
     
     """
     if is_running_gui():
@@ -298,6 +386,33 @@ def run_parameter_exploration(locator, pe_id, extra_info = {},
         except Exception, e:
             return (locator, pe_id,
                     debug.format_exception(e), debug.format_exc())
+    else:
+        from vistrails.core.param_explore import ParameterExplorationRunner
+        try:
+            (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
+            controller = VistrailController(v, locator, abstractions,
+                                            thumbnails, mashups,
+                                            auto_save=False)
+            try:
+                pe_id = int(pe_id)
+                pe = controller.vistrail.get_paramexp(pe_id)
+            except ValueError:
+                pe = controller.vistrail.get_named_paramexp(pe_id)
+            runner = ParameterExplorationRunner(controller, pe)
+            errors = []
+            for result in runner.run(extra_info, reason):
+                position = "%s_%s_%s" % result.position
+                debug.log("Parameter exploration %s: %s done" % (pe_id,
+                                                                 position))
+                for module_id, error in sorted(result.errors.iteritems()):
+                    errors.append("%s (module %s): %s" % (position,
+                                                          module_id, error))
+            if errors:
+                return (locator, pe_id, "%d errors" % len(errors),
+                        "\n".join(errors))
+        except Exception, e:
+            return (locator, pe_id,
+                    debug.format_exception(e), debug.format_exc())
 
 def run_parameter_explorations(w_list, extra_info = {},
                        reason="Console Mode Parameter Exploration Execution"):
@@ -420,6 +535,54 @@ class TestConsoleMode(unittest.TestCase):
         result = run([(locator, "v2")], update_vistrail=False)
         self.assertEquals(len(result), 0)
 
+    def test_batch_groups_locators(self):
+        import vistrails.core.console_mode as console_mode
+        root = vistrails.core.system.vistrails_root_directory()
+        dummy = XMLFileLocator(root + '/tests/resources/dummy.xml')
+        source = XMLFileLocator(root + '/tests/resources/pythonsource.xml')
+        loaded = []
+        orig_load_vistrail = console_mode.load_vistrail
+        def counting_load_vistrail(locator, *args, **kwargs):
+            loaded.append(locator)
+            return orig_load_vistrail(locator, *args, **kwargs)
+        console_mode.load_vistrail = counting_load_vistrail
+        try:
+            w_list = [(dummy, "int chain"),
+                      (source, "test_simple_success"),
+                      (XMLFileLocator(root + '/tests/resources/dummy.xml'),
+                       "float chain")]
+            results = run_and_get_results(w_list, update_vistrail=False,
+                                          workers=0)
+        finally:
+            console_mode.load_vistrail = orig_load_vistrail
+        self.assertEqual(loaded, [dummy, source])
+        self.assertEqual([r.workflow_info[0] for r in results],
+                         [dummy.name, source.name, dummy.name])
+        self.assertEqual([len(r.errors) for r in results], [0, 0, 0])
+
+        results = run_and_get_results(w_list, update_vistrail=False,
+                                      workers=2)
+        self.assertEqual([r.workflow_info[0] for r in results],
+                         [dummy.name, source.name, dummy.name])
+        self.assertEqual([len(r.errors) for r in results], [0, 0, 0])
+        self.assertEqual(len(results[1].executed), 1)
+
+    def test_batch_written_on_error(self):
+        root = vistrails.core.system.vistrails_root_directory()
+        dummy = XMLFileLocator(root + '/tests/resources/dummy.xml')
+        written = []
+        orig_write_vistrail = VistrailController.write_vistrail
+        def write_vistrail(controller, locator, *args, **kwargs):
+            written.append((locator, controller._auto_save))
+        VistrailController.write_vistrail = write_vistrail
+        try:
+            self.assertRaises(Exception, run_and_get_results,
+                              [(dummy, "int chain"), (dummy, "no such tag")],
+                              update_vistrail=True, workers=0)
+        finally:
+            VistrailController.write_vistrail = orig_write_vistrail
+        self.assertEqual(written, [(dummy, True)])
+
     def test_ticket_73(self):
         # Tests serializing a custom-named module to disk
         locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() + 
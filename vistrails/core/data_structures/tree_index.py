@@ -0,0 +1,239 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+from __future__ import division
+
+import unittest
+
+################################################################################
+# TreeIndex
+
+class TreeIndex(object):
+    """An index over a rooted tree that only grows by adding leaves, such as
+    the version tree of a vistrail.
+
+    Each node stores its parent, its depth and one "jump" pointer to an
+    ancestor, chosen from its parent's pointers when it is added (see
+    E. Myers, "An applicative random-access stack", 1983). The jumps of
+    a path form a skew-binary decomposition of it, so that finding the
+    ancestor of a node at a given depth, or the lowest common ancestor of
+    two nodes, takes O(log n) steps, while adding a node is O(1) and only
+    uses constant memory.
+
+    """
+
+    def __init__(self, root=0):
+        self.root = root
+        self._parent = {root: root}
+        self._depth = {root: 0}
+        self._jump = {root: root}
+        # nodes added before their parent, by parent
+        self._orphans = {}
+
+    def __contains__(self, node):
+        return node in self._depth
+
+    def __len__(self):
+        return len(self._depth)
+
+    def add(self, node, parent):
+        """add(node, parent) -> None
+        Adds node as a child of parent. If parent is not in the index yet,
+        node is added when parent is.
+
+        """
+        if parent not in self._depth:
+            self._orphans.setdefault(parent, []).append(node)
+            return
+        nodes = [(node, parent)]
+        while nodes:
+            node, parent = nodes.pop()
+            jump = self._jump[parent]
+            if (self._depth[parent] - self._depth[jump] ==
+                    self._depth[jump] - self._depth[self._jump[jump]]):
+                jump = self._jump[jump]
+            else:
+                jump = parent
+            self._parent[node] = parent
+            self._depth[node] = self._depth[parent] + 1
+            self._jump[node] = jump
+            nodes.extend((child, node)
+                         for child in self._orphans.pop(node, ()))
+
+    def parent(self, node):
+        """parent(node) -> node
+        Returns the parent of node, or None for the root.
+
+        """
+        if node == self.root:
+            return None
+        return self._parent[node]
+
+    def depth(self, node):
+        """depth(node) -> int
+        Returns the distance between node and the root.
+
+        """
+        return self._depth[node]
+
+    def ancestor(self, node, depth):
+        """ancestor(node, depth: int) -> node
+        Returns the ancestor of node that is at the given depth.
+
+        """
+        node_depth = self._depth[node]
+        if not 0 <= depth <= node_depth:
+            raise ValueError("No ancestor of %r at depth %d" % (node, depth))
+        while node_depth > depth:
+            jump = self._jump[node]
+            if self._depth[jump] >= depth:
+                node = jump
+            else:
+                node = self._parent[node]
+            node_depth = self._depth[node]
+        return node
+
+    def is_ancestor(self, ancestor, node):
+        """is_ancestor(ancestor, node) -> bool
+        Whether ancestor is node or one of its ancestors.
+
+        """
+        if ancestor not in self._depth or node not in self._depth:
+            return False
+        depth = self._depth[ancestor]
+        return (depth <= self._depth[node] and
+                self.ancestor(node, depth) == ancestor)
+
+    def common_ancestor(self, node1, node2):
+        """common_ancestor(node1, node2) -> node
+        Returns the lowest common ancestor of node1 and node2.
+
+        """
+        depth = min(self._depth[node1], self._depth[node2])
+        node1 = self.ancestor(node1, depth)
+        node2 = self.ancestor(node2, depth)
+        # nodes at the same depth have their jumps at the same depth
+        while node1 != node2:
+            jump1, jump2 = self._jump[node1], self._jump[node2]
+            if jump1 != jump2:
+                node1, node2 = jump1, jump2
+            else:
+                node1, node2 = self._parent[node1], self._parent[node2]
+        return node1
+
+    def closest_ancestor(self, node, candidates):
+        """closest_ancestor(node, candidates: iterable) -> node
+        Returns the deepest of the candidates that is node or one of its
+        ancestors, or None if there is none.
+
+        """
+        best = None
+        best_depth = -1
+        for candidate in candidates:
+            depth = self._depth.get(candidate, -1)
+            if depth > best_depth and self.is_ancestor(candidate, node):
+                best, best_depth = candidate, depth
+        return best
+
+    def path(self, node, start=None):
+        """path(node, start) -> list
+        Returns the nodes on the path from start (excluded, defaults to the
+        root) to node (included). start has to be an ancestor of node.
+
+        """
+        if start is None:
+            start = self.root
+        length = self._depth[node] - self._depth[start]
+        result = [None] * length
+        for i in xrange(length - 1, -1, -1):
+            result[i] = node
+            node = self._parent[node]
+        if node != start:
+            raise ValueError("%r is not an ancestor" % (start,))
+        return result
+
+################################################################################
+
+class TestTreeIndex(unittest.TestCase):
+    def make_tree(self, parents):
+        index = TreeIndex()
+        for node, parent in parents:
+            index.add(node, parent)
+        return index
+
+    def naive_ancestors(self, parents, node):
+        parents = dict(parents)
+        result = [node]
+        while node != 0:
+            node = parents[node]
+            result.append(node)
+        return result
+
+    def test_random(self):
+        import random
+        rng = random.Random(4)
+        parents = [(node, rng.randrange(max(0, node - 20), node))
+                   for node in xrange(1, 2000)]
+        index = self.make_tree(parents)
+        self.assertEqual(len(index), 2000)
+        for _ in xrange(300):
+            a, b = rng.randrange(2000), rng.randrange(2000)
+            ancestors_a = self.naive_ancestors(parents, a)
+            ancestors_b = set(self.naive_ancestors(parents, b))
+            expected = next(n for n in ancestors_a if n in ancestors_b)
+            self.assertEqual(index.common_ancestor(a, b), expected)
+            self.assertEqual(index.depth(a), len(ancestors_a) - 1)
+            self.assertEqual(index.path(a), ancestors_a[-2::-1])
+            self.assertEqual(index.is_ancestor(b, a), b in ancestors_a)
+
+    def test_chain(self):
+        index = self.make_tree((n, n - 1) for n in xrange(1, 1000))
+        self.assertEqual(index.ancestor(999, 3), 3)
+        self.assertEqual(index.common_ancestor(500, 999), 500)
+        self.assertEqual(index.path(10, 7), [8, 9, 10])
+        self.assertRaises(ValueError, index.path, 7, 10)
+        self.assertEqual(index.closest_ancestor(800, [0, 700, 900, 5]), 700)
+        self.assertIsNone(index.closest_ancestor(800, [900, -1]))
+        self.assertIsNone(index.parent(0))
+
+    def test_orphans(self):
+        index = self.make_tree([(3, 2), (4, 2), (2, 1), (1, 0)])
+        self.assertEqual(index.depth(4), 3)
+        self.assertEqual(index.common_ancestor(3, 4), 2)
+        self.assertNotIn(5, index)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -37,6 +37,7 @@ from __future__ import division
 
 from vistrails.core.vistrail.action import Action
 from vistrails.core.log.log import Log
+from vistrails.core.log.workflow_exec import WorkflowExec
 from vistrails.core.vistrail.operation import AddOp, ChangeOp, DeleteOp
 from vistrails.db.services.io import SaveBundle
 import vistrails.db.services.io
@@ -65,7 +66,14 @@ def save_workflow(workflow, filename):
 def save_vistrail_to_xml(vistrail, filename):
     vistrails.db.services.io.save_vistrail_to_xml(vistrail, filename)
 
-def load_vistrail(locator, is_abstraction=False):
+def load_vistrail(locator, is_abstraction=False, use_cache=True):
+    """load_vistrail(locator: Locator, is_abstraction: bool, use_cache: bool)
+         -> (vistrail, abstractions, thumbnails, mashups)
+
+    use_cache=False is only accepted by DBLocators, and keeps them from
+    storing a copy of the vistrail in DBLocator.cache.
+
+    """
     from vistrails.core.vistrail.vistrail import Vistrail
 
     abstraction_files = []
@@ -75,7 +83,10 @@ def load_vistrail(locator, is_abstraction=False):
     if locator is None:
         vistrail = Vistrail()
     else:
-        res = locator.load()
+        if use_cache:
+            res = locator.load()
+        else:
+            res = locator.load(use_cache=False)
         if type(res) == type(SaveBundle(None)):
             vistrail = res.vistrail
             abstraction_files.extend(res.abstractions)
@@ -114,11 +125,32 @@ def open_log(fname, was_appended=False):
     return log
 
 
+def open_log_index(fname):
+    return vistrails.db.services.io.open_log_index(fname)
+
+def iter_workflow_execs(index, entries=None):
+    """iter_workflow_execs(index: LogIndex, entries: list)
+         -> iter(WorkflowExec)
+
+    Reads workflow executions from an appended log, as selected by
+    index.find() (all of them by default).
+
+    """
+    for entry, workflow_exec in \
+            vistrails.db.services.io.iter_appended_workflow_execs(index,
+                                                                  entries):
+        WorkflowExec.convert(workflow_exec)
+        yield workflow_exec
+
 def merge_logs(new_log, log_fname):
     log = vistrails.db.services.io.merge_logs(new_log, log_fname)
     Log.convert(log)
     return log
 
+def save_merged_log(new_log, log_fname, fname, version=None):
+    vistrails.db.services.io.save_merged_log_to_xml(new_log, log_fname, fname,
+                                                    version)
+
 def get_workflow_diff(vt_pair_1, vt_pair_2):
     """get_workflow_diff( tuple(Vistrail, id), tuple(Vistrail, id) ) ->
             Pipeline, Pipeline, [tuple(id, id)], [tuple(id, id)], 
@@ -212,11 +212,12 @@ class DBLocator(_DBLocator, CoreLocator):
         self.__list = ExtConnectionList.getInstance(default_connections_file())
         self.ext_connection_id = -1
 
-    def load(self, klass=None):
+    def load(self, klass=None, use_cache=True):
         from vistrails.core.vistrail.vistrail import Vistrail
         if klass is None:
             klass = Vistrail
-        save_bundle = _DBLocator.load(self, klass.vtType, ThumbnailCache.getInstance().get_directory())
+        save_bundle = _DBLocator.load(self, klass.vtType, ThumbnailCache.getInstance().get_directory(),
+                                      use_cache)
         if klass.vtType == DBWorkflow.vtType:
             wf = save_bundle
             klass = self.get_convert_klass(wf.vtType)
@@ -490,8 +491,16 @@ class ZIPFileLocator(_ZIPFileLocator, CoreLocator):
             obj.locator = self
         return save_bundle
 
-    def save(self, save_bundle):
-        save_bundle = _ZIPFileLocator.save(self, save_bundle, False)
+    def save(self, save_bundle, incremental=None):
+        """Saves the bundle back to this file. Unless incremental is
+        given, the incrementalSave setting decides whether the changes
+        are appended to the file; a non-incremental save compacts it.
+        """
+        if incremental is None:
+            incremental = \
+                get_vistrails_configuration().check('incrementalSave')
+        save_bundle = _ZIPFileLocator.save(self, save_bundle, False,
+                                           incremental=incremental)
         for obj in save_bundle.get_db_objs():
             klass = self.get_convert_klass(obj.vtType)
             klass.convert(obj)
@@ -191,7 +191,9 @@ class BaseInterpreter(object):
             try:
                 info = pipeline.aliases[alias]
                 param = pipeline.db_get_object(info[0],info[1])
-                param.strValue = str(aliases[alias])
+                if param.strValue != str(aliases[alias]):
+                    param.strValue = str(aliases[alias])
+                    pipeline.invalidate_object_signatures(info[2], info[3])
             except KeyError:
                 pass
                     
@@ -209,7 +211,9 @@ class BaseInterpreter(object):
             for (vttype, oId, strval) in customParams:
                 try:
                     param = pipeline.db_get_object(vttype,oId)
-                    param.strValue = str(strval)
+                    if param.strValue != str(strval):
+                        param.strValue = str(strval)
+                        pipeline.invalidate_object_signatures(vttype, oId)
                 except Exception, e:
                     debug.debug("Problem when updating params", e)
 
@@ -221,8 +225,10 @@ class BaseInterpreter(object):
                     continue
                 strValue = vistrail_var.value
                 for func in m.functions:
-                    if func.name == 'value':
+                    if func.name == 'value' and \
+                            func.params[0].strValue != strValue:
                         func.params[0].strValue = strValue
+                        pipeline.invalidate_signatures(m.id)
 
     def set_done_summon_hook(self, hook):
         """ set_done_summon_hook(hook: function(pipeline, objects)) -> None
@@ -44,10 +44,14 @@ import cPickle as pickle
 import time
 
 from vistrails.core.common import InstanceObject, VistrailsInternalError
+from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core import debug
 import vistrails.core.interpreter.base
 from vistrails.core.interpreter.base import AbortExecution
+from vistrails.core.interpreter.result_cache import ResultCache, \
+    get_result_cache
+from vistrails.core.interpreter.scheduler import ParallelScheduler
 import vistrails.core.interpreter.utils
 from vistrails.core.log.controller import DummyLogController
 from vistrails.core.modules.basic_modules import identifier as basic_pkg, \
@@ -264,6 +268,20 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                    if mod.module_descriptor.identifier == identifier]
         self.clean_modules(modules)
 
+    def get_result_cache(self):
+        """get_result_cache() -> ResultCache
+
+        Returns the persistent result cache, or None if it is disabled.
+        """
+        conf = get_vistrails_configuration()
+        if not getattr(conf, 'resultCache', False):
+            return None
+        directory = vistrails.core.system.get_vistrails_directory(
+                'resultCacheDir')
+        if directory is None:
+            return None
+        return get_result_cache(directory, conf.resultCacheSize * 1024 * 1024)
+
     def make_connection(self, conn, src, dst):
         """make_connection(self, conn, src, dst)
         Builds a execution-time connection between modules.
@@ -358,6 +376,9 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
          module_added_set,
          conn_added_set) = self.add_to_persistent_pipeline(pipeline)
 
+        result_cache = self.get_result_cache()
+        persistent_graph = self._persistent_pipeline.graph
+
         # Create the new objects
         for i in module_added_set:
             persistent_id = tmp_to_persistent_module_map[i]
@@ -366,6 +387,13 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
             obj.interpreter = self
             obj.id = persistent_id
             obj.signature = module._signature
+
+            # Results are only stored for modules that feed other modules;
+            # sinks have side-effects that shouldn't be skipped
+            if (result_cache is not None and obj.is_cacheable() and
+                    persistent_graph.out_degree(persistent_id)):
+                obj.result_cache = (result_cache,
+                                    ResultCache.make_key(module))
             
             # Checking if output should be stored
             if module.has_annotation_with_key('annotate_output'):
@@ -470,6 +498,19 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         def get_remapped_id(id):
             return persistent_to_tmp_id_map[id]
 
+        # PARALLEL EXECUTION SETUP
+        # Nested executions (groups) always run on the calling thread
+        scheduler = None
+        if not self._streams:
+            nb_threads = getattr(get_vistrails_configuration(),
+                                 'executionThreads', 0)
+            if nb_threads > 1:
+                scheduler = ParallelScheduler(nb_threads)
+                view = scheduler.main_thread_proxy(view)
+                logger = scheduler.locked(logger)
+                module_executed_hook = [scheduler.on_main_thread(hook)
+                                        for hook in module_executed_hook]
+
         logging_obj = ViewUpdatingLogController(
                 logger=logger,
                 view=view,
@@ -521,25 +562,34 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
             persistent_sinks = [tmp_id_to_module_map[sink]
                                 for sink in pipeline.graph.sinks()]
 
+        result_cache = None
+        if not self._streams:
+            result_cache = self.get_result_cache()
+        if result_cache is not None:
+            result_cache_stats = result_cache.stats()
+
         self._streams.append(Generator.generators)
         Generator.generators = []
 
-        # Update new sinks
-        for obj in persistent_sinks:
+        def update_module(obj, update):
+            """Updates a module and reports its errors.
+
+            Returns False if the execution should stop.
+            """
             abort = False
             try:
-                obj.update()
-                continue
+                update()
+                return True
             except ModuleWasSuspended:
-                continue
+                return True
             except ModuleHadError:
                 pass
             except AbortExecution:
-                break
+                return False
             except ModuleSuspended, ms:
                 ms.module.logging.end_update(ms.module, ms,
                                              was_suspended=True)
-                continue
+                return True
             except ModuleErrors, mes:
                 for me in mes.module_errors:
                     me.module.logging.end_update(me.module, me)
@@ -553,8 +603,22 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                 mb.module.logging.end_update(mb.module)
                 logging_obj.signalError(mb.module, mb)
                 abort = True
-            if stop_on_error or abort:
-                break
+            return not (stop_on_error or abort)
+
+        # Update new sinks
+        if scheduler is not None:
+            scheduler.run(persistent_sinks, update_module)
+            stats = scheduler.stats()
+            debug.log("Parallel execution: %s" % stats)
+            logger.insert_workflow_exec_annotations(
+                    {'__parallel_execution__': stats})
+            record_usage(parallel_threads=scheduler.nb_threads,
+                         parallel_speedup=scheduler.module_time /
+                                          (scheduler.wall_time or 1.0))
+        else:
+            for obj in persistent_sinks:
+                if not update_module(obj, obj.update):
+                    break
 
         if Generator.generators:
             record_usage(generators=len(Generator.generators))
@@ -593,6 +657,21 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
 
         Generator.generators = self._streams.pop()
 
+        if result_cache is not None:
+            hits, misses, stores, evictions = [
+                    b - a
+                    for a, b in zip(result_cache_stats, result_cache.stats())]
+            if hits or misses or stores:
+                stats = ("%d hits, %d misses (hit rate %.0f%%), %d stored, "
+                         "%d evicted" % (
+                             hits, misses, 100.0 * hits / ((hits + misses) or 1),
+                             stores, evictions))
+                debug.log("Result cache: %s" % stats)
+                logger.insert_workflow_exec_annotations(
+                        {'__result_cache__': stats})
+                record_usage(result_cache_hits=hits,
+                             result_cache_misses=misses)
+
         if self.done_update_hook:
             self.done_update_hook(self._persistent_pipeline, self._objects)
                 
@@ -958,6 +1037,93 @@ class TestCachedInterpreter(unittest.TestCase):
         finally:
             StandardOutput.compute = old_compute
 
+    def test_touched_file(self):
+        """Test that a File is executed again when it changes on disk."""
+        import os
+        import tempfile
+        from vistrails.core.cache.path_metadata import \
+            get_path_metadata_cache
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.module_function import ModuleFunction
+        from vistrails.core.vistrail.module_param import ModuleParam
+        from vistrails.core.vistrail.pipeline import Pipeline
+
+        fd, filename = tempfile.mkstemp(prefix='vt_touched_')
+        os.close(fd)
+        try:
+            os.utime(filename, (1000, 1000))
+            pipeline = Pipeline()
+            pipeline.add_module(Module(
+                    id=0, name='File', package=basic_pkg,
+                    version=get_module_registry().get_package_by_name(
+                            basic_pkg).version,
+                    functions=[ModuleFunction(name='value', parameters=[
+                        ModuleParam(pos=0, type='File', val=filename)])]))
+            interpreter = CachedInterpreter.get()
+
+            def run():
+                result = interpreter.execute(
+                        pipeline,
+                        locator=XMLFileLocator('foo.xml'),
+                        current_version=1,
+                        view=DummyView())
+                self.assertFalse(result.errors)
+                return result.modules_added
+
+            self.assertEqual(run(), set([0]))
+            self.assertEqual(run(), set())
+            os.utime(filename, (2000, 2000))
+            get_path_metadata_cache().invalidate(filename)
+            self.assertEqual(run(), set([0]))
+        finally:
+            os.remove(filename)
+
+    def test_result_cache(self):
+        """Test reusing results stored on disk by another execution."""
+        import shutil
+        import tempfile
+        from vistrails.core.interpreter.noncached import Interpreter
+        from vistrails.tests.utils import capture_stdout, execute
+
+        conf = get_vistrails_configuration()
+        directory = tempfile.mkdtemp(prefix='vt_result_cache')
+        old_conf = conf.resultCache, conf.resultCacheDir
+        conf.resultCache, conf.resultCacheDir = True, directory
+        try:
+            cache = Interpreter.get().get_result_cache()
+            # The non-cached interpreter recomputes everything each time, so
+            # only the disk cache can spare the second execution
+            for i in xrange(2):
+                stats = cache.stats()
+                with capture_stdout() as out:
+                    self.assertFalse(execute([
+                            ('Float', 'org.vistrails.vistrails.basic', [
+                                ('value', [('Float', '44.0')]),
+                            ]),
+                            ('PythonCalc', 'org.vistrails.vistrails.pythoncalc', [
+                                ('value2', [('Float', '2.0')]),
+                                ('op', [('String', '-')]),
+                            ]),
+                            ('StandardOutput', 'org.vistrails.vistrails.basic',
+                             []),
+                        ],
+                        [
+                            (0, 'value', 1, 'value1'),
+                            (1, 'value', 2, 'value'),
+                        ]))
+                self.assertEqual(out, ['42.0'])
+                hits, misses, stores, evictions = [
+                        b - a for a, b in zip(stats, cache.stats())]
+                if i == 0:
+                    self.assertEqual((hits, misses, stores), (0, 2, 2))
+                else:
+                    # The Float module is not even looked up
+                    self.assertEqual((hits, misses, stores), (1, 0, 0))
+        finally:
+            conf.resultCache, conf.resultCacheDir = old_conf
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,396 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+
+"""Persistent cache of module results.
+
+The CachedInterpreter only keeps results in memory, for the lifetime of the
+process. When the resultCache configuration option is set, the outputs of
+cacheable modules are also pickled to a directory shared by every VisTrails
+process of the user (batch runs, servers, parallel workers...), in a file
+named after the signature of the subpipeline that computed them. A module
+whose signature is found there gets its outputs from the file instead of
+running itself and its upstream modules.
+
+Files are written atomically (to a temporary file which is then renamed), so
+readers never need to lock; the cache is trimmed to its maximum size, least
+recently used entries first, while holding a lock file so that processes
+don't step on each other.
+"""
+
+from __future__ import division
+
+import cPickle as pickle
+import errno
+import os
+import tempfile
+import threading
+import time
+
+from vistrails.core import debug
+from vistrails.core.cache.hasher import sha_hash
+from vistrails.core.modules.basic_modules import PathObject
+import vistrails.core.system
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+    import msvcrt
+
+
+def _paths(value):
+    """Yields the paths of the files referenced by an output value.
+    """
+    if isinstance(value, PathObject):
+        yield value.name
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            for path in _paths(v):
+                yield path
+    elif isinstance(value, dict):
+        for v in value.itervalues():
+            for path in _paths(v):
+                yield path
+
+
+class FileLock(object):
+    """An exclusive lock held by a single thread of a single process.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._thread_lock = threading.Lock()
+        self._fp = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._fp = open(self.filename, 'ab')
+            if fcntl is not None:
+                fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+            else: # pragma: no cover
+                self._fp.seek(0)
+                msvcrt.locking(self._fp.fileno(), msvcrt.LK_LOCK, 1)
+        except:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+            else: # pragma: no cover
+                self._fp.seek(0)
+                msvcrt.locking(self._fp.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._fp.close()
+            self._fp = None
+            self._thread_lock.release()
+
+
+class ResultCache(object):
+    """ResultCache(directory: str, max_size: int)
+
+    Stores dictionaries of output values in directory, using at most
+    max_size bytes.
+    """
+    SUFFIX = '.pkl'
+    TEMP_SUFFIX = '.tmp'
+
+    # Temporary files older than this were left by a process that died
+    STALE_TEMP_AGE = 3600
+
+    def __init__(self, directory, max_size):
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = FileLock(os.path.join(directory, 'lock'))
+        self._stats_lock = threading.Lock()
+        # Size of the cache the last time we looked, plus what we wrote since
+        self._size = None
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(module):
+        """make_key(module: vistrails.core.vistrail.module.Module) -> str
+
+        Returns the key for the results of a module of the persistent
+        pipeline, whose _signature is set.
+
+        The subpipeline signature describes the computation; the package
+        version of the module and the version of VisTrails are added so
+        that entries are not reused by code that might compute something
+        else.
+        """
+        hasher = sha_hash()
+        hasher.update(module._signature)
+        hasher.update(module.package)
+        hasher.update(module.version or '')
+        hasher.update(vistrails.core.system.vistrails_version())
+        return hasher.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def contains(self, key):
+        return os.path.exists(self._filename(key))
+
+    def load(self, key):
+        """load(key: str) -> dict
+
+        Returns the outputs stored for key, or None.
+        """
+        filename = self._filename(key)
+        try:
+            fp = open(filename, 'rb')
+        except IOError:
+            self._count('misses')
+            return None
+        try:
+            outputs = pickle.load(fp)
+        except Exception, e:
+            debug.warning("Removing unreadable result cache entry %s" %
+                          filename, e)
+            fp.close()
+            self._remove(filename)
+            self._count('misses')
+            return None
+        finally:
+            fp.close()
+        for path in _paths(outputs.values()):
+            if not os.path.exists(path):
+                self._count('misses')
+                return None
+        try:
+            # Marks the entry as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
+        self._count('hits')
+        return outputs
+
+    def store(self, key, outputs, exclude_dirs=()):
+        """store(key: str, outputs: dict, exclude_dirs: list) -> bool
+
+        Stores the outputs for key, unless they can't be pickled or
+        reference files inside one of exclude_dirs (temporary files that
+        won't be around for the next session).
+        """
+        exclude_dirs = [os.path.join(os.path.realpath(d), '')
+                        for d in exclude_dirs]
+        for path in _paths(outputs.values()):
+            path = os.path.realpath(path)
+            if any(path.startswith(d) for d in exclude_dirs):
+                return False
+        try:
+            data = pickle.dumps(outputs, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+        filename = self._filename(key)
+        try:
+            fd, temp_filename = tempfile.mkstemp(suffix=self.TEMP_SUFFIX,
+                                                 dir=self.directory)
+            fp = os.fdopen(fd, 'wb')
+            try:
+                fp.write(data)
+            finally:
+                fp.close()
+            try:
+                os.rename(temp_filename, filename)
+            except OSError:
+                # Windows won't replace an existing file; since entries are
+                # named after their content, the other one is just as good
+                self._remove(temp_filename)
+        except (IOError, OSError), e:
+            debug.warning("Couldn't write result cache entry %s" % filename,
+                          e)
+            return False
+        self._count('stores')
+        with self._stats_lock:
+            if self._size is not None:
+                self._size += len(data)
+            check = self._size is None or self._size > self.max_size
+        if check:
+            self.trim()
+        return True
+
+    def trim(self):
+        """trim() -> None
+
+        Removes the least recently used entries until the cache fits in
+        max_size (with some headroom, so this doesn't happen every time).
+        """
+        with self._lock:
+            now = time.time()
+            entries = []
+            size = 0
+            for name in os.listdir(self.directory):
+                filename = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                if name.endswith(self.SUFFIX):
+                    entries.append((st.st_mtime, st.st_size, filename))
+                    size += st.st_size
+                elif (name.endswith(self.TEMP_SUFFIX) and
+                        now - st.st_mtime > self.STALE_TEMP_AGE):
+                    self._remove(filename)
+            if size > self.max_size:
+                entries.sort()
+                target = self.max_size * 0.9
+                for mtime, entry_size, filename in entries:
+                    if size <= target:
+                        break
+                    if self._remove(filename):
+                        size -= entry_size
+                        self._count('evictions')
+            with self._stats_lock:
+                self._size = size
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+            return True
+        except OSError:
+            return False
+
+    def clear(self):
+        with self._lock:
+            for name in os.listdir(self.directory):
+                if name.endswith(self.SUFFIX):
+                    self._remove(os.path.join(self.directory, name))
+            with self._stats_lock:
+                self._size = 0
+
+    def stats(self):
+        """stats() -> (hits, misses, stores, evictions)
+        """
+        with self._stats_lock:
+            return self.hits, self.misses, self.stores, self.evictions
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_result_cache(directory, max_size):
+    """get_result_cache(directory: str, max_size: int) -> ResultCache
+
+    Returns the ResultCache for a directory, shared by the interpreters of
+    this process.
+    """
+    directory = os.path.realpath(directory)
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = ResultCache(directory, max_size)
+        else:
+            cache.max_size = max_size
+        return cache
+
+##############################################################################
+
+import shutil
+import unittest
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_result_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store_load(self):
+        cache = ResultCache(self.directory, 1 << 20)
+        self.assertIsNone(cache.load('a' * 40))
+        self.assertTrue(cache.store('a' * 40, {'value': [1, 2, 3]}))
+        self.assertTrue(cache.contains('a' * 40))
+        self.assertEqual(cache.load('a' * 40), {'value': [1, 2, 3]})
+        self.assertFalse(cache.store('b' * 40, {'value': lambda: None}))
+        self.assertFalse(cache.contains('b' * 40))
+        self.assertEqual(cache.stats(), (1, 1, 1, 0))
+
+        # Another process sees the same entries
+        other = ResultCache(self.directory, 1 << 20)
+        self.assertEqual(other.load('a' * 40), {'value': [1, 2, 3]})
+
+    def test_paths(self):
+        cache = ResultCache(self.directory, 1 << 20)
+        temp_dir = tempfile.mkdtemp(prefix='vt_tmp')
+        try:
+            filename = os.path.join(temp_dir, 'file')
+            open(filename, 'wb').close()
+            outputs = {'value': PathObject(filename)}
+            self.assertFalse(cache.store('a' * 40, outputs, [temp_dir]))
+            self.assertTrue(cache.store('a' * 40, outputs))
+            self.assertEqual(cache.load('a' * 40)['value'].name, filename)
+        finally:
+            shutil.rmtree(temp_dir)
+        # The file is gone, so is the entry
+        self.assertIsNone(cache.load('a' * 40))
+
+    def test_trim(self):
+        cache = ResultCache(self.directory, 1 << 20)
+        for i in xrange(5):
+            cache.store('%040d' % i, {'value': 'x' * 1000})
+            # Make the order of the entries unambiguous
+            os.utime(cache._filename('%040d' % i), (i, i))
+        cache.load('%040d' % 0)
+        cache.max_size = 3000
+        cache.trim()
+        self.assertLessEqual(cache._size, 3000 * 0.9)
+        self.assertTrue(cache.contains('%040d' % 0))
+        self.assertTrue(cache.contains('%040d' % 4))
+        self.assertFalse(cache.contains('%040d' % 1))
+        self.assertGreaterEqual(cache.evictions, 2)
@@ -0,0 +1,406 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+
+"""Parallel scheduling of the modules of a pipeline.
+
+The interpreter normally updates a pipeline by calling update() on each of its
+sinks, which recursively pulls the upstream modules one at a time. When the
+executionThreads configuration option is set, the CachedInterpreter instead
+uses a ParallelScheduler which walks the dependency graph and hands modules
+to a pool of worker threads as soon as all of their upstream modules are done.
+
+Only modules that declare themselves thread-safe (see
+vistrails_module.ThreadSafe) are run on the workers; everything else is
+updated on the thread that started the execution, so that modules touching
+the GUI or other global state keep running where they always did. Logging
+calls are serialized and view updates are forwarded to that thread as well.
+"""
+
+from __future__ import division
+
+from collections import deque
+import Queue
+import sys
+import threading
+import time
+
+from vistrails.core.modules.vistrails_module import Module
+
+
+def _is_lazy(obj):
+    """Whether a module decides itself which of its upstream modules to run.
+
+    Control-flow modules (If, Map, Fold, ...) override update_upstream() to
+    only update some of their inputs, and modules restored from the job cache
+    or the result cache don't update their upstream at all; the scheduler
+    doesn't look past them.
+    """
+    if not isinstance(obj, Module):
+        return True
+    update_upstream = getattr(type(obj).update_upstream, 'im_func', None)
+    if update_upstream is not Module.update_upstream.im_func:
+        return True
+    return bool(obj.useJobCache()) or obj.in_result_cache()
+
+
+class LockedProxy(object):
+    """Wraps a log controller so that it can be called from several threads.
+
+    The objects returned by the methods that create nested controllers are
+    wrapped as well, sharing the same lock.
+    """
+    _nested = frozenset(['recursing',
+                         'start_workflow_execution',
+                         'start_loop_execution'])
+
+    def __init__(self, obj, lock):
+        self._obj = obj
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        def locked(*args, **kwargs):
+            with self._lock:
+                result = attr(*args, **kwargs)
+            if name in self._nested and result is not None:
+                result = LockedProxy(result, self._lock)
+            return result
+        return locked
+
+
+class MainThreadProxy(object):
+    """Wraps an object so that its methods only ever run on a given thread.
+
+    Calls made from another thread are queued and replayed by the scheduler
+    (this is used for the view, which updates the GUI).
+    """
+    def __init__(self, obj, scheduler):
+        self._obj = obj
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        return self._scheduler.on_main_thread(attr)
+
+
+class ParallelScheduler(object):
+    """Updates modules in dependency order using a pool of threads.
+
+    Usage: wrap the view, hooks and logger with main_thread_proxy(),
+    on_main_thread() and locked(), then call run().
+    """
+    def __init__(self, nb_threads):
+        self.nb_threads = nb_threads
+        self._main_thread = threading.current_thread()
+        self._events = Queue.Queue()
+        self._log_lock = threading.RLock()
+
+        # Statistics about the last run
+        self.wall_time = 0.0
+        self.module_time = 0.0
+        self.threaded_modules = 0
+        self.main_modules = 0
+
+    def locked(self, logger):
+        return LockedProxy(logger, self._log_lock)
+
+    def main_thread_proxy(self, obj):
+        return MainThreadProxy(obj, self)
+
+    def on_main_thread(self, func):
+        """Returns a version of func that always runs on the main thread.
+        """
+        def call(*args, **kwargs):
+            if threading.current_thread() is self._main_thread:
+                return func(*args, **kwargs)
+            self._events.put(('call', func, args, kwargs))
+        return call
+
+    def can_run_in_thread(self, obj):
+        """Whether a module can be updated on a worker thread.
+
+        The module must be thread-safe, and not receive streams since these
+        are driven by the main thread once the graph has been updated.
+        """
+        if _is_lazy(obj) or not obj.is_thread_safe():
+            return False
+        from vistrails.core.modules.basic_modules import Generator
+        for connector_list in obj.inputPorts.itervalues():
+            for connector in connector_list:
+                if isinstance(connector.obj.outputPorts.get(connector.port),
+                              Generator):
+                    return False
+        return True
+
+    @staticmethod
+    def collect(sinks):
+        """collect(sinks: [Module]) -> ([Module], dict)
+
+        Returns the modules upstream of the sinks in topological order, along
+        with the set of upstream modules each of them depends on.
+        """
+        order = []
+        upstream = {}
+        for sink in sinks:
+            if sink in upstream:
+                continue
+            upstream[sink] = None
+            stack = [(sink, False)]
+            while stack:
+                obj, expanded = stack.pop()
+                if expanded:
+                    order.append(obj)
+                    continue
+                deps = set()
+                if not _is_lazy(obj):
+                    for connector_list in obj.inputPorts.itervalues():
+                        for connector in connector_list:
+                            deps.add(connector.obj)
+                upstream[obj] = deps
+                stack.append((obj, True))
+                for dep in deps:
+                    if dep not in upstream:
+                        upstream[dep] = None
+                        stack.append((dep, False))
+        return order, upstream
+
+    def run(self, sinks, handle):
+        """run(sinks: [Module], handle: callable) -> None
+
+        Updates the sinks and everything upstream of them.
+
+        handle(obj, update) is always called on the main thread, once per
+        module; it should call update(), which either updates the module or
+        re-raises the exception raised while updating it on a worker, and
+        return False to stop the execution.
+        """
+        start = time.time()
+        order, upstream = self.collect(sinks)
+        remaining = {}
+        downstream = dict((obj, []) for obj in order)
+        for obj in order:
+            remaining[obj] = len(upstream[obj])
+            for dep in upstream[obj]:
+                downstream[dep].append(obj)
+        ready = deque(obj for obj in order if not remaining[obj])
+
+        tasks = Queue.Queue()
+        workers = [threading.Thread(target=self._work, args=(tasks,),
+                                    name='vistrails-worker-%d' % i)
+                   for i in xrange(self.nb_threads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        state = {'in_flight': 0, 'stopped': False}
+        def done(obj, elapsed):
+            self.module_time += elapsed
+            for down in downstream[obj]:
+                remaining[down] -= 1
+                if not remaining[down]:
+                    ready.append(down)
+
+        def process(event):
+            if event[0] == 'call':
+                _, func, args, kwargs = event
+                func(*args, **kwargs)
+                return
+            _, obj, exc_info, elapsed = event
+            state['in_flight'] -= 1
+            self.threaded_modules += 1
+            def update():
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            if not handle(obj, update):
+                state['stopped'] = True
+            done(obj, elapsed)
+
+        try:
+            while True:
+                while True:
+                    try:
+                        process(self._events.get_nowait())
+                    except Queue.Empty:
+                        break
+                if state['stopped']:
+                    if not state['in_flight']:
+                        break
+                else:
+                    # Hand all the ready thread-safe modules to the workers,
+                    # then run one of the others here
+                    for obj in list(ready):
+                        if self.can_run_in_thread(obj):
+                            ready.remove(obj)
+                            state['in_flight'] += 1
+                            tasks.put(obj)
+                    # Lazy modules might pull modules that are still queued;
+                    # only run them once the workers are idle
+                    local = None
+                    for obj in ready:
+                        if not _is_lazy(obj) or not state['in_flight']:
+                            local = obj
+                            break
+                    if local is not None:
+                        ready.remove(local)
+                        t = time.time()
+                        if not handle(local, local.update):
+                            state['stopped'] = True
+                        self.main_modules += 1
+                        done(local, time.time() - t)
+                        continue
+                    if not ready and not state['in_flight']:
+                        break
+                process(self._events.get())
+        finally:
+            for worker in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+            while True:
+                try:
+                    event = self._events.get_nowait()
+                except Queue.Empty:
+                    break
+                if event[0] == 'call':
+                    process(event)
+            self.wall_time = time.time() - start
+
+    def _work(self, tasks):
+        while True:
+            obj = tasks.get()
+            if obj is None:
+                return
+            start = time.time()
+            try:
+                obj.update()
+            except Exception:
+                exc_info = sys.exc_info()
+            else:
+                exc_info = None
+            self._events.put(('done', obj, exc_info, time.time() - start))
+
+    def stats(self):
+        """Returns a short description of the last run, for the log.
+        """
+        speedup = self.module_time / self.wall_time if self.wall_time else 1.0
+        return ("%d threads, %d modules on workers, %d on main thread, "
+                "wall time %.3fs, module time %.3fs, speedup %.2fx" % (
+                    self.nb_threads, self.threaded_modules, self.main_modules,
+                    self.wall_time, self.module_time, speedup))
+
+##############################################################################
+
+import unittest
+
+from vistrails.core.modules.vistrails_module import ModuleConnector, \
+    ModuleError, ModuleHadError, ThreadSafe
+
+
+class _Sleep(ThreadSafe, Module):
+    def compute(self):
+        time.sleep(0.2)
+        self.thread = threading.current_thread()
+
+
+class _Fail(ThreadSafe, Module):
+    def compute(self):
+        raise ModuleError(self, "failed")
+
+
+class _Sink(Module):
+    def compute(self):
+        self.thread = threading.current_thread()
+
+
+class TestParallelScheduler(unittest.TestCase):
+    def make_pipeline(self, *upstream_classes):
+        sink = _Sink()
+        upstream = []
+        for klass in upstream_classes:
+            obj = klass()
+            sink.set_input_port('value', ModuleConnector(obj, 'self'))
+            upstream.append(obj)
+        return sink, upstream
+
+    def run_scheduler(self, sink):
+        handled = []
+        def handle(obj, update):
+            try:
+                update()
+            except (ModuleError, ModuleHadError), e:
+                handled.append((obj, type(e)))
+                return True
+            handled.append((obj, None))
+            return True
+        scheduler = ParallelScheduler(4)
+        scheduler.run([sink], handle)
+        return scheduler, handled
+
+    def test_collect(self):
+        sink, (a, b) = self.make_pipeline(_Sleep, _Sleep)
+        order, upstream = ParallelScheduler.collect([sink])
+        self.assertEqual(order[-1], sink)
+        self.assertEqual(set(order), set([sink, a, b]))
+        self.assertEqual(upstream[sink], set([a, b]))
+        self.assertEqual(upstream[a], set())
+
+    def test_concurrent(self):
+        sink, upstream = self.make_pipeline(_Sleep, _Sleep, _Sleep, _Sleep)
+        start = time.time()
+        scheduler, handled = self.run_scheduler(sink)
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual(len(handled), 5)
+        self.assertEqual(handled[-1], (sink, None))
+        self.assertTrue(all(obj.computed for obj in upstream))
+        self.assertIs(sink.thread, threading.current_thread())
+        self.assertIsNot(upstream[0].thread, threading.current_thread())
+        self.assertEqual((scheduler.threaded_modules,
+                          scheduler.main_modules),
+                         (4, 1))
+
+    def test_error(self):
+        sink, (ok, failed) = self.make_pipeline(_Sleep, _Fail)
+        scheduler, handled = self.run_scheduler(sink)
+        handled = dict(handled)
+        self.assertIsNone(handled[ok])
+        self.assertIs(handled[failed], ModuleError)
+        self.assertIs(handled[sink], ModuleHadError)
+        self.assertFalse(sink.computed)
@@ -38,6 +38,7 @@ pipelines."""
 from __future__ import division
 
 import vistrails.core.cache.hasher
+from vistrails.core.cache.path_metadata import get_path_metadata_cache
 from vistrails.core.debug import format_exception
 from vistrails.core.modules.module_registry import get_module_registry
 from vistrails.core.modules.vistrails_module import Module, new_module, \
@@ -57,6 +58,8 @@ import os
 import pickle
 import re
 import shutil
+import threading
+import time
 import zipfile
 import urllib
 
@@ -399,19 +402,10 @@ class Path(Constant):
 Path.default_value = PathObject('')
 
 def path_parameter_hasher(p):
-    def get_mtime(path):
-        t = int(os.path.getmtime(path))
-        if os.path.isdir(path):
-            for subpath in os.listdir(path):
-                subpath = os.path.join(path, subpath)
-                if os.path.isdir(subpath):
-                    t = max(t, get_mtime(subpath))
-        return t
-
     h = vistrails.core.cache.hasher.Hasher.parameter_signature(p)
     try:
         # FIXME: This will break with aliases - I don't really care that much
-        t = get_mtime(p.strValue)
+        t = get_path_metadata_cache().tree_mtime(p.strValue)
     except OSError:
         return h
     hasher = sha_hash()
@@ -1002,7 +996,72 @@ class Unpickle(Module):
 
 ##############################################################################
 
+class CompiledCodeCache(object):
+    """Bounded LRU cache of compiled code objects, keyed by source hash.
+
+    Modules running user code inside loops execute the same source many
+    times; this avoids unquoting and compiling it on every execution.
+
+    """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._code = {}
+        # key -> tick of the last use, to find the least recently used
+        self._last_used = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._code)
+
+    def clear(self):
+        with self._lock:
+            self._code.clear()
+            self._last_used.clear()
+
+    def get(self, source, quoted=False):
+        """get(source: str, quoted: bool) -> (code, float)
+
+        Returns the compiled code for source, which is URL-unquoted first
+        if quoted is True, and the time it took to compile (0 if it was
+        cached).
+        """
+        key = (sha_hash(source).digest(), quoted)
+        with self._lock:
+            code = self._code.get(key)
+            if code is not None:
+                self._tick += 1
+                self._last_used[key] = self._tick
+                self.hits += 1
+                return code, 0.0
+
+        start = time.time()
+        if quoted:
+            source = urllib.unquote(source)
+        # Python 2.6 needs code to end with newline
+        code = compile(source + '\n', '<string>', 'exec')
+        compile_time = time.time() - start
+
+        with self._lock:
+            self.misses += 1
+            self._code[key] = code
+            self._tick += 1
+            self._last_used[key] = self._tick
+            while len(self._code) > self.max_size:
+                oldest = min(self._last_used, key=self._last_used.get)
+                del self._last_used[oldest]
+                del self._code[oldest]
+        return code, compile_time
+
+compiled_code_cache = CompiledCodeCache()
+
+
 class CodeRunnerMixin(object):
+    # Locals that don't depend on the module, shared by all executions
+    _locals_template = None
+
     def __init__(self):
         self.output_ports_order = []
         super(CodeRunnerMixin, self).__init__()
@@ -1013,19 +1072,39 @@ class CodeRunnerMixin(object):
         # output_ports are reversed for display purposes...
         self.output_ports_order.reverse()
 
+    @staticmethod
+    def get_locals_template():
+        import vistrails.core.packagemanager
+        reg = get_module_registry()
+        template = CodeRunnerMixin._locals_template
+        if template is None or template['registry'] is not reg:
+            _m = vistrails.core.packagemanager.get_package_manager()
+            template = {'package_manager': _m,
+                        'registry': reg}
+            CodeRunnerMixin._locals_template = template
+        return template
+
     def run_code(self, code_str,
                  use_input=False,
-                 use_output=False):
+                 use_output=False,
+                 quoted=False):
         """run_code runs a piece of code as a VisTrails module.
         use_input and use_output control whether to use the inputport
         and output port dictionary as local variables inside the
-        execution."""
-        import vistrails.core.packagemanager
+        execution. If quoted is True, code_str is URL-quoted.
+
+        Compiled code is cached, and the time spent compiling and running
+        it is added to the execution log as the 'compile_time' and
+        'run_time' annotations."""
+        code, compile_time = compiled_code_cache.get(code_str, quoted)
         def fail(msg):
             raise ModuleError(self, msg)
         def cache_this():
             self.is_cacheable = lambda *args, **kwargs: True
-        locals_ = locals()
+        locals_ = {'vistrails': vistrails,
+                   'code_str': code_str,
+                   'use_input': use_input,
+                   'use_output': use_output}
         if use_input:
             for k in self.inputPorts:
                 locals_[k] = self.get_input(k)
@@ -1033,17 +1112,16 @@ class CodeRunnerMixin(object):
             for output_portname in self.output_ports_order:
                 if output_portname not in self.inputPorts:
                     locals_[output_portname] = None
-        _m = vistrails.core.packagemanager.get_package_manager()
-        reg = get_module_registry()
+        locals_.update(self.get_locals_template())
         locals_.update({'fail': fail,
-                        'package_manager': _m,
                         'cache_this': cache_this,
-                        'registry': reg,
                         'self': self})
         if 'source' in locals_:
             del locals_['source']
-        # Python 2.6 needs code to end with newline
-        exec code_str + '\n' in locals_, locals_
+        start = time.time()
+        exec code in locals_, locals_
+        self.annotate({'compile_time': '%f' % compile_time,
+                       'run_time': '%f' % (time.time() - start)})
         if use_output:
             for k in self.output_ports_order:
                 if locals_.get(k) is not None:
@@ -1071,8 +1149,8 @@ class PythonSource(CodeRunnerMixin, NotCacheable, Module):
     _output_pors = [OPort('self', 'Module')]
 
     def compute(self):
-        s = urllib.unquote(str(self.get_input('source')))
-        self.run_code(s, use_input=True, use_output=True)
+        self.run_code(str(self.get_input('source')),
+                      use_input=True, use_output=True, quoted=True)
 
 ##############################################################################
 
@@ -1651,6 +1729,22 @@ class TestPythonSource(unittest.TestCase):
                 ]))
         self.assertEqual(results[-1], "nb is 42")
 
+    def test_code_cache(self):
+        """Compiled code is reused and the cache is bounded"""
+        cache = CompiledCodeCache(max_size=2)
+        code, compile_time = cache.get('a%20%3D%201', quoted=True)
+        locals_ = {}
+        exec code in locals_
+        self.assertEqual(locals_['a'], 1)
+        self.assertIs(cache.get('a%20%3D%201', quoted=True)[0], code)
+        self.assertEqual(cache.get('a%20%3D%201', quoted=True)[1], 0.0)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        cache.get('b = 2')
+        cache.get('c = 3')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNot(cache.get('a%20%3D%201', quoted=True)[0], code)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
 
 class TestNumericConversions(unittest.TestCase):
     def test_full(self):
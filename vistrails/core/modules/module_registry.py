@@ -551,6 +551,7 @@ class ModuleRegistry(DBRegistry):
                 self.packages[other._default_package.identifier]
 
     def setup_indices(self):
+        self.clear_type_caches()
         self.descriptors_by_id = {}
         self.package_versions = self.db_packages_identifier_index
         self.packages = {}
@@ -626,13 +627,32 @@ class ModuleRegistry(DBRegistry):
         self.root_descriptor_id = descriptor.id
     root_descriptor = property(_get_root_descriptor, _set_root_descriptor)
 
+    def clear_type_caches(self):
+        """Forgets the basic descriptors and the port compatibilities that
+        were looked up, which change when modules are added or removed.
+
+        """
+        self._basic_descriptors = {}
+        self._specs_matched = {}
+
+    def _get_basic_descriptor(self, name):
+        try:
+            return self._basic_descriptors[name]
+        except KeyError:
+            descriptor = self.get_descriptor_by_name(
+                    get_vistrails_basic_pkg_id(), name)
+            self._basic_descriptors[name] = descriptor
+            return descriptor
+
     def add_descriptor(self, desc, package=None):
         if package is None:
             package = self._default_package
         # self.descriptors[(desc.package, desc.name, desc.namespace)] = desc
         self.descriptors_by_id[desc.id] = desc
         package.add_descriptor(desc)
+        self.clear_type_caches()
     def delete_descriptor(self, desc, package=None):
+        self.clear_type_caches()
         if package is None:
             try:
                 package = self.packages[desc.identifier]
@@ -1885,9 +1905,8 @@ class ModuleRegistry(DBRegistry):
         return converters
 
     def is_descriptor_list_subclass(self, sub_descs, super_descs):
-        basic_pkg = get_vistrails_basic_pkg_id()
-        variant_desc = self.get_descriptor_by_name(basic_pkg, 'Variant')
-        module_desc = self.get_descriptor_by_name(basic_pkg, 'Module')
+        variant_desc = self._get_basic_descriptor('Variant')
+        module_desc = self._get_basic_descriptor('Module')
 
         for (sub_desc, super_desc) in izip(sub_descs, super_descs):
             if sub_desc == variant_desc or super_desc == variant_desc:
@@ -1910,9 +1929,7 @@ class ModuleRegistry(DBRegistry):
         
         """
         # For a connection, this gets called for sub -> super
-        basic_pkg = get_vistrails_basic_pkg_id()
-        variant_desc = self.get_descriptor_by_name(basic_pkg, 'Variant')
-        list_desc = self.get_descriptor_by_name(basic_pkg, 'List')
+        variant_desc = self._get_basic_descriptor('Variant')
         # sometimes sub is coming None
         # I don't know if this is expected, so I will put a test here
         sub_descs = []
@@ -1929,20 +1946,18 @@ class ModuleRegistry(DBRegistry):
             return False
         elif super_descs == [variant_desc]:
             return True
-        elif [list_desc] in [super_descs, sub_descs]:
-            # Allow Lists to connect to anything
-            return True
-        #elif super_descs == [list_desc] and sub_descs != [list_desc] \
-        #     and sub.depth > 0:
-        #    # List is handled as Variant with depth 1
-        #    return True
-        #elif sub_descs == [list_desc] and super_descs != [list_desc] \
-        #     and super.depth > 0:
-        #    # List is handled as Variant with depth 1
-        #    return True
 
-        if (len(sub_descs) == len(super_descs) and
-                self.is_descriptor_list_subclass(sub_descs, super_descs)):
+        # The result only depends on the descriptors, so it is cached for
+        # each pair of signatures. Descriptors are keyed by identity, which
+        # is much faster than hashing them; the entry references them so
+        # that the ids can't be reused
+        key = (tuple(map(id, sub_descs)), tuple(map(id, super_descs)))
+        try:
+            matched = self._specs_matched[key][0]
+        except KeyError:
+            matched = self._are_descriptors_matched(sub_descs, super_descs)
+            self._specs_matched[key] = matched, sub_descs, super_descs
+        if matched:
             return True
 
         if allow_conversion:
@@ -1954,6 +1969,23 @@ class ModuleRegistry(DBRegistry):
 
         return False
 
+    def _are_descriptors_matched(self, sub_descs, super_descs):
+        list_desc = self._get_basic_descriptor('List')
+        if [list_desc] in [super_descs, sub_descs]:
+            # Allow Lists to connect to anything
+            return True
+        #elif super_descs == [list_desc] and sub_descs != [list_desc] \
+        #     and sub.depth > 0:
+        #    # List is handled as Variant with depth 1
+        #    return True
+        #elif sub_descs == [list_desc] and super_descs != [list_desc] \
+        #     and super.depth > 0:
+        #    # List is handled as Variant with depth 1
+        #    return True
+
+        return (len(sub_descs) == len(super_descs) and
+                self.is_descriptor_list_subclass(sub_descs, super_descs))
+
     def get_module_hierarchy(self, descriptor):
         """get_module_hierarchy(descriptor) -> [klass].
         Returns the module hierarchy all the way to Module, excluding
@@ -2190,3 +2222,35 @@ class TestModuleRegistry(unittest.TestCase):
         t1 = PortSpec(signature=[Float, Integer])
         t2 = PortSpec(signature=[Integer, Float])
         self.assertNotEquals(t1, t2)
+
+    def test_specs_matched_cache(self):
+        from vistrails.core.modules.basic_modules import Float, Integer, \
+            List, String, Variant
+        reg = get_module_registry()
+        def spec(*signature):
+            return PortSpec(signature=list(signature))
+        self.assertTrue(reg.are_specs_matched(spec(Integer), spec(Float)))
+        self.assertFalse(reg.are_specs_matched(spec(Float), spec(Integer)))
+        self.assertTrue(reg.are_specs_matched(spec(String, Integer),
+                                              spec(String, Float)))
+        self.assertFalse(reg.are_specs_matched(spec(String),
+                                               spec(String, Float)))
+        self.assertTrue(reg.are_specs_matched(spec(List), spec(Float)))
+        self.assertTrue(reg.are_specs_matched(spec(Float), spec(Variant)))
+        self.assertIn(((id(reg.get_descriptor(Integer)),),
+                       (id(reg.get_descriptor(Float)),)),
+                      reg._specs_matched)
+
+        # Adding a module clears the cache
+        class CacheTestModule(Float):
+            pass
+        basic_pkg = reg.packages[get_vistrails_basic_pkg_id()]
+        reg.add_module(CacheTestModule, package=basic_pkg.identifier,
+                       package_version=basic_pkg.version)
+        try:
+            self.assertEqual(reg._specs_matched, {})
+            self.assertTrue(reg.are_specs_matched(spec(CacheTestModule),
+                                                  spec(Float)))
+        finally:
+            reg.delete_module(basic_pkg.identifier, 'CacheTestModule')
+        self.assertEqual(reg._specs_matched, {})
@@ -133,7 +133,9 @@ def group_signature(pipeline, module, chm):
             function_sig = hash_list(input_functions[input_port_name], 
                                      Hasher.function_signature, chm)
             sig = Hasher.compound_signature([sig, function_sig])
-        input_module._input_port_signature = sig
+        if getattr(input_module, '_input_port_signature', None) != sig:
+            input_module._input_port_signature = sig
+            module.pipeline.invalidate_signatures(input_module.id)
     for input_port_name, done in covered_modules.iteritems():
         if done:
             continue
@@ -146,7 +148,9 @@ def group_signature(pipeline, module, chm):
             sig = Hasher.compound_signature([module_sig, function_sig])
         else:
             sig = Hasher.module_signature(input_module, chm)
-        input_module._input_port_signature = sig
+        if getattr(input_module, '_input_port_signature', None) != sig:
+            input_module._input_port_signature = sig
+            module.pipeline.invalidate_signatures(input_module.id)
 
     module.pipeline.refresh_signatures()
 
@@ -38,8 +38,12 @@ from __future__ import division
 import ast
 from base64 import b16encode, b16decode
 import copy
-from itertools import izip, product, chain
+from collections import deque
+from itertools import izip, islice, product, chain
 import json
+import Queue
+import sys
+import threading
 import time
 import traceback
 import warnings
@@ -196,6 +200,27 @@ class DummyModuleLogging(object):
 
 _dummy_logging = DummyModuleLogging()
 
+class RecordingModuleLogging(object):
+    """Records the logging calls of a module so that they can be replayed
+    later, on the thread that owns the logger.
+
+    This is used for loop iterations that run on worker threads (see
+    ModuleControlParam.LOOP_WORKERS_KEY); replaying the calls in iteration
+    order keeps the log exactly as if the iterations ran one after the other.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return record
+
+    def replay(self, logging):
+        for name, args, kwargs in self.calls:
+            getattr(logging, name)(*args, **kwargs)
+        self.calls = []
+
 ################################################################################
 # Module
 
@@ -318,6 +343,10 @@ class Module(object):
 
         self.signature = None
 
+        # (ResultCache, key) if the outputs of this module can be stored in
+        # the persistent result cache, set by the interpreter
+        self.result_cache = None
+
         # stores whether the output of the module should be annotated in the
         # execution log
         self.annotate_output = False
@@ -353,6 +382,8 @@ class Module(object):
         clone.output_specs = self.output_specs
         clone.input_specs_order = self.input_specs_order
         clone.output_specs_order = self.output_specs_order
+        # copies compute something else (e.g. a single loop iteration)
+        clone.result_cache = None
 
         return clone
 
@@ -381,6 +412,17 @@ class Module(object):
         """
         return True
 
+    def is_thread_safe(self):
+        """is_thread_safe() -> bool.
+        A Module should return whether its compute() can run on a worker
+        thread, concurrently with other modules, when the interpreter
+        schedules the pipeline in parallel (see the executionThreads
+        option). Modules that use the GUI or change global state (current
+        directory, environment, ...) should not.
+
+        """
+        return False
+
     def update_upstream_port(self, port_name):
         """Updates upstream of a single port instead of all ports."""
 
@@ -453,6 +495,53 @@ class Module(object):
                 params[spec.name] = module.translate_to_string(self.get_output(spec.name))
                 jm.setCache(self.signature, params, p_module.name)
 
+    def in_result_cache(self):
+        """ in_result_cache() -> Boolean
+            Checks if the outputs of this module can be read from the
+            persistent result cache
+        """
+        if self.result_cache is None or self.upToDate:
+            return False
+        cache, key = self.result_cache
+        return cache.contains(key)
+
+    def load_result_cache(self):
+        """ load_result_cache() -> Boolean
+            Sets the outputs from the persistent result cache if they are
+            there
+        """
+        if self.result_cache is None or self.upToDate:
+            return False
+        cache, key = self.result_cache
+        outputs = cache.load(key)
+        if outputs is None:
+            return False
+        for port_name, value in outputs.iteritems():
+            self.set_output(port_name, value)
+        self.upToDate = True
+        return True
+
+    def store_result_cache(self):
+        """ store_result_cache() -> None
+            Adds the outputs to the persistent result cache
+        """
+        if (self.result_cache is None or self.streamed_ports or
+                not self.is_cacheable()):
+            return
+        outputs = {}
+        for port_name, value in self.outputPorts.iteritems():
+            if port_name == 'self':
+                continue
+            if isinstance(value, Module):
+                # Modules (and generators) only make sense in this process
+                return
+            outputs[port_name] = value
+        cache, key = self.result_cache
+        exclude_dirs = []
+        if getattr(self, 'interpreter', None) is not None:
+            exclude_dirs.append(self.interpreter.filePool.directory)
+        cache.store(key, outputs, exclude_dirs)
+
     def update_upstream(self):
         """ update_upstream() -> None
         Go upstream from the current module, then update its upstream
@@ -553,7 +642,7 @@ class Module(object):
         elif self.computed:
             return
         self.logging.begin_update(self)
-        if not self.setJobCache():
+        if not self.setJobCache() and not self.load_result_cache():
             self.update_upstream()
         if self.upToDate:
             if not self.computed:
@@ -606,42 +695,101 @@ class Module(object):
                 errorTrace=traceback.format_exc())
         if self.annotate_output:
             self.annotate_output_values()
+        self.store_result_cache()
         self.upToDate = True
         self.had_error = False
         self.logging.end_update(self)
         self.logging.signalSuccess(self)
 
     def do_combine(self, combine_type, inputs, port_name_order):
+        elements, port_names, _ = self.iter_combine(combine_type, inputs,
+                                                    port_name_order)
+        return list(elements), port_names
+
+    def iter_combine(self, combine_type, inputs, port_name_order):
+        """iter_combine(combine_type: str, inputs: dict,
+                        port_name_order: list) -> (iterator, list, int)
+
+        Same as do_combine(), but the combined elements are generated as
+        they are consumed instead of being built in a list, which matters
+        for the cartesian product. Also returns their number.
+
+        """
         values = []
+        counts = []
         port_names = []
         for port_name in port_name_order:
             # this is how the (brittle) recursion is accomplished
             if not isinstance(port_name, basestring):
                 sub_combine_type = port_name[0]
                 sub_port_names = port_name[1:]
-                sub_values, sub_port_names = self.do_combine(sub_combine_type,
-                                                             inputs,
-                                                             sub_port_names)
+                sub_values, sub_port_names, sub_count = self.iter_combine(
+                        sub_combine_type, inputs, sub_port_names)
                 values.append(sub_values)
+                counts.append(sub_count)
                 port_names.extend(sub_port_names)
             else:
-                values.append((e,) for e in inputs[port_name])
+                port_values = inputs[port_name]
+                if not hasattr(port_values, '__len__'):
+                    port_values = list(port_values)
+                values.append((e,) for e in port_values)
+                counts.append(len(port_values))
                 port_names.append(port_name)
         if combine_type == "pairwise":
-            elements = [tuple(e for t in t_list for e in t)
-                        for t_list in izip(*values)]
+            t_lists = izip(*values)
+            count = min(counts) if counts else 0
         elif combine_type == "cartesian":
-            elements = [tuple(e for t in t_list for e in t)
-                        for t_list in product(*values)]
+            t_lists = product(*values)
+            count = reduce(lambda a, b: a * b, counts, 1)
         else:
             raise ValueError('Unknown combine type "%s"' % combine_type)
-        return elements, port_names
+        elements = (tuple(e for t in t_list for e in t) for t_list in t_lists)
+        return elements, port_names, count
 
     def get_combine_type(self, default="cartesian"):
         if ModuleControlParam.LOOP_KEY in self.control_params:
             return self.control_params[ModuleControlParam.LOOP_KEY]
         return default
 
+    def get_loop_workers(self):
+        """get_loop_workers() -> int
+
+        Returns the number of threads the iterations of this module are
+        run on, from its LOOP_WORKERS_KEY control parameter (or
+        get_default_loop_workers() if it is not set). Only modules
+        that are thread-safe, at the last level of iteration and not
+        while loops can run their iterations concurrently; for the others,
+        this is 1.
+
+        """
+        try:
+            workers = int(self.control_params.get(
+                    ModuleControlParam.LOOP_WORKERS_KEY,
+                    self.get_default_loop_workers()))
+        except ValueError:
+            raise ModuleError(self, "Invalid number of loop workers: %r" %
+                              self.control_params[
+                                      ModuleControlParam.LOOP_WORKERS_KEY])
+        if workers > 1 and not (self.is_thread_safe() and
+                                self.list_depth == 1 and
+                                ModuleControlParam.WHILE_COND_KEY not in
+                                    self.control_params and
+                                ModuleControlParam.WHILE_MAX_KEY not in
+                                    self.control_params):
+            debug.debug("Iterations of %s can't run concurrently" %
+                        self.__class__.__name__)
+            return 1
+        return max(workers, 1)
+
+    def get_default_loop_workers(self):
+        """get_default_loop_workers() -> int
+
+        Returns the number of threads the iterations of this module are
+        run on when its LOOP_WORKERS_KEY control parameter is not set.
+
+        """
+        return 1
+
     def compute_all(self):
         """This method executes the module once for each input.
            Similarly to controlflow's fold.
@@ -671,37 +819,40 @@ class Module(object):
             combine_type = custom_order[0]
             port_names = custom_order[1:]
 
-        elements, port_names = self.do_combine(combine_type, inputs, port_names)
-        num_inputs = len(elements)
+        elements, port_names, num_inputs = self.iter_combine(combine_type,
+                                                             inputs,
+                                                             port_names)
+        if num_inputs and not self.upToDate and self.list_depth == 1:
+            ## Type checking, before the first iteration and at the last
+            ## iteration level. Each list is checked on its own, which is
+            ## the same as checking each combination
+            for port_name in port_names:
+                self.typeChecking(self, [port_name],
+                                  [(e,) for e in inputs[port_name]])
+        workers = self.get_loop_workers()
         loop = self.logging.begin_loop_execution(self, num_inputs)
         ## Update everything for each value inside the list
         outputs = {}
-        for i in xrange(num_inputs):
-            self.logging.update_progress(self, float(i)/num_inputs)
+        def make_module(i, element):
             module = copy.copy(self)
             module.list_depth = self.list_depth - 1
             module.had_error = False
             module.was_suspended = False
 
             if not self.upToDate: # pragma: no partial
-                ## Type checking if first iteration and last iteration level
-                if i == 0 and self.list_depth == 1:
-                    self.typeChecking(module, port_names, elements)
-
                 module.upToDate = False
                 module.computed = False
-                self.setInputValues(module, port_names, elements[i], i)
-
-            loop.begin_iteration(module, i)
-
-            try:
-                module.update()
-            except ModuleSuspended, e:
-                e.loop_iteration = i
-                module.logging.end_update(module, e, was_suspended=True)
-                suspended.append(e)
+                self.setInputValues(module, port_names, element, i)
+            return module
+        def end_iteration(i, module, error):
+            if error is not None:
+                if not isinstance(error, ModuleSuspended):
+                    raise error[0], error[1], error[2]
+                error.loop_iteration = i
+                module.logging.end_update(module, error, was_suspended=True)
+                suspended.append(error)
                 loop.end_iteration(module)
-                continue
+                return
 
             loop.end_iteration(module)
 
@@ -716,6 +867,24 @@ class Module(object):
 
             self.logging.update_progress(self, i * 1.0 / num_inputs)
 
+        if workers > 1:
+            self.compute_iterations(elements, num_inputs, workers,
+                                    make_module, loop, end_iteration)
+        else:
+            for i, element in enumerate(elements):
+                self.logging.update_progress(self, float(i)/num_inputs)
+                module = make_module(i, element)
+
+                loop.begin_iteration(module, i)
+
+                try:
+                    module.update()
+                except ModuleSuspended, e:
+                    end_iteration(i, module, e)
+                    continue
+
+                end_iteration(i, module, None)
+
         if suspended:
             raise ModuleSuspended(
                     self,
@@ -727,6 +896,74 @@ class Module(object):
             self.set_output(nameOutput, outputs[nameOutput])
         loop.end_loop_execution()
 
+    def compute_iterations(self, elements, num_inputs, workers, make_module,
+                           loop, end_iteration):
+        """Runs the iterations of compute_all() on a pool of threads.
+
+        Modules are created and their results collected on this thread, in
+        iteration order; only update() runs on the workers. The logging
+        calls made by the iterations are recorded and replayed here, in
+        order, so the log is the same as when iterating serially. At most a
+        few batches of iterations are in flight at any time.
+
+        """
+        def update(module):
+            try:
+                module.update()
+            except ModuleSuspended, e:
+                return e
+            except Exception:
+                return sys.exc_info()
+            return None
+
+        tasks = Queue.Queue()
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                module, result = task
+                result.put(update(module))
+        threads = [threading.Thread(target=work) for _ in xrange(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            pending = deque()
+            elements = enumerate(elements)
+            while True:
+                # Keep the workers busy with the next batch while the
+                # results of the previous ones are collected
+                for i, element in islice(elements,
+                                         2 * workers - len(pending)):
+                    module = make_module(i, element)
+                    logging, module.logging = (module.logging,
+                                               RecordingModuleLogging())
+                    result = Queue.Queue(1)
+                    tasks.put((module, result))
+                    pending.append((i, module, logging, result))
+                if not pending:
+                    break
+                i, module, logging, result = pending.popleft()
+                error = result.get()
+                self.logging.update_progress(self, float(i)/num_inputs)
+                loop.begin_iteration(module, i)
+                recorded, module.logging = module.logging, logging
+                recorded.replay(logging)
+                end_iteration(i, module, error)
+        finally:
+            # Drop the iterations that didn't start, if we are stopping on
+            # an error
+            try:
+                while True:
+                    tasks.get_nowait()
+            except Queue.Empty:
+                pass
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+
     def build_stream(self):
         """Determines and builds correct generator type.
 
@@ -1648,6 +1885,15 @@ class NotCacheable(object):
 
 ################################################################################
 
+class ThreadSafe(object):
+    """ A mixin indicating that a module can be computed on a worker thread
+
+    """
+    def is_thread_safe(self):
+        return True
+
+################################################################################
+
 class Streaming(object):
     """ A mixin indicating support for streamable inputs
 
@@ -1847,7 +2093,91 @@ def new_module(base_module, name, class_dict={}, docstring=None):
 
 import unittest
 
+class _Square(ThreadSafe, Module):
+    def compute(self):
+        time.sleep(0.05)
+        self.set_output('value', self.get_input('value') ** 2)
+
+
+class _LoopLog(object):
+    """Records the loop logging calls, and the ones of the iterations.
+    """
+    def __init__(self):
+        self.calls = []
+        self.iterations = {}
+
+    def begin_loop_execution(self, obj, total_iterations=None):
+        self.calls.append(('begin_loop', total_iterations))
+        return self
+
+    def end_loop_execution(self):
+        self.calls.append(('end_loop',))
+
+    def begin_iteration(self, looped_obj, iteration):
+        self.iterations[id(looped_obj)] = iteration
+        self.calls.append(('begin_iteration', iteration))
+
+    def end_iteration(self, looped_obj):
+        self.calls.append(('end_iteration',
+                           self.iterations[id(looped_obj)]))
+
+    def update_progress(self, obj, progress):
+        pass
+
+    def __getattr__(self, name):
+        def log(obj, *args, **kwargs):
+            self.calls.append((name, self.iterations.get(id(obj))))
+        return log
+
+
 class TestImplicitLooping(unittest.TestCase):
+    def test_iter_combine(self):
+        module = Module()
+        inputs = {'a': [1, 2], 'b': ['x', 'y', 'z'], 'c': (True,)}
+        elements, port_names, count = module.iter_combine('cartesian',
+                                                          inputs,
+                                                          ['a', 'b'])
+        self.assertIs(iter(elements), elements)
+        self.assertEqual(list(elements), [(1, 'x'), (1, 'y'), (1, 'z'),
+                                          (2, 'x'), (2, 'y'), (2, 'z')])
+        self.assertEqual((port_names, count), (['a', 'b'], 6))
+        elements, port_names, count = module.iter_combine(
+                'cartesian', inputs, [['pairwise', 'a', 'b'], 'c'])
+        self.assertEqual(list(elements), [(1, 'x', True), (2, 'y', True)])
+        self.assertEqual((port_names, count), (['a', 'b', 'c'], 2))
+        self.assertEqual(module.do_combine('pairwise', inputs, ['b', 'a']),
+                         ([('x', 1), ('y', 2)], ['b', 'a']))
+
+    def run_loop(self, workers):
+        from vistrails.core.modules.basic_modules import create_constant
+        module = _Square()
+        module.logging = _LoopLog()
+        module.signature = '0' * 40
+        module.list_depth = 1
+        module.iterated_ports = [('value', 1, None)]
+        module.set_input_port('value',
+                              ModuleConnector(create_constant(range(12)),
+                                              'value'))
+        module.control_params[ModuleControlParam.LOOP_WORKERS_KEY] = \
+                str(workers)
+        start = time.time()
+        module.compute_all()
+        return (time.time() - start, module.get_output('value'),
+                module.logging.calls)
+
+    def test_loop_workers(self):
+        serial_time, serial_values, serial_calls = self.run_loop(1)
+        elapsed, values, calls = self.run_loop(4)
+        self.assertEqual(values, [i ** 2 for i in xrange(12)])
+        self.assertEqual(values, serial_values)
+        self.assertEqual(calls, serial_calls)
+        self.assertEqual(calls[:5], [('begin_loop', 12),
+                                     ('begin_iteration', 0),
+                                     ('begin_update', 0),
+                                     ('begin_compute', 0),
+                                     ('end_update', 0)])
+        self.assertLess(elapsed, serial_time / 2)
+
     def run_vt(self, vt_basename):
         from vistrails.core.system import vistrails_root_directory
         from vistrails.core.db.locator import FileLocator
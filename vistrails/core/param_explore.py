@@ -41,7 +41,10 @@ from __future__ import division
 from vistrails.core import debug
 from vistrails.core.vistrail.module_function import ModuleFunction
 from vistrails.core.vistrail.module_param import ModuleParam
+import collections
 import copy
+import multiprocessing
+import os
 
 import unittest
 
@@ -176,6 +179,7 @@ class InterpolateDiscreteParam(object):
             p.strValue = str(v)
             f.params.append(p)
         m.functions.append(f)
+        pipeline.invalidate_signatures(m.id)
 
 class ActionBasedParameterExploration(object):
     """
@@ -209,22 +213,39 @@ class ActionBasedParameterExploration(object):
         """
         results = []
         resultActions = []
-        
+        for (pipeline, performedActions) in self.iter_explore(pipeline,
+                                                              actions,
+                                                              pre_actions):
+            results.append(pipeline)
+            resultActions.append(performedActions)
+        return (results, resultActions)
+
+    def iter_explore(self, pipeline, actions, pre_actions=[]):
+        """ iter_explore(pipeline: Pipeline, actions: [action set],
+                         pre_actions: [action set])
+                         -> generator of (pipeline, actions)
+        Same as explore() but the interpolated pipelines are generated
+        one at a time, in the same order, instead of being all built
+        before the first one is returned. Only the pipelines on the
+        path to the current one are kept in memory.
+
+        """
         def exploreDimension(pipeline, performedActions, dim):
             """ exploreDimension(pipeline: Pipeline, performedActions: [actions],
-                                 dim: int) -> None
+                                 dim: int) -> generator
             Start applying actions to the pipeline at dimension
             dim. 'pipeline' will not be modified in the function
             
             """
             if dim<0:
-                results.append(pipeline)
-                resultActions.append(performedActions)
+                yield (pipeline, performedActions)
                 return
             currentActions = actions[dim]
             if len(currentActions)==0:
                 # Ignore empty dimension
-                exploreDimension(pipeline, performedActions, dim-1)
+                for result in exploreDimension(pipeline, performedActions,
+                                               dim-1):
+                    yield result
                 return
             for actionSet in currentActions:
                 currentPipeline = copy.copy(pipeline)
@@ -232,15 +253,16 @@ class ActionBasedParameterExploration(object):
                 for action in actionSet:
                     currentPipeline.perform_action(action)
                     currentPeformedActions.append(action)
-                exploreDimension(currentPipeline, currentPeformedActions, dim-1)
+                for result in exploreDimension(currentPipeline,
+                                               currentPeformedActions, dim-1):
+                    yield result
         
         # perform pre_actions
         currentPipeline = copy.copy(pipeline)
         for action in pre_actions:
             currentPipeline.perform_action(action)
         
-        exploreDimension(currentPipeline, pre_actions, len(actions)-1)
-        return (results, resultActions)
+        return exploreDimension(currentPipeline, pre_actions, len(actions)-1)
 
 def _pipelinePositions(sheetCount, rowCount, colCount,
                        pipelines):
@@ -254,14 +276,338 @@ def _pipelinePositions(sheetCount, rowCount, colCount,
 
     """
 
-    pipelinePositions = []
-    for pId in xrange(len(pipelines)):
-        col = pId % colCount
-        row = (pId // colCount) % rowCount
-        sheet = (pId // (colCount*rowCount)) % sheetCount
-        pipelinePositions.append((row, col, sheet))
-    return pipelinePositions
+    return [_pipelinePosition(pId, sheetCount, rowCount, colCount)
+            for pId in xrange(len(pipelines))]
+
+def _pipelinePosition(pId, sheetCount, rowCount, colCount):
+    """ _pipelinePosition(pId: int, sheetCount: int, rowCount: int,
+                          colCount: int) -> (row, col, sheet)
+    Returns the position of the pId-th pipeline of a parameter
+    exploration, see _pipelinePositions()
+
+    """
+    col = pId % colCount
+    row = (pId // colCount) % rowCount
+    sheet = (pId // (colCount*rowCount)) % sheetCount
+    return (row, col, sheet)
+
+
+class ExplorationResult(object):
+    """
+    ExplorationResult holds the outcome of executing one point of a
+    parameter exploration: its (row, col, sheet) position, the errors
+    as a dict {module_id: message}, the ids of the modules that were
+    actually executed (the others were found in the cache), the
+    name of its dumped spreadsheet cells, if any, and, when it ran in a
+    worker process with logging on, the XML of the workflow executions
+    it logged, until they are merged into the controller's log
+
+    """
+    def __init__(self, position, errors, executed, thumbnail=None,
+                 workflow_execs=None):
+        self.position = position
+        self.errors = errors
+        self.executed = executed
+        self.thumbnail = thumbnail
+        self.workflow_execs = workflow_execs
+
+def _executePoint(interpreter, name, position, pipeline, kwargs):
+    """ _executePoint(interpreter: CachedInterpreter, name: str,
+                      position: (row, col, sheet), pipeline: Pipeline,
+                      kwargs: dict) -> ExplorationResult
+    Executes one pipeline of the exploration, and returns a result that
+    can be sent back from a worker process
+    
+    """
+    extra_info = kwargs.get('extra_info')
+    thumbnail = None
+    if extra_info is not None and 'pathDumpCells' in extra_info:
+        extra_info = dict(extra_info)
+        extra_info['nameDumpCells'] = "%s_%s_%s_%s" % ((name,) + position)
+        thumbnail = os.path.join(extra_info['pathDumpCells'],
+                                 extra_info['nameDumpCells'])
+        kwargs = dict(kwargs, extra_info=extra_info)
+    try:
+        result = interpreter.execute(pipeline, **kwargs)
+    except Exception, e:
+        debug.unexpected_exception(e)
+        return ExplorationResult(position, {None: debug.format_exception(e)},
+                                 [], thumbnail)
+    errors = dict((module_id, str(error))
+                  for module_id, error in result.errors.iteritems())
+    executed = [module_id
+                for module_id, was_executed in result.executed.iteritems()
+                if was_executed]
+    return ExplorationResult(position, errors, executed, thumbnail)
+
+# Queue on which a worker process reports the chunks it starts, see
+# _initWorker()
+_started_chunks = None
+
+def _initWorker(started_chunks=None):
+    """ _initWorker(started_chunks: multiprocessing.Queue) -> None
+    Initializes an exploration worker process. If started_chunks is
+    given, _executePoints() puts (chunk id, pid) on it when it starts a
+    chunk, so that the parent process can tell which chunk was lost when
+    a worker dies
+    
+    """
+    global _started_chunks
+    _started_chunks = started_chunks
+    from vistrails.core.application import init_worker
+    init_worker()
+
+def _executePoints(args):
+    """ _executePoints(args: tuple) -> list of ExplorationResult
+    Executes a chunk of points in a worker process. Consecutive points
+    only differ in the first dimension, so the upstream modules they
+    share are found in the cache of the worker's interpreter.
+    The locator is sent as an URL and the pipelines and actions as XML;
+    if logging is on, each point is logged to a new log whose workflow
+    executions are sent back with the result
+    
+    """
+    from vistrails.core.db.io import serialize, unserialize
+    from vistrails.core.db.locator import BaseLocator
+    from vistrails.core.interpreter.default import get_default_interpreter
+    from vistrails.core.log.controller import LogController
+    from vistrails.core.log.log import Log
+    from vistrails.core.vistrail.action import Action
+    from vistrails.core.vistrail.pipeline import Pipeline
+
+    name, chunk_id, points, kwargs, variables, locator_url, logging = args
+    if _started_chunks is not None:
+        _started_chunks.put((chunk_id, os.getpid()))
+    if variables:
+        kwargs = dict(kwargs, vistrail_variables=variables.get)
+    if locator_url is not None:
+        kwargs = dict(kwargs, locator=BaseLocator.from_url(locator_url))
+    interpreter = get_default_interpreter()
+    results = []
+    # Errors are returned as results: the parent process only hears about
+    # chunks that completed
+    for position, xml, action_xmls in points:
+        log = Log() if logging else None
+        try:
+            pipeline = unserialize(xml, Pipeline)
+            point_kwargs = dict(kwargs,
+                                actions=[unserialize(a, Action)
+                                         for a in action_xmls])
+            if log is not None:
+                point_kwargs['logger'] = LogController(log)
+            result = _executePoint(interpreter, name, position, pipeline,
+                                   point_kwargs)
+        except Exception, e:
+            result = ExplorationResult(
+                    position, {None: debug.format_exception(e)}, [])
+        if log is not None:
+            result.workflow_execs = [serialize(workflow_exec)
+                                     for workflow_exec in log.workflow_execs]
+        results.append(result)
+    return results
+
+class ParameterExplorationRunner(object):
+    """
+    ParameterExplorationRunner executes a parameter exploration without
+    the GUI. The points of the exploration are generated lazily and
+    either executed one after the other by the default interpreter, or
+    dispatched in chunks to a pool of worker processes (see the
+    parameterExplorationWorkers configuration option). In both cases
+    the results are yielded as they complete, upstream modules that
+    several points share are reused through the cache, and the
+    executions are logged to the controller's log.
+
+    Spreadsheet cells are not positioned, so this is meant for
+    explorations whose output does not need the spreadsheet
+    
+    """
+    # Number of points sent to a worker at a time
+    POINTS_PER_TASK = 4
+    # Seconds between checks for dead workers while waiting for a chunk
+    WORKER_POLL_INTERVAL = 1.0
+
+    def __init__(self, controller, pe, workers=None):
+        """ ParameterExplorationRunner(controller: VistrailController,
+                                       pe: ParameterExploration,
+                                       workers: int)
+                                       -> ParameterExplorationRunner
+        If workers is None, it is read from the configuration; 0 or 1
+        execute the points in this process
+        
+        """
+        self.controller = controller
+        self.pe = pe
+        if workers is None:
+            from vistrails.core.configuration import \
+                get_vistrails_configuration
+            workers = getattr(get_vistrails_configuration(),
+                              'parameterExplorationWorkers', 0)
+        self.workers = workers
+        self.vistrail_vars = []
+
+    def iter_points(self):
+        """ iter_points() -> generator of ((row, col, sheet),
+                                           Pipeline, [actions])
+        Generates the points of the exploration in order
+        
+        """
+        controller = self.controller
+        if self.pe.action_id != controller.current_version:
+            controller.change_selected_version(self.pe.action_id)
+        collected = self.pe.collectParameterActions(
+                controller.current_pipeline)
+        if not collected:
+            return
+        actions, pre_actions, self.vistrail_vars = collected
+        if not any(actions):
+            return
+        dim = [max(1, len(a)) for a in actions]
+        explorer = ActionBasedParameterExploration()
+        pipelines = explorer.iter_explore(controller.current_pipeline,
+                                          actions, pre_actions)
+        for pId, (pipeline, performedActions) in enumerate(pipelines):
+            yield (_pipelinePosition(pId, dim[2], dim[1], dim[0]),
+                   pipeline, performedActions)
+
+    def _variables(self):
+        """ _variables() -> dict
+        Returns the vistrail variables that are not overridden by the
+        exploration
+        
+        """
+        return dict((v.uuid, v)
+                    for v in self.controller.get_vistrail_variables()
+                    if v.uuid not in self.vistrail_vars)
+
+    def _name(self):
+        return os.path.splitext(self.controller.name)[0] or 'untitled'
+
+    def run(self, extra_info=None, reason='Parameter Exploration'):
+        """ run(extra_info: dict, reason: str)
+              -> generator of ExplorationResult
+        Executes the exploration, yielding results as they complete.
+        Points are executed in order when running in this process; when
+        running on workers, chunks of points are yielded in the order
+        they were dispatched. A chunk that fails as a whole, e.g. because
+        its worker died, gives an error result for each of its points
+        
+        """
+        kwargs = {'current_version': self.controller.current_version,
+                  'reason': reason}
+        if extra_info is not None:
+            kwargs['extra_info'] = extra_info
+        if self.workers > 1:
+            return self._run_workers(kwargs)
+        return self._run_here(kwargs)
+
+    def _run_here(self, kwargs):
+        from vistrails.core.interpreter.default import get_default_interpreter
+
+        interpreter = get_default_interpreter()
+        kwargs = dict(kwargs, locator=self.controller.locator,
+                      logger=self.controller.get_logger())
+        for position, pipeline, performedActions in self.iter_points():
+            point_kwargs = dict(kwargs, actions=performedActions)
+            variables = self._variables()
+            if variables:
+                point_kwargs['vistrail_variables'] = variables.get
+            yield _executePoint(interpreter, self._name(), position,
+                                pipeline, point_kwargs)
 
+    def _run_workers(self, kwargs):
+        from vistrails.core.db.io import serialize
+
+        locator = self.controller.locator
+        locator_url = locator.to_url() if locator is not None else None
+        logging = self.controller.logging_on()
+        started_chunks = multiprocessing.Queue()
+        pool = multiprocessing.Pool(self.workers, _initWorker,
+                                    (started_chunks,))
+        chunk_pids = {}
+        try:
+            # Keep a couple of chunks queued per worker; the points are
+            # only generated when there is room for them
+            pending = collections.deque()
+            chunk = []
+            points = self.iter_points()
+            while True:
+                point = next(points, None)
+                if point is not None:
+                    position, pipeline, performedActions = point
+                    chunk.append((position, serialize(pipeline),
+                                  [serialize(action)
+                                   for action in performedActions]))
+                if chunk and (point is None or
+                              len(chunk) == self.POINTS_PER_TASK):
+                    chunk_id = len(chunk_pids)
+                    chunk_pids[chunk_id] = None
+                    task = pool.apply_async(
+                            _executePoints,
+                            ((self._name(), chunk_id, chunk, kwargs,
+                              self._variables(), locator_url, logging),))
+                    pending.append((chunk_id, [p[0] for p in chunk], task))
+                    chunk = []
+                while pending and (point is None or
+                                   len(pending) >= 2 * self.workers):
+                    chunk_id, positions, task = pending.popleft()
+                    results = self._wait_chunk(started_chunks, chunk_pids,
+                                               chunk_id, positions, task)
+                    for result in results:
+                        self._merge_log(result)
+                        yield result
+                if point is None:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _wait_chunk(self, started_chunks, chunk_pids, chunk_id, positions,
+                    task):
+        """ _wait_chunk(...) -> list of ExplorationResult
+        Waits for a chunk dispatched by _run_workers(). The pool replaces
+        a worker that dies but never completes the chunk it was running,
+        so the chunk is given up when the worker that started it (as
+        reported on started_chunks) is no longer running
+        
+        """
+        while True:
+            try:
+                return task.get(self.WORKER_POLL_INTERVAL)
+            except multiprocessing.TimeoutError:
+                pass
+            except Exception, e:
+                # The chunk raised, or could not be sent or sent back
+                error = debug.format_exception(e)
+                break
+            while not started_chunks.empty():
+                started_id, pid = started_chunks.get()
+                chunk_pids[started_id] = pid
+            pid = chunk_pids[chunk_id]
+            if pid is not None and not task.ready() and \
+                    pid not in set(p.pid for p in
+                                   multiprocessing.active_children()):
+                error = "Worker process exited unexpectedly"
+                break
+        return [ExplorationResult(position, {None: error}, [])
+                for position in positions]
+
+    def _merge_log(self, result):
+        """ _merge_log(result: ExplorationResult) -> None
+        Adds the workflow executions logged by a worker to the log of
+        the controller
+        
+        """
+        from vistrails.core.db.io import unserialize
+        from vistrails.core.log.workflow_exec import WorkflowExec
+
+        if not result.workflow_execs:
+            return
+        log = self.controller.log
+        for xml in result.workflow_execs:
+            workflow_exec = unserialize(xml, WorkflowExec)
+            workflow_exec.id = log.id_scope.getNewId(WorkflowExec.vtType)
+            log.add_workflow_exec(workflow_exec)
+        result.workflow_execs = None
 
 ################################################################################
         
@@ -283,5 +629,108 @@ class TestParameterExploration(unittest.TestCase):
                           (5, 5.0, 'two'),
                           (10, 10.0, 'three')])
 
+    def testIterExplore(self):
+        class FakePipeline(object):
+            def __init__(self, actions=[]):
+                self.actions = list(actions)
+            def __copy__(self):
+                return FakePipeline(self.actions)
+            def perform_action(self, action):
+                self.actions.append(action)
+
+        actions = [[('a1',), ('a2',), ('a3',)], [], [('b1', 'c1'), ('b2', 'c2')]]
+        explorer = ActionBasedParameterExploration()
+        points = explorer.iter_explore(FakePipeline(), actions, ['pre'])
+        pipeline, performed = next(points)
+        self.assertEqual(pipeline.actions, ['pre', 'b1', 'c1', 'a1'])
+        self.assertEqual(performed, pipeline.actions)
+        self.assertEqual(len(list(points)), 5)
+        pipelines, performed = explorer.explore(FakePipeline(), actions,
+                                                ['pre'])
+        self.assertEqual([p.actions for p in pipelines],
+                         [p.actions for p, _ in explorer.iter_explore(
+                                 FakePipeline(), actions, ['pre'])])
+        self.assertEqual([p.actions[-1] for p in pipelines],
+                         ['a1', 'a2', 'a3'] * 2)
+
+    def testRunner(self):
+        from vistrails.core.paramexplore.function import PEFunction
+        from vistrails.core.paramexplore.param import PEParam
+        from vistrails.core.paramexplore.paramexplore import \
+            ParameterExploration as PE
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        from vistrails.tests.utils import enable_package
+
+        identifier = 'org.vistrails.vistrails.pythoncalc'
+        enable_package(identifier)
+        controller = VistrailController(Vistrail(), auto_save=False)
+        controller.change_selected_version(0)
+        module = controller.add_module(identifier, 'PythonCalc')
+        controller.update_function(module, 'value2', ['2.0'])
+        pe = PE(action_id=controller.current_version,
+                dims='[3, 2, 1, 1]', layout='{}', functions=[
+                PEFunction(module_id=module.id, port_name='value1',
+                           parameters=[PEParam(pos=0, dimension=0,
+                                               interpolator='List',
+                                               value='[1.0, 2.0, 3.0]')]),
+                PEFunction(module_id=module.id, port_name='op',
+                           parameters=[PEParam(pos=0, dimension=1,
+                                               interpolator='List',
+                                               value='["+", "?"]')])])
+
+        from vistrails.core.configuration import get_vistrails_configuration
+        conf = get_vistrails_configuration()
+        old_log = conf.executionLog
+        conf.executionLog = True
+        try:
+            for workers in (0, 2):
+                nb_execs = len(controller.log.workflow_execs)
+                runner = ParameterExplorationRunner(controller, pe, workers)
+                results = sorted(runner.run(), key=lambda r: r.position)
+                self.assertEqual([r.position for r in results],
+                                 [(row, col, 0)
+                                  for row in xrange(2) for col in xrange(3)])
+                self.assertEqual([bool(r.errors) for r in results],
+                                 [False] * 3 + [True] * 3)
+                self.assertIn("unrecognized operation",
+                              results[3].errors[module.id])
+                # The executions in workers are logged too
+                self.assertEqual(len(controller.log.workflow_execs),
+                                 nb_execs + 6)
+        finally:
+            conf.executionLog = old_log
+
+    def testRunnerWorkerDies(self):
+        import urllib
+        from vistrails.core.modules.basic_modules import identifier
+        from vistrails.core.paramexplore.function import PEFunction
+        from vistrails.core.paramexplore.param import PEParam
+        from vistrails.core.paramexplore.paramexplore import \
+            ParameterExploration as PE
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        controller = VistrailController(Vistrail(), auto_save=False)
+        controller.change_selected_version(0)
+        module = controller.add_module(identifier, 'PythonSource')
+        sources = [urllib.quote(source)
+                   for source in ("import os; os._exit(1)", "pass")]
+        pe = PE(action_id=controller.current_version,
+                dims='[2, 1, 1, 1]', layout='{}', functions=[
+                PEFunction(module_id=module.id, port_name='source',
+                           parameters=[PEParam(pos=0, dimension=0,
+                                               interpolator='List',
+                                               value=repr(sources))])])
+        runner = ParameterExplorationRunner(controller, pe, 2)
+        runner.POINTS_PER_TASK = 1
+        runner.WORKER_POLL_INTERVAL = 0.1
+        results = sorted(runner.run(), key=lambda r: r.position)
+        self.assertEqual([r.position for r in results],
+                         [(0, 0, 0), (0, 1, 0)])
+        self.assertEqual(results[0].errors,
+                         {None: "Worker process exited unexpectedly"})
+        self.assertFalse(results[1].errors)
+
 if __name__ == '__main__':
     unittest.main()
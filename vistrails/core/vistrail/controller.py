@@ -48,7 +48,7 @@ import vistrails.core.db.action
 import vistrails.core.db.io
 import vistrails.core.db.locator
 from vistrails.core import debug
-from vistrails.core.data_structures.graph import Graph
+from vistrails.core.data_structures.graph import Graph, GraphException
 from vistrails.core.interpreter.default import get_default_interpreter
 from vistrails.core.vistrail.job import JobMonitor
 from vistrails.core.layout.workflow_layout import WorkflowLayout, \
@@ -88,6 +88,7 @@ from vistrails.core.vistrail.pipeline import Pipeline
 from vistrails.core.vistrail.port import Port
 from vistrails.core.vistrail.port_spec import PortSpec
 from vistrails.core.vistrail.port_spec_item import PortSpecItem
+from vistrails.core.vistrail.terse_graph import TerseGraphBuilder
 from vistrails.core.vistrail.vistrail import Vistrail
 from vistrails.core.theme import DefaultCoreTheme
 from vistrails.db import VistrailsDBException
@@ -161,6 +162,7 @@ class VistrailController(object):
         self.flush_pipeline_cache()
         self._current_full_graph = None
         self._current_terse_graph = None
+        self._terse_graph_builder = None
         self.show_upgrades = False
         # if delayed_update is True, version tree and 'changed' status
         # needs to be updated
@@ -545,6 +547,7 @@ class VistrailController(object):
         desc_key = Action.ANNOTATION_DESCRIPTION
         added_upgrade = False
         should_migrate_tags = get_vistrails_configuration().check("migrateTags")
+        changed_versions = []
         for action in self._delayed_actions:
             self.vistrail.add_action(action, start_version,
                                      self.current_session)
@@ -554,6 +557,7 @@ class VistrailController(object):
                 self.vistrail.set_upgrade(start_version, str(action.id))
             if should_migrate_tags:
                 self.migrate_tags(start_version, action.id)
+            changed_versions.extend((start_version, action.id))
             self.current_version = action.id
             start_version = action.id
             added_upgrade = True
@@ -577,7 +581,7 @@ class VistrailController(object):
             if delay_update:
                 self.delayed_update = True
             else:
-                self.recompute_terse_graph()
+                self.update_terse_graph(changed_versions)
                 self.invalidate_version_tree(False)
 
     def clear_delayed_actions(self):
@@ -622,7 +626,7 @@ class VistrailController(object):
                 self.vistrail.change_description(description, action.id)
             self.current_version = action.db_id
             self.set_changed(True)
-            self.recompute_terse_graph()
+            self.update_terse_graph([action.db_id])
             
     def create_module_from_descriptor(self, *args, **kwargs):
         return self.create_module_from_descriptor_static(self.id_scope,
@@ -2766,6 +2770,7 @@ class VistrailController(object):
             full = self._current_full_graph
         changed = False
         new_current_version = None
+        pruned = []
         for v in versions:
             if v!=0: # not root
                 highest = v
@@ -2780,12 +2785,19 @@ class VistrailController(object):
                     changed = True
                     if highest == self.current_version:
                         new_current_version = full.parent(highest)
+                    # pruning also removes the tags of the whole subtree
+                    subtree = [highest]
+                    while subtree:
+                        version = subtree.pop()
+                        pruned.append(version)
+                        subtree.extend(to for to, _ in
+                                       full.adjacency_list[version])
                 self.vistrail.pruneVersion(highest)
         if changed:
             self.set_changed(True)
         if new_current_version is not None:
             self.change_selected_version(new_current_version)
-        self.recompute_terse_graph()
+        self.update_terse_graph(pruned)
         self.invalidate_version_tree(False)
 
     def hide_versions_below(self, v=None):
@@ -2951,133 +2963,42 @@ class VistrailController(object):
                                         'hideUpgrades', True)
         self.show_upgrades = show_upgrades
 
+        builder = TerseGraphBuilder()
+        builder.rebuild(self, show_upgrades)
+        self._terse_graph_builder = builder
+        self._current_terse_graph = builder.graph
         # get full version tree (including pruned nodes) this tree is
         # kept updated all the time. This data is read only and should
         # not be updated!
-        fullVersionTree = self.vistrail.tree.getVersionTree()
-
-        # create tersed tree
-        open_list = [(0, None, False, False)]  # Elements to be handled
-        tersedVersionTree = Graph()
-
-        # cache actionMap and tagMap because they're properties, sort
-        # of slow
-        am = self.vistrail.actionMap
-        tm = self.vistrail.get_tagMap()
-        last_n = self.vistrail.getLastActions(self.num_versions_always_shown)
-
-        upgrades = set()
-        upgrade_rev_map = {}
-        current_version = self.current_version
-        def rev_map(v):
-            return upgrade_rev_map.get(v, v)
-
-        if not self.show_upgrades:
-            # process upgrade annotations
-            for ann in self.vistrail.action_annotations:
-                if ann.key != Vistrail.UPGRADE_ANNOTATION:
-                    continue
-                # The target is an upgrade
-                upgrades.add(int(ann.value))
-                # Map from upgraded version to original
-                upgrade_rev_map[int(ann.value)] = ann.action_id
-
-            # Map current version
-            current_version = rev_map(current_version)
-
-            # Map tags
-            tm, orig_tm = {}, tm
-            for version, name in sorted(orig_tm.iteritems(),
-                                        key=lambda p: p[0]):
-                v = version
-                while v in upgrade_rev_map:
-                    v = upgrade_rev_map[v]
-                    if v in orig_tm:
-                        # Found another tag in upgrade chain, don't move tag
-                        v = version
-                        break
-                tm[v] = name
-            del orig_tm
-
-            # Transitively flatten upgrade_rev_map
-            for k, v in upgrade_rev_map.iteritems():
-                while v in upgrade_rev_map:
-                    v = upgrade_rev_map[v]
-                upgrade_rev_map[k] = v
-
-        while open_list:
-            current, parent, expandable, collapsible = open_list.pop()
-
-            # mount children list
-            all_children = [
-                to for to, _ in fullVersionTree.adjacency_list[current]
-                if to in am]
-            children = []
-            while all_children:
-                child = all_children.pop()
-                # Pruned: drop it
-                if self.vistrail.is_pruned(child):
-                    pass
-                # An upgrade: get its children directly
-                # (unless it is tagged, and that tag couldn't be moved)
-                elif (not self.show_upgrades and
-                      (child in upgrades or
-                       am[child].description == 'Upgrade') and
-                      child not in tm):
-                    all_children.extend(
-                        to for to, _ in fullVersionTree.adjacency_list[child]
-                        if to in am)
-                else:
-                    children.append(child)
+        self._current_full_graph = self.vistrail.tree.getVersionTree()
+        self._upgrade_rev_map = builder.upgrade_rev_map
 
-            display = (self.full_tree or
-                       current == 0 or                 # is root
-                       current in tm or                # hasTag:
-                       current in last_n or            # show latest
-                       current == current_version or   # isCurrentVersion
-                       len(children) != 1)             # leaf or branch
-
-            if (display or am[current].expand):        # forced expansion
-
-                # yes it will!  this needs to be here because if we
-                # are refining version view receives the graph without
-                # the non matching elements
-                if (not self.refine or
-                        (self.refine and not self.search) or
-                        current == 0 or
-                        (self.refine and self.search and
-                         self.search.match(self.vistrail, am[current])) or
-                        current == current_version):
-                    # add vertex...
-                    tersedVersionTree.add_vertex(current, tm.get(current))
-
-                    # ...and the parent
-                    if parent is not None:
-                        collapse_here = not collapsible and not display
-                        tersedVersionTree.add_edge(parent, current,
-                                                   (expandable, collapse_here))
-                        collapsible = collapsible or collapse_here
-
-                    # update the parent info that will be used by the
-                    # children of this node
-                    parentToChildren = current
-                    expandable = False
-                else:
-                    parentToChildren = parent
-                    expandable = True
-            else:
-                parentToChildren = parent
-                expandable = True
+    def update_terse_graph(self, versions=()):
+        """ update_terse_graph(versions: list of version numbers) -> None
+        Updates the terse graph after the given versions were added,
+        tagged, pruned or upgraded, without walking the whole version tree.
+        Changes to the current version need not be listed. Falls back to
+        recompute_terse_graph() if the change can't be applied incrementally
 
-            if collapsible and len(children) > 1:
-                collapsible = False
-            for child in children:
-                open_list.append((child, parentToChildren,
-                                  expandable, collapsible))
+        """
+        show_upgrades = not getattr(get_vistrails_configuration(),
+                                    'hideUpgrades', True)
+        builder = self._terse_graph_builder
+        if (builder is None or
+                builder.graph is not self._current_terse_graph or
+                not builder.update(self, versions, show_upgrades)):
+            VistrailController.recompute_terse_graph(self, show_upgrades)
+
+    def check_terse_graph(self):
+        """ check_terse_graph() -> bool
+        Checks that the incrementally updated terse graph is the same as
+        the one recompute_terse_graph() would build
 
-        self._current_terse_graph = tersedVersionTree
-        self._current_full_graph = self.vistrail.tree.getVersionTree()
-        self._upgrade_rev_map = upgrade_rev_map
+        """
+        builder = TerseGraphBuilder()
+        builder.rebuild(self, self.show_upgrades)
+        return (self._terse_graph_builder is not None and
+                builder.same_graph(self._terse_graph_builder))
 
     def save_version_graph(self, filename, tersed=True, highlight=None):
         if tersed:
@@ -3701,14 +3622,10 @@ class VistrailController(object):
         """ Version switch cost as action distance
 
         """
-        cost = 0
-        am = self.vistrail.actionMap
         if descendant == -1:
             descendant = 0
-        while descendant != ancestor:
-            descendant = am[descendant].parent
-            cost += 1
-        return cost
+        index = self.vistrail.tree.index
+        return index.depth(descendant) - index.depth(ancestor)
 
     def do_version_switch(self, new_version, report_all_errors=False,
                           do_validate=True, from_root=False):
@@ -4072,6 +3989,13 @@ class VistrailController(object):
 
     def write_log(self, locator):
         if self.log:
+            if (self.vistrail.db_log_filename is not None and
+                    isinstance(locator,
+                               vistrails.core.db.locator.XMLFileLocator)):
+                # no need to load the whole log to write it out
+                vistrails.core.db.io.save_merged_log(
+                        self.log, self.vistrail.db_log_filename, locator.name)
+                return
             if self.vistrail.db_log_filename is not None:
                 log = vistrails.core.db.io.merge_logs(self.log, 
                                             self.vistrail.db_log_filename)
@@ -4318,8 +4242,11 @@ class VistrailController(object):
             result = copy.copy(self._pipelines[version])
         else:
             # Find the closest upstream pipeline to the current one
-            cv = self._current_full_graph.inverse_immutable().closest_vertex
-            closest = cv(version, self._pipelines)
+            closest = self.vistrail.tree.index.closest_ancestor(
+                    version, self._pipelines)
+            if closest is None:
+                raise GraphException("no vertices reachable: %s %s" % (
+                        version, self._pipelines.keys()))
             if use_current:
                 cost_to_closest_version = self.version_switch_cost(version,
                                                                    closest)
@@ -4570,3 +4497,40 @@ class TestTerseGraph(unittest.TestCase):
             13L: [(14L, (False, False)), (17L, (False, False))],
             4L: [], 6L: [], 10L: [], 14L: [], 17L: [],
         })
+
+    def test_incremental_update(self):
+        """Updates the tersed version tree as versions are added"""
+        import random
+
+        configuration = get_vistrails_configuration()
+        hide_upgrades = getattr(configuration, 'hideUpgrades', True)
+        try:
+            for hide in (True, False):
+                setattr(configuration, 'hideUpgrades', hide)
+                self.check_incremental_update(random.Random(4))
+        finally:
+            setattr(configuration, 'hideUpgrades', hide_upgrades)
+
+    def check_incremental_update(self, rng):
+        controller = self.get_workflow('upgrades2.xml')
+        controller.recompute_terse_graph()
+        vistrail = controller.vistrail
+        for i in xrange(60):
+            version = rng.choice(vistrail.getVersionGraph().vertices.keys())
+            operation = rng.random()
+            if operation < 0.1 and version != 0:
+                controller.prune_versions([version])
+            elif operation < 0.3 and version != 0:
+                vistrail.set_tag(version, 'tag %d' % i)
+                controller.update_terse_graph([version])
+            else:
+                controller.current_version = version
+                if operation < 0.45:
+                    action = Action(id=-1)
+                    controller.set_action_annotation(
+                            action, Action.ANNOTATION_DESCRIPTION, "Upgrade")
+                    controller._delayed_actions = [action]
+                    controller.flush_delayed_actions()
+                else:
+                    controller.add_new_action(Action(id=-1))
+            self.assertTrue(controller.check_terse_graph())
@@ -147,6 +147,7 @@ class Pipeline(DBWorkflow):
             self._module_signatures = \
                 Bidict([(k,copy.copy(v))
                         for (k,v) in other._module_signatures.iteritems()])
+        self._signature_owners = {}
 
         self.graph = Graph()
         for module in self.module_list:
@@ -262,6 +263,7 @@ class Pipeline(DBWorkflow):
         self._subpipeline_signatures = Bidict()
         self._module_signatures = Bidict()
         self._connection_signatures = Bidict()
+        self._signature_owners = {}
 
     def get_tmp_id(self, type):
         """get_tmp_id(type: str) -> long
@@ -347,6 +349,11 @@ class Pipeline(DBWorkflow):
                 msg = "Pipeline cannot execute '%s %s' operation" % \
                     (op.vtType, op.what)
                 raise VistrailsInternalError(msg)
+            # generic changes to a module's contents (functions, control
+            # parameters, port specs...) invalidate that module
+            if what != Location.vtType:
+                self.invalidate_object_signatures(op.parentObjType,
+                                                  op.parentObjId)
 
         if op.vtType == 'add':
             f(op.data, op.parentObjType, op.parentObjId)
@@ -371,6 +378,9 @@ class Pipeline(DBWorkflow):
     def change_module(self, old_id, m, *args):
         if not self.has_module_with_id(old_id):
             raise VistrailsInternalError("module %s doesn't exist" % old_id)
+        self.invalidate_signatures(old_id)
+        if old_id in self._module_signatures:
+            del self._module_signatures[old_id]
         self.db_change_object(old_id, m)
         self.graph.delete_vertex(old_id)
         self.graph.add_vertex(m.id)
@@ -410,6 +420,7 @@ class Pipeline(DBWorkflow):
             assert(c.sourceId != c.destinationId)        
             self.graph.add_edge(c.sourceId, c.destinationId, c.id)
             self.ensure_connection_specs([c.id])
+            self.invalidate_signatures(c.destinationId)
 
             source_name = c.source.name
             output_ports = self.modules[c.sourceId].connected_output_ports
@@ -433,6 +444,7 @@ class Pipeline(DBWorkflow):
 
         old_conn = self.connections[old_id]
         if old_conn.source is not None and old_conn.destination is not None:
+            self.invalidate_signatures(old_conn.destinationId)
             self.graph.delete_edge(old_conn.sourceId, old_conn.destinationId,
                                    old_conn.id)
             if self.graph.out_degree(old_conn.sourceId) < 1:
@@ -450,6 +462,7 @@ class Pipeline(DBWorkflow):
             assert(c.sourceId != c.destinationId)
             self.graph.add_edge(c.sourceId, c.destinationId, c.id)
             self.ensure_connection_specs([c.id])
+            self.invalidate_signatures(c.destinationId)
             self.modules[c.sourceId].connected_output_ports.add(c.source.name)
             self.modules[c.destinationId].connected_input_ports.add(
                 c.destination.name)
@@ -468,6 +481,7 @@ class Pipeline(DBWorkflow):
         if conn.source is not None and conn.destination is not None and \
                 (conn.destinationId, conn.id) in \
                 self.graph.edges_from(conn.sourceId):
+            self.invalidate_signatures(conn.destinationId)
             self.graph.delete_edge(conn.sourceId, conn.destinationId, conn.id)
 
             c = conn
@@ -483,6 +497,7 @@ class Pipeline(DBWorkflow):
             del self._connection_signatures[id]
         
     def add_parameter(self, param, parent_type, parent_id):
+        self.invalidate_object_signatures(parent_type, parent_id)
         self.db_add_object(param, parent_type, parent_id)
         if not self.has_alias(param.alias):
             self.change_alias(param.alias, 
@@ -493,12 +508,14 @@ class Pipeline(DBWorkflow):
                               None)
 
     def delete_parameter(self, param_id, param_type, parent_type, parent_id):
+        self.invalidate_object_signatures(parent_type, parent_id)
         self.db_delete_object(param_id, ModuleParam.vtType,
                               parent_type, parent_id)
         self.remove_alias(ModuleParam.vtType, param_id, parent_type, 
                           parent_id, None)
 
     def change_parameter(self, old_param_id, param, parent_type, parent_id):
+        self.invalidate_object_signatures(parent_type, parent_id)
         self.remove_alias(ModuleParam.vtType, old_param_id, 
                           parent_type, parent_id, None)
         self.db_change_object(old_param_id, param,
@@ -519,6 +536,7 @@ class Pipeline(DBWorkflow):
             self.graph.add_edge(connection.sourceId, 
                                 connection.destinationId, 
                                 connection.id)
+            self.invalidate_signatures(connection.destinationId)
             c = connection
             source_name = c.source.name
             output_ports = self.modules[c.sourceId].connected_output_ports
@@ -535,6 +553,7 @@ class Pipeline(DBWorkflow):
     def delete_port(self, port_id, port_type, parent_type, parent_id):
         conn = self.connections[parent_id]
         if len(conn.ports) >= 2:
+            self.invalidate_signatures(conn.destinationId)
             self.graph.delete_edge(conn.sourceId, 
                                    conn.destinationId, 
                                    conn.id)
@@ -552,6 +571,7 @@ class Pipeline(DBWorkflow):
     def change_port(self, old_port_id, port, parent_type, parent_id):
         connection = self.connections[parent_id]
         if len(connection.ports) >= 2:
+            self.invalidate_signatures(connection.destinationId)
             source_list = self.graph.adjacency_list[connection.sourceId]
             source_list.remove((connection.destinationId, connection.id))
             dest_list = \
@@ -679,6 +699,7 @@ class Pipeline(DBWorkflow):
                 # FIXME: check if a change parameter action needs to be generated
                 parameter = self.db_get_object(what, oId)
                 parameter.strValue = str(value)
+                self.invalidate_object_signatures(parentType, parentId)
             else:
                 raise VistrailsInternalError("only parameters are supported")
         
@@ -825,12 +846,108 @@ class Pipeline(DBWorkflow):
     def has_connection_signature(self, signature):
         return signature in self._connection_signatures.inverse
 
-    def refresh_signatures(self):
-        self._connection_signatures = {}
-        self._subpipeline_signatures = {}
-        self._module_signatures = {}
+    def refresh_signatures(self, full=False):
+        """refresh_signatures(full: bool) -> None
+        Recomputes the signatures that were invalidated since they were
+        last computed, and those of the modules whose signature depends
+        on outside state (see volatile_signature_modules()). With
+        full=True, every signature is recomputed."""
+        if full:
+            self._connection_signatures = Bidict()
+            self._subpipeline_signatures = Bidict()
+            self._module_signatures = Bidict()
+        else:
+            for module_id in self.volatile_signature_modules():
+                self.invalidate_signatures(module_id)
         self.compute_signatures()
 
+    def volatile_signature_modules(self):
+        """volatile_signature_modules() -> [int]
+        Returns the ids of the modules that have a cached signature
+        computed by a custom hasher, either a module hasher
+        (ModuleSettings.signature) or a constant hasher used by one of
+        their parameters (ModuleSettings.constant_signature). These can
+        depend on outside state, like the modification time of a file,
+        so they can't be reused from one execution to the next."""
+        registry = get_module_registry()
+        constant_hashers = registry._constant_hasher_map
+        result = []
+        for module_id in self._module_signatures.keys():
+            module = self.modules.get(module_id)
+            if module is None:
+                continue
+            try:
+                descriptor = registry.get_descriptor_by_name(
+                        module.package, module.name, module.namespace)
+            except ModuleRegistryException:
+                continue
+            if descriptor.hasher_callable() is not None:
+                result.append(module_id)
+            elif any((p.identifier, p.type, p.namespace) in constant_hashers
+                     for f in module.functions for p in f.params):
+                result.append(module_id)
+        return result
+
+    def invalidate_signatures(self, module_id):
+        """invalidate_signatures(module_id: int) -> None
+        Drops the cached signature of module_id, and the subpipeline and
+        connection signatures of every module downstream of it, so that
+        they get recomputed by the next compute_signatures()."""
+        if module_id in self._module_signatures:
+            del self._module_signatures[module_id]
+        # a subpipeline signature is only computed after the upstream
+        # ones, so modules downstream of a missing one are missing too
+        stack = [module_id]
+        while stack:
+            m_id = stack.pop()
+            if m_id not in self._subpipeline_signatures:
+                continue
+            del self._subpipeline_signatures[m_id]
+            for (_, conn_id) in self.graph.edges_to(m_id):
+                if conn_id in self._connection_signatures:
+                    del self._connection_signatures[conn_id]
+            for (dest_id, conn_id) in self.graph.edges_from(m_id):
+                if conn_id in self._connection_signatures:
+                    del self._connection_signatures[conn_id]
+                stack.append(dest_id)
+
+    def invalidate_object_signatures(self, obj_type, obj_id):
+        """invalidate_object_signatures(obj_type: str, obj_id: int) -> None
+        Invalidates the signatures of the module containing the given
+        object (a function, parameter, port spec...) or of the
+        destination of the given connection."""
+        if obj_type is None or obj_id is None:
+            return
+        if obj_type in (Module.vtType, Abstraction.vtType, Group.vtType):
+            if obj_id in self.modules:
+                self.invalidate_signatures(obj_id)
+            return
+        if obj_type == Connection.vtType:
+            if obj_id in self.connections:
+                conn = self.connections[obj_id]
+                if conn.source is not None and conn.destination is not None:
+                    self.invalidate_signatures(conn.destinationId)
+            return
+        key = (obj_type, obj_id)
+        if key not in self._signature_owners:
+            # objects never move between modules, so the index only
+            # needs rebuilding when it doesn't know about the object
+            self._signature_owners = {}
+            for module in self.module_list:
+                for (obj, _, _) in module.db_children():
+                    self._signature_owners[(obj.vtType, obj.db_id)] = \
+                        module.id
+        try:
+            module_id = self._signature_owners[key]
+        except KeyError:
+            # unknown owner, recompute everything to be safe
+            self._connection_signatures = Bidict()
+            self._subpipeline_signatures = Bidict()
+            self._module_signatures = Bidict()
+        else:
+            if module_id in self.modules:
+                self.invalidate_signatures(module_id)
+
     def compute_signatures(self):
         """compute_signatures(): compute all module and subpipeline signatures
         for this pipeline."""
@@ -1457,6 +1574,44 @@ class TestPipeline(unittest.TestCase):
         self.assertNotEquals(c_sig_size_before, c_sig_size_after)
         self.assertNotEquals(p_sig_size_before, p_sig_size_after)
 
+    def test_incremental_signatures(self):
+        """Makes sure only the changed module and its downstream cone
+        get new signatures."""
+        from vistrails.core.vistrail.operation import ChangeOp
+        id_scope = IdScope()
+        p = self.create_default_pipeline(id_scope)
+        p.build_index()
+        p.refresh_signatures(full=True)
+        sig_1 = p._subpipeline_signatures[1]
+        sig_2 = p._subpipeline_signatures[2]
+
+        old_function = p.modules[0].functions[0]
+        param = ModuleParam(type='Float', val='3.0')
+        new_function = ModuleFunction(
+            id=id_scope.getNewId(ModuleFunction.vtType),
+            name=old_function.name,
+            parameters=[param])
+        p.perform_operation(ChangeOp(id=-1,
+                                     what=ModuleFunction.vtType,
+                                     oldObjId=old_function.real_id,
+                                     newObjId=new_function.real_id,
+                                     parentObjId=0,
+                                     parentObjType=Module.vtType,
+                                     data=new_function))
+        self.assertNotIn(0, p._module_signatures)
+        self.assertNotIn(2, p._subpipeline_signatures)
+        self.assertIs(p._subpipeline_signatures[1], sig_1)
+        p.refresh_signatures()
+        incremental = (dict(p._module_signatures),
+                       dict(p._subpipeline_signatures),
+                       dict(p._connection_signatures))
+        self.assertNotEqual(incremental[1][2], sig_2)
+        p.refresh_signatures(full=True)
+        self.assertEqual(incremental,
+                         (dict(p._module_signatures),
+                          dict(p._subpipeline_signatures),
+                          dict(p._connection_signatures)))
+
     def test_delete_connections(self):
         p = self.create_default_pipeline()
         p.delete_connection(0)
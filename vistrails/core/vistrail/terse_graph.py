@@ -0,0 +1,348 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Incremental maintenance of the terse version tree.
+
+The terse version tree only shows the interesting versions of the full
+tree (root, tagged, current, latest, branches and leaves), without pruned
+versions and, optionally, without upgrades. It is computed by a walk from
+the root. TerseGraphBuilder remembers the state each version was reached
+with, so that after versions are added, tagged, pruned or upgraded only
+the walk down to those versions has to be redone.
+
+"""
+from __future__ import division
+
+from vistrails.core.data_structures.graph import Graph
+from vistrails.core.vistrail.vistrail import Vistrail
+
+
+class TerseGraphBuilder(object):
+    """Computes the terse version tree of a controller and updates it.
+
+    rebuild() computes the tree from scratch. update() takes the versions
+    that were added, tagged, pruned or upgraded since and only walks the
+    paths leading to them, plus the subtrees whose incoming state changed.
+    It returns False if the change cannot be applied incrementally (view
+    settings changed, an upgrade was removed), in which case the caller
+    should rebuild.
+
+    """
+    def __init__(self):
+        self.vistrail = None
+        self.settings = None
+        self.graph = None
+        self.upgrade_rev_map = {}
+
+    @staticmethod
+    def get_settings(controller, show_upgrades):
+        search = controller.search if controller.refine else None
+        return (show_upgrades, controller.full_tree, controller.refine,
+                search, controller.num_versions_always_shown)
+
+    def rebuild(self, controller, show_upgrades):
+        vistrail = controller.vistrail
+        self.vistrail = vistrail
+        self.settings = self.get_settings(controller, show_upgrades)
+        self.graph = Graph()
+        # version -> (terse parent, expandable, collapsible) it was reached
+        # with; version -> children the walk went into; version -> edge
+        # from its terse parent
+        self._visits = {}
+        self._children = {}
+        self._edges = {}
+
+        # upgrade -> upgraded version, and back
+        self._upgrade_parent = {}
+        self._upgrade_child = {}
+        # upgrade -> original version, transitively
+        self.upgrade_rev_map = {}
+        # original version -> set of versions upgraded from it, and itself
+        self._upgrade_members = {}
+        # version -> tag shown; tagged version -> where its tag is shown
+        self._tags = {}
+        self._tag_sources = {}
+
+        if not show_upgrades:
+            for ann in vistrail.action_annotations:
+                if ann.key != Vistrail.UPGRADE_ANNOTATION:
+                    continue
+                self._upgrade_parent[int(ann.value)] = ann.action_id
+                self._upgrade_child[ann.action_id] = int(ann.value)
+            for upgrade in self._upgrade_parent:
+                root = upgrade
+                while root in self._upgrade_parent:
+                    root = self._upgrade_parent[root]
+                self.upgrade_rev_map[upgrade] = root
+                self._upgrade_members.setdefault(root, set([root])).add(
+                        upgrade)
+        self._retag(vistrail.get_tagMap())
+
+        self.current = self.upgrade_rev_map.get(controller.current_version,
+                                                controller.current_version)
+        self.last_n = set(vistrail.getLastActions(
+                controller.num_versions_always_shown))
+        self._walk(controller, None)
+
+    def update(self, controller, versions, show_upgrades):
+        if (controller.vistrail is not self.vistrail or
+                self.get_settings(controller, show_upgrades) != self.settings):
+            return False
+        vistrail = self.vistrail
+        versions = set(versions)
+        changed = set(versions)
+
+        if not show_upgrades:
+            for version in versions:
+                ann = vistrail.get_action_annotation(
+                        version, Vistrail.UPGRADE_ANNOTATION)
+                upgrade = int(ann.value) if ann is not None else None
+                if upgrade == self._upgrade_child.get(version):
+                    continue
+                if (version in self._upgrade_child or
+                        upgrade in self._upgrade_parent):
+                    # An existing upgrade was changed or removed
+                    return False
+                self._upgrade_parent[upgrade] = version
+                self._upgrade_child[version] = upgrade
+                root = self.upgrade_rev_map.get(version, version)
+                members = self._upgrade_members.setdefault(root, set([root]))
+                for member in self._upgrade_members.pop(upgrade, (upgrade,)):
+                    self.upgrade_rev_map[member] = root
+                    members.add(member)
+                changed.add(upgrade)
+
+        # Tags can move along upgrade chains, recompute them for the
+        # affected chains
+        sources = set()
+        for version in changed:
+            root = self.upgrade_rev_map.get(version, version)
+            sources.update(self._upgrade_members.get(root, (root,)))
+        changed.update(self._retag(sources))
+
+        current = self.upgrade_rev_map.get(controller.current_version,
+                                           controller.current_version)
+        if current != self.current:
+            changed.update((current, self.current))
+            self.current = current
+        last_n = set(vistrail.getLastActions(
+                controller.num_versions_always_shown))
+        changed.update(last_n.symmetric_difference(self.last_n))
+        self.last_n = last_n
+
+        # The walk has to go through every ancestor of a changed version
+        am = vistrail.actionMap
+        dirty = set()
+        for version in changed:
+            while version not in dirty:
+                dirty.add(version)
+                if version not in am:
+                    break
+                version = am[version].parent
+        self._walk(controller, dirty)
+        return True
+
+    def _retag(self, sources):
+        """Recomputes where the tags of the given versions are shown.
+
+        Returns the versions whose shown tag might have changed.
+        """
+        vistrail = self.vistrail
+        changed = set()
+        for source in sources:
+            target = self._tag_sources.pop(source, None)
+            if target is not None:
+                self._tags.pop(target, None)
+                changed.add(target)
+        for source in sorted(sources):
+            tag = vistrail.get_tag(source)
+            if tag is None:
+                continue
+            # Show the tag on the original version, unless there is
+            # another tag in the upgrade chain
+            target = source
+            while target in self._upgrade_parent:
+                target = self._upgrade_parent[target]
+                if vistrail.has_tag(target):
+                    target = source
+                    break
+            self._tags[target] = tag
+            self._tag_sources[source] = target
+            changed.add(target)
+        return changed
+
+    def _walk(self, controller, dirty):
+        """Walks the full tree from the root, adding the versions to show.
+
+        If dirty is not None, versions not in dirty that are reached with
+        the same state as last time are skipped, along with their subtree.
+        """
+        vistrail = self.vistrail
+        show_upgrades, full_tree, refine, search, _ = self.settings
+        full = vistrail.tree.getVersionTree()
+        am = vistrail.actionMap
+        tm = self._tags
+        upgrades = self.upgrade_rev_map
+        last_n = self.last_n
+        current_version = self.current
+
+        open_list = [(0, None, False, False)]  # Elements to be handled
+        while open_list:
+            current, parent, expandable, collapsible = open_list.pop()
+            state = (parent, expandable, collapsible)
+            if (dirty is not None and current not in dirty and
+                    self._visits.get(current) == state):
+                continue
+            self._visits[current] = state
+
+            # mount children list
+            all_children = [
+                to for to, _ in full.adjacency_list[current]
+                if to in am]
+            children = []
+            while all_children:
+                child = all_children.pop()
+                # Pruned: drop it
+                if vistrail.is_pruned(child):
+                    pass
+                # An upgrade: get its children directly
+                # (unless it is tagged, and that tag couldn't be moved)
+                elif (not show_upgrades and
+                      (child in upgrades or
+                       am[child].description == 'Upgrade') and
+                      child not in tm):
+                    all_children.extend(
+                        to for to, _ in full.adjacency_list[child]
+                        if to in am)
+                else:
+                    children.append(child)
+            old_children = self._children.get(current)
+            if old_children:
+                for child in set(old_children).difference(children):
+                    self._forget(child)
+            self._children[current] = children
+
+            display = (full_tree or
+                       current == 0 or                 # is root
+                       current in tm or                # hasTag:
+                       current in last_n or            # show latest
+                       current == current_version or   # isCurrentVersion
+                       len(children) != 1)             # leaf or branch
+
+            shown = False
+            edge = None
+            if (display or am[current].expand):        # forced expansion
+
+                # yes it will!  this needs to be here because if we
+                # are refining version view receives the graph without
+                # the non matching elements
+                if (not refine or
+                        (refine and not search) or
+                        current == 0 or
+                        (refine and search and
+                         search.match(vistrail, am[current])) or
+                        current == current_version):
+                    shown = True
+
+                    # ...and the parent
+                    if parent is not None:
+                        collapse_here = not collapsible and not display
+                        edge = (parent, (expandable, collapse_here))
+                        collapsible = collapsible or collapse_here
+
+                    # update the parent info that will be used by the
+                    # children of this node
+                    parentToChildren = current
+                    expandable = False
+                else:
+                    parentToChildren = parent
+                    expandable = True
+            else:
+                parentToChildren = parent
+                expandable = True
+            self._place(current, shown, edge, tm.get(current))
+
+            if collapsible and len(children) > 1:
+                collapsible = False
+            for child in children:
+                open_list.append((child, parentToChildren,
+                                  expandable, collapsible))
+
+    def _place(self, version, shown, edge, tag):
+        """Makes the graph reflect whether a version is shown and its edge.
+        """
+        graph = self.graph
+        old_edge = self._edges.pop(version, None)
+        if not shown:
+            if version in graph.vertices:
+                graph.delete_vertex(version)
+            return
+        if version in graph.vertices:
+            graph.vertices[version] = tag
+        else:
+            graph.add_vertex(version, tag)
+        if edge != old_edge:
+            if (old_edge is not None and old_edge[0] in graph.vertices and
+                    graph.has_edge(old_edge[0], version)):
+                graph.delete_edge(old_edge[0], version, old_edge[1])
+            if edge is not None:
+                graph.add_edge(edge[0], version, edge[1])
+        if edge is not None:
+            self._edges[version] = edge
+
+    def _forget(self, version):
+        """Removes a version that is no longer reached, with its subtree.
+        """
+        graph = self.graph
+        open_list = [version]
+        while open_list:
+            version = open_list.pop()
+            self._visits.pop(version, None)
+            self._edges.pop(version, None)
+            open_list.extend(self._children.pop(version, ()))
+            if version in graph.vertices:
+                graph.delete_vertex(version)
+
+    def same_graph(self, other):
+        """Compares the terse trees of two builders, ignoring edge order.
+        """
+        def edges(graph):
+            return sorted((frm, to, data)
+                          for frm, lto in graph.adjacency_list.iteritems()
+                          for to, data in lto)
+        return (self.graph.vertices == other.graph.vertices and
+                edges(self.graph) == edges(other.graph) and
+                self.upgrade_rev_map == other.upgrade_rev_map)
@@ -40,12 +40,15 @@ from vistrails.core.paramexplore.paramexplore import ParameterExploration
 import copy
 import datetime
 import getpass
+import heapq
 
 from vistrails.db.domain import DBVistrail
 from vistrails.db.services.io import open_vt_log_from_db, open_log_from_xml
+from vistrails.db.services.workflow_cache import WorkflowCache
 from vistrails.core.db.locator import DBLocator
 from vistrails.core.log.log import Log
 from vistrails.core.data_structures.graph import Graph
+from vistrails.core.data_structures.tree_index import TreeIndex
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core import debug
 import vistrails.core.db.io
@@ -121,6 +124,9 @@ class Vistrail(DBVistrail):
             self.is_abstraction = other.is_abstraction
             self.locator = other.locator
 
+        # snapshots of materialized pipelines at checkpoint versions
+        self.workflow_cache = WorkflowCache()
+
         # object to keep explicit expanded 
         # version tree always updated
         self.tree = ExplicitExpandedVersionTree(self)
@@ -411,20 +417,7 @@ class Vistrail(DBVistrail):
         """
         if (v1<=0 or v2<=0):
             return 0
-        
-        t1 = set()
-        t1.add(v1)
-        t = self.actionMap[v1].parent
-        while  t != 0:
-            t1.add(t)
-            t = self.actionMap[t].parent
-        
-        t = v2
-        while t != 0:
-            if t in t1:
-                return t
-            t = self.actionMap[t].parent
-        return 0
+        return self.tree.index.common_ancestor(v1, v2)
     
     def getLastCommonVersion(self, v):
         """getLastCommonVersion(v: Vistrail) -> int
@@ -459,20 +452,8 @@ class Vistrail(DBVistrail):
         assert t >= start
         if t == start:
             return []
-        result = []
-        action = self.actionMap[t]
-        
-        while 1:
-            result.append(action)
-            if action.timestep == start:
-                break
-            if action.parent == start:
-                if start != 0:
-                    action = self.actionMap[action.parent]
-                break
-            action = self.actionMap[action.parent]
-        result.reverse()
-        return result
+        action_map = self.actionMap
+        return [action_map[v] for v in self.tree.index.path(t, start)]
     
     def update_object(self, obj, **kwargs):
         self.db_update_object(obj, **kwargs)
@@ -520,12 +501,9 @@ class Vistrail(DBVistrail):
         Returns the last n actions performed
         """
         last_n = []
-        num_actions = len(self.actionMap)
-        if num_actions < n:
-            n = num_actions
-        if n > 0:
-            sorted_keys = sorted(self.actionMap.keys())
-            last_n = sorted_keys[num_actions-n:num_actions-1]
+        if n > 1:
+            # the latest version itself is not included
+            last_n = sorted(heapq.nlargest(n, self.actionMap)[1:])
         return last_n
 
     def hasVersion(self, version):
@@ -1149,11 +1127,14 @@ class ExplicitExpandedVersionTree(object):
         self.expandedVersionTree = Graph()
         self.expandedVersionTree.add_vertex(0)
         self.tersedVersionTree = Graph()
+        # depths and ancestors, for path and common ancestor queries
+        self.index = TreeIndex(0)
 
     def addVersion(self, id, prevId):
         # print "add version %d child of %d" % (id, prevId)
         self.expandedVersionTree.add_vertex(id)
         self.expandedVersionTree.add_edge(prevId,id,0)
+        self.index.add(id, prevId)
     
     def getVersionTree(self):
         return self.expandedVersionTree
@@ -37,7 +37,8 @@ from __future__ import division, with_statement
 
 from vistrails.core import debug
 from vistrails.core.bundles import py_import
-from vistrails.core.system import get_elementtree_library, strftime
+from vistrails.core.system import get_elementtree_library, strftime, \
+    time_strptime
 from vistrails.core.utils import Chdir
 from vistrails.core.mashup.mashup_trail import Mashuptrail
 from vistrails.core.modules.sub_module import get_cur_abs_namespace,\
@@ -45,9 +46,12 @@ from vistrails.core.modules.sub_module import get_cur_abs_namespace,\
 
 import vistrails.core.requirements
 
+import binascii
 from datetime import datetime
 import os.path
+import re
 import shutil
+import sqlite3
 import tempfile
 import copy
 import warnings
@@ -56,9 +60,10 @@ import zipfile
 from vistrails.db import VistrailsDBException
 from vistrails.db.domain import DBVistrail, DBWorkflow, DBLog, DBAbstraction, DBGroup, \
     DBRegistry, DBWorkflowExec, DBOpmGraph, DBProvDocument, DBAnnotation, \
-    DBMashuptrail, DBStartup
+    DBMashuptrail, DBStartup, DBAction, DBActionAnnotation
 import vistrails.db.services.abstraction
 import vistrails.db.services.log
+from vistrails.db.services.log_index import INDEX_SUFFIX, LogIndex
 import vistrails.db.services.opm
 import vistrails.db.services.prov
 import vistrails.db.services.registry
@@ -74,8 +79,22 @@ ElementTree = get_elementtree_library()
 
 CONNECT_TIMEOUT = 15
 
+# directory of the .vt members written by incremental saves
+JOURNAL_DIR = 'journal'
+# suffix of the copy of the central directory of a .vt file that is kept
+# while members are appended to it
+ZIP_BACKUP_SUFFIX = '.append-backup'
+
 _db_lib = None
 def get_db_lib():
+    """get_db_lib() -> module
+
+    Returns the DB-API module used to connect to databases. This is
+    MySQLdb unless set_db_lib(sqlite3) was called, in which case the
+    'db' entry of connection configs is the path of a local repository
+    file.
+
+    """
     global _db_lib
     if _db_lib is None:
         MySQLdb = py_import('MySQLdb', {
@@ -83,13 +102,59 @@ def get_db_lib():
                 'linux-debian': 'python-mysqldb',
                 'linux-ubuntu': 'python-mysqldb',
                 'linux-fedora': 'MySQL-python'})
-        # import sqlite3
         _db_lib = MySQLdb
     return _db_lib
 def set_db_lib(lib):
     global _db_lib
     _db_lib = lib
 
+def is_sqlite_connection(db_connection):
+    return isinstance(db_connection, sqlite3.Connection)
+
+def db_error_args(e):
+    """db_error_args(e: Exception) -> (int, str)
+    Returns the (code, message) pair of a DB-API error. sqlite3 errors
+    carry no code.
+
+    """
+    if len(e.args) > 1:
+        return (e.args[0], e.args[1])
+    return (0, str(e))
+
+def _convert_sqlite_datetime(value):
+    return datetime(*time_strptime(value[:19], '%Y-%m-%d %H:%M:%S')[0:6])
+sqlite3.register_converter('datetime', _convert_sqlite_datetime)
+
+class SQLiteConnection(sqlite3.Connection):
+    """A sqlite3 connection offering the parts of the MySQLdb connection
+    interface used by the persistence layer.
+
+    """
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.text_factory = str
+
+    def begin(self):
+        # Like MySQL's BEGIN, this ends the current transaction; the next
+        # statement that writes opens a new one
+        self.commit()
+
+    def ping(self):
+        try:
+            self.execute("SELECT 1;")
+        except sqlite3.ProgrammingError, e:
+            # closed connection
+            raise sqlite3.OperationalError(*e.args)
+
+def _connect(config):
+    if get_db_lib() is sqlite3:
+        return sqlite3.connect(config['db'],
+                               timeout=config['connect_timeout'],
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               factory=SQLiteConnection)
+    # FIXME allow config to be kwargs and args?
+    return get_db_lib().connect(**config)
+
 
 class SaveBundle(object):
     """Transient bundle of objects to be saved or loaded.
@@ -192,13 +257,11 @@ def open_db_connection(config):
     if 'connect_timeout' not in config:
         config['connect_timeout'] = CONNECT_TIMEOUT
     try:
-        # FIXME allow config to be kwargs and args?
-        db_connection = get_db_lib().connect(**config)
-        #db_connection = get_db_lib().connect(config)
+        db_connection = _connect(config)
         return db_connection
     except get_db_lib().Error, e:
         # should have a DB exception type
-        msg = "cannot open connection (%d: %s)" % (e.args[0], e.args[1])
+        msg = "cannot open connection (%d: %s)" % db_error_args(e)
         raise VistrailsDBException(msg)
 
 def close_db_connection(db_connection):
@@ -214,10 +277,10 @@ def test_db_connection(config):
     if 'connect_timeout' not in config:
         config['connect_timeout'] = CONNECT_TIMEOUT
     try:
-        db_connection = get_db_lib().connect(**config)
+        db_connection = _connect(config)
         close_db_connection(db_connection)
     except get_db_lib().Error, e:
-        msg = "connection test failed (%d: %s)" % (e.args[0], e.args[1])
+        msg = "connection test failed (%d: %s)" % db_error_args(e)
         raise VistrailsDBException(msg)
     except TypeError, e:
         msg = "connection test failed (%s)" %str(e)
@@ -291,7 +354,7 @@ def get_db_object_list(config, obj_type):
         
     except get_db_lib().Error, e:
         msg = "Couldn't get list of vistrails objects from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+            db_error_args(e)
         raise VistrailsDBException(msg)
     return result
 
@@ -311,7 +374,7 @@ def get_db_object_modification_time(db_connection, obj_id, obj_type):
         c.close()
     except get_db_lib().Error, e:
         msg = "Couldn't get object modification time from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+            db_error_args(e)
         raise VistrailsDBException(msg)
     return time
 
@@ -330,7 +393,7 @@ def get_db_object_version(db_connection, obj_id, obj_type):
         c.close()
     except get_db_lib().Error, e:
         msg = "Couldn't get object version from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+            db_error_args(e)
         raise VistrailsDBException(msg)
     return version
 
@@ -408,7 +471,7 @@ def get_db_abstraction_modification_time(db_connection, abstraction):
         c.close()
     except get_db_lib().Error, e:
         msg = "Couldn't get modification time from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+            db_error_args(e)
         raise VistrailsDBException(msg)
     return modtime
 
@@ -445,7 +508,7 @@ def get_db_ids_from_vistrail(db_connection, vt_id, id_key):
         c.close()
     except get_db_lib().Error, e:
         msg = "Couldn't get object ids from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+            db_error_args(e)
         raise VistrailsDBException(msg)
     return [i[0] for i in abs_ids]
 
@@ -482,7 +545,7 @@ def get_matching_abstraction_id(db_connection, abstraction):
             id = result[0][0]
     except get_db_lib().Error, e:
         msg = "Couldn't get object modification time from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+            db_error_args(e)
         raise VistrailsDBException(msg)
     return id
 
@@ -491,19 +554,17 @@ def setup_db_tables(db_connection, version=None, old_version=None):
         version = currentVersion
     if old_version is None:
         old_version = version
+    sqlite = is_sqlite_connection(db_connection)
     try:
         def execute_file(c, f):
             cmd = ""
-#             auto_inc_str = 'auto_increment'
-#             not_null_str = 'not null'
-#             engine_str = 'engine=InnoDB;'
+            auto_inc_str = 'int not null auto_increment primary key'
+            engine_str = ' engine=InnoDB;'
+            drop_str = 'DROP TABLE IF EXISTS '
             for line in f:
-#                 if line.find(auto_inc_str) > 0:
-#                     num = line.find(auto_inc_str)
-#                     line = line[:num] + line[num+len(auto_inc_str):]
-#                 if line.find(not_null_str) > 0:
-#                     num = line.find(not_null_str)
-#                     line = line[:num] + line[num+len(not_null_str):]
+                if sqlite:
+                    line = line.replace(auto_inc_str,
+                                        'integer primary key autoincrement')
                 line = line.strip()
                 if cmd or not line.startswith('--'):
                     cmd += line
@@ -511,12 +572,16 @@ def setup_db_tables(db_connection, version=None, old_version=None):
                 else:
                     ending = None
                 if ending and ending[-1] == ';':
-                    # FIXME engine stuff switch for MySQLdb, sqlite3
                     cmd = cmd.rstrip()
-#                     if cmd.endswith(engine_str):
-#                         cmd = cmd[:-len(engine_str)] + ';'
-                    #print cmd
-                    c.execute(cmd)
+                    if sqlite and cmd.endswith(engine_str):
+                        cmd = cmd[:-len(engine_str)] + ';'
+                    if sqlite and cmd.startswith(drop_str):
+                        # sqlite drops one table per statement
+                        for tbl in cmd[len(drop_str):-1].split(','):
+                            c.execute('%s%s;' % (drop_str, tbl.strip()))
+                    else:
+                        #print cmd
+                        c.execute(cmd)
                     cmd = ""
 
         # delete tables
@@ -581,10 +646,12 @@ def open_bundle_from_zip_xml(bundle_type, filename):
         raise VistrailsDBException("cannot open bundle of type '%s' from zip" %\
                                        bundle_type)
 
-def save_bundle_to_zip_xml(save_bundle, filename, tmp_dir=None, version=None):
+def save_bundle_to_zip_xml(save_bundle, filename, tmp_dir=None, version=None,
+                           incremental=False):
     bundle_type = save_bundle.bundle_type
     if bundle_type == DBVistrail.vtType:
-        return save_vistrail_bundle_to_zip_xml(save_bundle, filename, tmp_dir, version)
+        return save_vistrail_bundle_to_zip_xml(save_bundle, filename, tmp_dir,
+                                               version, incremental)
     elif bundle_type == DBLog.vtType:
         return save_log_bundle_to_xml(save_bundle, filename, version)
     elif bundle_type == DBWorkflow.vtType:
@@ -684,11 +751,10 @@ def unserialize(str, obj_type):
 
 def open_vistrail_from_xml(filename):
     """open_vistrail_from_xml(filename) -> Vistrail"""
-    tree = ElementTree.parse(filename)
-    version = get_version_for_xml(tree.getroot())
+    version = get_version_for_xml_file(filename)
     try:
         daoList = getVersionDAO(version)
-        vistrail = daoList.open_from_xml(filename, DBVistrail.vtType, tree)
+        vistrail = daoList.open_from_xml(filename, DBVistrail.vtType)
         if vistrail is None:
             raise VistrailsDBException("Couldn't read vistrail from XML")
         vistrail = translate_vistrail(vistrail, version)
@@ -711,6 +777,7 @@ def open_vistrail_bundle_from_zip_xml(filename):
     and thumbnails inside archive are '.png' files in 'thumbs' dir
 
     """
+    recover_zip_xml(filename)
     vt_save_dir = tempfile.mkdtemp(prefix='vt_save')
 
     z = zipfile.ZipFile(filename)
@@ -726,11 +793,18 @@ def open_vistrail_bundle_from_zip_xml(filename):
     unknown_files = []
     thumbnail_files = []
     mashups = []
+    journal_files = []
+    journal_dir = os.path.join(vt_save_dir, JOURNAL_DIR)
     try:
         for root, dirs, files in os.walk(vt_save_dir):
             for fname in files:
-                if fname == 'vistrail' and root == vt_save_dir:
+                if root == journal_dir:
+                    journal_files.append(fname)
+                elif fname == 'vistrail' and root == vt_save_dir:
                     vistrail = open_vistrail_from_xml(os.path.join(root, fname))
+                elif fname == 'log' + INDEX_SUFFIX and root == vt_save_dir:
+                    # index of the log, rebuilt when needed
+                    pass
                 elif fname == 'log' and root == vt_save_dir:
                     # FIXME read log to get execution info
                     # right now, just ignore the file
@@ -766,7 +840,14 @@ def open_vistrail_bundle_from_zip_xml(filename):
                                        unknown_files)
     if vistrail is None:
         raise VistrailsDBException("vt file does not contain vistrail")
+    if journal_files:
+        log_fname = apply_zip_xml_journal(vistrail, vt_save_dir,
+                                          sorted(journal_files))
     vistrail.db_log_filename = log_fname
+    # objects read from the file are flagged as changed (e.g. by the
+    # translation from an older version); they match the file, so clear
+    # that for the next save to be incremental
+    vistrail.db_commit_journal()
 
     # call package hooks
     from vistrails.core.packagemanager import get_package_manager
@@ -779,6 +860,39 @@ def open_vistrail_bundle_from_zip_xml(filename):
                              thumbnails=thumbnail_files, mashups=mashups)
     return (save_bundle, vt_save_dir)
 
+def apply_zip_xml_journal(vistrail, vt_save_dir, journal_files):
+    """apply_zip_xml_journal(vistrail: DBVistrail, vt_save_dir: str,
+                             journal_files: list) -> str
+
+    Adds the actions and annotations of the journal members written by
+    incremental saves to vistrail and appends their log entries to the
+    log, in the order they were saved. The journal directory is removed
+    afterwards so that the next full save writes the regular layout.
+    Returns the filename of the log, or None if there is none.
+
+    """
+    journal_dir = os.path.join(vt_save_dir, JOURNAL_DIR)
+    log_fname = os.path.join(vt_save_dir, 'log')
+    for fname in journal_files:
+        journal_fname = os.path.join(journal_dir, fname)
+        if fname.endswith('.log'):
+            with open(log_fname, 'ab') as log_file:
+                with open(journal_fname, 'rb') as journal_file:
+                    shutil.copyfileobj(journal_file, log_file)
+        else:
+            journal = open_vistrail_from_xml(journal_fname)
+            for action in journal.db_actions:
+                vistrail.db_add_action(action)
+            for annotation in journal.db_annotations:
+                vistrail.db_add_annotation(annotation)
+            for annotation in journal.db_actionAnnotations:
+                vistrail.db_add_actionAnnotation(annotation)
+    shutil.rmtree(journal_dir)
+    vistrails.db.services.vistrail.update_id_scope(vistrail)
+    if os.path.exists(log_fname):
+        return log_fname
+    return None
+
 def open_vistrail_bundle_from_db(db_connection, vistrail_id, tmp_dir=None):
     """open_vistrail_bundle_from_db(db_connection, id: long, tmp_dir: str) -> SaveBundle
        Open a vistrail bundle from the database.
@@ -834,6 +948,34 @@ def open_vistrail_from_db(db_connection, id, lock=False, version=None):
     for db_action in vistrail.db_get_actions():
         db_action.db_operations.sort(key=lambda x: x.db_id)
     vistrails.db.services.vistrail.update_id_scope(vistrail)
+    vistrail.db_reset_journal()
+    return vistrail
+
+def open_vistrail_version_from_db(db_connection, id, action_id, lock=False,
+                                  version=None):
+    """open_vistrail_version_from_db(db_connection, id: long,
+                                     action_id: long, lock: bool,
+                                     version: str) -> DBVistrail
+
+    Reads only the actions from the root to action_id, which is enough
+    to materialize that version's workflow. The other actions are not
+    loaded, so the result cannot be saved back.
+
+    """
+    if db_connection is None:
+        msg = "Need to call open_db_connection() before reading"
+        raise VistrailsDBException(msg)
+    if version is None:
+        version = get_db_object_version(db_connection, id, DBVistrail.vtType)
+    dao_list = getVersionDAO(version)
+    if not hasattr(dao_list, 'open_vistrail_version_from_db'):
+        return open_vistrail_from_db(db_connection, id, lock, version)
+    vistrail = dao_list.open_vistrail_version_from_db(db_connection, id,
+                                                      action_id, lock)
+    vistrail = translate_vistrail(vistrail, version)
+    for db_action in vistrail.db_get_actions():
+        db_action.db_operations.sort(key=lambda x: x.db_id)
+    vistrails.db.services.vistrail.update_id_scope(vistrail)
     return vistrail
 
 def save_vistrail_to_xml(vistrail, filename, version=None):
@@ -859,14 +1001,18 @@ def save_vistrail_to_xml(vistrail, filename, version=None):
     vistrail.db_currentVersion = current_action
     return vistrail
 
-def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, version=None):
+def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None,
+                                    version=None, incremental=False):
     """save_vistrail_bundle_to_zip_xml(save_bundle: SaveBundle, filename: str,
-                                vt_save_dir: str, version: str)
+                                vt_save_dir: str, version: str,
+                                incremental: bool)
          -> (save_bundle: SaveBundle, vt_save_dir: str)
 
     save_bundle: a SaveBundle object containing vistrail data to save
     filename: filename to save to
     vt_save_dir: directory storing any previous files
+    incremental: append the changes to filename if possible, see
+                 append_vistrail_bundle_to_zip_xml()
 
     Generates a zip compressed version of vistrail.
     It raises an Exception if there was an error.
@@ -886,7 +1032,8 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
     
     # Save Vistrail
     xml_fname = os.path.join(vt_save_dir, 'vistrail')
-    save_vistrail_to_xml(save_bundle.vistrail, xml_fname, version)
+    if not incremental:
+        save_vistrail_to_xml(save_bundle.vistrail, xml_fname, version)
 
     # Save Log
     if save_bundle.vistrail.db_log_filename is not None:
@@ -974,34 +1121,231 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
             package.saveVistrailFileHook(save_bundle.vistrail, vt_save_dir)
     except Exception, e:
         debug.warning("Could not call package hooks", str(e))
-    tmp_zip_dir = tempfile.mkdtemp(prefix='vt_zip')
-    tmp_zip_file = os.path.join(tmp_zip_dir, "vt.zip")
 
+    if incremental and not append_vistrail_bundle_to_zip_xml(
+            save_bundle, filename, vt_save_dir, version):
+        # not everything can be appended, rewrite the whole file
+        save_vistrail_to_xml(save_bundle.vistrail,
+                             os.path.join(vt_save_dir, 'vistrail'), version)
+        incremental = False
+    if not incremental:
+        tmp_zip_dir = tempfile.mkdtemp(prefix='vt_zip')
+        tmp_zip_file = os.path.join(tmp_zip_dir, "vt.zip")
+
+        z = zipfile.ZipFile(tmp_zip_file, 'w', get_zip_compression(filename))
+        try:
+            with Chdir(vt_save_dir):
+                # zip current directory
+                for root, dirs, files in os.walk('.'):
+                    for f in files:
+                        if root == '.' and f == 'log' + INDEX_SUFFIX:
+                            # the log index is not part of the format
+                            continue
+                        z.write(os.path.join(root, f))
+            z.close()
+            shutil.copyfile(tmp_zip_file, filename)
+            # a backup left by an interrupted append doesn't apply anymore
+            if os.path.exists(filename + ZIP_BACKUP_SUFFIX):
+                os.unlink(filename + ZIP_BACKUP_SUFFIX)
+        finally:
+            os.unlink(tmp_zip_file)
+            os.rmdir(tmp_zip_dir)
+    save_bundle.vistrail.db_commit_journal()
+    save_bundle = SaveBundle(save_bundle.bundle_type, save_bundle.vistrail,
+                             save_bundle.log, thumbnails=saved_thumbnails,
+                             abstractions=saved_abstractions,
+                             mashups=saved_mashups)
+    return (save_bundle, vt_save_dir)
+
+def _sync_file(filename):
+    with open(filename, 'rb') as f:
+        os.fsync(f.fileno())
+
+def recover_zip_xml(filename):
+    """recover_zip_xml(filename: str) -> bool
+
+    Restores a vt file to its state before an incremental save that
+    didn't complete, using the central directory saved next to it by
+    append_vistrail_bundle_to_zip_xml(). The members written before the
+    central directory are never modified by an append, so putting it
+    back gives the file as it was. Returns whether a backup was found.
+
+    """
+    backup_fname = filename + ZIP_BACKUP_SUFFIX
+    if not os.path.isfile(backup_fname):
+        return False
+    with open(backup_fname, 'rb') as f:
+        offset = int(f.readline())
+        directory = f.read()
+    debug.warning("Restoring %s after an interrupted save" % filename)
+    with open(filename, 'r+b') as f:
+        f.seek(offset)
+        f.write(directory)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+    os.unlink(backup_fname)
+    return True
+
+def get_zip_compression(filename):
     try:
         import zlib
     except ImportError:
         warnings.warn("zlib unavailable, cannot compress %s" % filename,
                       UserWarning)
-        compression = zipfile.ZIP_STORED
+        return zipfile.ZIP_STORED
     else:
-        compression = zipfile.ZIP_DEFLATED
-    z = zipfile.ZipFile(tmp_zip_file, 'w', compression)
+        return zipfile.ZIP_DEFLATED
+
+def append_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir,
+                                      version=None):
+    """append_vistrail_bundle_to_zip_xml(save_bundle: SaveBundle,
+                                         filename: str, vt_save_dir: str,
+                                         version: str) -> bool
+
+    Appends what changed since filename was last saved from vt_save_dir
+    as new members, without rewriting the existing ones: the journaled
+    actions and annotations go to a partial vistrail in the journal
+    directory, along with the new log entries, and new files such as
+    thumbnails are added as is. open_vistrail_bundle_from_zip_xml()
+    replays the journal and the next full save folds it back in.
+
+    Returns False without writing anything when the changes are not
+    all additions, in which case the file needs a full save.
+
+    """
+    vistrail = save_bundle.vistrail
+    xml_fname = os.path.join(vt_save_dir, 'vistrail')
+    log_fname = os.path.join(vt_save_dir, 'log')
+    if (version not in (None, currentVersion) or
+            not vistrail.db_journal_is_complete() or
+            vistrail.db_log_filename not in (None, log_fname) or
+            not os.path.isfile(xml_fname)):
+        return False
+    try:
+        z = zipfile.ZipFile(filename)
+        try:
+            members = dict((info.filename, info) for info in z.infolist())
+            start_dir = z.start_dir
+        finally:
+            z.close()
+    except (IOError, zipfile.BadZipfile):
+        return False
+    vt_member = members.pop('vistrail', None)
+    if (vt_member is None or
+            vt_member.file_size != os.path.getsize(xml_fname)):
+        # not the file vt_save_dir was extracted from
+        return False
+
+    # the log in vt_save_dir is the concatenation of its members
+    seq = 0
+    log_size = 0
+    if 'log' in members:
+        log_size += members.pop('log').file_size
+    for name in sorted(members):
+        if name.startswith(JOURNAL_DIR + '/'):
+            info = members.pop(name)
+            if name.endswith('.log'):
+                log_size += info.file_size
+                name = name[:-len('.log')]
+            seq = max(seq, int(name[len(JOURNAL_DIR) + 1:]))
+    log_tail = ''
+    if os.path.isfile(log_fname):
+        if os.path.getsize(log_fname) < log_size:
+            return False
+        with open(log_fname, 'rb') as log_file:
+            log_file.seek(log_size)
+            log_tail = log_file.read()
+    elif log_size:
+        return False
+
+    new_files = []
+    for root, dirs, files in os.walk(vt_save_dir):
+        for fname in files:
+            path = os.path.join(root, fname)
+            name = os.path.relpath(path, vt_save_dir).replace(os.sep, '/')
+            if name in ('vistrail', 'log', 'log' + INDEX_SUFFIX):
+                continue
+            info = members.pop(name, None)
+            if info is None:
+                new_files.append((path, name))
+                continue
+            with open(path, 'rb') as f:
+                crc = binascii.crc32(f.read()) & 0xffffffff
+            if info.file_size != os.path.getsize(path) or info.CRC != crc:
+                return False
+    if members:
+        # some files were removed
+        return False
+
+    journal = vistrail.db_get_journal()
+    if not journal and not log_tail and not new_files:
+        return True
+    seq += 1
+    # The new members overwrite the central directory, which is written
+    # again after them: keep a copy until that is done, so that
+    # recover_zip_xml() can undo an append that gets interrupted
+    with open(filename, 'rb') as f:
+        f.seek(start_dir)
+        directory = f.read()
+    backup_fname = filename + ZIP_BACKUP_SUFFIX
+    with open(backup_fname + '.tmp', 'wb') as f:
+        f.write('%d\n' % start_dir)
+        f.write(directory)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(backup_fname + '.tmp', backup_fname)
     try:
-        with Chdir(vt_save_dir):
-            # zip current directory
-            for root, dirs, files in os.walk('.'):
-                for f in files:
-                    z.write(os.path.join(root, f))
+        _append_zip_xml_members(vistrail, filename, journal, log_tail,
+                                new_files, seq)
+        _sync_file(filename)
+    except Exception:
+        recover_zip_xml(filename)
+        raise
+    os.unlink(backup_fname)
+    return True
+
+def _append_zip_xml_members(vistrail, filename, journal, log_tail, new_files,
+                            seq):
+    z = zipfile.ZipFile(filename, 'a', get_zip_compression(filename))
+    try:
+        if journal:
+            partial = DBVistrail(id=vistrail.db_id, name=vistrail.db_name,
+                                 version=currentVersion)
+            for obj in journal:
+                if obj.vtType == DBAction.vtType:
+                    partial.db_add_action(obj)
+                elif obj.vtType == DBAnnotation.vtType:
+                    partial.db_add_annotation(obj)
+                elif obj.vtType == DBActionAnnotation.vtType:
+                    partial.db_add_actionAnnotation(obj)
+            (fd, partial_fname) = tempfile.mkstemp(prefix='vt_journal')
+            os.close(fd)
+            try:
+                save_vistrail_to_xml(partial, partial_fname)
+                z.write(partial_fname, '%s/%06d' % (JOURNAL_DIR, seq))
+            finally:
+                os.unlink(partial_fname)
+        if log_tail:
+            z.writestr('%s/%06d.log' % (JOURNAL_DIR, seq), log_tail,
+                       z.compression)
+        for path, name in new_files:
+            z.write(path, name)
+    finally:
         z.close()
-        shutil.copyfile(tmp_zip_file, filename)
+
+def compact_zip_xml(filename):
+    """compact_zip_xml(filename: str) -> None
+
+    Rewrites a vt file that was saved incrementally in the regular
+    layout, folding its journal into the vistrail and the log.
+
+    """
+    (save_bundle, vt_save_dir) = open_vistrail_bundle_from_zip_xml(filename)
+    try:
+        save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir)
     finally:
-        os.unlink(tmp_zip_file)
-        os.rmdir(tmp_zip_dir)
-    save_bundle = SaveBundle(save_bundle.bundle_type, save_bundle.vistrail,
-                             save_bundle.log, thumbnails=saved_thumbnails,
-                             abstractions=saved_abstractions,
-                             mashups=saved_mashups)
-    return (save_bundle, vt_save_dir)
+        close_zip_xml(vt_save_dir)
 
 def save_vistrail_bundle_to_db(save_bundle, db_connection, do_copy=False, version=None):
     if save_bundle.vistrail is None:
@@ -1065,6 +1409,9 @@ def save_vistrail_to_db(vistrail, db_connection, do_copy=False, version=None):
                 vistrails.db.services.vistrail.synchronize(old_vistrail, vistrail, 
                                                  current_action)
             vistrail = old_vistrail
+            # synchronize() also changes actions that were already
+            # written, write every dirty object
+            vistrail.db_journal = None
     vistrail.db_last_modified = get_current_time(db_connection)
 
     vistrail = translate_vistrail(vistrail, vistrail.db_version, version)
@@ -1097,6 +1444,7 @@ def save_vistrail_to_db(vistrail, db_connection, do_copy=False, version=None):
     if wfToSave:
         dao_list.save_many_to_db(db_connection, wfToSave, True)
     db_connection.commit()
+    vistrail.db_reset_journal()
     return vistrail
 
 ##############################################################################
@@ -1187,7 +1535,9 @@ def get_saved_workflows(vistrail, db_connection):
     if not vistrail.db_id:
         return []
     c = db_connection.cursor()
-    c.execute("SELECT parent_id FROM workflow WHERE vistrail_id=%s;", (vistrail.db_id,))
+    c.execute(format_prepared_statement(
+            "SELECT parent_id FROM workflow WHERE vistrail_id=?;"),
+              (vistrail.db_id,))
     ids = [i[0] for i in c.fetchall()]
     c.close()
     return ids
@@ -1198,27 +1548,9 @@ def get_saved_workflows(vistrail, db_connection):
 def open_log_from_xml(filename, was_appended=False):
     """open_log_from_xml(filename) -> DBLog"""
     if was_appended:
-        parser = ElementTree.XMLTreeBuilder()
-        parser.feed("<log>\n")
-        f = open(filename, "rb")
-        parser.feed(f.read())
-        parser.feed("</log>\n")
-        root = parser.close()
-        workflow_execs = []
-        for node in root:
-            version = get_version_for_xml(node)
-            daoList = getVersionDAO(version)
-            workflow_exec = \
-                daoList.read_xml_object(DBWorkflowExec.vtType, node)
-            if version != currentVersion:
-                # if version is wrong, dump this into a dummy log object, 
-                # then translate, then get workflow_exec back
-                log = DBLog()
-                translate_log(log, currentVersion, version)
-                log.db_add_workflow_exec(workflow_exec)
-                log = translate_log(log, version)
-                workflow_exec = log.db_workflow_execs[0]
-            workflow_execs.append(workflow_exec)
+        with open_log_index(filename) as index:
+            workflow_execs = [workflow_exec for entry, workflow_exec
+                              in iter_appended_workflow_execs(index)]
         log = DBLog(workflow_execs=workflow_execs)
         vistrails.db.services.log.update_ids(log)
     else:
@@ -1230,6 +1562,43 @@ def open_log_from_xml(filename, was_appended=False):
         vistrails.db.services.log.update_id_scope(log)
     return log
 
+def open_log_index(filename):
+    """open_log_index(filename) -> LogIndex
+
+    Opens the index of an appended log file, creating or updating it as
+    needed. Use find() and count() on the result to select workflow
+    executions and iter_appended_workflow_execs() to read them.
+
+    """
+    return LogIndex(filename)
+
+def iter_appended_workflow_execs(index, entries=None):
+    """iter_appended_workflow_execs(index: LogIndex, entries: list)
+         -> iter((LogIndexEntry, DBWorkflowExec))
+
+    Reads the given entries (all of them by default) from an appended log
+    file, one workflow execution at a time. The executions get the ids they
+    would have if the whole log were loaded.
+
+    """
+    if entries is None:
+        entries = index.find()
+    for entry, node in index.iter_xml(entries):
+        version = get_version_for_xml(node)
+        daoList = getVersionDAO(version)
+        workflow_exec = \
+            daoList.read_xml_object(DBWorkflowExec.vtType, node)
+        if version != currentVersion:
+            # if version is wrong, dump this into a dummy log object, 
+            # then translate, then get workflow_exec back
+            log = DBLog()
+            translate_log(log, currentVersion, version)
+            log.db_add_workflow_exec(workflow_exec)
+            log = translate_log(log, version)
+            workflow_exec = log.db_workflow_execs[0]
+        workflow_exec.db_id = entry.id
+        yield entry, workflow_exec
+
 def open_log_from_db(db_connection, id, lock=False, version=None):
     """open_log_from_db(db_connection, id : long: lock: bool, version: str) 
          -> DBLog 
@@ -1254,12 +1623,12 @@ def open_vt_log_from_db(db_connection, vt_id, version=None):
     if db_connection is not None:
         try:
             c = db_connection.cursor()
-            # FIXME MySQL versus sqlite3
-            res = c.execute("SELECT id FROM log_tbl WHERE vistrail_id=%s;", (vt_id,))
+            res = c.execute(format_prepared_statement(
+                    "SELECT id FROM log_tbl WHERE vistrail_id=?;"), (vt_id,))
             ids = [i[0] for i in c.fetchall()]
             c.close()
         except get_db_lib().Error, e:
-            debug.critical("Error getting log id:s %d: %s" % (e.args[0], e.args[1]))
+            debug.critical("Error getting log id:s %d: %s" % db_error_args(e))
     log = DBLog()
     if hasattr(dao_list, 'open_many_from_db'): # does not exist pre 1.0.2
         logs = dao_list.open_many_from_db(db_connection, DBLog.vtType, ids)
@@ -1337,12 +1706,80 @@ def save_log_bundle_to_db(save_bundle, db_connection, do_copy=False,
     return SaveBundle(DBLog.vtType, log=log)
 
 def merge_logs(new_log, vt_log_fname):
+    """merge_logs(new_log: DBLog, vt_log_fname: str) -> DBLog
+
+    Loads the whole appended log and adds the executions of new_log to it.
+    Use save_merged_log_to_xml() when the result only needs to be written
+    to a file.
+
+    """
     log = open_log_from_xml(vt_log_fname, True)
     for workflow_exec in new_log.db_workflow_execs:
         workflow_exec.db_id = log.id_scope.getNewId(DBWorkflowExec.vtType)
         log.db_add_workflow_exec(workflow_exec)
     return log
 
+_start_tag_id_re = re.compile(r'(<workflowExec\b[^>]*?\sid=")[^"]*(")')
+
+def save_merged_log_to_xml(new_log, vt_log_fname, filename, version=None):
+    """save_merged_log_to_xml(new_log: DBLog, vt_log_fname: str,
+                              filename: str, version: str) -> None
+
+    Writes the same file as saving merge_logs(new_log, vt_log_fname), but
+    copies the workflowExec elements of the appended log as they are,
+    using the ranges recorded in its LogIndex; only the elements stored
+    with another schema version are parsed and translated.
+
+    """
+    if version is None:
+        version = currentVersion
+    if not new_log.db_version:
+        new_log.db_version = currentVersion
+    daoList = getVersionDAO(version)
+
+    def write_workflow_exec(log_file, workflow_exec, wf_exec_id):
+        old_id = workflow_exec.db_id
+        workflow_exec.db_id = wf_exec_id
+        try:
+            node = daoList.write_xml_object(workflow_exec)
+        finally:
+            workflow_exec.db_id = old_id
+        log_file.write('  %s\n' % ElementTree.tostring(node).strip())
+
+    # same root element as save_log_to_xml() writes
+    header = ('<%s version="%s" '
+              'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+              'xsi:schemaLocation="http://www.vistrails.org/log.xsd">\n' %
+              (DBLog.vtType, version))
+    next_id = 1
+    log_file = open(filename, 'wb')
+    try:
+        log_file.write(header)
+        with open_log_index(vt_log_fname) as index:
+            with open(vt_log_fname, 'rb') as vt_log_file:
+                for entry in index.find():
+                    next_id = max(next_id, entry.id + 1)
+                    if entry.version == version:
+                        vt_log_file.seek(entry.offset)
+                        xml = vt_log_file.read(entry.length)
+                        xml = _start_tag_id_re.sub(
+                                r'\g<1>%d\2' % entry.id, xml, 1)
+                        log_file.write('  %s\n' % xml.strip())
+                    else:
+                        (_, workflow_exec), = \
+                            iter_appended_workflow_execs(index, [entry])
+                        log = DBLog(workflow_execs=[workflow_exec])
+                        log = translate_log(log, currentVersion, version)
+                        write_workflow_exec(log_file, log.db_workflow_execs[0],
+                                            entry.id)
+        new_log = translate_log(new_log, new_log.db_version, version)
+        for workflow_exec in new_log.db_workflow_execs:
+            write_workflow_exec(log_file, workflow_exec, next_id)
+            next_id += 1
+        log_file.write('</%s>\n' % DBLog.vtType)
+    finally:
+        log_file.close()
+
 ##############################################################################
 # OPM I/O
 
@@ -1543,7 +1980,7 @@ def open_thumbnails_from_db(db_connection, obj_type, obj_id, tmp_dir=None):
         c.close()
     except get_db_lib().Error, e:
         msg = "Couldn't get thumbnails list from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+            db_error_args(e)
         raise VistrailsDBException(msg)
     # Next get all thumbnails from the db that aren't already in tmp_dir
     get_db_file_names = [fname for fname in file_names if fname not in os.listdir(tmp_dir)]
@@ -1561,7 +1998,7 @@ def open_thumbnails_from_db(db_connection, obj_type, obj_id, tmp_dir=None):
             c.close()
         except get_db_lib().Error, e:
             msg = "Couldn't get thumbnail from db (%d : %s)" % \
-                (e.args[0], e.args[1])
+                db_error_args(e)
             raise VistrailsDBException(msg)
         if row is not None:
             image_bytes = row[0]
@@ -1607,7 +2044,7 @@ def save_thumbnails_to_db(absfnames, db_connection):
         c.close()
     except get_db_lib().Error, e:
         msg = "Couldn't check which thumbnails already exist in db (%d : %s)" % \
-            (e.args[0], e.args[1])
+            db_error_args(e)
         raise VistrailsDBException(msg)
     insert_absfnames = [absfname for absfname in absfnames if os.path.basename(absfname) not in db_file_names]
 
@@ -1631,7 +2068,7 @@ def save_thumbnails_to_db(absfnames, db_connection):
         raise VistrailsDBException(msg)
     except get_db_lib().Error, e:
         msg = "Couldn't insert thumbnail into db (%d : %s)" % \
-            (e.args[0], e.args[1])
+            db_error_args(e)
         raise VistrailsDBException(msg)
     return None
 ##############################################################################
@@ -1786,6 +2223,20 @@ def get_version_for_xml(root):
     msg = "Cannot find version information"
     raise VistrailsDBException(msg)
 
+def get_version_for_xml_file(filename):
+    """get_version_for_xml_file(filename: str) -> str
+
+    Reads the version from the root tag only, without parsing the rest
+    of the file.
+
+    """
+    f = open(filename, 'rb')
+    try:
+        for _, root in ElementTree.iterparse(f, ('start',)):
+            return get_version_for_xml(root)
+    finally:
+        f.close()
+
 def get_type_for_xml(root):
     return root.tag
 
@@ -1794,17 +2245,20 @@ def get_current_time(db_connection=None):
     if db_connection is not None:
         try:
             c = db_connection.cursor()
-            # FIXME MySQL versus sqlite3
-            c.execute("SELECT NOW();")
-            # c.execute("SELECT DATETIME('NOW');")
+            sqlite = is_sqlite_connection(db_connection)
+            if sqlite:
+                c.execute("SELECT DATETIME('NOW', 'localtime');")
+            else:
+                c.execute("SELECT NOW();")
             row = c.fetchone()
             if row:
-                # FIXME MySQL versus sqlite3
-                timestamp = row[0]
-                # timestamp = strptime(row[0], '%Y-%m-%d %H:%M:%S')
+                if sqlite:
+                    timestamp = _convert_sqlite_datetime(row[0])
+                else:
+                    timestamp = row[0]
             c.close()
         except get_db_lib().Error, e:
-            debug.critical("Logger Error %d: %s" % (e.args[0], e.args[1]))
+            debug.critical("Logger Error %d: %s" % db_error_args(e))
 
     return timestamp
 
@@ -1881,3 +2335,363 @@ class TestDBIO(unittest.TestCase):
                 self.fail(str(e))
         finally:
             os.rmdir(testdir)
+
+    def test_iterparse_vistrail(self):
+        """ test that streaming a vistrail matches the tree reader """
+
+        (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+            DBVistrail.vtType,
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/terminator.vt'))
+        try:
+            # re-save in the current version, which is the one streamed
+            fname = os.path.join(vt_save_dir, 'vistrail_current')
+            save_vistrail_to_xml(save_bundle.vistrail, fname)
+            self.assertEqual(get_version_for_xml_file(fname), currentVersion)
+
+            daoList = getVersionDAO(currentVersion)
+            tree = ElementTree.parse(fname)
+            expected = daoList.open_from_xml(fname, DBVistrail.vtType, tree)
+            vistrail = daoList.open_from_xml(fname, DBVistrail.vtType)
+            self.assertFalse(vistrail.is_dirty)
+            self.assertEqual(serialize(vistrail), serialize(expected))
+
+            vistrail = daoList.iterparse_vistrail(
+                    fname, defer=('actionAnnotation',))
+            self.assertFalse(vistrail.db_actionAnnotations)
+            self.assertTrue(vistrail.db_deferred_xml)
+            daoList.read_deferred_xml(vistrail)
+            self.assertFalse(vistrail.db_deferred_xml)
+            self.assertEqual(
+                    sorted(vistrail.db_actionAnnotations_id_index),
+                    sorted(expected.db_actionAnnotations_id_index))
+        finally:
+            close_zip_xml(vt_save_dir)
+
+    def test_appended_log(self):
+        """ test reading and re-saving the log of a vt file """
+
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        filename = os.path.join(testdir, 'visvar.vt')
+        (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+            DBVistrail.vtType,
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/visvar-1.0.2.vt'))
+        try:
+            log_fname = save_bundle.vistrail.db_log_filename
+            log = open_log_from_xml(log_fname, True)
+            self.assertTrue(log.db_workflow_execs)
+            self.assertEqual([e.db_id for e in log.db_workflow_execs],
+                             range(1, len(log.db_workflow_execs) + 1))
+            self.assertTrue(os.path.exists(log_fname + INDEX_SUFFIX))
+
+            with open_log_index(log_fname) as index:
+                last, = index.find(newest_first=True, limit=1)
+                (entry, workflow_exec), = iter_appended_workflow_execs(
+                        index, [last])
+            self.assertEqual(workflow_exec.db_id,
+                             len(log.db_workflow_execs))
+            self.assertEqual(workflow_exec.db_ts_start,
+                             log.db_workflow_execs[-1].db_ts_start)
+
+            save_bundle_to_zip_xml(save_bundle, filename, vt_save_dir)
+            z = zipfile.ZipFile(filename)
+            try:
+                names = [os.path.normpath(n) for n in z.namelist()]
+            finally:
+                z.close()
+            self.assertIn('log', names)
+            self.assertNotIn('log' + INDEX_SUFFIX, names)
+        finally:
+            shutil.rmtree(testdir)
+            shutil.rmtree(vt_save_dir)
+
+    def test_save_merged_log(self):
+        """ test writing an appended log and new executions as one log """
+
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        filename = os.path.join(testdir, 'log.xml')
+        (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+            DBVistrail.vtType,
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/visvar-1.0.2.vt'))
+        try:
+            # the executions of the test file are stored as 1.0.2, append
+            # some more in the current version
+            log_fname = os.path.join(testdir, 'log')
+            shutil.copyfile(save_bundle.vistrail.db_log_filename, log_fname)
+            new_log = open_log_from_xml(log_fname, True)
+            new_log = DBLog(workflow_execs=new_log.db_workflow_execs[:2])
+            save_log_to_xml(new_log, log_fname, do_append=True)
+            save_merged_log_to_xml(new_log, log_fname, filename)
+            log = open_log_from_xml(filename)
+            expected = merge_logs(new_log, log_fname)
+            self.assertEqual(
+                    [(e.db_id, e.db_ts_start, e.db_parent_version)
+                     for e in log.db_workflow_execs],
+                    [(e.db_id, e.db_ts_start, e.db_parent_version)
+                     for e in expected.db_workflow_execs])
+            self.assertEqual(
+                    len(log.db_workflow_execs[0].db_item_execs),
+                    len(expected.db_workflow_execs[0].db_item_execs))
+        finally:
+            shutil.rmtree(testdir)
+            shutil.rmtree(vt_save_dir)
+
+    def test_db_error_args(self):
+        """ test reading the code and message of DB-API errors """
+        self.assertEqual(db_error_args(Exception(2003, 'x')), (2003, 'x'))
+        self.assertEqual(db_error_args(sqlite3.OperationalError('y')),
+                         (0, 'y'))
+
+    def test_sqlite_round_trip(self):
+        """ test saving a vistrail to a sqlite repository and reading it """
+
+        global _db_lib
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+            DBVistrail.vtType,
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/terminator.vt'))
+        old_db_lib = _db_lib
+        set_db_lib(sqlite3)
+        try:
+            db_connection = open_db_connection(
+                {'db': os.path.join(testdir, 'repository.db')})
+            self.assertTrue(ping_db_connection(db_connection))
+            setup_db_tables(db_connection)
+            expected = save_bundle.vistrail
+            saved = save_vistrail_to_db(expected, db_connection, True)
+            self.assertIsNotNone(saved.db_id)
+            vistrail = open_vistrail_from_db(db_connection, saved.db_id)
+            self.assertIsInstance(vistrail.db_last_modified, datetime)
+            self.assertEqual(
+                    sorted((a.db_id, a.db_prevId, a.db_date,
+                            len(a.db_operations))
+                           for a in vistrail.db_actions),
+                    sorted((a.db_id, a.db_prevId, a.db_date,
+                            len(a.db_operations))
+                           for a in expected.db_actions))
+            self.assertEqual(
+                    sorted((a.db_action_id, a.db_key, a.db_value)
+                           for a in vistrail.db_actionAnnotations),
+                    sorted((a.db_action_id, a.db_key, a.db_value)
+                           for a in expected.db_actionAnnotations))
+            close_db_connection(db_connection)
+            self.assertFalse(ping_db_connection(db_connection))
+        finally:
+            _db_lib = old_db_lib
+            close_zip_xml(vt_save_dir)
+            shutil.rmtree(testdir)
+
+    def test_sqlite_delta_save(self):
+        """ test that a reopened vistrail only writes its changes """
+        from vistrails.db.domain import DBAction, DBAdd, DBModule
+
+        global _db_lib
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+            DBVistrail.vtType,
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/terminator.vt'))
+        old_db_lib = _db_lib
+        set_db_lib(sqlite3)
+        try:
+            db_connection = open_db_connection(
+                {'db': os.path.join(testdir, 'repository.db')})
+            setup_db_tables(db_connection)
+            vt_id = save_vistrail_to_db(save_bundle.vistrail, db_connection,
+                                        True).db_id
+            vistrail = open_vistrail_from_db(db_connection, vt_id)
+            self.assertEqual(vistrail.db_journal, [])
+
+            id_scope = vistrail.idScope
+            module = DBModule(id=id_scope.getNewId(DBModule.vtType),
+                              name='String', cache=1, namespace='',
+                              package='org.vistrails.vistrails.basic',
+                              version='2.1.1')
+            add = DBAdd(id=id_scope.getNewId('operation'),
+                        what=DBModule.vtType, objectId=module.db_id,
+                        data=module)
+            action = DBAction(id=id_scope.getNewId(DBAction.vtType),
+                              prevId=max(vistrail.db_actions_id_index),
+                              date=get_current_time(), user='test',
+                              operations=[add])
+            vistrail.db_add_action(action)
+            edited = vistrail.db_actionAnnotations[0]
+            edited.db_value = 'edited'
+            self.assertEqual(vistrail.db_journal, [action])
+
+            dao_list = getVersionDAO(currentVersion)
+            children = dao_list.get_save_children(vistrail, False)
+            self.assertEqual(set(id(c) for c, _, _ in children),
+                             set(id(c) for c in [vistrail, action, add,
+                                                 module, edited]))
+            vistrail = save_vistrail_to_db(vistrail, db_connection)
+            self.assertEqual(vistrail.db_journal, [])
+
+            reopened = open_vistrail_from_db(db_connection, vt_id)
+            self.assertEqual(sorted(reopened.db_actions_id_index),
+                             sorted(vistrail.db_actions_id_index))
+            self.assertEqual(reopened.db_actionAnnotations_id_index[
+                    edited.db_id].db_value, 'edited')
+
+            partial = open_vistrail_version_from_db(db_connection, vt_id,
+                                                    action.db_id)
+            path = []
+            version = action.db_id
+            while version != 0:
+                path.append(version)
+                version = reopened.db_actions_id_index[version].db_prevId
+            self.assertEqual(sorted(partial.db_actions_id_index),
+                             sorted(path))
+            self.assertEqual(
+                serialize(vistrails.db.services.vistrail.materializeWorkflow(
+                    partial, action.db_id)),
+                serialize(vistrails.db.services.vistrail.materializeWorkflow(
+                    reopened, action.db_id)))
+            close_db_connection(db_connection)
+        finally:
+            _db_lib = old_db_lib
+            close_zip_xml(vt_save_dir)
+            shutil.rmtree(testdir)
+
+    def test_incremental_zip_save(self):
+        """ test appending changes to a vt file and compacting it """
+        from vistrails.db.domain import DBAction, DBAdd, DBModule
+
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        filename = os.path.join(testdir, 'terminator.vt')
+        shutil.copyfile(
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/terminator.vt'), filename)
+        vt_save_dirs = []
+        def reopen():
+            (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+                DBVistrail.vtType, filename)
+            vt_save_dirs.append(vt_save_dir)
+            return (save_bundle, vt_save_dir)
+        def members():
+            z = zipfile.ZipFile(filename)
+            try:
+                return dict((i.filename, i.CRC) for i in z.infolist())
+            finally:
+                z.close()
+        try:
+            # the first save after opening the file can already append
+            (save_bundle, vt_save_dir) = reopen()
+            before = members()
+
+            vistrail = save_bundle.vistrail
+            id_scope = vistrail.idScope
+            module = DBModule(id=id_scope.getNewId(DBModule.vtType),
+                              name='String', cache=1, namespace='',
+                              package='org.vistrails.vistrails.basic',
+                              version='2.1.1')
+            add = DBAdd(id=id_scope.getNewId('operation'),
+                        what=DBModule.vtType, objectId=module.db_id,
+                        data=module)
+            action = DBAction(id=id_scope.getNewId(DBAction.vtType),
+                              prevId=max(vistrail.db_actions_id_index),
+                              date=get_current_time(), user='test',
+                              operations=[add])
+            vistrail.db_add_action(action)
+            with open(os.path.join(vt_save_dir, 'log'), 'ab') as f:
+                f.write('<workflowExec id="-1"/>\n')
+            with open(os.path.join(vt_save_dir, 'log'), 'rb') as f:
+                log = f.read()
+            vistrail.db_log_filename = os.path.join(vt_save_dir, 'log')
+            save_vistrail_bundle_to_zip_xml(save_bundle, filename,
+                                            vt_save_dir, incremental=True)
+            after = members()
+            for name, crc in before.iteritems():
+                self.assertEqual(after[name], crc)
+            self.assertEqual(sorted(set(after) - set(before)),
+                             ['journal/000001', 'journal/000001.log'])
+
+            (save_bundle, vt_save_dir) = reopen()
+            self.assertEqual(sorted(save_bundle.vistrail.db_actions_id_index),
+                             sorted(vistrail.db_actions_id_index))
+            with open(os.path.join(vt_save_dir, 'log'), 'rb') as f:
+                self.assertEqual(f.read(), log)
+            self.assertFalse(os.path.exists(os.path.join(vt_save_dir,
+                                                         JOURNAL_DIR)))
+
+            # changing older objects needs a full save
+            save_bundle.vistrail.db_actionAnnotations[0].db_value = 'edited'
+            save_vistrail_bundle_to_zip_xml(save_bundle, filename,
+                                            vt_save_dir, incremental=True)
+            self.assertFalse(any(name.startswith(JOURNAL_DIR + '/')
+                                 for name in members()))
+            (save_bundle, vt_save_dir) = reopen()
+            self.assertEqual(
+                save_bundle.vistrail.db_actionAnnotations[0].db_value,
+                'edited')
+
+            save_bundle.vistrail.db_add_annotation(
+                DBAnnotation(id=save_bundle.vistrail.idScope.getNewId(
+                        DBAnnotation.vtType), key='test', value='1'))
+            save_vistrail_bundle_to_zip_xml(save_bundle, filename,
+                                            vt_save_dir, incremental=True)
+            self.assertIn('journal/000001', members())
+            compact_zip_xml(filename)
+            self.assertFalse(any(name.startswith(JOURNAL_DIR + '/')
+                                 for name in members()))
+            (save_bundle, vt_save_dir) = reopen()
+            self.assertEqual(
+                save_bundle.vistrail.db_get_annotation_by_key('test').db_value,
+                '1')
+        finally:
+            for vt_save_dir in vt_save_dirs:
+                close_zip_xml(vt_save_dir)
+            shutil.rmtree(testdir)
+
+    def test_interrupted_zip_append(self):
+        """ test recovering a vt file when appending to it is interrupted """
+        global _append_zip_xml_members
+
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        filename = os.path.join(testdir, 'terminator.vt')
+        shutil.copyfile(
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/terminator.vt'), filename)
+        with open(filename, 'rb') as f:
+            original = f.read()
+
+        def interrupted(vistrail, filename, *args):
+            # the new members start where the central directory was
+            z = zipfile.ZipFile(filename)
+            start_dir = z.start_dir
+            z.close()
+            with open(filename, 'r+b') as f:
+                f.seek(start_dir)
+                f.write('\0' * 100)
+                f.truncate()
+            raise SystemExit
+
+        (save_bundle, vt_save_dir) = open_vistrail_bundle_from_zip_xml(
+            filename)
+        old_append = _append_zip_xml_members
+        _append_zip_xml_members = interrupted
+        try:
+            vistrail = save_bundle.vistrail
+            vistrail.db_add_annotation(
+                DBAnnotation(id=vistrail.idScope.getNewId(
+                        DBAnnotation.vtType), key='test', value='1'))
+            self.assertRaises(SystemExit, save_vistrail_bundle_to_zip_xml,
+                              save_bundle, filename, vt_save_dir,
+                              incremental=True)
+            self.assertRaises(zipfile.BadZipfile, zipfile.ZipFile, filename)
+            self.assertTrue(os.path.exists(filename + ZIP_BACKUP_SUFFIX))
+        finally:
+            _append_zip_xml_members = old_append
+            close_zip_xml(vt_save_dir)
+        try:
+            (save_bundle, vt_save_dir) = open_vistrail_bundle_from_zip_xml(
+                filename)
+            close_zip_xml(vt_save_dir)
+            self.assertFalse(os.path.exists(filename + ZIP_BACKUP_SUFFIX))
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), original)
+        finally:
+            shutil.rmtree(testdir)
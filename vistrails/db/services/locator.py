@@ -628,7 +628,8 @@ class ZIPFileLocator(XMLFileLocator):
                 obj.locator = self
             return save_bundle
 
-    def save(self, save_bundle, do_copy=True, version=None):
+    def save(self, save_bundle, do_copy=True, version=None,
+             incremental=False):
         if do_copy:
             # make sure we create a fresh temporary directory if we're
             # duplicating the vistrail
@@ -636,7 +637,10 @@ class ZIPFileLocator(XMLFileLocator):
         else:
             # otherwise, use the existing temp directory if one is set
             tmp_dir = self.tmp_dir
-        (save_bundle, tmp_dir) = io.save_bundle_to_zip_xml(save_bundle, self._name, tmp_dir, version)
+        (save_bundle, tmp_dir) = io.save_bundle_to_zip_xml(save_bundle,
+                                                           self._name,
+                                                           tmp_dir, version,
+                                                           incremental)
         self.tmp_dir = tmp_dir
         for obj in save_bundle.get_db_objs():
             obj.locator = self
@@ -813,10 +817,16 @@ class DBLocator(BaseLocator):
         DBLocator.cache_connections[self._hash] = connection
         return connection
 
-    def load(self, type, tmp_dir=None):
+    def load(self, type, tmp_dir=None, use_cache=True):
+        """load(type: str, tmp_dir: str, use_cache: bool) -> SaveBundle
+
+        If use_cache is False, DBLocator.cache is neither used nor updated,
+        for callers that keep what they load themselves.
+
+        """
         self._hash = self.hash()
         #print "LLoad Big|type", type
-        if DBLocator.cache.has_key(self._hash):
+        if use_cache and DBLocator.cache.has_key(self._hash):
             save_bundle = DBLocator.cache[self._hash]
             obj = save_bundle.get_primary_obj()
 
@@ -844,8 +854,10 @@ class DBLocator(BaseLocator):
             obj.locator = self
         
         _hash = self.hash()
-        DBLocator.cache[self._hash] = save_bundle.do_copy()
-        DBLocator.cache_timestamps[self._hash] = primary_obj.db_last_modified
+        if use_cache:
+            DBLocator.cache[self._hash] = save_bundle.do_copy()
+            DBLocator.cache_timestamps[self._hash] = \
+                primary_obj.db_last_modified
         return save_bundle
 
     def save(self, save_bundle, do_copy=False, version=None):
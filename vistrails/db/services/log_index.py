@@ -0,0 +1,378 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Sidecar index for appended log files.
+
+The log of a .vt bundle is a sequence of workflowExec elements appended to
+the same file after each execution, with no enclosing element. Reading it
+used to mean parsing the whole file. LogIndex keeps, in a SQLite database
+next to the log, the byte range and the main attributes of each workflowExec
+so that they can be filtered and paged through without reading the rest of
+the file. The index is updated incrementally as the log grows.
+"""
+
+from __future__ import division
+
+from collections import namedtuple
+from datetime import datetime
+import hashlib
+import os
+import sqlite3
+
+from vistrails.core.system import get_elementtree_library
+
+ElementTree = get_elementtree_library()
+
+
+INDEX_SUFFIX = '.idx'
+
+LogIndexEntry = namedtuple('LogIndexEntry',
+                           ['id', 'offset', 'length', 'version',
+                            'parent_version', 'ts_start', 'ts_end',
+                            'completed', 'user', 'name'])
+
+
+class LogIndex(object):
+    """Index of the workflow executions in an appended log file.
+
+    Entries are numbered from 1 in file order, which matches the ids given
+    to the workflow executions when the whole log is loaded.
+    """
+    FORMAT = '1'
+    TAG = '<workflowExec'
+    CHUNK_SIZE = 1 << 20
+    HEAD_SIZE = 4096
+
+    def __init__(self, log_filename, index_filename=None):
+        self.log_filename = log_filename
+        if index_filename is None:
+            index_filename = log_filename + INDEX_SUFFIX
+        try:
+            self.conn = sqlite3.connect(index_filename)
+            self._create_tables()
+        except sqlite3.Error:
+            # Read-only location or corrupted index: index in memory
+            self.conn = sqlite3.connect(':memory:')
+            self._create_tables()
+        self.update()
+
+    def _create_tables(self):
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta("
+                          "key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS workflow_exec("
+                          "id INTEGER PRIMARY KEY, offset INTEGER, "
+                          "length INTEGER, version TEXT, "
+                          "parent_version INTEGER, ts_start TEXT, "
+                          "ts_end TEXT, completed INTEGER, user TEXT, "
+                          "name TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS workflow_exec_ts "
+                          "ON workflow_exec(ts_start)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS workflow_exec_version "
+                          "ON workflow_exec(parent_version)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_meta(self):
+        return dict(self.conn.execute("SELECT key, value FROM meta"))
+
+    def _head_hash(self, fp, size):
+        fp.seek(0)
+        return hashlib.sha1(fp.read(size)).hexdigest()
+
+    def update(self):
+        """Indexes the workflow executions appended since the last update.
+
+        The index is rebuilt if the log was replaced rather than appended to.
+        """
+        with open(self.log_filename, 'rb') as fp:
+            fp.seek(0, os.SEEK_END)
+            size = fp.tell()
+            meta = self._get_meta()
+            indexed_size = int(meta.get('size', 0))
+            head_size = int(meta.get('head_size', 0))
+            if (meta.get('format') != self.FORMAT or
+                    size < indexed_size or
+                    meta.get('head') != self._head_hash(fp, head_size)):
+                self.conn.execute("DELETE FROM workflow_exec")
+                indexed_size = 0
+            elif size == indexed_size:
+                return
+
+            starts = self._scan(fp, indexed_size)
+            last = self.conn.execute("SELECT id, offset FROM workflow_exec "
+                                     "ORDER BY id DESC LIMIT 1").fetchone()
+            if last is not None:
+                # The last record now ends where the first new one starts
+                end = starts[0][0] if starts else size
+                self.conn.execute("UPDATE workflow_exec SET length=? "
+                                  "WHERE id=?", (end - last[1], last[0]))
+            rows = []
+            for i, (offset, start_tag) in enumerate(starts):
+                if i + 1 < len(starts):
+                    length = starts[i + 1][0] - offset
+                else:
+                    length = size - offset
+                rows.append((offset, length) + self._parse_start_tag(start_tag))
+            self.conn.executemany("INSERT INTO workflow_exec(offset, length, "
+                                  "version, parent_version, ts_start, ts_end, "
+                                  "completed, user, name) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            head_size = min(size, self.HEAD_SIZE)
+            self.conn.executemany("INSERT OR REPLACE INTO meta(key, value) "
+                                  "VALUES (?, ?)",
+                                  [('format', self.FORMAT),
+                                   ('size', str(size)),
+                                   ('head_size', str(head_size)),
+                                   ('head', self._head_hash(fp, head_size))])
+            self.conn.commit()
+
+    def _scan(self, fp, pos):
+        """Finds the start tags of the workflowExec elements after pos.
+
+        Returns a list of (offset, start tag) tuples. Only the file is read,
+        nothing is parsed.
+        """
+        starts = []
+        tag_len = len(self.TAG)
+        fp.seek(pos)
+        buf = ''
+        buf_start = pos
+        while True:
+            data = fp.read(self.CHUNK_SIZE)
+            buf += data
+            i = 0
+            incomplete = None
+            while True:
+                found = buf.find(self.TAG, i)
+                if found == -1 or found + tag_len >= len(buf):
+                    if found != -1:
+                        incomplete = found
+                    break
+                end = buf.find('>', found)
+                if end == -1:
+                    incomplete = found
+                    break
+                if buf[found + tag_len] in ' \t\r\n/>':
+                    starts.append((buf_start + found, buf[found:end + 1]))
+                i = end + 1
+            if not data:
+                break
+            if incomplete is not None:
+                cut = incomplete
+            else:
+                cut = max(i, len(buf) - tag_len + 1)
+            buf_start += cut
+            buf = buf[cut:]
+        return starts
+
+    @staticmethod
+    def _parse_start_tag(start_tag):
+        if not start_tag.endswith('/>'):
+            start_tag = start_tag[:-1] + '/>'
+        node = ElementTree.fromstring(start_tag)
+        def get_int(name):
+            try:
+                return int(node.get(name))
+            except (TypeError, ValueError):
+                return None
+        return (node.get('version'), get_int('parentVersion'),
+                node.get('tsStart'), node.get('tsEnd'), get_int('completed'),
+                node.get('user'), node.get('name'))
+
+    def find(self, since=None, until=None, version=None, completed=None,
+             user=None, offset=0, limit=None, newest_first=False):
+        """find(...) -> [LogIndexEntry]
+
+        Returns the entries of the workflow executions that started between
+        since and until (datetime or 'YYYY-MM-DD HH:MM:SS' strings), for the
+        given vistrail version(s), completion status and user. All filters
+        are optional; offset and limit allow paging through the results.
+        """
+        where, args = self._where(since, until, version, completed, user)
+        query = "SELECT id, offset, length, version, parent_version, " \
+                "ts_start, ts_end, completed, user, name FROM workflow_exec"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY id DESC" if newest_first else " ORDER BY id"
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            args.extend([-1 if limit is None else limit, offset])
+        return [LogIndexEntry(*row) for row in self.conn.execute(query, args)]
+
+    def count(self, since=None, until=None, version=None, completed=None,
+              user=None):
+        """Returns the number of workflow executions matching the filters.
+        """
+        where, args = self._where(since, until, version, completed, user)
+        query = "SELECT COUNT(*) FROM workflow_exec"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        return self.conn.execute(query, args).fetchone()[0]
+
+    @staticmethod
+    def _where(since, until, version, completed, user):
+        def timestamp(t):
+            if isinstance(t, datetime):
+                return t.strftime('%Y-%m-%d %H:%M:%S')
+            return t
+        where = []
+        args = []
+        if since is not None:
+            where.append("ts_start >= ?")
+            args.append(timestamp(since))
+        if until is not None:
+            where.append("ts_start <= ?")
+            args.append(timestamp(until))
+        if version is not None:
+            if isinstance(version, (int, long)):
+                version = [version]
+            version = list(version)
+            where.append("parent_version IN (%s)" %
+                         ", ".join("?" * len(version)))
+            args.extend(version)
+        if completed is not None:
+            where.append("completed = ?")
+            args.append(completed)
+        if user is not None:
+            where.append("user = ?")
+            args.append(user)
+        return where, args
+
+    def read_xml(self, entry):
+        """Parses the workflowExec element of an entry.
+        """
+        with open(self.log_filename, 'rb') as fp:
+            fp.seek(entry.offset)
+            return ElementTree.fromstring(fp.read(entry.length))
+
+    def iter_xml(self, entries):
+        """Parses the workflowExec elements of several entries.
+        """
+        with open(self.log_filename, 'rb') as fp:
+            for entry in entries:
+                fp.seek(entry.offset)
+                yield entry, ElementTree.fromstring(fp.read(entry.length))
+
+
+###############################################################################
+
+import shutil
+import tempfile
+import unittest
+
+
+class TestLogIndex(unittest.TestCase):
+    RECORD = ('<workflowExec completed="%d" id="-1" parentVersion="%d" '
+              'tsStart="2015-01-%02d 10:00:00" tsEnd="2015-01-%02d 10:00:01" '
+              'user="%s" version="1.0.4">\n'
+              '  <moduleExec id="%d" moduleId="0" moduleName="m" />\n'
+              '</workflowExec>\n')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_log_')
+        self.filename = os.path.join(self.directory, 'log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def append(self, days):
+        with open(self.filename, 'ab') as fp:
+            for day in days:
+                fp.write(self.RECORD % (day % 2, day * 10, day, day,
+                                        'alice' if day < 5 else 'bob', day))
+
+    def check_records(self, index, days):
+        entries = index.find()
+        self.assertEqual([e.id for e in entries], range(1, len(days) + 1))
+        self.assertEqual([e.parent_version for e in entries],
+                         [d * 10 for d in days])
+        for entry, node in index.iter_xml(entries):
+            self.assertEqual(node.tag, 'workflowExec')
+            self.assertEqual(node[0].get('id'), str(entry.parent_version // 10))
+
+    def test_chunks(self):
+        """Indexes a file read in chunks smaller than the records.
+        """
+        self.append(range(1, 8))
+        old_size, LogIndex.CHUNK_SIZE = LogIndex.CHUNK_SIZE, 17
+        try:
+            with LogIndex(self.filename) as index:
+                self.check_records(index, range(1, 8))
+        finally:
+            LogIndex.CHUNK_SIZE = old_size
+
+    def test_incremental(self):
+        """Appends to the log and reopens the index.
+        """
+        self.append(range(1, 4))
+        with LogIndex(self.filename) as index:
+            self.check_records(index, range(1, 4))
+        self.assertTrue(os.path.exists(self.filename + INDEX_SUFFIX))
+        self.append(range(4, 6))
+        with LogIndex(self.filename) as index:
+            self.check_records(index, range(1, 6))
+
+        # Replace the log: the index is rebuilt
+        os.remove(self.filename)
+        self.append([9, 8])
+        with LogIndex(self.filename) as index:
+            self.check_records(index, [9, 8])
+
+    def test_filters(self):
+        self.append(range(1, 8))
+        with LogIndex(self.filename) as index:
+            self.assertEqual(index.count(), 7)
+            self.assertEqual(index.count(completed=1), 4)
+            self.assertEqual(index.count(user='bob'), 3)
+            self.assertEqual(
+                    [e.id for e in index.find(
+                            since=datetime(2015, 1, 3),
+                            until='2015-01-05 23:59:59')],
+                    [3, 4, 5])
+            self.assertEqual([e.id for e in index.find(version=[20, 60])],
+                             [2, 6])
+            self.assertEqual([e.id for e in index.find(newest_first=True,
+                                                       offset=1, limit=2)],
+                             [6, 5])
+            self.assertEqual([e.id for e in index.find(offset=5)], [6, 7])
@@ -73,11 +73,17 @@ def update_id_scope(vistrail):
 def materializeWorkflow(vistrail, version):
     # construct path up through tree and perform each action
     if vistrail.db_has_action_with_id(version):
-        workflow = DBWorkflow()
-        #for action in getActionChain(vistrail, version):
-        #    oldPerformAction(action, workflow)
-        performActions(getActionChain(vistrail, version), 
-                            workflow)
+        # vistrails that carry a WorkflowCache replay from the nearest
+        # cached checkpoint instead of the root
+        cache = getattr(vistrail, 'workflow_cache', None)
+        if cache is not None:
+            workflow = cache.materialize(vistrail, version)
+        else:
+            workflow = DBWorkflow()
+            #for action in getActionChain(vistrail, version):
+            #    oldPerformAction(action, workflow)
+            performActions(getActionChain(vistrail, version), 
+                                workflow)
         workflow.db_id = version
         workflow.db_vistrailId = vistrail.db_id
         return workflow
@@ -714,6 +720,13 @@ def fixActions(vistrail, v, actions):
 # Diff methods
 
 def getSharedRoot(vistrail, versions):
+    # core Vistrails keep an index of their version tree
+    index = getattr(getattr(vistrail, 'tree', None), 'index', None)
+    if index is not None and versions and \
+            all(v <= 0 or v in index for v in versions):
+        if min(versions) <= 0:
+            return 0
+        return reduce(index.common_ancestor, versions)
     # base case is 0
     current = copy.copy(versions)
     while 0 not in current:
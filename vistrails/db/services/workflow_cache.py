@@ -0,0 +1,339 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Checkpointed cache of materialized workflows.
+
+Materializing a version replays the whole action chain from the root,
+which gets expensive on deep version trees. WorkflowCache keeps copies
+of materialized workflows at checkpoint versions (every
+`checkpoint_interval` actions from the root, plus tagged versions) in an
+LRU store bounded by the total number of workflow objects. A version is
+then built by copying the snapshot of its nearest cached ancestor and
+replaying only the remaining actions.
+
+"""
+from __future__ import division
+
+from vistrails.core import debug
+from vistrails.db import VistrailsDBException
+from vistrails.db.domain import DBAbstraction, DBGroup, DBModule, DBWorkflow
+from vistrails.db.services.action_chain import getCurrentOperations
+
+import unittest
+
+TAG_ANNOTATION = '__tag__'
+
+class ReplayError(VistrailsDBException):
+    """Raised when an action cannot be applied to a workflow on its own.
+    """
+
+class WorkflowCache(object):
+    """LRU store of workflow snapshots keyed by version id.
+
+    Snapshots are private: callers always receive a copy, so workflows
+    returned from materialize() can be modified freely.
+
+    """
+    def __init__(self, checkpoint_interval=50, max_objects=200000):
+        self.checkpoint_interval = checkpoint_interval
+        self.max_objects = max_objects
+        # version -> (workflow, depth, size)
+        self._snapshots = {}
+        # version -> tick of the last use, to find the least recently used
+        self._last_used = {}
+        self._tick = 0
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.replayed_actions = 0
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def __contains__(self, version):
+        return version in self._snapshots
+
+    def clear(self):
+        """Drops every snapshot, e.g. after actions were renumbered."""
+        self._snapshots.clear()
+        self._last_used.clear()
+        self._size = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'replayed_actions': self.replayed_actions,
+                'snapshots': len(self._snapshots),
+                'objects': self._size}
+
+    def is_checkpoint(self, vistrail, version, depth):
+        if self.checkpoint_interval > 0 and \
+                depth % self.checkpoint_interval == 0:
+            return True
+        return vistrail.db_has_actionAnnotation_with_action_id(
+            (version, TAG_ANNOTATION))
+
+    def materialize(self, vistrail, version):
+        """materialize(vistrail: DBVistrail, version: int) -> DBWorkflow
+
+        Builds the workflow for version, which must be an action of
+        vistrail, from the nearest cached ancestor.
+
+        """
+        # walk up to the nearest cached ancestor (or the root)
+        chain = []
+        current = version
+        while current > 0 and current not in self._snapshots:
+            action = vistrail.db_get_action_by_id(current)
+            chain.append(action)
+            current = action.db_prevId
+        chain.reverse()
+
+        if current > 0:
+            self.hits += 1
+            self._touch(current)
+            snapshot, base_depth = self._snapshots[current][:2]
+        else:
+            self.misses += 1
+            snapshot = None
+            base_depth = 0
+
+        # only the deepest checkpoint on the chain is stored
+        checkpoint = -1
+        for i in xrange(len(chain) - 1, -1, -1):
+            if self.is_checkpoint(vistrail, chain[i].db_id,
+                                  base_depth + i + 1):
+                checkpoint = i
+                break
+
+        try:
+            if snapshot is None:
+                # replay net operations from the root like
+                # materializeWorkflow does
+                workflow = DBWorkflow()
+                head = chain[:checkpoint + 1] if checkpoint >= 0 else chain
+                replay_net(head, workflow)
+                self.replayed_actions += len(head)
+                if checkpoint < 0:
+                    return workflow
+            else:
+                workflow = snapshot.do_copy()
+                head = chain[:checkpoint + 1]
+                replay_sequential(head, workflow)
+                self.replayed_actions += len(head)
+            if checkpoint >= 0:
+                self._store(chain[checkpoint].db_id, workflow,
+                            base_depth + checkpoint + 1)
+                workflow = workflow.do_copy()
+            tail = chain[checkpoint + 1:]
+            replay_sequential(tail, workflow)
+            self.replayed_actions += len(tail)
+        except ReplayError, e:
+            # operations that cannot be applied one at a time on top of
+            # a snapshot are still consistent when taken as a whole
+            debug.warning("Replaying version %s from the root: %s" %
+                          (version, e))
+            self.clear()
+            chain = []
+            current = version
+            while current > 0:
+                action = vistrail.db_get_action_by_id(current)
+                chain.append(action)
+                current = action.db_prevId
+            chain.reverse()
+            workflow = DBWorkflow()
+            replay_net(chain, workflow)
+            self.replayed_actions += len(chain)
+        return workflow
+
+    def _touch(self, version):
+        self._tick += 1
+        self._last_used[version] = self._tick
+
+    def _store(self, version, workflow, depth):
+        size = len(workflow.objects)
+        if size > self.max_objects:
+            return
+        if version in self._snapshots:
+            self._size -= self._snapshots.pop(version)[2]
+        self._snapshots[version] = (workflow, depth, size)
+        self._touch(version)
+        self._size += size
+        while self._size > self.max_objects:
+            oldest = min(self._last_used, key=self._last_used.get)
+            del self._last_used[oldest]
+            self._size -= self._snapshots.pop(oldest)[2]
+            self.evictions += 1
+
+def replay_net(actions, workflow):
+    for operation in getCurrentOperations(actions):
+        workflow.db_add_object(operation.db_data,
+                               operation.db_parentObjType,
+                               operation.db_parentObjId)
+
+def _check_object(workflow, obj_type, obj_id, action):
+    if obj_type is None or obj_id is None:
+        return
+    if obj_type == DBAbstraction.vtType or obj_type == DBGroup.vtType:
+        obj_type = DBModule.vtType
+    if not workflow.db_has_object(obj_type, obj_id):
+        raise ReplayError("action %s needs missing object of type '%s' "
+                          "with id '%s'" % (action.db_id, obj_type, obj_id))
+
+def replay_sequential(actions, workflow):
+    for action in actions:
+        for operation in action.db_operations:
+            _check_object(workflow, operation.db_parentObjType,
+                          operation.db_parentObjId, action)
+            if operation.vtType == 'change':
+                _check_object(workflow, operation.db_data.vtType,
+                              operation.db_oldObjId, action)
+            elif operation.vtType == 'delete':
+                _check_object(workflow, operation.db_what,
+                              operation.db_objectId, action)
+            if operation.vtType == 'add':
+                workflow.db_add_object(operation.db_data,
+                                       operation.db_parentObjType,
+                                       operation.db_parentObjId)
+            elif operation.vtType == 'change':
+                workflow.db_change_object(operation.db_oldObjId,
+                                          operation.db_data,
+                                          operation.db_parentObjType,
+                                          operation.db_parentObjId)
+            elif operation.vtType == 'delete':
+                workflow.db_delete_object(operation.db_objectId,
+                                          operation.db_what,
+                                          operation.db_parentObjType,
+                                          operation.db_parentObjId)
+            else:
+                msg = "Unrecognized operation '%s'" % operation.vtType
+                raise TypeError(msg)
+
+################################################################################
+
+class TestWorkflowCache(unittest.TestCase):
+    def load_vistrail(self):
+        from vistrails.core.db.locator import FileLocator
+        import vistrails.core.system
+        return FileLocator(vistrails.core.system.vistrails_root_directory() +
+                           '/tests/resources/terminator.vt').load().vistrail
+
+    def check_all_versions(self, vistrail, cache):
+        from vistrails.core.vistrail.pipeline import Pipeline
+        import vistrails.db.services.vistrail
+        versions = sorted(vistrail.db_actions_id_index)
+        vistrail.workflow_cache = None
+        expected = {}
+        for version in versions:
+            workflow = vistrails.db.services.vistrail.materializeWorkflow(
+                vistrail, version)
+            Pipeline.convert(workflow)
+            expected[version] = workflow
+        vistrail.workflow_cache = cache
+        # visit in reverse so deep versions populate the cache first
+        for version in reversed(versions):
+            workflow = vistrails.db.services.vistrail.materializeWorkflow(
+                vistrail, version)
+            Pipeline.convert(workflow)
+            self.assertEqual(workflow, expected[version])
+
+    def test_materialize(self):
+        vistrail = self.load_vistrail()
+        cache = WorkflowCache(checkpoint_interval=5)
+        self.check_all_versions(vistrail, cache)
+        stats = cache.stats()
+        self.assertGreater(stats['hits'], 0)
+        self.assertGreater(stats['snapshots'], 0)
+
+    def test_snapshot_isolation(self):
+        vistrail = self.load_vistrail()
+        cache = WorkflowCache(checkpoint_interval=1)
+        version = max(vistrail.db_actions_id_index)
+        workflow = cache.materialize(vistrail, version)
+        for module in list(workflow.db_modules):
+            workflow.db_delete_module(module)
+        self.assertGreater(len(cache.materialize(vistrail,
+                                                 version).db_modules), 0)
+
+    def test_budget(self):
+        vistrail = self.load_vistrail()
+        cache = WorkflowCache(checkpoint_interval=1, max_objects=100)
+        self.check_all_versions(vistrail, cache)
+        self.assertLessEqual(cache.stats()['objects'], 100)
+        self.assertGreater(cache.evictions, 0)
+
+    def test_replay_errors(self):
+        from vistrails.core.vistrail.pipeline import Pipeline
+        global replay_sequential
+        vistrail = self.load_vistrail()
+        version = max(vistrail.db_actions_id_index)
+        expected = WorkflowCache(checkpoint_interval=0).materialize(
+            vistrail, version)
+        Pipeline.convert(expected)
+        cache = WorkflowCache(checkpoint_interval=1)
+        cache.materialize(vistrail, version)
+        self.assertGreater(len(cache), 0)
+
+        def fail(error):
+            def replay(actions, workflow):
+                raise error
+            return replay
+        old_replay_sequential = replay_sequential
+        try:
+            # missing objects: the version is replayed from the root
+            replay_sequential = fail(ReplayError("missing object"))
+            workflow = cache.materialize(vistrail, version)
+            Pipeline.convert(workflow)
+            self.assertEqual(workflow, expected)
+            self.assertEqual(len(cache), 0)
+
+            # other errors are not hidden
+            cache.materialize(vistrail, version - 1)
+            replay_sequential = fail(KeyError(version))
+            self.assertRaises(KeyError, cache.materialize, vistrail, version)
+        finally:
+            replay_sequential = old_replay_sequential
+
+    def test_replay_missing_object(self):
+        from vistrails.db.domain import DBAction, DBDelete
+        action = DBAction(id=1, operations=[
+                DBDelete(id=1, what=DBModule.vtType, objectId=12)])
+        self.assertRaises(ReplayError,
+                          replay_sequential, [action], DBWorkflow())
+
+if __name__ == '__main__':
+    unittest.main()
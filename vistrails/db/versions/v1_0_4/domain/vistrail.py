@@ -38,9 +38,11 @@ from __future__ import division
 
 import copy
 import hashlib
+from itertools import chain
 from auto_gen import DBVistrail as _DBVistrail
 from auto_gen import DBAdd, DBChange, DBDelete, DBAbstraction, DBGroup, \
-    DBModule, DBAnnotation, DBActionAnnotation, DBParameterExploration
+    DBModule, DBAnnotation, DBActionAnnotation, DBParameterExploration, \
+    DBAction, DBTag, DBControlParameter, DBVistrailVariable
 from id_scope import IdScope
 
 class DBVistrail(_DBVistrail):
@@ -62,6 +64,12 @@ class DBVistrail(_DBVistrail):
         self.db_log_filename = None
         self.log = None
 
+        # actions and annotations added since the vistrail was last read
+        # from or committed to the database; None when it was not, in
+        # which case saves visit every child
+        self.db_journal = None
+        self.db_journal_sizes = None
+
     def __copy__(self):
         return DBVistrail.do_copy(self)
 
@@ -72,6 +80,7 @@ class DBVistrail(_DBVistrail):
         cp.idScope = copy.copy(self.idScope)
         cp.db_objects = copy.copy(self.db_objects)
         cp.db_log_filename = self.db_log_filename
+        cp.db_journal = None
         if self.log is not None:
             cp.log = copy.copy(self.log)
         else:
@@ -127,6 +136,96 @@ class DBVistrail(_DBVistrail):
             self.idScope.updateBeginId('parameter_exploration',
                                        paramexp.db_id+1)
 
+    def db_add_action(self, action):
+        _DBVistrail.db_add_action(self, action)
+        if self.db_journal is not None:
+            self.db_journal.append(action)
+
+    def db_add_annotation(self, annotation):
+        _DBVistrail.db_add_annotation(self, annotation)
+        if self.db_journal is not None:
+            self.db_journal.append(annotation)
+
+    def db_add_actionAnnotation(self, actionAnnotation):
+        _DBVistrail.db_add_actionAnnotation(self, actionAnnotation)
+        if self.db_journal is not None:
+            self.db_journal.append(actionAnnotation)
+
+    def db_reset_journal(self):
+        self.db_journal = []
+        self.db_journal_sizes = self._db_get_child_counts()
+
+    def db_commit_journal(self):
+        """db_commit_journal() -> None
+
+        Resets the journal once its changes were written out, clearing
+        the dirty flags that db_get_changed_children() looks at.
+
+        """
+        for obj in chain(self.db_journal or [],
+                         self.db_get_changed_children()):
+            for (child, _, _) in obj.db_children():
+                child.is_dirty = False
+                child.is_new = False
+        self.db_reset_journal()
+
+    def _db_get_child_counts(self):
+        return {DBAction.vtType: len(self.db_actions),
+                DBTag.vtType: len(self.db_tags),
+                DBAnnotation.vtType: len(self.db_annotations),
+                DBControlParameter.vtType: len(self.db_controlParameters),
+                DBVistrailVariable.vtType: len(self.db_vistrailVariables),
+                DBParameterExploration.vtType: \
+                    len(self.db_parameter_explorations),
+                DBActionAnnotation.vtType: len(self.db_actionAnnotations)}
+
+    def db_get_journal(self):
+        """db_get_journal() -> list
+
+        Returns the journaled objects that were not deleted since.
+
+        """
+        indices = {DBAction.vtType: self.db_actions_id_index,
+                   DBAnnotation.vtType: self.db_annotations_id_index,
+                   DBActionAnnotation.vtType: \
+                       self.db_actionAnnotations_id_index}
+        return [obj for obj in self.db_journal
+                if indices[obj.vtType].get(obj.db_id) is obj]
+
+    def db_get_changed_children(self):
+        """db_get_changed_children() -> list
+
+        Returns the children that are not journaled but were changed in
+        place: tags, annotations, etc. and the actions whose notes were
+        edited.
+
+        """
+        journaled = set(id(obj) for obj in self.db_journal or [])
+        changed = [action for action in self.db_actions
+                   if action.is_dirty and id(action) not in journaled]
+        for child in chain(self.db_tags, self.db_annotations,
+                           self.db_controlParameters,
+                           self.db_vistrailVariables,
+                           self.db_parameter_explorations,
+                           self.db_actionAnnotations):
+            if id(child) not in journaled and child.has_changes():
+                changed.append(child)
+        return changed
+
+    def db_journal_is_complete(self):
+        """db_journal_is_complete() -> bool
+
+        Whether the journal alone accounts for the changes since it was
+        reset, i.e. nothing older was changed or deleted.
+
+        """
+        if self.db_journal is None or self.db_get_changed_children():
+            return False
+        counts = dict(self.db_journal_sizes)
+        for obj in self.db_get_journal():
+            counts[obj.vtType] += 1
+        return counts == self._db_get_child_counts()
+
     def db_add_object(self, obj):
         self.db_objects[(obj.vtType, obj.db_id)] = obj
 
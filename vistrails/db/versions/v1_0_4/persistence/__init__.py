@@ -35,8 +35,10 @@
 ###############################################################################
 from __future__ import division
 
+from itertools import chain
 from xml.auto_gen import XMLDAOListBase
 from sql.auto_gen import SQLDAOListBase
+from vistrails.core import debug
 from vistrails.core.system import get_elementtree_library
 
 from vistrails.db import VistrailsDBException
@@ -49,6 +51,31 @@ root_set = set([DBVistrail.vtType, DBWorkflow.vtType,
 
 ElementTree = get_elementtree_library()
 
+# tables of a vistrail's children, by how rows refer to their parent
+# (used to load a single version)
+action_id_children = ['add', 'change', 'delete', 'actionAnnotation']
+vistrail_id_children = ['tag', 'vistrailVariable', 'parameter_exploration']
+parent_type_children = ['abstraction', 'annotation', 'connection',
+                        'controlParameter', 'function', 'group', 'location',
+                        'module', 'other', 'parameter', 'pe_function',
+                        'pe_parameter', 'plugin_data', 'port', 'portSpec']
+fixed_parent_children = {'portSpec': ['portSpecItem']}
+# number of ids in one "IN" clause
+SELECT_IN_SIZE = 500
+
+# top-level children of a vistrail element: tag -> (dao name, list name)
+vistrail_children = {'action': ('action', 'actions'),
+                     'tag': ('tag', 'tags'),
+                     'annotation': ('annotation', 'annotations'),
+                     'controlParameter': ('controlParameter',
+                                          'controlParameters'),
+                     'vistrailVariable': ('vistrailVariable',
+                                          'vistrailVariables'),
+                     'parameterExploration': ('parameter_exploration',
+                                              'parameter_explorations'),
+                     'actionAnnotation': ('actionAnnotation',
+                                          'actionAnnotations')}
+
 
 class DAOList(dict):
     def __init__(self):
@@ -86,10 +113,92 @@ class DAOList(dict):
     def open_from_xml(self, filename, vtType, tree=None):
         """open_from_xml(filename) -> DBVistrail"""
         if tree is None:
+            if vtType == DBVistrail.vtType:
+                return self.iterparse_vistrail(filename)
             tree = self.parse_xml_file(filename)
         vistrail = self.read_xml_object(vtType, tree.getroot())
         return vistrail
 
+    def iterparse_vistrail(self, filename, defer=()):
+        """iterparse_vistrail(filename, defer: set) -> DBVistrail
+
+        Reads a vistrail without building the whole element tree: each
+        top-level child (action, annotation, ...) is turned into its
+        domain object as soon as its end tag is read, then dropped from
+        the tree. Children whose tag is in defer are kept as XML strings
+        in vistrail.db_deferred_xml and are only read by
+        read_deferred_xml(); they must be read before new ids are
+        allocated on the vistrail.
+
+        """
+        children = dict((name, []) for (_, name)
+                        in vistrail_children.itervalues())
+        deferred = []
+        root = None
+        depth = 0
+        f = open(filename, 'rb')
+        try:
+            for event, elem in ElementTree.iterparse(f, ('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                tag = elem.tag
+                if tag[0] == '{':
+                    tag = tag.split('}')[1]
+                if tag in defer:
+                    deferred.append(ElementTree.tostring(elem))
+                elif tag in vistrail_children:
+                    dao_name, name = vistrail_children[tag]
+                    children[name].append(
+                        self['xml'][dao_name].fromXML(elem))
+                elif elem.text is not None and elem.text.strip() != '':
+                    debug.warning("Unexpected element in vistrail: %s" %
+                                  elem.tag)
+                root.remove(elem)
+        finally:
+            f.close()
+
+        if root is None:
+            return None
+        # the root element has no children left, so this only reads
+        # its attributes
+        attrs = self.read_xml_object(DBVistrail.vtType, root)
+        if attrs is None:
+            return None
+        vistrail = DBVistrail(id=attrs.db_id,
+                              version=attrs.db_version,
+                              name=attrs.db_name,
+                              **children)
+        vistrail.db_deferred_xml = deferred
+        vistrail.is_dirty = False
+        return vistrail
+
+    def read_deferred_xml(self, vistrail):
+        """read_deferred_xml(vistrail: DBVistrail) -> None
+
+        Reads back the children skipped by iterparse_vistrail().
+
+        """
+        deferred = getattr(vistrail, 'db_deferred_xml', None)
+        if not deferred:
+            return
+        is_dirty = vistrail.is_dirty
+        for xml_str in deferred:
+            node = ElementTree.fromstring(xml_str)
+            tag = node.tag
+            if tag[0] == '{':
+                tag = tag.split('}')[1]
+            dao_name, name = vistrail_children[tag]
+            obj = self['xml'][dao_name].fromXML(node)
+            getattr(vistrail, 'db_add_' + dao_name)(obj)
+        vistrail.db_deferred_xml = []
+        vistrail.is_dirty = is_dirty
+
     def save_to_xml(self, obj, filename, tags, version=None):
         """save_to_xml(obj : object, filename: str, tags: dict,
                        version: str) -> None
@@ -179,6 +288,111 @@ class DAOList(dict):
 
         return res
 
+    def open_vistrail_version_from_db(self, db_connection, id, version,
+                                      lock=False):
+        """ Loads a vistrail with only the actions on the path from the
+            root to version, plus the vistrail-level tags, annotations,
+            variables and explorations. Children are selected level by
+            level from the ids of the objects loaded so far.
+        """
+        vistrail_dao = self['sql'][DBVistrail.vtType]
+        res_objects = vistrail_dao.get_sql_columns(db_connection, {'id': id},
+                                                   lock)
+        if len(res_objects) != 1:
+            raise VistrailsDBException("No objects of type '%s' and "
+                                       "id '%s' exist in the database" % \
+                                           (DBVistrail.vtType, id))
+        res = res_objects.values()[0]
+        global_props = {'entity_id': res.db_id,
+                        'entity_type': res.vtType}
+
+        # the action table is small, the path is found from its rows
+        actions = self['sql']['action'].get_sql_columns(db_connection,
+                                                         global_props, lock)
+        action_ids = []
+        while version != 0:
+            action = actions.get(('action', version))
+            if action is None:
+                raise VistrailsDBException("Version %s does not exist in "
+                                           "vistrail %s" % (version, id))
+            action_ids.append(version)
+            version = action.db_prevId
+
+        all_objects = dict(res_objects)
+        for action_id in action_ids:
+            key = ('action', action_id)
+            all_objects[key] = actions[key]
+
+        def chunks(ids):
+            ids = sorted(ids)
+            for i in xrange(0, len(ids), SELECT_IN_SIZE):
+                yield ids[i:i + SELECT_IN_SIZE]
+
+        def where(**kwargs):
+            props = dict(global_props)
+            props.update(kwargs)
+            return props
+
+        daoList = []
+        dbCommandList = []
+        for dao_type in action_id_children:
+            dao = self['sql'][dao_type]
+            for ids in chunks(action_ids):
+                daoList.append(dao)
+                dbCommandList.append(dao.get_sql_select(
+                        db_connection, where(action_id=ids), lock))
+        for dao_type in vistrail_id_children:
+            dao = self['sql'][dao_type]
+            daoList.append(dao)
+            dbCommandList.append(dao.get_sql_select(
+                    db_connection, where(parent_id=res.db_id), lock))
+        parents = {DBVistrail.vtType: [res.db_id], 'action': action_ids}
+        while dbCommandList or parents:
+            for parent_type, parent_ids in parents.iteritems():
+                for ids in chunks(parent_ids):
+                    for dao_type in parent_type_children:
+                        dao = self['sql'][dao_type]
+                        daoList.append(dao)
+                        dbCommandList.append(dao.get_sql_select(
+                                db_connection,
+                                where(parent_type=parent_type, parent_id=ids),
+                                lock))
+                    for dao_type in fixed_parent_children.get(parent_type,
+                                                              []):
+                        dao = self['sql'][dao_type]
+                        daoList.append(dao)
+                        dbCommandList.append(dao.get_sql_select(
+                                db_connection, where(parent_id=ids), lock))
+            if not dbCommandList:
+                break
+            results = vistrail_dao.executeSQLGroup(db_connection,
+                                                   dbCommandList, True)
+            parents = {}
+            for dao, data in zip(daoList, results):
+                current_objs = dao.process_sql_columns(data, global_props)
+                all_objects.update(current_objs)
+                for key in current_objs:
+                    parents.setdefault(key[0], []).append(key[1])
+                    if key[0] == DBGroup.vtType:
+                        new_props = {'parent_id': key[1],
+                                     'entity_id': global_props['entity_id'],
+                                     'entity_type': global_props['entity_type']}
+                        res_obj = self.open_from_db(db_connection,
+                                                    DBWorkflow.vtType,
+                                                    None, lock, new_props)
+                        all_objects[(res_obj.vtType, res_obj.db_id)] = res_obj
+            daoList = []
+            dbCommandList = []
+
+        for key, obj in all_objects.iteritems():
+            if obj is res:
+                continue
+            self['sql'][obj.vtType].from_sql_fast(obj, all_objects)
+        for obj in all_objects.itervalues():
+            obj.is_dirty = False
+            obj.is_new = False
+        return res
+
     def open_many_from_db(self, db_connection, vtType, ids, lock=False):
         """ Loads multiple objects. They need to be loaded as one single
             multiple select statement command for performance reasons.
@@ -266,13 +480,30 @@ class DAOList(dict):
     
         return objects
 
+    def get_save_children(self, obj, do_copy):
+        """ Returns the children of obj that a save needs to visit. For a
+            vistrail that keeps a journal, these are the journaled
+            objects, the other vistrail-level children that changed
+            (tags, annotations and action notes are edited in place) and
+            the vistrail itself.
+        """
+        if do_copy or getattr(obj, 'db_journal', None) is None:
+            return obj.db_children()
+        parent = (obj.vtType, obj.db_id)
+        children = []
+        for child in chain(obj.db_get_journal(),
+                           obj.db_get_changed_children()):
+            children.extend(child.db_children(parent))
+        children.append((obj, None, None))
+        return children
+
     def save_to_db(self, db_connection, obj, do_copy=False, global_props=None):
         if do_copy == 'with_ids':
             do_copy = True
         elif do_copy and obj.db_id is not None:
             obj.db_id = None
 
-        children = obj.db_children()
+        children = self.get_save_children(obj, do_copy)
         children.reverse()
         if global_props is None:
             global_props = {'entity_type': obj.vtType}
@@ -330,6 +561,8 @@ class DAOList(dict):
                                                           global_props,
                                                           lastId)
             self['sql'][child.vtType].to_sql_fast(child, do_copy)
+            child.is_dirty = False
+            child.is_new = False
             if child.vtType == DBGroup.vtType:
                 if child.db_workflow:
                     # print '*** entity_type:', global_props['entity_type']
@@ -354,7 +587,7 @@ class DAOList(dict):
             if do_copy and obj.db_id is not None:
                 obj.db_id = None
 
-            children = obj.db_children()
+            children = self.get_save_children(obj, do_copy)
             children.reverse()
             global_props = {'entity_type': obj.vtType}
 
@@ -424,6 +657,8 @@ class DAOList(dict):
                                                               global_props,
                                                               lastId)
                 self['sql'][child.vtType].to_sql_fast(child, do_copy)
+                child.is_dirty = False
+                child.is_new = False
                 if child.vtType == DBGroup.vtType:
                     if child.db_workflow:
                         # print '*** entity_type:', global_props['entity_type']
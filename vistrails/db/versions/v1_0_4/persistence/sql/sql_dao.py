@@ -41,7 +41,7 @@ from datetime import date, datetime
 from vistrails.core import debug
 from vistrails.core.system import strftime, time_strptime
 from vistrails.db import VistrailsDBException
-from vistrails.db.services.io import get_db_lib
+from vistrails.db.services.io import get_db_lib, is_sqlite_connection
 
 class SQLDAO:
     def __init__(self):
@@ -137,9 +137,15 @@ class SQLDAO:
         whereClause = ''
         values = []
         for column, value in whereMap.iteritems():
-            whereStr += '%s%s = %%s' % \
-                        (whereClause, column)
-            values.append(value)
+            if isinstance(value, list):
+                # match any of the values
+                whereStr += '%s%s IN (%s)' % \
+                            (whereClause, column, ', '.join(['%s'] * len(value)))
+                values.extend(value)
+            else:
+                whereStr += '%s%s = %%s' % \
+                            (whereClause, column)
+                values.append(value)
             whereClause = ' AND '
         dbCommand = """SELECT %s FROM %s WHERE %s""" % \
                     (columnStr, table, whereStr)
@@ -199,8 +205,17 @@ class SQLDAO:
             (table, whereStr)
         return (dbCommand, tuple(values))
 
+    def prepareSQLite(self, dbCommand):
+        """ Rewrites a MySQL-style prepared statement for sqlite3 """
+        if dbCommand.endswith(" FOR UPDATE;"):
+            # sqlite locks the whole database when writing
+            dbCommand = dbCommand[:-len(" FOR UPDATE;")] + ";"
+        return dbCommand.replace('%s', '?')
+
     def executeSQL(self, db, cmd_tuple, isFetch):
         dbCommand, values = cmd_tuple
+        if is_sqlite_connection(db):
+            dbCommand = self.prepareSQLite(dbCommand)
         # print 'db: %s' % dbCommand
         # print 'values:', values
         data = None
@@ -222,6 +237,8 @@ class SQLDAO:
         """ Executes a command consisting of multiple SELECT statements
             It returns a list of results from the SELECT statements
         """
+        if is_sqlite_connection(db):
+            return self.executeSQLiteGroup(db, dbCommandList, isFetch)
         data = []
         # break up into bundles
         BUNDLE_SIZE = 10000
@@ -253,6 +270,45 @@ class SQLDAO:
             n += BUNDLE_SIZE
         return data
 
+    def executeSQLiteGroup(self, db, dbCommandList, isFetch):
+        """ Executes a list of commands on a sqlite3 connection
+
+        Commands sharing a prepared statement are sent together through
+        executemany, except for inserts that rely on an auto-increment
+        id, which run one by one so their lastrowid can be returned
+        (the result for batched commands is None). The writes are part
+        of the connection's current transaction.
+
+        """
+        data = [None] * len(dbCommandList)
+        batches = {}
+        order = []
+        cur = db.cursor()
+        try:
+            for i, (prepared, values) in enumerate(dbCommandList):
+                if isFetch:
+                    cur.execute(self.prepareSQLite(prepared), values)
+                    data[i] = cur.fetchall()
+                elif (prepared.startswith('INSERT') and
+                        'id' not in prepared[:prepared.index(')')].
+                        split('(', 1)[1].split(', ')):
+                    cur.execute(self.prepareSQLite(prepared), values)
+                    data[i] = cur.lastrowid
+                elif prepared in batches:
+                    batches[prepared].append(values)
+                else:
+                    batches[prepared] = [values]
+                    order.append(prepared)
+            for prepared in order:
+                cur.executemany(self.prepareSQLite(prepared),
+                                batches[prepared])
+        except Exception, e:
+            raise VistrailsDBException('Command failed: %s -- """ %s """' %
+                                       (e, prepared))
+        finally:
+            cur.close()
+        return data
+
     def start_transaction(self, db):
         db.begin()
 
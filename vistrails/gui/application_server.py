@@ -38,6 +38,7 @@ from __future__ import division
 
 import Queue
 import base64
+import functools
 import hashlib
 import inspect
 import sys
@@ -60,6 +61,8 @@ from SimpleXMLRPCServer import SimpleXMLRPCServer
 from datetime import date, datetime
 
 from vistrails.core.application import VistrailsApplicationInterface
+from vistrails.core.cache.vistrail_cache import RequestCoalescer, \
+    VistrailCache
 import vistrails.gui.theme
 import vistrails.core.application
 from vistrails.gui import qt
@@ -117,6 +120,26 @@ class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn,
     related objects because they won't be in the main thread."""
 ################################################################################
 
+vistrail_cache = VistrailCache()
+request_coalescer = RequestCoalescer()
+
+def coalesced(method):
+    """Makes concurrent calls to a RequestHandler method with the same
+    arguments share a single execution."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__,) + args
+        try:
+            hash(key)
+        except TypeError:
+            return method(self, *args, **kwargs)
+        if kwargs:
+            return method(self, *args, **kwargs)
+        return request_coalescer.run(key, method, self, *args)
+    return wrapper
+
+################################################################################
+
 class RequestHandler(object):
     """This class will handle all the requests sent to the server.
     Add new methods here and they will be exposed through the XML-RPC interface
@@ -149,6 +172,8 @@ class RequestHandler(object):
         Memory usage of the current process in kilobytes. We plan to
         use this to clear cache on demand later.
         I believe this works on Linux only.
+        The statistics of the vistrail cache and the number of coalesced
+        requests are reported along.
         """
         status = None
         result = {'peak': 0, 'rss': 0}
@@ -164,6 +189,8 @@ class RequestHandler(object):
         finally:
             if status is not None:
                 status.close()
+        result['vistrail_cache'] = vistrail_cache.stats()
+        result['coalesced_requests'] = request_coalescer.coalesced
         return result
 
     def path_exists_and_not_empty(self, path):
@@ -202,8 +229,7 @@ class RequestHandler(object):
                                 obj_type=None,
                                 connection_id=None)
 
-            v = locator.load().vistrail
-            p = v.getPipeline(long(version))
+            p = vistrail_cache.get_pipeline(locator, long(version))
 
             if p:
                 result = []
@@ -257,7 +283,7 @@ class RequestHandler(object):
                                 obj_type=None,
                                 connection_id=None)
             (vistrail, abstractions, thumbnails, mashups) = \
-                                                      io.load_vistrail(locator)
+                                          vistrail_cache.load_vistrail(locator)
             for mashuptrail in mashups:
                 # Find tagged mashups for this version
                 if mashuptrail.vtVersion == version:
@@ -566,7 +592,7 @@ class RequestHandler(object):
                                 obj_id=int(vt_id),
                                 obj_type=None,
                                 connection_id=None)
-            (vistrail, _, _, _)  = io.load_vistrail(locator)
+            (vistrail, _, _, _)  = vistrail_cache.load_vistrail(locator)
 
             # get server packages
             local_packages = [x.identifier for x in \
@@ -578,7 +604,7 @@ class RequestHandler(object):
 
             # find runnable workflows
             for version_id, version_tag in vistrail.get_tagMap().iteritems():
-                pipeline = vistrail.getPipeline(version_id)
+                pipeline = vistrail_cache.get_pipeline(locator, version_id)
                 workflow_packages = set()
                 on_repo = True
                 has_python_source = False
@@ -905,6 +931,7 @@ class RequestHandler(object):
             return (str(e), 0)
 
     #vistrails
+    @coalesced
     def run_from_db(self, host, port, db_name, vt_id, path_to_figures,
                     version=None,  pdf=False, vt_tag='', build_always=False,
                     parameters='', is_local=True):
@@ -1056,8 +1083,7 @@ class RequestHandler(object):
                                 obj_type=None,
                                 connection_id=None)
 
-            v = locator.load().vistrail
-            p = v.getPipeline(long(version))
+            p = vistrail_cache.get_pipeline(locator, long(version))
 
             if p:
                 result = []
@@ -1099,7 +1125,7 @@ class RequestHandler(object):
                                 obj_type=None,
                                 connection_id=None)
 
-            (v, _ , _, _)  = io.load_vistrail(locator)
+            (v, _ , _, _)  = vistrail_cache.load_vistrail(locator)
             if v.has_tag_str(vt_tag):
                 version = v.get_tag_str(vt_tag).action_id
             self.server_logger.info("Answer: %s" % version)
@@ -1133,7 +1159,7 @@ class RequestHandler(object):
                                 obj_type=None,
                                 connection_id=None)
 
-            (v, _ , _, _)  = io.load_vistrail(locator)
+            (v, _ , _, _)  = vistrail_cache.load_vistrail(locator)
             result = io.serialize(v)
             return (result, 1)
         except xmlrpclib.ProtocolError, err:
@@ -1163,8 +1189,7 @@ class RequestHandler(object):
                                 obj_type=None,
                                 connection_id=None)
 
-            (v, _ , _, _)  = io.load_vistrail(locator)
-            p = v.getPipeline(long(version))
+            p = vistrail_cache.get_pipeline(locator, long(version))
             if p:
                 result = io.serialize(p)
                 self.server_logger.info("success")
@@ -1187,6 +1212,7 @@ class RequestHandler(object):
             self.server_logger.error(traceback.format_exc())
         return (result, 0)
 
+    @coalesced
     def get_wf_graph_pdf(self, host, port, db_name, vt_id, version, is_local=True):
         """get_wf_graph_pdf(host:str, port:int, db_name:str, vt_id:int,
                           version:int) -> str
@@ -1271,6 +1297,7 @@ class RequestHandler(object):
             self.server_logger.error(traceback.format_exc())
             return (str(e), 0)
 
+    @coalesced
     def get_wf_graph_png(self, host, port, db_name, vt_id, version, is_local=True):
         """get_wf_graph_png(host:str, port:int, db_name:str, vt_id:int,
                           version:int) -> str
@@ -1372,6 +1399,7 @@ class RequestHandler(object):
         else:
             return False
 
+    @coalesced
     def get_vt_graph_png(self, host, port, db_name, vt_id, is_local=True):
         """get_vt_graph_png(host:str, port: str, db_name: str, vt_id:str) -> str
         Returns the relative url of the generated image
@@ -1461,6 +1489,7 @@ class RequestHandler(object):
             self.server_logger.error(traceback.format_exc())
             return (str(e), 0)
 
+    @coalesced
     def get_vt_graph_pdf(self, host, port, db_name, vt_id, is_local=True):
         """get_vt_graph_pdf(host:str, port: str, db_name: str, vt_id:str) -> str
         Returns the relative url of the generated image
@@ -1551,6 +1580,7 @@ class RequestHandler(object):
             self.server_logger.error(traceback.format_exc())
             return (str(e), 0)
         
+    @coalesced
     def get_vt_zip(self, host, port, db_name, vt_id):
         """get_vt_zip(host:str, port: str, db_name: str, vt_id:str) -> str
         Returns a .vt file encoded as base64 string
@@ -1615,8 +1645,7 @@ class RequestHandler(object):
                                 obj_type=None,
                                 connection_id=None)
 
-            (v, _ , _, _)  = io.load_vistrail(locator)
-            p = v.getPipeline(long(version))
+            p = vistrail_cache.get_pipeline(locator, long(version))
             if p:
                 vistrail = Vistrail()
                 action_list = []
@@ -1720,7 +1749,7 @@ class RequestHandler(object):
                                 connection_id=None)
 
             result = []
-            v = locator.load().vistrail
+            (v, _ , _, _)  = vistrail_cache.load_vistrail(locator)
             for elem, tag in v.get_tagMap().iteritems():
                 action_map = v.actionMap[long(elem)]
                 thumbnail_fname = ""
@@ -2205,6 +2234,10 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
 
         if config.has_option("script", "virtual_display"):
             virtual_display = config.get("script", "virtual_display")
+
+        if config.has_option("cache", "max_vistrails"):
+            vistrail_cache.max_vistrails = config.getint("cache",
+                                                         "max_vistrails")
         
         if virtual_display == "":
             virtual_display = "0"
@@ -173,6 +173,17 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
         whileLayout.addStretch(1)
         self.layout().addLayout(whileLayout)
 
+        layout = QtGui.QHBoxLayout()
+        self.workersLabel = QtGui.QLabel("Loop threads:")
+        layout.addWidget(self.workersLabel)
+        layout.setStretch(0, 0)
+        self.workersEdit = QtGui.QLineEdit()
+        self.workersEdit.setValidator(QtGui.QIntValidator(self))
+        self.workersEdit.setToolTip('Run the iterations of a looped module on this many threads (thread-safe modules only)')
+        layout.addWidget(self.workersEdit)
+        layout.setStretch(1, 1)
+        self.layout().addLayout(layout)
+
         self.jobCacheButton = QtGui.QCheckBox("Cache Output Persistently")
         self.jobCacheButton.setToolTip('Cache the module results persistently to disk. (outputs must be constants)')
         self.layout().addWidget(self.jobCacheButton)
@@ -208,6 +219,7 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
         self.delayEdit.textChanged.connect(self.stateChanged)
         self.feedInputEdit.textChanged.connect(self.stateChanged)
         self.feedOutputEdit.textChanged.connect(self.stateChanged)
+        self.workersEdit.textChanged.connect(self.stateChanged)
         self.jobCacheButton.toggled.connect(self.stateChanged)
 
     def sizeHint(self):
@@ -304,6 +316,7 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
             self.feedInputLabel.setVisible(False)
             self.feedOutputLabel.setVisible(False)
             self.portCombiner.setVisible(False)
+            self.workersEdit.setEnabled(False)
             self.jobCacheButton.setEnabled(False)
             self.state_changed = False
             self.saveButton.setEnabled(False)
@@ -329,6 +342,8 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
         self.feedOutputLabel.setVisible(False)
         self.portCombiner.setVisible(False)
         self.portCombiner.setDefault(module)
+        self.workersEdit.setEnabled(True)
+        self.workersEdit.setText('')
         self.jobCacheButton.setEnabled(True)
         self.jobCacheButton.setChecked(False)
         if module.has_control_parameter_with_name(ModuleControlParam.LOOP_KEY):
@@ -357,6 +372,9 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
         if module.has_control_parameter_with_name(ModuleControlParam.WHILE_OUTPUT_KEY):
             output = module.get_control_parameter_by_name(ModuleControlParam.WHILE_OUTPUT_KEY).value
             self.feedOutputEdit.setText(output)
+        if module.has_control_parameter_with_name(ModuleControlParam.LOOP_WORKERS_KEY):
+            workers = module.get_control_parameter_by_name(ModuleControlParam.LOOP_WORKERS_KEY).value
+            self.workersEdit.setText(workers)
         if module.has_control_parameter_with_name(ModuleControlParam.JOB_CACHE_KEY):
             jobCache = module.get_control_parameter_by_name(ModuleControlParam.JOB_CACHE_KEY).value
             self.jobCacheButton.setChecked(jobCache.lower()=='true')
@@ -384,6 +402,8 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
                        _while and self.feedInputEdit.text()))
         values.append((ModuleControlParam.WHILE_OUTPUT_KEY,
                        _while and self.feedOutputEdit.text()))
+        values.append((ModuleControlParam.LOOP_WORKERS_KEY,
+                       self.workersEdit.text()))
         jobCache = self.jobCacheButton.isChecked()
         values.append((ModuleControlParam.JOB_CACHE_KEY,
                        [False, 'true'][jobCache]))
@@ -349,7 +349,6 @@ class VistrailController(QtCore.QObject, BaseController):
         if action is not None:
             BaseController.add_new_action(self, action, description)
             self.emit(QtCore.SIGNAL("new_action"), action)
-            self.recompute_terse_graph()
 
     ##########################################################################
 
@@ -659,6 +658,11 @@ class VistrailController(QtCore.QObject, BaseController):
         self._current_graph_layout.layout_from(self.vistrail,
                                                self._current_terse_graph)
 
+    def update_terse_graph(self, versions=()):
+        BaseController.update_terse_graph(self, versions)
+        self._current_graph_layout.layout_from(self.vistrail,
+                                               self._current_terse_graph)
+
     def refine_graph(self, step=1.0):
         """ refine_graph(step: float in [0,1]) -> (Graph, Graph)        
         Refine the graph of the current vistrail based the search
@@ -707,12 +711,11 @@ class VistrailController(QtCore.QObject, BaseController):
             if not dest_node_in_terse_tree and \
                     not current_node_will_be_visible and not current == 0:
                 # we're going from one boring node to another,
-                # so just rename the node on the terse graph
-                self._current_terse_graph.rename_vertex(current, new_version)
+                # so just replace the node on the terse graph
+                BaseController.update_terse_graph(self)
                 self.replace_unnamed_node_in_version_tree(current, new_version)
             else:
-                # bail, for now
-                self.recompute_terse_graph()
+                self.update_terse_graph()
                 self.invalidate_version_tree(False)
         
 
@@ -784,7 +787,9 @@ class VistrailController(QtCore.QObject, BaseController):
             self.vistrail.addTag(tag, self.current_base_version)
 
         self.set_changed(True)
-        self.recompute_terse_graph()
+        self.update_terse_graph([v for v in (tag_version,
+                                             self.current_base_version)
+                                 if v is not None])
         self.invalidate_version_tree(False)
         return True
 
@@ -1255,29 +1260,26 @@ class VistrailController(QtCore.QObject, BaseController):
         if self.current_pipeline and actions:
             pe_log_id = uuid.uuid1()
             explorer = ActionBasedParameterExploration()
-            (pipelines, performedActions) = explorer.explore(
-                self.current_pipeline, actions, pre_actions)
+            # The pipelines are generated one at a time, as they get executed
+            points = explorer.iter_explore(self.current_pipeline, actions,
+                                           pre_actions)
             
             dim = [max(1, len(a)) for a in actions]
+            pointCount = reduce(lambda a, b: a*b, dim)
             if use_spreadsheet:
-                from vistrails.gui.paramexplore.virtual_cell import positionPipelines, assembleThumbnails
+                from vistrails.gui.paramexplore.virtual_cell import positionPipeline, assembleThumbnails
                 from vistrails.gui.paramexplore.pe_view import QParamExploreView
-                modifiedPipelines, pipelinePositions = positionPipelines(
-                    'PE#%d %s' % (QParamExploreView.explorationId, self.name),
-                    dim[2], dim[1], dim[0], pipelines, pe.layout, self)
+                sheetPrefix = 'PE#%d %s' % (QParamExploreView.explorationId,
+                                            self.name)
                 QParamExploreView.explorationId += 1
+                def place(pId, pipeline):
+                    return positionPipeline(sheetPrefix, dim[2], dim[1],
+                                            dim[0], pId, pipeline, pe.layout)
             else:
-                from vistrails.core.param_explore import _pipelinePositions
-                modifiedPipelines = pipelines
-                pipelinePositions = _pipelinePositions(
-                    dim[2], dim[1], dim[0], pipelines)
-
-            mCount = []
-            for p in modifiedPipelines:
-                if len(mCount)==0:
-                    mCount.append(0)
-                else:
-                    mCount.append(len(p.modules)+mCount[len(mCount)-1])
+                from vistrails.core.param_explore import _pipelinePosition
+                def place(pId, pipeline):
+                    return pipeline, _pipelinePosition(pId, dim[2], dim[1],
+                                                       dim[0])
 
             from vistrails.gui.job_monitor import QJobView
             jobView = QJobView.instance()
@@ -1290,18 +1292,21 @@ class VistrailController(QtCore.QObject, BaseController):
             try:
                 # Now execute the pipelines
 
-                if showProgress:
-                    totalProgress = sum([len(p.modules) for p in modifiedPipelines])
-                    self.progress = PEProgressDialog(self.vistrail_view, totalProgress)
-                    self.progress.show()
-
                 interpreter = get_default_interpreter()
 
                 images = {}
                 errors = []
-                for pi in xrange(len(modifiedPipelines)):
+                totalProgress = 0
+                for pi, (pipeline, performedActions) in enumerate(points):
+                    pipeline, pipelinePosition = place(pi, pipeline)
                     if showProgress:
-                        self.progress.setValue(mCount[pi])
+                        if pi == 0:
+                            # all the points have the same modules
+                            totalProgress = pointCount * len(pipeline.modules)
+                            self.progress = PEProgressDialog(
+                                self.vistrail_view, totalProgress)
+                            self.progress.show()
+                        self.progress.setValue(pi * len(pipeline.modules))
                         QtCore.QCoreApplication.processEvents()
                         if self.progress.wasCanceled():
                             break
@@ -1311,18 +1316,18 @@ class VistrailController(QtCore.QObject, BaseController):
                                 QtCore.QCoreApplication.processEvents()
                     if use_spreadsheet:
                         name = os.path.splitext(self.name)[0] + \
-                                             ("_%s_%s_%s" % pipelinePositions[pi])
+                                             ("_%s_%s_%s" % pipelinePosition)
                         extra_info['nameDumpCells'] = name
                         if 'pathDumpCells' in extra_info:
-                            images[pipelinePositions[pi]] = \
+                            images[pipelinePosition] = \
                                        os.path.join(extra_info['pathDumpCells'], name)
-                    pe_cell_id = (pe_log_id,) + pipelinePositions[pi]
+                    pe_cell_id = (pe_log_id,) + pipelinePosition
                     kwargs = {'locator': self.locator,
                               'job_monitor': self.jobMonitor,
                               'current_version': self.current_version,
                               'reason': 'Parameter Exploration %s %s_%s_%s' % pe_cell_id,
                               'logger': self.get_logger(),
-                              'actions': performedActions[pi],
+                              'actions': performedActions,
                               'extra_info': extra_info
                               }
                     if view:
@@ -1337,7 +1342,7 @@ class VistrailController(QtCore.QObject, BaseController):
 
                     # Create job
                     # check if a job exist for this workflow
-                    job_id = 'Parameter Exploration %s %s %s_%s_%s' % ((self.current_version, pe.id) + pipelinePositions[pi])
+                    job_id = 'Parameter Exploration %s %s %s_%s_%s' % ((self.current_version, pe.id) + pipelinePosition)
 
                     current_workflow = None
                     for wf in self.jobMonitor.workflows.itervalues():
@@ -1349,20 +1354,20 @@ class VistrailController(QtCore.QObject, BaseController):
                         current_workflow = JobWorkflow(job_id)
                         self.jobMonitor.startWorkflow(current_workflow)
                     try:
-                        result = interpreter.execute(modifiedPipelines[pi], **kwargs)
+                        result = interpreter.execute(pipeline, **kwargs)
                     finally:
                         self.jobMonitor.finishWorkflow()
 
                     for error in result.errors.itervalues():
                         if use_spreadsheet:
-                            pp = pipelinePositions[pi]
+                            pp = pipelinePosition
                             errors.append(((pp[1], pp[0], pp[2]), error))
                         else:
                             errors.append(((0,0,0), error))
 
             finally:
                 jobView.updating_now = False
-                if showProgress:
+                if showProgress and self.progress is not None:
                     self.progress.setValue(totalProgress)
                     self.progress.hide()
                     self.progress.deleteLater()
@@ -41,4 +41,7 @@ from vistrails.core.configuration import ConfigurationObject
 
 from identifiers import *
 
-configuration = ConfigurationObject(env=(None, str))
+# max_processes is the number of tool processes that can run at the same
+# time, which is also how many iterations of a module run concurrently by
+# default; 0 for one per CPU
+configuration = ConfigurationObject(env=(None, str), max_processes=1)
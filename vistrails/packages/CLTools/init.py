@@ -38,12 +38,14 @@ from __future__ import division
 
 import errno
 import json
+import multiprocessing
 import os
 import shutil
 import subprocess
 import sys
+import threading
 
-from vistrails.core.modules.vistrails_module import Module, ModuleError, IncompleteImplementation, new_module
+from vistrails.core.modules.vistrails_module import Module, ModuleError, IncompleteImplementation, ThreadSafe, new_module
 import vistrails.core.modules.module_registry
 from vistrails.core import debug
 from vistrails.core.packagemanager import get_package_manager
@@ -55,8 +57,24 @@ import identifiers
 
 cl_tools = {}
 
+# Limits the number of tool processes running at the same time
+process_slots = None
 
-class CLTools(Module):
+
+def get_max_processes():
+    """Returns the number of tool processes that can run at the same time.
+
+    This is 1 unless the max_processes setting enables running tools in
+    parallel.
+    """
+    if not configuration.has('max_processes'):
+        return 1
+    elif configuration.max_processes > 0:
+        return configuration.max_processes
+    return multiprocessing.cpu_count()
+
+
+class CLTools(ThreadSafe, Module):
     """ CLTools is the base Module.
      We will create a SUDSWebService Module for each method published by 
      the web service.
@@ -65,6 +83,10 @@ class CLTools(Module):
     def compute(self):
         raise IncompleteImplementation # pragma: no cover
 
+    def get_default_loop_workers(self):
+        # Iterations run as concurrent processes, up to the process limit
+        return get_max_processes()
+
 
 SUFFIX = '.clt'
 DEFAULTFILESUFFIX = '.cld'
@@ -191,13 +213,10 @@ def _add_tool(path):
             type = type.lower()
             if self.has_input(name):
                 value = self.get_input(name)
+                # Files are connected to the process directly, strings are
+                # written to a pipe unless std_using_files is set
                 if "file" == type:
-                    if file_std:
-                        f = open(value.name, 'rb')
-                    else:
-                        f = open(value.name, 'rb')
-                        stdin = f.read()
-                        f.close()
+                    f = open(value.name, 'rb')
                 elif "string" == type:
                     if file_std:
                         file = self.interpreter.filePool.create_file()
@@ -206,34 +225,20 @@ def _add_tool(path):
                         f.close()
                         f = open(file.name, 'rb')
                     else:
+                        f = None
                         stdin = value
                 else: # pragma: no cover
                     raise ValueError
-                if file_std:
+                if f is not None:
                     open_files.append(f)
                     kwargs['stdin'] = f.fileno()
                 else:
                     kwargs['stdin'] = subprocess.PIPE
-        if "stdout" in self.conf:
-            if file_std:
-                name, type, options = self.conf["stdout"]
-                type = type.lower()
-                file = self.interpreter.filePool.create_file(
-                        suffix=DEFAULTFILESUFFIX)
-                if "file" == type:
-                    self.set_output(name, file)
-                elif "string" == type:
-                    setOutput.append((name, file))
-                else: # pragma: no cover
-                    raise ValueError
-                f = open(file.name, 'wb')
-                open_files.append(f)
-                kwargs['stdout'] = f.fileno()
-            else:
-                kwargs['stdout'] = subprocess.PIPE
-        if "stderr" in self.conf:
-            if file_std:
-                name, type, options = self.conf["stderr"]
+        # Outputs are written to files by the process as it runs, so that
+        # they don't have to be held in memory
+        for pipe in ('stdout', 'stderr'):
+            if pipe in self.conf:
+                name, type, options = self.conf[pipe]
                 type = type.lower()
                 file = self.interpreter.filePool.create_file(
                         suffix=DEFAULTFILESUFFIX)
@@ -245,9 +250,7 @@ def _add_tool(path):
                     raise ValueError
                 f = open(file.name, 'wb')
                 open_files.append(f)
-                kwargs['stderr'] = f.fileno()
-            else:
-                kwargs['stderr'] = subprocess.PIPE
+                kwargs[pipe] = f.fileno()
 
         if fail_with_cmd:
             return_code = 0
@@ -311,18 +314,21 @@ def _add_tool(path):
         if 'dir' in self.conf:
             kwargs['cwd'] = self.conf['dir']
 
-        process = subprocess.Popen(args, **kwargs)
-        if file_std:
-            process.wait()
-        else:
-            #if stdin:
-            #    print "stdin:", len(stdin), stdin[:30]
-            stdout, stderr = _eintr_retry_call(process.communicate, stdin)
-            #stdout, stderr = process.communicate(stdin)
-            #if stdout:
-            #    print "stdout:", len(stdout), stdout[:30]
-            #if stderr:
-            #    print "stderr:", len(stderr), stderr[:30]
+        if vistrails.core.system.systemType not in ['Windows', 'Microsoft']:
+            # Don't leak the files opened by other threads (e.g. the pipes
+            # of concurrent tools) into the process
+            kwargs['close_fds'] = True
+
+        try:
+            with process_slots:
+                process = subprocess.Popen(args, **kwargs)
+                if stdin is None:
+                    _eintr_retry_call(process.wait)
+                else:
+                    _eintr_retry_call(process.communicate, stdin)
+        finally:
+            for f in open_files:
+                f.close()
 
         if return_code is not None:
             if process.returncode != return_code:
@@ -330,44 +336,11 @@ def _add_tool(path):
                                   process.returncode, return_code))
         self.set_output('return_code', process.returncode)
 
-        for f in open_files:
-            f.close()
-
         for name, file in setOutput:
             f = open(file.name, 'rb')
             self.set_output(name, f.read())
             f.close()
 
-        if not file_std:
-            if "stdout" in self.conf:
-                name, type, options = self.conf["stdout"]
-                type = type.lower()
-                if "file" == type:
-                    file = self.interpreter.filePool.create_file(
-                            suffix=DEFAULTFILESUFFIX)
-                    f = open(file.name, 'wb')
-                    f.write(stdout)
-                    f.close()
-                    self.set_output(name, file)
-                elif "string" == type:
-                    self.set_output(name, stdout)
-                else: # pragma: no cover
-                    raise ValueError
-            if "stderr" in self.conf:
-                name, type, options = self.conf["stderr"]
-                type = type.lower()
-                if "file" == type:
-                    file = self.interpreter.filePool.create_file(
-                            suffix=DEFAULTFILESUFFIX)
-                    f = open(file.name, 'wb')
-                    f.write(stderr)
-                    f.close()
-                    self.set_output(name, file)
-                elif "string" == type:
-                    self.set_output(name, stderr)
-                else: # pragma: no cover
-                    raise ValueError
-
 
     # create docstring
     d = """This module is a wrapper for the command line tool '%s'""" % \
@@ -427,6 +400,8 @@ def add_tool(path):
 
 
 def initialize(*args, **keywords):
+    global process_slots
+    process_slots = threading.BoundedSemaphore(get_max_processes())
     reload_scripts(initial=True)
 
 
@@ -586,3 +561,57 @@ class TestCLTools(unittest.TestCase):
         """With std_using_files: use files instead of pipes.
         """
         self.do_the_test('intern_cltools_2')
+
+    def test_max_processes(self):
+        """Tools run one at a time unless parallelism is enabled.
+        """
+        old_max = configuration.max_processes
+        try:
+            configuration.max_processes = 1
+            self.assertEqual(get_max_processes(), 1)
+            configuration.max_processes = 3
+            self.assertEqual(get_max_processes(), 3)
+            configuration.max_processes = 0
+            self.assertEqual(get_max_processes(),
+                             multiprocessing.cpu_count())
+        finally:
+            configuration.max_processes = old_max
+
+    def test_iterations(self):
+        """Iterations run as concurrent processes connected to files.
+        """
+        global process_slots
+        old_slots = process_slots
+        old_max = configuration.max_processes
+        configuration.max_processes = 3
+        process_slots = threading.BoundedSemaphore(3)
+        toolname = 'intern_cltools_3'
+        try:
+            with intercept_results(self._tools[toolname], 'stdout') as (
+                    stdout,):
+                self.assertFalse(execute([
+                        ('List', 'org.vistrails.vistrails.basic', [
+                            ('value', [('List', '[3, 1, 0, 2]')]),
+                        ]),
+                        (toolname, 'org.vistrails.vistrails.cltools', [
+                            ('stdin', [('File',
+                                        self.testdir + '/test_1.cltest')]),
+                        ]),
+                    ],
+                    [
+                        (0, 'value', 1, 'times'),
+                    ]))
+        finally:
+            configuration.max_processes = old_max
+            process_slots = old_slots
+        self.assertEqual(len(stdout[-1]), 4)
+        times = []
+        for nb, f in zip([3, 1, 0, 2], stdout[-1]):
+            with open(f.name, 'rb') as fp:
+                start, end = map(float, fp.readline().split())
+                self.assertEqual(fp.read(), 'this is a\ntest' * nb)
+            times.append((start, end))
+        # Some of the processes ran at the same time
+        self.assertTrue(any(s1 < e2 and s2 < e1
+                            for i, (s1, e1) in enumerate(times)
+                            for s2, e2 in times[i + 1:]))
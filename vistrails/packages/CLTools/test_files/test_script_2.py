@@ -0,0 +1,18 @@
+# pragma: no testimport
+
+from __future__ import division
+
+import sys
+import time
+
+
+if __name__ == '__main__':
+    # Writes the time at which it started and stopped, then its input
+    # repeated the number of times given on the command line
+    start = time.time()
+    time.sleep(0.5)
+    sys.stdout.write('%f %f\n' % (start, time.time()))
+    content = sys.stdin.read()
+    for i in range(int(sys.argv[1])):
+        sys.stdout.write(content)
+    sys.exit(0)
@@ -46,4 +46,10 @@ check is performed efficiently using HTTP headers.
 
 from __future__ import division
 
+from vistrails.core.configuration import ConfigurationObject
+
 from identifiers import *
+
+# max_cache_size is in megabytes, 0 for no limit; download_threads is the
+# number of downloads that can run at the same time
+configuration = ConfigurationObject(max_cache_size=0, download_threads=4)
@@ -0,0 +1,425 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+
+"""Bookkeeping for the download cache of the URL package.
+
+CacheIndex remembers the content hash, size and last use of each file in the
+cache directory. Files with identical contents are hard-linked to a single
+copy under the .objects directory, and the least recently used files are
+evicted when the cache grows over its size limit.
+
+DownloadManager runs downloads on a bounded pool of worker threads, so that
+the DownloadFile modules of a pipeline that run concurrently don't open more
+connections than that, and so that two modules asking for the same URL at the
+same time share a single download.
+"""
+
+from __future__ import division
+
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+
+try:
+    import hashlib
+    sha_hash = hashlib.sha1
+except ImportError:
+    import sha
+    sha_hash = sha.new
+
+from vistrails.core import debug
+
+
+def hash_file(filename, hasher=None):
+    """Feeds the content of a file to a SHA-1 hasher and returns it.
+    """
+    if hasher is None:
+        hasher = sha_hash()
+    with open(filename, 'rb') as fp:
+        while True:
+            chunk = fp.read(1 << 20)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher
+
+
+def replace_file(source, destination):
+    """Renames a file, replacing the destination if it exists.
+    """
+    if os.name == 'nt' and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+class CacheIndex(object):
+    """Index of the files in a download cache.
+
+    Entries are keyed by file name (relative to the cache directory) and
+    record the SHA-1 of the content, its size, the time it was downloaded and
+    the time it was last used.
+    The index is saved as JSON in the cache directory after each change.
+
+    max_size is the limit in bytes on the total size of the distinct contents
+    in the cache, or None.
+    """
+    INDEX_NAME = '.index'
+    OBJECTS_NAME = '.objects'
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.objects = os.path.join(directory, self.OBJECTS_NAME)
+        self.index_file = os.path.join(directory, self.INDEX_NAME)
+        self.lock = threading.RLock()
+        self.stats = dict(hits=0, misses=0, deduplicated=0, evicted=0,
+                          downloaded_bytes=0, resumed_bytes=0)
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, 'rb') as fp:
+                entries = json.load(fp)
+            if not isinstance(entries, dict):
+                raise ValueError("index is not a dictionary")
+        except IOError:
+            entries = {}
+        except ValueError, e:
+            debug.warning("Download cache index is corrupted, ignoring it",
+                          e)
+            entries = {}
+        self.entries = dict(
+                (name, entry)
+                for name, entry in entries.iteritems()
+                if os.path.isfile(os.path.join(self.directory, name)))
+
+    def save(self):
+        temp = self.index_file + '.tmp'
+        with open(temp, 'wb') as fp:
+            json.dump(self.entries, fp)
+        replace_file(temp, self.index_file)
+
+    def total_size(self):
+        """Total size of the distinct contents in the cache.
+        """
+        sizes = dict((entry['hash'], entry['size'])
+                     for entry in self.entries.itervalues())
+        return sum(sizes.itervalues())
+
+    def fetched(self, name):
+        """Returns the time at which a file was downloaded, or None.
+
+        Files with the same content share their modification time, so this
+        is used instead.
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            return entry['fetched']
+
+    def hit(self, name):
+        """Records that a cached file was used without downloading it.
+        """
+        with self.lock:
+            self.stats['hits'] += 1
+            entry = self.entries.get(name)
+            if entry is not None:
+                entry['used'] = time.time()
+            else:
+                # File from before the index existed, add it now
+                filename = os.path.join(self.directory, name)
+                try:
+                    self.entries[name] = {
+                            'hash': hash_file(filename).hexdigest(),
+                            'size': os.path.getsize(filename),
+                            'fetched': os.path.getmtime(filename),
+                            'used': time.time()}
+                except (IOError, OSError):
+                    return
+            self.save()
+
+    def add(self, name, digest, size):
+        """Records a file that was just downloaded.
+
+        If a file with the same content is already in the cache, the new file
+        is replaced with a link to it.
+        """
+        with self.lock:
+            self.stats['misses'] += 1
+            self.stats['downloaded_bytes'] += size
+            filename = os.path.join(self.directory, name)
+            link = getattr(os, 'link', None)
+            if link is not None:
+                obj = os.path.join(self.objects, digest)
+                try:
+                    if not os.path.isdir(self.objects):
+                        os.mkdir(self.objects)
+                    if os.path.isfile(obj):
+                        temp = filename + '.link'
+                        link(obj, temp)
+                        replace_file(temp, filename)
+                        self.stats['deduplicated'] += 1
+                    else:
+                        link(filename, obj)
+                except OSError, e:
+                    debug.warning("Couldn't link downloaded file into the "
+                                  "cache", e)
+            now = time.time()
+            self.entries[name] = {'hash': digest, 'size': size,
+                                  'fetched': now, 'used': now}
+            self.evict(keep=name)
+            self.save()
+
+    def evict(self, keep=None):
+        """Removes the least recently used files until the cache fits.
+        """
+        if self.max_size is None:
+            return
+        with self.lock:
+            total = self.total_size()
+            if total <= self.max_size:
+                return
+            for name in sorted(self.entries,
+                               key=lambda n: self.entries[n]['used']):
+                if total <= self.max_size:
+                    break
+                if name == keep:
+                    continue
+                total -= self.remove(name)
+                self.stats['evicted'] += 1
+
+    def remove(self, name):
+        """Removes a file from the cache.
+
+        Returns the number of bytes freed.
+        """
+        with self.lock:
+            entry = self.entries.pop(name)
+            filename = os.path.join(self.directory, name)
+            for path in (filename, filename + '.etag'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            digest = entry['hash']
+            if any(other['hash'] == digest
+                   for other in self.entries.itervalues()):
+                return 0
+            try:
+                os.remove(os.path.join(self.objects, digest))
+            except OSError:
+                pass
+            return entry['size']
+
+
+class DownloadTask(object):
+    """A download queued on a DownloadManager.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self.job.execute()
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.done.set()
+
+    def wait(self, progress=None, interval=0.1):
+        """Waits for the download to finish and returns its result.
+
+        progress is called on the waiting thread with the fraction of the
+        file that has been downloaded, whenever it changes. Exceptions raised
+        by the job are re-raised here.
+        """
+        last = None
+        while True:
+            # Event.wait() only returns the flag since Python 2.7
+            self.done.wait(interval)
+            if self.done.is_set():
+                break
+            current = getattr(self.job, 'progress', None)
+            if progress is not None and current is not None and \
+                    current != last:
+                progress(current)
+                last = current
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class DownloadManager(object):
+    """Runs downloads on a bounded pool of worker threads.
+
+    Jobs are objects with an execute() method, and optionally a progress
+    attribute holding the fraction already downloaded. Submitting a job with
+    the same key as one that is still running returns the existing task.
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max(1, max_workers)
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.tasks = {}
+        self.workers = []
+        self.file_locks = {}
+
+    def file_lock(self, name):
+        """Returns the lock that has to be held to write a given file.
+        """
+        with self.lock:
+            try:
+                return self.file_locks[name]
+            except KeyError:
+                lock = self.file_locks[name] = threading.Lock()
+                return lock
+
+    def submit(self, key, job):
+        with self.lock:
+            task = self.tasks.get(key)
+            if task is not None:
+                return task
+            task = DownloadTask(job)
+            self.tasks[key] = task
+            self.queue.put((key, task))
+            if len(self.workers) < min(self.max_workers, len(self.tasks)):
+                worker = threading.Thread(target=self._work,
+                                          name='DownloadManager worker')
+                worker.daemon = True
+                self.workers.append(worker)
+                worker.start()
+            return task
+
+    def _work(self):
+        while True:
+            key, task = self.queue.get()
+            try:
+                task.run()
+            finally:
+                with self.lock:
+                    del self.tasks[key]
+
+
+###############################################################################
+
+import shutil
+import tempfile
+import unittest
+
+
+class TestCacheIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_test_urlcache_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, index, name, content, used):
+        with open(os.path.join(self.directory, name), 'wb') as fp:
+            fp.write(content)
+        index.add(name, sha_hash(content).hexdigest(), len(content))
+        index.entries[name]['used'] = used
+
+    def test_dedup_and_evict(self):
+        index = CacheIndex(self.directory, max_size=10)
+        self.write(index, 'a', 'aaaa', 1)
+        self.write(index, 'b', 'aaaa', 2)
+        self.write(index, 'c', 'cccc', 3)
+        self.assertEqual(index.total_size(), 8)
+        self.assertEqual(index.stats['deduplicated'], 1)
+        if hasattr(os, 'link'):
+            self.assertTrue(os.path.samefile(
+                    os.path.join(self.directory, 'a'),
+                    os.path.join(self.directory, 'b')))
+
+        # Loading the index back
+        index = CacheIndex(self.directory, max_size=10)
+        self.assertEqual(sorted(index.entries), ['a', 'b', 'c'])
+
+        # 'a' and 'b' have to go for the new file to fit
+        self.write(index, 'd', 'dddddd', 4)
+        self.assertEqual(sorted(index.entries), ['c', 'd'])
+        self.assertEqual(index.stats['evicted'], 2)
+        self.assertEqual(index.total_size(), 10)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'a')))
+        if hasattr(os, 'link'):
+            self.assertEqual(sorted(os.listdir(index.objects)),
+                             sorted([sha_hash('cccc').hexdigest(),
+                                     sha_hash('dddddd').hexdigest()]))
+
+        # A hit makes 'c' the most recently used
+        index.hit('c')
+        self.write(index, 'e', 'ee', 5)
+        self.assertEqual(sorted(index.entries), ['c', 'e'])
+
+
+class TestDownloadManager(unittest.TestCase):
+    class Job(object):
+        def __init__(self, event, result):
+            self.event = event
+            self.result = result
+            self.runs = 0
+
+        def execute(self):
+            self.runs += 1
+            self.event.wait()
+            if isinstance(self.result, Exception):
+                raise self.result
+            return self.result
+
+    def test_coalesce(self):
+        manager = DownloadManager(max_workers=2)
+        event = threading.Event()
+        job1 = self.Job(event, 'one')
+        job2 = self.Job(event, ValueError('two'))
+        task1 = manager.submit('a', job1)
+        self.assertIs(manager.submit('a', self.Job(event, 'other')), task1)
+        task2 = manager.submit('b', job2)
+        self.assertEqual(len(manager.workers), 2)
+        event.set()
+        self.assertEqual(task1.wait(), 'one')
+        with self.assertRaises(ValueError):
+            task2.wait()
+        self.assertEqual((job1.runs, job2.runs), (1, 1))
@@ -41,7 +41,10 @@ without its associated data.
 
 This package uses a local cache, inside the per-user VisTrails directory. This
 way, files that haven't been changed do not need to be downloaded again. The
-check is performed efficiently using HTTP headers.
+check is performed efficiently using HTTP headers. Interrupted HTTP downloads
+are resumed, files with the same content are only stored once, and the least
+recently used files are removed when the cache grows over the max_cache_size
+configuration setting (in megabytes, 0 for no limit).
 """
 
 from __future__ import division
@@ -50,6 +53,7 @@ from datetime import datetime
 import email.utils
 import os
 import re
+import time
 import urllib
 import urllib2
 
@@ -65,19 +69,30 @@ from vistrails.core import debug
 import vistrails.core.modules.basic_modules
 from vistrails.core.modules.basic_modules import PathObject
 import vistrails.core.modules.module_registry
-from vistrails.core.modules.vistrails_module import Module, ModuleError
+from vistrails.core.modules.vistrails_module import Module, ModuleError, \
+    ThreadSafe
 from vistrails.core.system import current_dot_vistrails, strptime
 from vistrails.core.upgradeworkflow import UpgradeWorkflowHandler
 
+from . import configuration
+from .cache import CacheIndex, DownloadManager, hash_file, replace_file
 from .identifiers import identifier
 from .http_directory import download_directory
 from .https_if_available import build_opener
 
 
 package_directory = None
+cache_index = None
+download_manager = None
 
 MAX_CACHE_FILENAME = 100
 
+# The size of the chunks read from the network grows while they arrive fast
+# and shrinks when they are slow, so that progress still gets updated
+MIN_CHUNKSIZE = 16 * 1024
+MAX_CHUNKSIZE = 1024 * 1024
+CHUNK_TIME = 0.1
+
 
 ###############################################################################
 
@@ -94,49 +109,64 @@ def cache_filename(url):
 ###############################################################################
 
 class Downloader(object):
+    # Whether a partially downloaded file is kept to resume from it
+    resumable = False
+
     def __init__(self, url, module, insecure):
         self.url = url
         self.module = module
         self.opener = build_opener(insecure=insecure)
+        self.progress = None
+        self.cached = False
 
     def execute(self):
         """ Tries to download a file from url.
 
         Returns the path to the local file.
         """
-        self.local_filename = os.path.join(package_directory,
-                                           cache_filename(self.url))
+        self.cache_name = cache_filename(self.url)
+        self.local_filename = os.path.join(package_directory, self.cache_name)
+        self.part_filename = self.local_filename + '.part'
+        self.resume_from = 0
 
-        # Before download
-        self.pre_download()
+        with download_manager.file_lock(self.cache_name):
+            # Before download
+            self.pre_download()
 
-        # Send request
-        try:
-            response = self.send_request()
-        except urllib2.URLError, e:
-            if self.is_in_local_cache:
-                debug.warning("A network error occurred. DownloadFile will "
-                              "use a cached version of the file")
+            # Send request
+            try:
+                response = self.send_request()
+            except urllib2.URLError, e:
+                if self.is_in_local_cache:
+                    debug.warning("A network error occurred. DownloadFile "
+                                  "will use a cached version of the file")
+                    self.cache_hit()
+                    return self.local_filename
+                else:
+                    raise ModuleError(
+                            self.module,
+                            "Network error: %s" % debug.format_exception(e))
+            if response is None:
+                self.cache_hit()
                 return self.local_filename
-            else:
-                raise ModuleError(
-                        self.module,
-                        "Network error: %s" % debug.format_exception(e))
-        if response is None:
-            return self.local_filename
 
-        # Read response headers
-        self.size_header = None
-        if not self.read_headers(response):
-            return self.local_filename
+            # Read response headers
+            self.size_header = None
+            if not self.read_headers(response):
+                self.cache_hit()
+                return self.local_filename
+
+            # Download
+            self.download(response)
 
-        # Download
-        self.download(response)
+            # Post download
+            self.post_download(response)
 
-        # Post download
-        self.post_download(response)
+            return self.local_filename
 
-        return self.local_filename
+    def cache_hit(self):
+        self.cached = True
+        cache_index.hit(self.cache_name)
 
     def pre_download(self):
         pass
@@ -148,31 +178,51 @@ class Downloader(object):
         return True
 
     def download(self, response):
+        """Reads the response into the cache.
+
+        The data goes to a .part file which replaces the cached file once
+        complete, appending to it if resume_from is set.
+        """
         try:
-            dl_size = 0
-            CHUNKSIZE = 4096
-            f2 = open(self.local_filename, 'wb')
-            while True:
-                if self.size_header is not None:
-                    self.module.logging.update_progress(
-                            self.module,
-                            dl_size * 1.0/self.size_header)
-                chunk = response.read(CHUNKSIZE)
-                if not chunk:
-                    break
-                dl_size += len(chunk)
-                f2.write(chunk)
-            f2.close()
+            if self.resume_from:
+                hasher = hash_file(self.part_filename)
+                mode = 'ab'
+            else:
+                hasher = sha_hash()
+                mode = 'wb'
+            dl_size = self.resume_from
+            chunksize = MIN_CHUNKSIZE
+            with open(self.part_filename, mode) as f2:
+                while True:
+                    if self.size_header is not None:
+                        self.progress = dl_size / self.size_header
+                    start = time.time()
+                    chunk = response.read(chunksize)
+                    if not chunk:
+                        break
+                    elapsed = time.time() - start
+                    dl_size += len(chunk)
+                    hasher.update(chunk)
+                    f2.write(chunk)
+                    if elapsed < CHUNK_TIME and len(chunk) == chunksize:
+                        chunksize = min(chunksize * 2, MAX_CHUNKSIZE)
+                    elif elapsed > CHUNK_TIME * 10:
+                        chunksize = max(chunksize // 2, MIN_CHUNKSIZE)
             response.close()
+            replace_file(self.part_filename, self.local_filename)
 
         except Exception, e:
-            try:
-                os.unlink(self.local_filename)
-            except OSError:
-                pass
+            if not self.resumable:
+                try:
+                    os.unlink(self.part_filename)
+                except OSError:
+                    pass
             raise ModuleError(
                     self.module,
                     "Error retrieving URL: %s" % debug.format_exception(e))
+        if self.resume_from:
+            cache_index.stats['resumed_bytes'] += self.resume_from
+        cache_index.add(self.cache_name, hasher.hexdigest(), dl_size)
 
     def post_download(self, response):
         pass
@@ -183,6 +233,8 @@ class Downloader(object):
 
 
 class HTTPDownloader(Downloader):
+    resumable = True
+
     def pre_download(self):
         # Get ETag from disk
         try:
@@ -190,6 +242,14 @@ class HTTPDownloader(Downloader):
                 self.etag = etag_file.read()
         except IOError:
             self.etag = None
+        # Get the validator of the partial file, which tells the server to
+        # only send the rest of the file if it hasn't changed
+        try:
+            with open(self.part_filename + '.etag') as etag_file:
+                self.part_validator = etag_file.read()
+            self.resume_from = os.path.getsize(self.part_filename)
+        except (IOError, OSError):
+            self.part_validator = None
 
     def send_request(self):
         try:
@@ -200,13 +260,20 @@ class HTTPDownloader(Downloader):
                     self.etag)
             try:
                 mtime = email.utils.formatdate(
-                        os.path.getmtime(self.local_filename),
+                        self._local_time(),
                         usegmt=True)
                 request.add_header(
                     'If-Modified-Since',
                     mtime)
             except OSError:
                 pass
+            if self.resume_from and self.part_validator:
+                request.add_header(
+                    'Range',
+                    'bytes=%d-' % self.resume_from)
+                request.add_header(
+                    'If-Range',
+                    self.part_validator)
             return self.opener.open(request)
         except urllib2.HTTPError, e:
             if e.code == 304:
@@ -226,11 +293,51 @@ class HTTPDownloader(Downloader):
             self.size_header = int(size_header)
         except (KeyError, ValueError):
             self.size_header = None
+
+        if self.resume_from:
+            content_range = response.headers.get('content-range', '')
+            if response.getcode() != 206:
+                self.resume_from = 0
+            elif not content_range.startswith('bytes %d-' % self.resume_from):
+                response.close()
+                self._remove_part()
+                raise ModuleError(self.module,
+                                  "Server returned an invalid range, "
+                                  "download will restart from the beginning")
+            elif self.size_header is not None:
+                self.size_header += self.resume_from
+
+        if not self.resume_from:
+            # Remember what we are downloading, in case we need to resume
+            validator = response.headers.get('etag')
+            if not validator or validator.startswith('W/'):
+                validator = self.mod_header
+            if validator:
+                with open(self.part_filename + '.etag', 'w') as etag_file:
+                    etag_file.write(validator)
+            else:
+                self._remove_part()
         return True
 
+    def _remove_part(self):
+        for filename in (self.part_filename, self.part_filename + '.etag'):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def _local_time(self):
+        """Time at which the cached file was downloaded.
+
+        Raises OSError if the file isn't in the cache.
+        """
+        fetched = cache_index.fetched(self.cache_name)
+        if fetched is not None:
+            return fetched
+        return os.path.getmtime(self.local_filename)
+
     def _is_outdated(self):
-        local_time = datetime.utcfromtimestamp(
-                os.path.getmtime(self.local_filename))
+        local_time = datetime.utcfromtimestamp(self._local_time())
         try:
             remote_time = strptime(self.mod_header,
                                    "%a, %d %b %Y %H:%M:%S %Z")
@@ -249,6 +356,10 @@ class HTTPDownloader(Downloader):
         if (not self.is_in_local_cache or
                 not self.mod_header or self._is_outdated()):
             Downloader.download(self, response)
+            self._remove_part()
+        else:
+            response.close()
+            self.cache_hit()
 
     def post_download(self, response):
         try:
@@ -301,6 +412,8 @@ class SSHDownloader(object):
     def __init__(self, url, module, insecure):
         self.url = url
         self.module = module
+        self.progress = None
+        self.cached = False
 
     def execute(self):
         # Parse URL
@@ -338,8 +451,8 @@ class SSHDownloader(object):
         scp = py_import('scp', {
                 'pip': 'scp'})
 
-        local_filename = os.path.join(package_directory,
-                                      cache_filename(self.url))
+        name = cache_filename(self.url)
+        local_filename = os.path.join(package_directory, name)
 
         ssh = paramiko.SSHClient()
         ssh.load_system_host_keys()
@@ -350,7 +463,11 @@ class SSHDownloader(object):
             raise ModuleError(self.module, debug.format_exception(e))
         client = scp.SCPClient(ssh.get_transport())
 
-        client.get(path, local_filename)
+        with download_manager.file_lock(name):
+            client.get(path, local_filename + '.part')
+            replace_file(local_filename + '.part', local_filename)
+            cache_index.add(name, hash_file(local_filename).hexdigest(),
+                            os.path.getsize(local_filename))
         return local_filename
 
 
@@ -361,7 +478,7 @@ downloaders = {
     'scp': SSHDownloader}
 
 
-class DownloadFile(Module):
+class DownloadFile(ThreadSafe, Module):
     """ Downloads file from URL.
 
     This modules downloads a remote file. It tries to cache files on the local
@@ -392,6 +509,10 @@ class DownloadFile(Module):
         be specified
 
     If `insecure` is set, an invalid TLS certificate will not cause an error.
+
+    The downloads run on a pool of download_threads threads (a package
+    setting) shared by all DownloadFile modules; modules asking for the same
+    URL at the same time share the download.
     """
 
     def compute(self):
@@ -410,7 +531,19 @@ class DownloadFile(Module):
         """
         scheme = urllib2.splittype(url)[0]
         DL = downloaders.get(scheme, Downloader)
-        return DL(url, self, insecure).execute()
+        task = download_manager.submit((url, insecure),
+                                       DL(url, self, insecure))
+        try:
+            local_filename = task.wait(
+                    lambda progress: self.logging.update_progress(self,
+                                                                  progress))
+        except ModuleError, e:
+            if e.module is self:
+                raise
+            # The download was started by another module
+            raise ModuleError(self, e.msg)
+        self.annotate({'cached': str(task.job.cached)})
+        return local_filename
 
 
 class HTTPDirectory(Module):
@@ -534,7 +667,8 @@ def initialize(*args, **keywords):
     renamed = 0
     for old_name in sorted(os.listdir(package_directory)):
         old_filename = os.path.join(package_directory, old_name)
-        if old_filename in handled:
+        if old_filename in handled or old_name.endswith(('.part',
+                                                         '.part.etag')):
             continue
         if len(old_name) > MAX_CACHE_FILENAME:
             hasher = sha_hash()
@@ -562,6 +696,12 @@ def initialize(*args, **keywords):
     if renamed:
         debug.warning("Renamed %d downloaded cache files" % renamed)
 
+    global cache_index, download_manager
+    max_size = configuration.max_cache_size
+    cache_index = CacheIndex(package_directory,
+                             max_size * 1024 * 1024 if max_size > 0 else None)
+    download_manager = DownloadManager(configuration.download_threads)
+
 
 def handle_module_upgrade_request(controller, module_id, pipeline):
     module_remap = {
@@ -642,6 +782,130 @@ class TestDownloadFile(unittest.TestCase):
             ]))
 
 
+class TestDownloadCache(unittest.TestCase):
+    """Downloads files from a local HTTP server.
+    """
+    files = {'/a': ('a' * 100000, '"a1"'),
+             '/copy': ('a' * 100000, '"a2"'),
+             '/b': ('0123456789' * 1000, '"b1"')}
+
+    @classmethod
+    def setUpClass(cls):
+        import BaseHTTPServer
+        import threading
+
+        from vistrails.core.packagemanager import get_package_manager
+        from vistrails.core.modules.module_registry import MissingPackage
+        pm = get_package_manager()
+        try:
+            pm.get_package(identifier)
+        except MissingPackage:
+            pm.late_enable_package('URL')
+
+        files = cls.files
+        requests = cls.requests = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append((self.path, dict(self.headers)))
+                content, etag = files[self.path.split('?', 1)[0]]
+                if self.headers.get('if-none-match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                start = 0
+                ranges = self.headers.get('range')
+                if ranges and self.headers.get('if-range') == etag:
+                    start = int(ranges[6:-1])
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                                     start, len(content) - 1, len(content)))
+                else:
+                    self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', len(content) - start)
+                self.end_headers()
+                self.wfile.write(content[start:])
+
+            def log_message(self, format, *args):
+                pass
+
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        cls.url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        del self.requests[:]
+
+    def get(self, path):
+        return HTTPDownloader(self.url + path, None, False).execute()
+
+    def read(self, filename):
+        with open(filename, 'rb') as fp:
+            return fp.read()
+
+    def test_pipeline(self):
+        from vistrails.tests.utils import execute, intercept_result
+        with intercept_result(DownloadFile, 'local_filename') as results:
+            self.assertFalse(execute([
+                    ('DownloadFile', identifier, [
+                        ('url', [('String', self.url + '/b?pipeline')]),
+                    ]),
+                ]))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(self.read(results[0]), self.files['/b'][0])
+
+    def test_revalidate(self):
+        hits = cache_index.stats['hits']
+        filename = self.get('/b')
+        self.assertEqual(self.read(filename), self.files['/b'][0])
+        self.assertEqual(self.get('/b'), filename)
+        self.assertEqual(self.requests[-1][1].get('if-none-match'), '"b1"')
+        self.assertEqual(cache_index.stats['hits'], hits + 1)
+
+    def test_resume(self):
+        local_filename = os.path.join(package_directory,
+                                      cache_filename(self.url + '/a'))
+        for filename in (local_filename, local_filename + '.etag'):
+            if os.path.exists(filename):
+                os.remove(filename)
+        with open(local_filename + '.part', 'wb') as fp:
+            fp.write('a' * 1000)
+        with open(local_filename + '.part.etag', 'wb') as fp:
+            fp.write('"a1"')
+        resumed = cache_index.stats['resumed_bytes']
+        self.assertEqual(self.get('/a'), local_filename)
+        self.assertEqual(self.requests[-1][1].get('range'), 'bytes=1000-')
+        self.assertEqual(self.read(local_filename), self.files['/a'][0])
+        self.assertFalse(os.path.exists(local_filename + '.part'))
+        self.assertFalse(os.path.exists(local_filename + '.part.etag'))
+        self.assertEqual(cache_index.stats['resumed_bytes'], resumed + 1000)
+
+        # A partial file for another version of the file is discarded
+        with open(local_filename + '.part', 'wb') as fp:
+            fp.write('b' * 1000)
+        with open(local_filename + '.part.etag', 'wb') as fp:
+            fp.write('"a0"')
+        os.remove(local_filename + '.etag')
+        self.get('/a')
+        self.assertEqual(self.read(local_filename), self.files['/a'][0])
+
+    def test_dedup(self):
+        filename1 = self.get('/a')
+        filename2 = self.get('/copy')
+        self.assertNotEqual(filename1, filename2)
+        self.assertEqual(self.read(filename2), self.files['/copy'][0])
+        if hasattr(os, 'link'):
+            self.assertTrue(os.path.samefile(filename1, filename2))
+
+
 class TestHTTPDirectory(unittest.TestCase):
     def test_download(self):
         url = 'http://www.vistrails.org/testing/httpdirectory/test/'
@@ -36,6 +36,12 @@
 
 from __future__ import division
 
+from vistrails.core.configuration import ConfigurationObject
+
 identifier="edu.poly.vistrails.parallel_flow"
 name="Parallel Flow"
 version="0.1.1"
+
+# backend is either 'ipython' (an IPython cluster) or 'multiprocessing'
+# (processes on the local machine, 'workers' of them or one per CPU if 0)
+configuration = ConfigurationObject(backend='ipython', workers=0)
@@ -40,7 +40,12 @@ from vistrails.core.modules.vistrails_module import Module
 from vistrails.core.modules.module_registry import get_module_registry
 from vistrails.core.modules.basic_modules import List, String
 
-from engine_manager import EngineManager
+try:
+    from engine_manager import EngineManager
+except ImportError:
+    # Without IPython, only the multiprocessing backend can be used
+    EngineManager = None
+import local
 from map import Map
 
 
@@ -56,10 +61,14 @@ def initialize(*args,**keywords):
 
 
 def finalize():
-    EngineManager.cleanup()
+    local.cleanup()
+    if EngineManager is not None:
+        EngineManager.cleanup()
 
 
 def menu_items():
+    if EngineManager is None:
+        return ()
     return (
             ("Start new engine processes",
              lambda: EngineManager.start_engines()),
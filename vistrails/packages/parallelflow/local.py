@@ -0,0 +1,162 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+
+"""Runs Map on a pool of local processes.
+
+This backend doesn't need an IPython cluster: the batches of input values
+are dispatched to worker processes started with multiprocessing, and the
+results are collected in order. The workers are kept between executions,
+so they stay warm the same way IPython engines do.
+"""
+
+from __future__ import division
+
+import multiprocessing
+import threading
+
+from vistrails.core.modules.module_registry import get_module_registry
+
+from .worker import execute_batch
+
+
+def _execute_batch(args):
+    return execute_batch(*args)
+
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+def get_pool(nb_workers=None):
+    """get_pool(nb_workers: int) -> multiprocessing.Pool
+
+    Returns the pool of worker processes, starting it if needed.
+
+    The pool is restarted if the number of workers changed, or if packages
+    were enabled or disabled since it was started, since forked workers only
+    know about the modules that were loaded at that time.
+    """
+    global _pool, _pool_key
+    if not nb_workers:
+        nb_workers = multiprocessing.cpu_count()
+    key = nb_workers, frozenset(get_module_registry().packages)
+    with _pool_lock:
+        if _pool is not None and _pool_key != key:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+        if _pool is None:
+            from vistrails.core.application import init_worker
+            _pool = multiprocessing.Pool(nb_workers, init_worker)
+            _pool_key = key
+        return _pool
+
+
+def map_batches(template_hash, template, input_types, output_port, batches,
+                nb_workers=None):
+    """map_batches(template_hash: str, template: str, input_types: list,
+                   output_port: str, batches: list, nb_workers: int) -> list
+
+    Runs worker.execute_batch() for each batch on the pool, returning the
+    results in the same order as batches.
+    """
+    pool = get_pool(nb_workers)
+    return pool.map(_execute_batch,
+                    [(template_hash, template, input_types, output_port,
+                      batch)
+                     for batch in batches],
+                    chunksize=1)
+
+
+def cleanup():
+    """Stops the worker processes.
+    """
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+            _pool_key = None
+
+##############################################################################
+
+import unittest
+
+
+class TestLocalBackend(unittest.TestCase):
+    def tearDown(self):
+        cleanup()
+
+    def test_map_batches(self):
+        from vistrails.packages.parallelflow.map import sha1_hash
+        from vistrails.core.db.io import serialize
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.module_function import ModuleFunction
+        from vistrails.core.vistrail.module_param import ModuleParam
+        from vistrails.core.vistrail.pipeline import Pipeline
+        from vistrails.db.versions import currentVersion
+        from vistrails.tests.utils import enable_package
+
+        identifier = 'org.vistrails.vistrails.pythoncalc'
+        enable_package(identifier)
+        package = get_module_registry().get_package_by_name(identifier)
+        pipeline = Pipeline(version=currentVersion)
+        pipeline.add_module(Module(
+                id=0,
+                name='PythonCalc',
+                package=identifier,
+                version=package.version,
+                functions=[
+                    ModuleFunction(id=0, pos=0, name='value2', parameters=[
+                        ModuleParam(id=0, pos=0, type='Float', val='2.0')]),
+                    ModuleFunction(id=1, pos=1, name='op', parameters=[
+                        ModuleParam(id=1, pos=0, type='String', val='*')]),
+                ]))
+        template = serialize(pipeline)
+        template_hash = sha1_hash(template).hexdigest()
+
+        batches = [[(float(i),) for i in xrange(j, j + 3)]
+                   for j in xrange(0, 15, 3)]
+        results = map_batches(
+                template_hash, template,
+                [('value1', 'org.vistrails.vistrails.basic:Float')],
+                'value', batches, 2)
+        self.assertEqual([r['output']
+                          for batch in results for r in batch['results']],
+                         [2.0 * i for i in xrange(15)])
+        self.assertTrue(all(batch['machine_log'] for batch in results))
@@ -36,11 +36,8 @@
 
 from __future__ import division
 
-import vistrails.core.db.action
-from vistrails.core.db.locator import XMLFileLocator
 from vistrails.core.db.io import serialize, unserialize
 from vistrails.core import debug
-from vistrails.core.interpreter.default import get_default_interpreter
 from vistrails.core.log.group_exec import GroupExec
 from vistrails.core.log.machine import Machine
 from vistrails.core.log.module_exec import ModuleExec
@@ -50,26 +47,20 @@ import vistrails.core.modules.utils
 from vistrails.core.modules.vistrails_module import Module, ModuleError, \
     InvalidOutput
 from vistrails.core.vistrail.annotation import Annotation
-from vistrails.core.vistrail.controller import VistrailController
 from vistrails.core.vistrail.group import Group
-from vistrails.core.vistrail.module_function import ModuleFunction
-from vistrails.core.vistrail.module_param import ModuleParam
 from vistrails.core.vistrail.pipeline import Pipeline
-from vistrails.core.vistrail.vistrail import Vistrail
-from vistrails.db.domain import IdScope
 import vistrails.db.versions
 
 import copy
 import inspect
-from itertools import izip
-import os
+import math
+import multiprocessing
 import re
 import sys
-import tempfile
-
-from IPython.parallel.error import CompositeError
 
+from . import configuration
 from .api import get_client
+from . import local
 
 try:
     import hashlib
@@ -82,94 +73,17 @@ except ImportError:
 ###############################################################################
 # This function is sent to the engines which execute it
 #
-# It receives the workflow, and the list of targeted output ports
+# It receives the serialized module to execute, which the engines only load
+# the first time they see it, the targeted output port and a batch of input
+# values
 #
-# It returns the corresponding computed outputs and the execution log
+# It returns the corresponding computed outputs and the execution logs
 #
-def execute_wf(wf, output_port):
-    # Save the workflow in a temporary file
-    temp_wf_fd, temp_wf = tempfile.mkstemp()
-
-    try:
-        f = open(temp_wf, 'w')
-        f.write(wf)
-        f.close()
-        os.close(temp_wf_fd)
-
-        # Clean the cache
-        interpreter = get_default_interpreter()
-        interpreter.flush()
-
-        # Load the Pipeline from the temporary file
-        vistrail = Vistrail()
-        locator = XMLFileLocator(temp_wf)
-        workflow = locator.load(Pipeline)
-
-        # Build a Vistrail from this single Pipeline
-        action_list = []
-        for module in workflow.module_list:
-            action_list.append(('add', module))
-        for connection in workflow.connection_list:
-            action_list.append(('add', connection))
-        action = vistrails.core.db.action.create_action(action_list)
-
-        vistrail.add_action(action, 0L)
-        vistrail.update_id_scope()
-        tag = 'parallel flow'
-        vistrail.addTag(tag, action.id)
-
-        # Build a controller and execute
-        controller = VistrailController()
-        controller.set_vistrail(vistrail, None)
-        controller.change_selected_version(vistrail.get_version_number(tag))
-        execution = controller.execute_current_workflow(
-                custom_aliases=None,
-                custom_params=None,
-                extra_info=None,
-                reason='API Pipeline Execution')
-
-        # Build a list of errors
-        errors = []
-        pipeline = vistrail.getPipeline(tag)
-        execution_errors = execution[0][0].errors
-        if execution_errors:
-            for key in execution_errors:
-                module = pipeline.modules[key]
-                msg = '%s: %s' %(module.name, execution_errors[key])
-                errors.append(msg)
-
-        # Get the execution log from the controller
-        try:
-            module_log = controller.log.workflow_execs[0].item_execs[0]
-        except IndexError:
-            errors.append("Module log not found")
-            return dict(errors=errors)
-        else:
-            machine = controller.log.workflow_execs[0].machines[
-                    module_log.machine_id]
-            xml_log = serialize(module_log)
-            machine_log = serialize(machine)
-
-        # Get the output value
-        output = None
-        if not execution_errors:
-            executed_module, = execution[0][0].executed
-            executed_module = execution[0][0].objects[executed_module]
-            try:
-                output = executed_module.get_output(output_port)
-            except ModuleError:
-                errors.append("Output port not found: %s" % output_port)
-                return dict(errors=errors)
-            if isinstance(output, Module):
-                raise TypeError("Output value is a Module instance")
-
-        # Return the dictionary, that will be sent back to the client
-        return dict(errors=errors,
-                    output=output,
-                    xml_log=xml_log,
-                    machine_log=machine_log)
-    finally:
-        os.unlink(temp_wf)
+def execute_batch(template_hash, template, input_types, output_port,
+                  elements):
+    from vistrails.packages.parallelflow.worker import execute_batch
+    return execute_batch(template_hash, template, input_types, output_port,
+                         elements)
 
 ###############################################################################
 
@@ -182,12 +96,17 @@ def strip_ansi_codes(s):
 # Map Operator
 #
 class Map(Module):
-    """The Map Module executes a map operator in parallel on IPython engines.
+    """The Map Module executes a map operator in parallel on IPython engines,
+    or on local processes if the package's 'backend' setting is
+    'multiprocessing'.
 
     The FunctionPort should be connected to the 'self' output of the module you
     want to execute.
     The InputList is the list of values to be scattered on the engines.
     """
+    # Number of batches the values are split into, per engine
+    BATCHES_PER_WORKER = 4
+
     def __init__(self):
         Module.__init__(self)
 
@@ -240,101 +159,101 @@ class Map(Module):
         # Create inputList to always have iterable elements
         # to simplify code
         if len(nameInput) == 1:
-            element_is_iter = False
             inputList = [[element] for element in rawInputList]
         else:
-            element_is_iter = True
             inputList = rawInputList
 
-        workflows = []
-        module = None
-        vtType = None
+        # getting first connector, ignoring the rest
+        connector = self.inputPorts.get('FunctionPort')[0]
+        module = connector.obj
+
+        # pipeline
+        original_pipeline = connector.obj.moduleInfo['pipeline']
+
+        # module
+        module_id = connector.obj.moduleInfo['moduleId']
+        vtType = original_pipeline.modules[module_id].vtType
+
+        # checking types
+        self.typeChecking(connector.obj, nameInput, inputList)
+
+        pipeline_db_module = original_pipeline.modules[module_id].do_copy()
+
+        # transforming a subworkflow in a group
+        # TODO: should we also transform inner subworkflows?
+        if pipeline_db_module.is_abstraction():
+            group = Group(id=pipeline_db_module.id,
+                          cache=pipeline_db_module.cache,
+                          location=pipeline_db_module.location,
+                          functions=pipeline_db_module.functions,
+                          annotations=pipeline_db_module.annotations)
+
+            source_port_specs = pipeline_db_module.sourcePorts()
+            dest_port_specs = pipeline_db_module.destinationPorts()
+            for source_port_spec in source_port_specs:
+                group.add_port_spec(source_port_spec)
+            for dest_port_spec in dest_port_specs:
+                group.add_port_spec(dest_port_spec)
+
+            group.pipeline = pipeline_db_module.pipeline
+            pipeline_db_module = group
+
+        # the engines add a function for each input port to the module
+        input_types = []
+        for inputPort in nameInput:
+            p_spec = pipeline_db_module.get_port_spec(inputPort, 'input')
+            descrs = p_spec.descriptors()
+            if len(descrs) != 1:
+                raise ModuleError(
+                        self,
+                        "Tuple input ports are not supported")
+            if not issubclass(descrs[0].module, Constant):
+                raise ModuleError(
+                        self,
+                        "Module inputs should be Constant types")
+            input_types.append((inputPort, p_spec.sigstring[1:-1]))
+
+        # serializing module once, engines keep it around
+        template = self.serialize_module(pipeline_db_module)
+        template_hash = sha1_hash(template).hexdigest()
+
+        backend = configuration.backend
+        if backend == 'multiprocessing':
+            map_result = self.run_local(module, template_hash, template,
+                                        input_types, nameOutput, inputList)
+        elif backend == 'ipython':
+            map_result = self.run_ipython(module, template_hash, template,
+                                          input_types, nameOutput, inputList)
+        else:
+            raise ModuleError(self, "Unknown parallelflow backend %r" %
+                              backend)
 
-        # iterating through the connectors
-        for connector in self.inputPorts.get('FunctionPort'):
-            module = connector.obj
+        self.process_results(module, vtType, map_result)
 
-            # pipeline
-            original_pipeline = connector.obj.moduleInfo['pipeline']
+    def run_local(self, module, template_hash, template, input_types,
+                  nameOutput, inputList):
+        """Executes the module on a pool of local processes.
+        """
+        nb_workers = configuration.workers
+        if not nb_workers:
+            nb_workers = multiprocessing.cpu_count()
 
-            # module
-            module_id = connector.obj.moduleInfo['moduleId']
-            vtType = original_pipeline.modules[module_id].vtType
+        # setting computing color
+        module.logging.set_computing(module)
 
-            # serialize the module for each value in the list
-            for i, element in enumerate(inputList):
-                if element_is_iter:
-                    self.element = element
-                else:
-                    self.element = element[0]
-
-                # checking type and setting input in the module
-                self.typeChecking(connector.obj, nameInput, inputList)
-                self.setInputValues(connector.obj, nameInput, element, i)
-
-                pipeline_db_module = original_pipeline.modules[module_id].do_copy()
-
-                # transforming a subworkflow in a group
-                # TODO: should we also transform inner subworkflows?
-                if pipeline_db_module.is_abstraction():
-                    group = Group(id=pipeline_db_module.id,
-                                  cache=pipeline_db_module.cache,
-                                  location=pipeline_db_module.location,
-                                  functions=pipeline_db_module.functions,
-                                  annotations=pipeline_db_module.annotations)
-
-                    source_port_specs = pipeline_db_module.sourcePorts()
-                    dest_port_specs = pipeline_db_module.destinationPorts()
-                    for source_port_spec in source_port_specs:
-                        group.add_port_spec(source_port_spec)
-                    for dest_port_spec in dest_port_specs:
-                        group.add_port_spec(dest_port_spec)
-
-                    group.pipeline = pipeline_db_module.pipeline
-                    pipeline_db_module = group
-
-                # getting highest id between functions to guarantee unique ids
-                # TODO: can get current IdScope here?
-                if pipeline_db_module.functions:
-                    high_id = max(function.db_id
-                                  for function in pipeline_db_module.functions)
-                else:
-                    high_id = 0
-
-                # adding function and parameter to module in pipeline
-                # TODO: 'pos' should not be always 0 here
-                id_scope = IdScope(beginId=long(high_id+1))
-                for elementValue, inputPort in izip(element, nameInput):
-
-                    p_spec = pipeline_db_module.get_port_spec(inputPort, 'input')
-                    descrs = p_spec.descriptors()
-                    if len(descrs) != 1:
-                        raise ModuleError(
-                                self,
-                                "Tuple input ports are not supported")
-                    if not issubclass(descrs[0].module, Constant):
-                        raise ModuleError(
-                                self,
-                                "Module inputs should be Constant types")
-                    type = p_spec.sigstring[1:-1]
-
-                    mod_function = ModuleFunction(id=id_scope.getNewId(ModuleFunction.vtType),
-                                                  pos=0,
-                                                  name=inputPort)
-                    mod_param = ModuleParam(id=0L,
-                                            pos=0,
-                                            type=type,
-                                            val=elementValue)
-
-                    mod_function.add_parameter(mod_param)
-                    pipeline_db_module.add_function(mod_function)
-
-                # serializing module
-                wf = self.serialize_module(pipeline_db_module)
-                workflows.append(wf)
-
-            # getting first connector, ignoring the rest
-            break
+        batches = self.make_batches(inputList, nb_workers)
+        try:
+            return local.map_batches(template_hash, template, input_types,
+                                     nameOutput, batches, nb_workers)
+        except Exception, e:
+            raise ModuleError(self, "Error from worker processes: %s" %
+                              debug.format_exception(e))
+
+    def run_ipython(self, module, template_hash, template, input_types,
+                    nameOutput, inputList):
+        """Executes the module on the engines of an IPython cluster.
+        """
+        from IPython.parallel.error import CompositeError
 
         # IPython stuff
         try:
@@ -363,21 +282,11 @@ class Map(Module):
         if uninitialized:
             init_view = rc[uninitialized]
             with init_view.sync_imports():
-                import tempfile
-                import inspect
-
                 # VisTrails API
                 import vistrails
                 import vistrails.core
-                import vistrails.core.db.action
                 import vistrails.core.application
-                import vistrails.core.modules.module_registry
-                from vistrails.core.db.io import serialize
-                from vistrails.core.vistrail.vistrail import Vistrail
-                from vistrails.core.vistrail.pipeline import Pipeline
-                from vistrails.core.db.locator import XMLFileLocator
-                from vistrails.core.vistrail.controller import VistrailController
-                from vistrails.core.interpreter.default import get_default_interpreter
+                import vistrails.packages.parallelflow.worker
 
             # initializing a VisTrails application
             try:
@@ -398,23 +307,55 @@ class Map(Module):
         module.logging.set_computing(module)
 
         # executing function in engines
-        # each map returns a dictionary
+        # inputs are sent in batches, each returns a dictionary
+        batches = self.make_batches(inputList, len(engines))
         try:
             ldview = rc.load_balanced_view()
-            map_result = ldview.map_sync(execute_wf, workflows, [nameOutput]*len(workflows))
+            map_result = ldview.map_sync(execute_batch,
+                                         [template_hash] * len(batches),
+                                         [template] * len(batches),
+                                         [input_types] * len(batches),
+                                         [nameOutput] * len(batches),
+                                         batches)
         except CompositeError, e:
             self.print_compositeerror(e)
             raise ModuleError(self, "Error from IPython engines:\n"
                               "%s" % self.list_exceptions(e))
 
+        return map_result
+
+    @classmethod
+    def make_batches(cls, inputList, nb_workers):
+        """make_batches(inputList: list, nb_workers: int) -> list
+
+        Splits the input values in a few batches per worker, so that setup
+        and communication costs are paid per batch rather than per element
+        while still balancing the load.
+        """
+        elements = [tuple(element) for element in inputList]
+        batch_size = max(1, int(math.ceil(
+                len(elements) / (nb_workers * cls.BATCHES_PER_WORKER))))
+        return [elements[i:i + batch_size]
+                for i in xrange(0, len(elements), batch_size)]
+
+    def process_results(self, module, vtType, map_result):
+        """process_results(module: Module, vtType: str,
+                           map_result: list) -> None
+
+        Checks the results of the batches, sets self.result and adds the
+        execution logs to this module's log.
+        """
         # verifying errors
         errors = []
-        for engine in range(len(map_result)):
-            if map_result[engine]['errors']:
-                msg = "ModuleError in engine %d: '%s'" % (
-                        engine,
-                        ', '.join(map_result[engine]['errors']))
-                errors.append(msg)
+        element = 0
+        for batch in map_result:
+            for execution in batch['results']:
+                if execution['errors']:
+                    msg = "ModuleError in element %d: '%s'" % (
+                            element,
+                            ', '.join(execution['errors']))
+                    errors.append(msg)
+                element += 1
 
         if errors:
             raise ModuleError(self, '\n'.join(errors))
@@ -422,52 +363,55 @@ class Map(Module):
         # setting success color
         module.logging.signalSuccess(module)
 
-        reg = vistrails.core.modules.module_registry.get_module_registry()
         self.result = []
-        for map_execution in map_result:
-            output = map_execution['output']
-            self.result.append(output)
+        for batch in map_result:
+            for execution in batch['results']:
+                self.result.append(execution['output'])
 
         # including execution logs
-        for engine in range(len(map_result)):
-            log = map_result[engine]['xml_log']
-            exec_ = None
-            if (vtType == 'abstraction') or (vtType == 'group'):
-                exec_ = unserialize(log, GroupExec)
-            elif (vtType == 'module'):
-                exec_ = unserialize(log, ModuleExec)
-            else:
-                # something is wrong...
-                continue
-
-            # assigning new ids to existing annotations
-            exec_annotations = exec_.annotations
-            for i in range(len(exec_annotations)):
-                exec_annotations[i].id = self.logging.log.log.id_scope.getNewId(Annotation.vtType)
-
-            parallel_annotation = Annotation(key='parallel_execution', value=True)
-            parallel_annotation.id = self.logging.log.log.id_scope.getNewId(Annotation.vtType)
-            annotations = [parallel_annotation] + exec_annotations
-            exec_.annotations = annotations
-
-            # before adding the execution log, we need to get the machine information
-            machine = unserialize(map_result[engine]['machine_log'], Machine)
+        id_scope = self.logging.log.log.id_scope
+        for batch in map_result:
+            # before adding the execution logs, we need to get the machine
+            # information
+            machine = unserialize(batch['machine_log'], Machine)
             machine_id = self.logging.add_machine(machine)
 
-            # recursively add machine information to execution items
-            def add_machine_recursive(exec_):
-                for item in exec_.item_execs:
-                    if hasattr(item, 'machine_id'):
-                        item.machine_id = machine_id
-                        if item.vtType in ('abstraction', 'group'):
-                            add_machine_recursive(item)
-
-            exec_.machine_id = machine_id
-            if (vtType == 'abstraction') or (vtType == 'group'):
-                add_machine_recursive(exec_)
-
-            self.logging.add_exec(exec_)
-
+            for execution in batch['results']:
+                log = execution['xml_log']
+                exec_ = None
+                if (vtType == 'abstraction') or (vtType == 'group'):
+                    exec_ = unserialize(log, GroupExec)
+                elif (vtType == 'module'):
+                    exec_ = unserialize(log, ModuleExec)
+                else:
+                    # something is wrong...
+                    continue
+
+                # assigning new ids to existing annotations
+                exec_annotations = exec_.annotations
+                for i in range(len(exec_annotations)):
+                    exec_annotations[i].id = id_scope.getNewId(
+                            Annotation.vtType)
+
+                parallel_annotation = Annotation(key='parallel_execution',
+                                                 value=True)
+                parallel_annotation.id = id_scope.getNewId(Annotation.vtType)
+                annotations = [parallel_annotation] + exec_annotations
+                exec_.annotations = annotations
+
+                # recursively add machine information to execution items
+                def add_machine_recursive(exec_):
+                    for item in exec_.item_execs:
+                        if hasattr(item, 'machine_id'):
+                            item.machine_id = machine_id
+                            if item.vtType in ('abstraction', 'group'):
+                                add_machine_recursive(item)
+
+                exec_.machine_id = machine_id
+                if (vtType == 'abstraction') or (vtType == 'group'):
+                    add_machine_recursive(exec_)
+
+                self.logging.add_exec(exec_)
 
     def serialize_module(self, module):
         """
@@ -0,0 +1,222 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+
+"""Executes Map elements in a worker process.
+
+The client sends the module to run as a serialized single-module pipeline
+(the template), identified by its hash, along with batches of input values.
+Workers keep the templates they have seen, so each one is only parsed once,
+and run every element with the same interpreter, only adding the functions
+that set the inputs for that element.
+
+This module is imported on the workers, it shouldn't depend on the backend.
+"""
+
+from __future__ import division
+
+from itertools import izip
+
+from vistrails.core.db.io import serialize, unserialize
+from vistrails.core.interpreter.default import get_default_interpreter
+from vistrails.core.log.controller import LogController
+from vistrails.core.log.log import Log
+from vistrails.core.log.machine import Machine
+from vistrails.core.modules.vistrails_module import Module, ModuleError
+from vistrails.core.vistrail.module_function import ModuleFunction
+from vistrails.core.vistrail.module_param import ModuleParam
+from vistrails.core.vistrail.pipeline import Pipeline
+from vistrails.db.domain import IdScope
+
+
+# Number of templates a worker remembers
+MAX_TEMPLATES = 8
+
+_templates = {}
+# Template hashes, least recently used first
+_templates_order = []
+
+
+def get_template(template_hash, template):
+    """get_template(template_hash: str, template: str) -> Module
+
+    Returns the module of a serialized template pipeline.
+    """
+    try:
+        module = _templates[template_hash]
+    except KeyError:
+        module, = unserialize(template, Pipeline).module_list
+        while len(_templates) >= MAX_TEMPLATES:
+            del _templates[_templates_order.pop(0)]
+        _templates[template_hash] = module
+    else:
+        _templates_order.remove(template_hash)
+    _templates_order.append(template_hash)
+    return module
+
+
+def make_pipeline(template_module, input_types, element):
+    """make_pipeline(template_module: Module, input_types: list,
+                     element: tuple) -> Pipeline
+
+    Builds the pipeline for one element from the template module, adding a
+    function for each (port name, type) of input_types.
+    """
+    module = template_module.do_copy()
+    # getting highest id between functions to guarantee unique ids
+    if module.functions:
+        high_id = max(function.db_id for function in module.functions)
+    else:
+        high_id = 0
+    id_scope = IdScope(beginId=long(high_id + 1))
+    for value, (port_name, type_name) in izip(element, input_types):
+        function = ModuleFunction(id=id_scope.getNewId(ModuleFunction.vtType),
+                                  pos=0,
+                                  name=port_name)
+        # same conversion as when the pipeline was serialized to XML
+        function.add_parameter(ModuleParam(id=0L,
+                                           pos=0,
+                                           type=type_name,
+                                           val=str(value)))
+        module.add_function(function)
+    pipeline = Pipeline()
+    pipeline.add_module(module)
+    return pipeline
+
+
+def execute_element(pipeline, output_port, logger):
+    """execute_element(pipeline: Pipeline, output_port: str,
+                       logger: LogController) -> dict
+
+    Runs a single-module pipeline, returning the output and the log of the
+    module.
+    """
+    interpreter = get_default_interpreter()
+    result = interpreter.execute(pipeline,
+                                 logger=logger,
+                                 reason='API Pipeline Execution')
+    # Only this element needs these modules, don't keep them in the cache
+    interpreter.clean_modules([obj.id for obj in result.objects.itervalues()])
+
+    errors = []
+    for key, error in result.errors.iteritems():
+        errors.append('%s: %s' % (pipeline.modules[key].name, error))
+
+    try:
+        module_log = logger.log.workflow_execs[-1].item_execs[0]
+    except IndexError:
+        errors.append("Module log not found")
+        return dict(errors=errors)
+
+    output = None
+    if not result.errors:
+        obj, = result.objects.itervalues()
+        try:
+            output = obj.get_output(output_port)
+        except ModuleError:
+            errors.append("Output port not found: %s" % output_port)
+            return dict(errors=errors)
+        if isinstance(output, Module):
+            raise TypeError("Output value is a Module instance")
+
+    return dict(errors=errors,
+                output=output,
+                xml_log=serialize(module_log))
+
+
+def execute_batch(template_hash, template, input_types, output_port,
+                  elements):
+    """execute_batch(template_hash: str, template: str, input_types: list,
+                     output_port: str, elements: list) -> dict
+
+    Runs the template module once for each element of the batch.
+
+    Returns a dictionary with the serialized machine, shared by all the
+    execution logs, and the list of results (errors, output and serialized
+    log of the module) in the same order as elements.
+    """
+    template_module = get_template(template_hash, template)
+    logger = LogController(Log())
+    results = []
+    for element in elements:
+        pipeline = make_pipeline(template_module, input_types, element)
+        results.append(execute_element(pipeline, output_port, logger))
+    return dict(machine_log=serialize(logger.machine),
+                results=results)
+
+##############################################################################
+
+import unittest
+
+
+class TestWorker(unittest.TestCase):
+    def test_execute_batch(self):
+        from vistrails.packages.parallelflow.map import sha1_hash
+        from vistrails.core.modules.module_registry import get_module_registry
+        from vistrails.core.vistrail.module import Module as PipelineModule
+        from vistrails.db.versions import currentVersion
+        from vistrails.tests.utils import enable_package
+
+        identifier = 'org.vistrails.vistrails.pythoncalc'
+        enable_package(identifier)
+        package = get_module_registry().get_package_by_name(identifier)
+        module = PipelineModule(
+                id=0,
+                name='PythonCalc',
+                package=identifier,
+                version=package.version,
+                functions=[
+                    ModuleFunction(id=0, pos=0, name='value2', parameters=[
+                        ModuleParam(id=0, pos=0, type='Float', val='2.0')]),
+                    ModuleFunction(id=1, pos=1, name='op', parameters=[
+                        ModuleParam(id=1, pos=0, type='String', val='-')]),
+                ])
+        pipeline = Pipeline(version=currentVersion)
+        pipeline.add_module(module)
+        template = serialize(pipeline)
+        template_hash = sha1_hash(template).hexdigest()
+
+        input_types = [('value1', 'org.vistrails.vistrails.basic:Float')]
+        for i in xrange(2):
+            result = execute_batch(template_hash, template, input_types, 'value',
+                                   [(44.0,), (5.0,), ('oops',)])
+            self.assertEqual(len(_templates), 1)
+            (ok1, ok2, failed) = result['results']
+            self.assertEqual((ok1['errors'], ok1['output']), ([], 42.0))
+            self.assertEqual(ok2['output'], 3.0)
+            self.assertTrue(ok1['xml_log'])
+            self.assertTrue(failed['errors'])
+        self.assertIsNotNone(unserialize(result['machine_log'], Machine))
@@ -45,6 +45,7 @@ import uuid
 import vistrails.core.debug
 from vistrails.core.configuration import ConfigurationObject
 from vistrails.core.cache.hasher import Hasher
+from vistrails.core.cache.path_metadata import get_path_metadata_cache
 from vistrails.core.modules.basic_modules import Path, PathObject, Directory, Boolean, \
     String, Constant
 from vistrails.core.modules.module_registry import get_module_registry, MissingModule, \
@@ -515,12 +516,23 @@ def persistent_module_hasher(pipeline, module, chm):
     current_hash = Hasher.module_signature(module, chm)
     ref = None
     read_local = False
+    local_path = None
     for function in module.functions:
         if function.name == "ref":
             ref = PersistentRef.translate_to_python(function.params[0].strValue)
         if function.name == 'readLocal':
             read_local = \
                 Boolean.translate_to_python(function.params[0].strValue)
+        if function.name == 'localPath':
+            local_path = function.params[0].strValue
+    if read_local and local_path:
+        # the local copy is what gets read, so it has to be hashed too
+        try:
+            t = get_path_metadata_cache().tree_mtime(local_path)
+        except OSError:
+            pass
+        else:
+            return Hasher.compound_signature([current_hash, str(t)])
     if ref and not read_local and db_access.ref_exists(ref.id, ref.version):
         if ref.version is None:
             ref.version = repo.get_current_repo().get_latest_version(ref.id)
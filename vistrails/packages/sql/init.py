@@ -36,9 +36,11 @@
 
 from __future__ import division
 
+from itertools import chain, izip
 from sqlalchemy.engine import create_engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.exc import SQLAlchemyError
+import threading
 import urllib
 
 from vistrails.core.db.action import create_action
@@ -50,7 +52,13 @@ from vistrails.core.modules.vistrails_module import Module, ModuleError
 from vistrails.core.upgradeworkflow import UpgradeWorkflowHandler
 from vistrails.core.utils import versions_increasing
 
-from vistrails.packages.tabledata.common import TableObject
+from vistrails.packages.tabledata.common import get_numpy, TableObject
+
+
+# Engines are kept across executions, so that connections come from their
+# pools instead of a new engine being set up every time
+_engines = {}
+_engines_lock = threading.Lock()
 
 
 class DBConnection(Module):
@@ -79,6 +87,17 @@ class DBConnection(Module):
                   port=self.force_get_input('port', None),
                   database=self.get_input('db_name'))
 
+        key = str(url)
+        with _engines_lock:
+            engine = _engines.get(key)
+        if engine is None:
+            engine = self.create_engine(url)
+            with _engines_lock:
+                engine = _engines.setdefault(key, engine)
+
+        self.set_output('connection', engine.connect())
+
+    def create_engine(self, url):
         try:
             engine = create_engine(url)
         except ImportError, e:
@@ -134,16 +153,65 @@ class DBConnection(Module):
                     self,
                     "SQLAlchemy has no support for protocol %r -- are you "
                     "sure you spelled that correctly?" % url.drivername)
+        return engine
 
-        self.set_output('connection', engine.connect())
+
+def make_table(names, batches):
+    """Builds a column-oriented TableObject from batches of rows.
+
+    Columns where all values are numbers are turned into NumPy arrays if
+    NumPy is available, the others are lists.
+    """
+    numpy = get_numpy(False)
+    chunks = [[] for name in names]
+    kinds = [int if numpy is not None else None] * len(names)
+    nb_rows = 0
+    for rows in batches:
+        nb_rows += len(rows)
+        for i, values in enumerate(izip(*rows)):
+            chunks[i].append(values)
+            if kinds[i] is None:
+                continue
+            for value in values:
+                value_type = type(value)
+                if value_type is float:
+                    kinds[i] = float
+                elif value_type is not int and value_type is not long:
+                    kinds[i] = None
+                    break
+
+    columns = []
+    for kind, column_chunks in izip(kinds, chunks):
+        values = chain.from_iterable(column_chunks)
+        if kind is not None and nb_rows:
+            dtype = numpy.float64 if kind is float else numpy.int64
+            try:
+                columns.append(numpy.fromiter(values, dtype, nb_rows))
+                continue
+            except OverflowError:
+                values = chain.from_iterable(column_chunks)
+        columns.append(list(values))
+    return TableObject(columns, nb_rows, list(names))
 
 
 class SQLSource(Module):
+    """Runs a query on a database.
+
+    Input ports added to the module are passed as parameters to the query.
+    Rows are fetched in batches of batchSize, using a server-side cursor if
+    the driver supports it. If streamResults is set, the result port
+    streams one Table per batch instead of a single Table, and resultSet
+    is not set.
+    """
     _settings = ModuleSettings(configure_widget=
             'vistrails.packages.sql.widgets:SQLSourceConfigurationWidget')
     _input_ports = [('connection', '(DBConnection)'),
                     ('cacheResults', '(basic:Boolean)'),
-                    ('source', '(basic:String)')]
+                    ('source', '(basic:String)'),
+                    ('batchSize', '(basic:Integer)',
+                     {'optional': True, 'defaults': "['10000']"}),
+                    ('streamResults', '(basic:Boolean)',
+                     {'optional': True, 'defaults': "['False']"})]
     _output_ports = [('connection', '(DBConnection)'),
                      ('result', '(org.vistrails.vistrails.tabledata:Table)'),
                      ('resultSet', '(basic:List)')]
@@ -159,14 +227,20 @@ class SQLSource(Module):
         connection = self.get_input('connection')
         self.set_output('connection', connection)
         inputs = dict((k, self.get_input(k)) for k in self.inputPorts.iterkeys()
-                  if k not in ('source', 'connection', 'cacheResults'))
+                  if k not in ('source', 'connection', 'cacheResults',
+                               'batchSize', 'streamResults'))
         s = urllib.unquote(str(self.get_input('source')))
+        batch_size = self.get_input('batchSize')
+        if batch_size < 1:
+            raise ModuleError(self, "batchSize should be positive")
+        streaming = self.get_input('streamResults')
 
         try:
             transaction = connection.begin()
-            results = connection.execute(s, inputs)
+            results = connection.execution_options(stream_results=True) \
+                    .execute(s, inputs)
             try:
-                rows = results.fetchall()
+                rows = results.fetchmany(batch_size)
             except Exception:
                 self.set_output('result', None)
                 self.set_output('resultSet', None)
@@ -174,17 +248,50 @@ class SQLSource(Module):
                 # results.returns_rows is True
                 # We don't use 'if return_rows' because this attribute didn't
                 # use to exist
-                table = TableObject.from_dicts(rows, results.keys())
+                if streaming:
+                    self.is_cacheable = lambda: False
+                    self.stream_results(transaction, results, rows,
+                                        batch_size)
+                    return
+                result_set = list(rows)
+                batches = [rows]
+                while rows:
+                    rows = results.fetchmany(batch_size)
+                    result_set.extend(rows)
+                    batches.append(rows)
+                table = make_table(results.keys(), batches)
+                del batches
                 self.set_output('result', table)
-                self.set_output('resultSet', rows)
+                self.set_output('resultSet', result_set)
             transaction.commit()
         except SQLAlchemyError, e:
             raise ModuleError(self, debug.format_exception(e))
 
+    def stream_results(self, transaction, results, rows, batch_size):
+        """Sets the result port to stream a Table for each batch of rows.
+
+        The transaction is committed once all the rows have been read.
+        """
+        names = results.keys()
+        def tables(rows):
+            while rows:
+                yield make_table(names, [rows])
+                rows = results.fetchmany(batch_size)
+            transaction.commit()
+        self.set_streaming_output('result', tables(rows))
+        self.set_output('resultSet', None)
+
 
 _modules = [DBConnection, SQLSource]
 
 
+def finalize():
+    with _engines_lock:
+        for engine in _engines.itervalues():
+            engine.dispose()
+        _engines.clear()
+
+
 def handle_module_upgrade_request(controller, module_id, pipeline):
     # Before 0.0.3, SQLSource's resultSet output was type ListOfElements (which
     #   doesn't exist anymore)
@@ -335,3 +442,92 @@ class TestSQL(unittest.TestCase):
                 os.remove(test_db)
             except OSError:
                 pass # Oops, we are leaking the file here...
+
+    def test_make_table(self):
+        """Builds a Table from several batches of rows.
+        """
+        table = make_table(['n', 'x', 's', 'm'],
+                           [[(1, 0.5, 'a', 1), (2, 1, 'b', None)],
+                            [],
+                            [(3L, 2.0, 'c', 'd')]])
+        self.assertEqual(table.names, ['n', 'x', 's', 'm'])
+        self.assertEqual((table.rows, table.columns), (3, 4))
+        self.assertEqual(list(table.get_column(0)), [1, 2, 3])
+        self.assertEqual(list(table.get_column(1)), [0.5, 1.0, 2.0])
+        self.assertEqual(table.get_column(2), ['a', 'b', 'c'])
+        self.assertEqual(table.get_column(3), [1, None, 'd'])
+        numpy = get_numpy(False)
+        if numpy is not None:
+            self.assertEqual(table.get_column(0).dtype, numpy.int64)
+            self.assertEqual(table.get_column(1).dtype, numpy.float64)
+
+        table = make_table(['n'], [[]])
+        self.assertEqual((table.rows, table.columns), (0, 1))
+        self.assertEqual(list(table.get_column(0)), [])
+
+    def test_batches(self):
+        """Fetches and streams results in small batches.
+        """
+        import os
+        import sqlite3
+        import tempfile
+        import urllib2
+        from vistrails.core.modules.basic_modules import PythonSource
+        from vistrails.tests.utils import execute, intercept_results
+        identifier = 'org.vistrails.vistrails.sql'
+
+        test_db_fd, test_db = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(test_db_fd)
+        try:
+            conn = sqlite3.connect(test_db)
+            conn.execute('CREATE TABLE test(n INTEGER, s VARCHAR(8))')
+            conn.executemany('INSERT INTO test(n, s) VALUES(?, ?)',
+                             [(i, str(i)) for i in xrange(5)])
+            conn.commit()
+            conn.close()
+
+            source = "SELECT n, s FROM test ORDER BY n"
+
+            def run(streaming, code):
+                with intercept_results(PythonSource, 'o') as (o,):
+                    self.assertFalse(execute([
+                            ('DBConnection', identifier, [
+                                ('protocol', [('String', 'sqlite')]),
+                                ('db_name', [('String', test_db)]),
+                            ]),
+                            ('SQLSource', identifier, [
+                                ('source', [('String', urllib2.quote(source))]),
+                                ('batchSize', [('Integer', '2')]),
+                                ('streamResults', [('Boolean', streaming)]),
+                            ]),
+                            ('PythonSource', 'org.vistrails.vistrails.basic', [
+                                ('source', [('String', urllib2.quote(code))]),
+                            ]),
+                        ],
+                        [
+                            (0, 'connection', 1, 'connection'),
+                            (1, 'result', 2, 't'),
+                        ],
+                        add_port_specs=[
+                            (2, 'input', 't',
+                             'org.vistrails.vistrails.tabledata:Table'),
+                            (2, 'output', 'o',
+                             'org.vistrails.vistrails.basic:List'),
+                        ]))
+                self.assertEqual(len(o), 1)
+                return o[0]
+
+            self.assertEqual(
+                    run('False', "o = [t.rows, list(t.get_column(0)), "
+                                 "t.get_column(1)]"),
+                    [5, [0, 1, 2, 3, 4], ['0', '1', '2', '3', '4']])
+            # Without a streaming downstream module, the batches are
+            # collected in a list
+            self.assertEqual(
+                    run('True', "o = [list(b.get_column(0)) for b in t]"),
+                    [[0, 1], [2, 3], [4]])
+        finally:
+            try:
+                os.remove(test_db)
+            except OSError:
+                pass # Oops, we are leaking the file here...
@@ -54,6 +54,57 @@ def utf8(obj):
         return bytes(obj)
 
 
+def numeric_array(column, kinds='iu'):
+    """Returns a column as a numpy array if it only holds numbers.
+
+    `kinds` are the accepted numpy dtype kinds: integers by default, 'iuf' to
+    also accept floats. Returns None if numpy is not available or if the
+    column holds anything else (text, booleans, ...), in which case the
+    row-by-row code should be used.
+    """
+    numpy = get_numpy(False)
+    if numpy is None:
+        return None
+    if isinstance(column, numpy.ndarray):
+        if column.dtype.kind in kinds:
+            return column
+        return None
+    types = (int, long, float) if 'f' in kinds else (int, long)
+    for value in column:
+        if type(value) not in types:
+            return None
+    try:
+        column = numpy.array(column)
+    except OverflowError:
+        return None
+    if column.dtype.kind not in kinds:
+        return None
+    return column
+
+
+def numeric_key_array(table, index, kinds='iu'):
+    """Returns a key column of a table as a numpy array, or None.
+
+    Only columns that already hold numbers are used, see numeric_array(). The
+    numeric version of text columns (like CSVFile's) is not: it would make
+    different keys equal ('7' and '07', or floats that only differ past
+    float32 precision), so they are compared as strings by the row-by-row
+    code.
+    """
+    return numeric_array(table.get_column(index), kinds)
+
+
+def take_rows(column, rows):
+    """Selects some rows from a column (a list or numpy array).
+    """
+    numpy = get_numpy(False)
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        return column[numpy.asarray(rows, dtype=numpy.intp)]
+    if numpy is not None and isinstance(rows, numpy.ndarray):
+        rows = rows.tolist()
+    return [column[i] for i in rows]
+
+
 class JoinedTables(TableObject):
     def __init__(self, left_t, right_t, left_key_col, right_key_col,
                  case_sensitive=False, always_prefix=False):
@@ -67,7 +118,7 @@ class JoinedTables(TableObject):
         self.build_column_names()
         self.compute_row_map()
         self.column_cache = {}
-        self.rows = len(self.row_map)
+        self.rows = len(self.left_rows)
 
     def build_column_names(self):
         left_name = self.left_t.name
@@ -101,19 +152,13 @@ class JoinedTables(TableObject):
         if (index, numeric) in self.column_cache:
             return self.column_cache[(index, numeric)]
 
-        result = []
         if index < self.left_t.columns:
             column = self.left_t.get_column(index, numeric)
-            for i in xrange(self.left_t.rows):
-                if i in self.row_map:
-                    result.append(column[i])
+            result = take_rows(column, self.left_rows)
         else:
             column = self.right_t.get_column(index - self.left_t.columns,
                                              numeric)
-            for i in xrange(self.left_t.rows):
-                if i in self.row_map:
-                    j = self.row_map[i]
-                    result.append(column[j])
+            result = take_rows(column, self.right_rows)
 
         numpy = get_numpy(False)
         if numeric and numpy is not None:
@@ -122,6 +167,31 @@ class JoinedTables(TableObject):
         return result
 
     def compute_row_map(self):
+        """Finds the matching rows of the two tables.
+
+        Sets left_rows and right_rows, the indexes of the rows that end up in
+        the joined table, in the order of the left table. If several rows of
+        the right table have the same key, the last one is used.
+
+        Integer keys are matched with a sort join on numpy arrays (see
+        numeric_key_array()); other keys are compared as stripped strings,
+        using a dict.
+        """
+        left_keys = numeric_key_array(self.left_t, self.left_key_col)
+        right_keys = None
+        if left_keys is not None:
+            right_keys = numeric_key_array(self.right_t, self.right_key_col)
+        if left_keys is not None and right_keys is not None:
+            numpy = get_numpy()
+            order = numpy.argsort(right_keys, kind='mergesort')
+            sorted_keys = right_keys[order]
+            pos = numpy.searchsorted(sorted_keys, left_keys, side='right') - 1
+            found = pos >= 0
+            found[found] = sorted_keys[pos[found]] == left_keys[found]
+            self.left_rows = numpy.flatnonzero(found)
+            self.right_rows = order[pos[self.left_rows]]
+            return
+
         def build_key_dict(table, key_col):
             column = table.get_column(key_col)
             if self.case_sensitive:
@@ -134,14 +204,16 @@ class JoinedTables(TableObject):
 
         right_keys = build_key_dict(self.right_t, self.right_key_col)
 
-        self.row_map = {}
+        self.left_rows = []
+        self.right_rows = []
         for left_row_idx, key in enumerate(
                 self.left_t.get_column(self.left_key_col)):
             key = utf8(key).strip()
             if not self.case_sensitive:
                 key = key.upper()
             if key in right_keys:
-                self.row_map[left_row_idx] = right_keys[key]
+                self.left_rows.append(left_row_idx)
+                self.right_rows.append(right_keys[key])
 
 
 class JoinTables(Table):
@@ -270,6 +342,10 @@ class SelectFromTable(Table):
                       'values': "[[], ['==', '!=', '<', '>', '<=', '>='], []]"})]
     _output_ports = [('value', Table)]
 
+    numpy_comparisons = {'==': 'equal', '!=': 'not_equal',
+                         '<': 'less', '>': 'greater',
+                         '<=': 'less_equal', '>=': 'greater_equal'}
+
     @staticmethod
     def make_condition(comparand, comparer):
         if isinstance(comparand, float):
@@ -294,6 +370,30 @@ class SelectFromTable(Table):
         else:
             raise ValueError("Invalid comparison operator %r" % comparer)
 
+    @classmethod
+    def select_rows(cls, table, idx, comparer, comparand):
+        """Returns the indexes of the rows matching a condition.
+
+        Numeric conditions are evaluated on the whole column at once if numpy
+        is available.
+        """
+        condition = cls.make_condition(comparand, comparer)
+        numeric = isinstance(comparand, float)
+        column = table.get_column(idx, numeric)
+        numpy = get_numpy(False)
+        if (numeric and numpy is not None and
+                isinstance(column, numpy.ndarray) and
+                comparer in cls.numpy_comparisons):
+            # Compare in double precision, like the scalar condition
+            column = column.astype(numpy.float64)
+            mask = getattr(numpy, cls.numpy_comparisons[comparer])(
+                    column, comparand)
+            return numpy.flatnonzero(mask).tolist()
+        else:
+            return [i
+                    for i, col_val in enumerate(column)
+                    if condition(col_val)]
+
     def compute(self):
         table = self.get_input('table')
 
@@ -317,16 +417,11 @@ class SelectFromTable(Table):
                                   "No column %d, table only has %d columns" % (
                                   idx, table.columns))
 
-        condition = self.make_condition(comparand, comparer)
-        numeric = isinstance(comparand, float)
-        column = table.get_column(idx, numeric)
-        matched_rows = [i
-                        for i, col_val in enumerate(column)
-                        if condition(col_val)]
+        matched_rows = self.select_rows(table, idx, comparer, comparand)
         columns = []
         for col in xrange(table.columns):
             column = table.get_column(col)
-            columns.append([column[row] for row in matched_rows])
+            columns.append(take_rows(column, matched_rows))
         selected_table = TableObject(columns, len(matched_rows), table.names)
         self.set_output('value', selected_table)
 
@@ -341,21 +436,60 @@ class AggregatedTable(TableObject):
         self.build_map()
 
     def build_map(self):
-        agg_map = {}
-        for i, val in enumerate(self.table.get_column(self.group_col)):
-            if val in agg_map:
-                agg_map[val].append(i)
-            else:
-                agg_map[val] = [i]
-        self.agg_rows = [(min(rows), rows) for rows in agg_map.itervalues()]
-        self.agg_rows.sort()
-        self.rows = len(self.agg_rows)
+        """Assigns each row of the table to a group.
+
+        Sets first_rows, the index of the first row of each group (in order),
+        and row_groups, the group number of each row. Numeric keys (see
+        numeric_key_array()) are grouped with numpy.unique(), other keys with
+        a dict.
+        """
+        numeric_keys = numeric_key_array(self.table, self.group_col, 'iuf')
+        if numeric_keys is not None and len(numeric_keys):
+            numpy = get_numpy()
+            uniques, first, inverse = numpy.unique(numeric_keys,
+                                                   return_index=True,
+                                                   return_inverse=True)
+            # numpy.unique() sorts by value, we want the order of appearance
+            order = numpy.argsort(first)
+            rank = numpy.empty_like(order)
+            rank[order] = numpy.arange(len(order))
+            self.first_rows = first[order]
+            self.row_groups = rank[inverse]
+        else:
+            keys = self.table.get_column(self.group_col)
+            agg_map = {}
+            self.first_rows = []
+            self.row_groups = []
+            for i, val in enumerate(keys):
+                try:
+                    group = agg_map[val]
+                except KeyError:
+                    group = agg_map[val] = len(self.first_rows)
+                    self.first_rows.append(i)
+                self.row_groups.append(group)
+        self.rows = len(self.first_rows)
         self.columns = 2
         if self.table.names is not None:
             self.names = [self.table.names[self.group_col],
                           self.table.names[self.col]]
 
     def get_column(self, index, numeric=False):
+        if index == 0:
+            col = self.table.get_column(self.group_col, numeric)
+            return [col[i] for i in self.first_rows]
+        elif self.op not in ('count', 'sum', 'average', 'min', 'max'):
+            raise ValueError('Unknown operation: "%s"' % self.op)
+
+        numpy = get_numpy(False)
+        if numpy is not None:
+            return self._aggregate_numpy(numpy)
+
+        groups = [[] for i in xrange(self.rows)]
+        for i, group in enumerate(self.row_groups):
+            groups[group].append(i)
+        if self.op == 'count':
+            return [len(rows) for rows in groups]
+
         def average(value_iter):
             # value_iter can only be used once
             sum = 0
@@ -367,18 +501,31 @@ class AggregatedTable(TableObject):
                   'average': average,
                   'min': min,
                   'max': max}
-        if index == 0:
-            col = self.table.get_column(self.group_col, numeric)
-            return [col[x[0]] for x in self.agg_rows]
+        col = self.table.get_column(self.col, True)
+        return [op_map[self.op](col[idx] for idx in rows)
+                for rows in groups]
+
+    def _aggregate_numpy(self, numpy):
+        groups = numpy.asarray(self.row_groups, dtype=numpy.intp)
+        counts = numpy.bincount(groups, minlength=self.rows)
+        if self.op == 'count':
+            return counts.tolist()
+        elif not self.rows:
+            return []
+
+        values = numpy.asarray(self.table.get_column(self.col, True),
+                               dtype=numpy.float64)
+        if self.op in ('sum', 'average'):
+            result = numpy.bincount(groups, weights=values,
+                                    minlength=self.rows)
+            if self.op == 'average':
+                result /= counts
         else:
-            if self.op == 'count':
-                return [len(x[1]) for x in self.agg_rows]
-            elif self.op in op_map:
-                col = self.table.get_column(self.col, True)
-                return [op_map[self.op](col[idx] for idx in x[1])
-                        for x in self.agg_rows]
-            else:
-                raise ValueError('Unknown operation: "%s"' % self.op)
+            ufunc = numpy.minimum if self.op == 'min' else numpy.maximum
+            order = numpy.argsort(groups, kind='mergesort')
+            starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+            result = ufunc.reduceat(values[order], starts)
+        return result.tolist()
 
 
 class AggregateColumn(Table):
@@ -523,6 +670,73 @@ class TestJoin(unittest.TestCase):
         self.assertEqual(table.get_column(1, False), ['one', '2', 'five'])
 
 
+    def test_integer_keys(self):
+        """Joins on integer keys, and checks against joining on strings.
+        """
+        left_ids = [4, 1, 2, 7, 5]
+        right_ids = [5, 1, 3, 1, 4]
+        def join(to_key):
+            left = TableObject([[to_key(i) for i in left_ids],
+                                ['d', 'a', 'b', 'g', 'e']],
+                               5, ['id', 'name'])
+            right = TableObject([[to_key(i) for i in right_ids],
+                                 [50, 10, 30, 11, 40]],
+                                5, ['id', 'value'])
+            return JoinedTables(left, right, 0, 0)
+        numeric = join(int)
+        text = join(lambda i: 'id%d' % i)
+        self.assertIsNotNone(numeric_array(numeric.left_t.get_column(0)))
+        self.assertIsNone(numeric_key_array(text.left_t, 0))
+        self.assertEqual(numeric.rows, 3)
+        self.assertEqual(text.rows, 3)
+        self.assertEqual(list(numeric.left_rows), text.left_rows)
+        self.assertEqual(list(numeric.right_rows), text.right_rows)
+        self.assertEqual(numeric.get_column(1), ['d', 'a', 'e'])
+        self.assertEqual(numeric.get_column(3), [40, 11, 50])
+
+    def test_text_keys(self):
+        """Joins and groups on text keys that look like numbers.
+        """
+        import os
+        import shutil
+        import tempfile
+        from .read.read_csv import CSVTable
+
+        directory = tempfile.mkdtemp(prefix='vt_test_join_')
+        try:
+            def csv_table(name, contents):
+                filename = os.path.join(directory, name)
+                with open(filename, 'wb') as fp:
+                    fp.write(contents)
+                return CSVTable(filename, True, ',', use_sniffer=False)
+            left = csv_table('left.csv', 'id,name\n7,g\n1,a\n')
+            right = csv_table('right.csv',
+                              'id,value\n07,70\n7.0,71\n1,10\n')
+            self.assertIsNone(numeric_key_array(left, 0))
+            joined = JoinedTables(left, right, 0, 0)
+            self.assertEqual(joined.rows, 1)
+            self.assertEqual(joined.get_column(1), ['a'])
+            self.assertEqual(joined.get_column(3), ['10'])
+
+            grouped = AggregatedTable(
+                    csv_table('keys.csv', 'id\n1\n01\n1.0\n2\n1\n'),
+                    'count', 0, 0)
+            self.assertEqual(grouped.rows, 4)
+            self.assertEqual(list(grouped.first_rows), [0, 1, 2, 3])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_float_keys(self):
+        """Groups on float keys that are equal in float32.
+        """
+        table = TableObject([[1.00000001, 1.0, 1.00000001, 2.0]],
+                            4, ['id'])
+        grouped = AggregatedTable(table, 'count', 0, 0)
+        self.assertIsNotNone(numeric_key_array(table, 0, 'iuf'))
+        self.assertEqual(grouped.rows, 3)
+        self.assertEqual(list(grouped.first_rows), [0, 1, 3])
+
+
 class TestProjection(unittest.TestCase):
     def do_project(self, project_functions, error=None):
         with intercept_result(ProjectTable, 'value') as results:
@@ -736,3 +950,26 @@ class TestAggregate(unittest.TestCase):
                                    ('group_by_index', [('Integer', '2')])])
         self.assertEqual(table.get_column(0, False), ['T', 'F'])
         self.assertEqual(table.get_column(1, True), [-7, 21])
+
+    def test_numeric_groups(self):
+        """Groups on numeric keys, and checks against grouping strings.
+        """
+        keys = [3, 1, 3, 2.5, 1, 3]
+        values = [1, 2, 3, 4, 5, 6]
+        for op, expected in [('count', [3, 2, 1]),
+                             ('sum', [10, 7, 4]),
+                             ('average', [10 / 3, 3.5, 4]),
+                             ('min', [1, 2, 4]),
+                             ('max', [6, 5, 4])]:
+            results = []
+            for to_key in (lambda k: k, str):
+                table = TableObject([[to_key(k) for k in keys], values],
+                                    6, ['key', 'value'])
+                agg = AggregatedTable(table, op, 1, 0)
+                self.assertEqual(list(agg.first_rows), [0, 1, 3])
+                self.assertEqual(agg.get_column(0), [to_key(k)
+                                                     for k in [3, 1, 2.5]])
+                results.append(agg.get_column(1, True))
+            for result in results:
+                for r, e in zip(result, expected):
+                    self.assertAlmostEqual(r, e)
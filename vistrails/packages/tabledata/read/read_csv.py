@@ -36,7 +36,8 @@
 from __future__ import division
 
 import csv
-import operator
+from itertools import islice, izip
+import os
 
 from ..common import get_numpy, TableObject, Table, InternalModuleError
 
@@ -48,17 +49,163 @@ def count_lines(fp):
     return lines
 
 
-# FIXME : test coverage for CSVTable
+class _PackedColumn(object):
+    """Values of a column, stored as one NUL-separated string per chunk.
+
+    The csv module rejects NUL bytes, so they can't appear in a value. This
+    avoids keeping a Python string object per field; if `filename` is set,
+    the chunks are appended to that file instead of being kept in memory.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._chunks = [] # strings, or (offset, size) in the file
+        self._size = 0
+        if filename is not None:
+            open(filename, 'wb').close()
+
+    def append(self, values):
+        data = '\0'.join(values)
+        if self.filename is None:
+            self._chunks.append(data)
+        else:
+            with open(self.filename, 'ab') as fp:
+                fp.write(data)
+            self._chunks.append((self._size, len(data)))
+            self._size += len(data)
+
+    def iter_chunks(self):
+        if self.filename is None:
+            for data in self._chunks:
+                yield data.split('\0')
+        else:
+            with open(self.filename, 'rb') as fp:
+                for offset, size in self._chunks:
+                    fp.seek(offset)
+                    yield fp.read(size).split('\0')
+
+
+class CSVColumnStore(object):
+    """Columns of a CSV file, read in a single pass.
+
+    The file is parsed in chunks of rows which are transposed into one packed
+    buffer per column (see _PackedColumn), so that the parsed rows can be
+    released right away. The lists of values and the numeric versions of the
+    columns are built from these buffers when first requested, a chunk at a
+    time, and kept for the next requests; if
+    `memmap_dir` is set, the buffers are written there, and the numeric
+    columns are written as .npy files and memory-mapped instead of being
+    kept in memory.
+    """
+    CHUNK_ROWS = 65536
+
+    def __init__(self, filename, nb_columns, skip_lines=0, delimiter=None,
+                 dialect=None, memmap_dir=None):
+        self.filename = filename
+        self.memmap_dir = memmap_dir
+        self.rows = 0
+        if memmap_dir is not None:
+            self._columns = [_PackedColumn(os.path.join(memmap_dir,
+                                                        'column_%d.txt' % i))
+                             for i in xrange(nb_columns)]
+        else:
+            self._columns = [_PackedColumn() for i in xrange(nb_columns)]
+        self._values = {}
+        self._numeric = {}
+        self._invalid = {} # column index -> (nb of fields, line number)
+
+        with open(filename, 'rb') as fp:
+            for i in xrange(skip_lines):
+                line = fp.readline()
+                if not line:
+                    raise ValueError("skip_lines greater than the number "
+                                     "of lines in the file")
+            if dialect is not None:
+                reader = csv.reader(fp, dialect=dialect)
+            else:
+                reader = csv.reader(fp, delimiter=delimiter)
+            while True:
+                chunk = list(islice(reader, self.CHUNK_ROWS))
+                if not chunk:
+                    break
+                if min(len(row) for row in chunk) >= nb_columns:
+                    for column, values in izip(self._columns, izip(*chunk)):
+                        column.append(values)
+                else:
+                    self._add_short_rows(chunk)
+                self.rows += len(chunk)
+
+    def _add_short_rows(self, chunk):
+        for index, column in enumerate(self._columns):
+            values = []
+            for rownb, row in enumerate(chunk, self.rows + 1):
+                if index < len(row):
+                    values.append(row[index])
+                else:
+                    values.append('')
+                    self._invalid.setdefault(index, (len(row), rownb))
+            column.append(values)
+
+    def _check_column(self, index):
+        if index in self._invalid:
+            raise ValueError("Invalid CSV file: only %d fields on "
+                             "line %d (column %d requested)" % (
+                                 self._invalid[index] + (index,)))
+        return self._columns[index]
+
+    def get_column(self, index):
+        if index in self._values:
+            return self._values[index]
+
+        result = []
+        for values in self._check_column(index).iter_chunks():
+            result.extend(values)
+        self._values[index] = result
+        return result
+
+    def get_numeric_column(self, index):
+        if index in self._numeric:
+            return self._numeric[index]
+
+        column = self._check_column(index)
+        numpy = get_numpy(False)
+        if numpy is None:
+            result = []
+            for values in column.iter_chunks():
+                result.extend(float(e) for e in values)
+        else:
+            if self.memmap_dir is not None:
+                filename = os.path.join(self.memmap_dir,
+                                        'column_%d.npy' % index)
+                result = numpy.lib.format.open_memmap(
+                        filename, mode='w+', dtype=numpy.float32,
+                        shape=(self.rows,))
+            else:
+                result = numpy.empty((self.rows,), dtype=numpy.float32)
+            start = 0
+            for values in column.iter_chunks():
+                result[start:start + len(values)] = values
+                start += len(values)
+            if self.memmap_dir is not None:
+                result.flush()
+                del result
+                result = numpy.load(filename, mmap_mode='r')
+
+        self._numeric[index] = result
+        return result
+
+
 class CSVTable(TableObject):
     def __init__(self, csv_file, header_present, delimiter,
-                 skip_lines=0, dialect=None, use_sniffer=True):
-        self._rows = None
+                 skip_lines=0, dialect=None, use_sniffer=True,
+                 memmap_dir=None):
+        self._store = None
 
         self.header_present = header_present
         self.delimiter = delimiter
         self.filename = csv_file
         self.skip_lines = skip_lines
         self.dialect = dialect
+        self.memmap_dir = memmap_dir
 
         (self.columns, self.names, self.delimiter,
          self.header_present, self.dialect) = \
@@ -67,8 +214,6 @@ class CSVTable(TableObject):
         if self.header_present:
             self.skip_lines += 1
 
-        self.column_cache = {}
-
     @staticmethod
     def read_file(filename, delimiter=None, header_present=True,
                   skip_lines=0, dialect=None, use_sniffer=True):
@@ -121,54 +266,25 @@ class CSVTable(TableObject):
 
         return column_count, column_names, delimiter, header_present, dialect
 
-    def get_column(self, index, numeric=False):
-        if (index, numeric) in self.column_cache:
-            return self.column_cache[(index, numeric)]
-
-        numpy = get_numpy(False)
+    @property
+    def store(self):
+        """The column store, read from the file on first access.
+        """
+        if self._store is None:
+            self._store = CSVColumnStore(self.filename, self.columns,
+                                         self.skip_lines, self.delimiter,
+                                         self.dialect, self.memmap_dir)
+        return self._store
 
-        if numeric and numpy is not None:
-            result = numpy.loadtxt(
-                    self.filename,
-                    dtype=numpy.float32,
-                    delimiter=self.delimiter,
-                    skiprows=self.skip_lines,
-                    usecols=[index])
+    def get_column(self, index, numeric=False):
+        if numeric:
+            return self.store.get_numeric_column(index)
         else:
-            with open(self.filename, 'rb') as fp:
-                for i in xrange(self.skip_lines):
-                    line = fp.readline()
-                    if not line:
-                        raise ValueError("skip_lines greater than the number "
-                                         "of lines in the file")
-                if self.dialect is not None:
-                    reader = csv.reader(fp, dialect=self.dialect)
-                else:
-                    reader = csv.reader(fp, delimiter=self.delimiter)
-
-                getter = operator.itemgetter(index)
-                try:
-                    result = []
-                    for rownb, row in enumerate(reader, 1):
-                        result.append(getter(row))
-                except IndexError:
-                    raise ValueError("Invalid CSV file: only %d fields on "
-                                     "line %d (column %d requested)" % (
-                                         len(row), rownb, index))
-            if numeric:
-                result = [float(e) for e in result]
-
-        self.column_cache[(index, numeric)] = result
-        return result
+            return self.store.get_column(index)
 
     @property
     def rows(self):
-        if self._rows is not None:
-            return self._rows
-        with open(self.filename, 'rb') as fp:
-            self._rows = count_lines(fp)
-        self._rows -= self.skip_lines
-        return self._rows
+        return self.store.rows
 
 
 class CSVFile(Table):
@@ -178,6 +294,11 @@ class CSVFile(Table):
     able to guess the actual format of the file in most cases, or you can use
     the `delimiter`, `header_present` and `skip_lines` ports to force how the
     file will be read.
+
+    The file is only parsed once, when the first column is requested. If
+    `memmap_columns` is set, the columns are stored in temporary files, and
+    numeric columns in .npy files that are memory-mapped, rather than kept
+    in memory.
     """
     _input_ports = [
             ('file', '(org.vistrails.vistrails.basic:File)'),
@@ -190,7 +311,9 @@ class CSVFile(Table):
             ('skip_lines', '(org.vistrails.vistrails.basic:Integer)',
              {'optional': True, 'defaults': "['0']"}),
             ('dialect', '(org.vistrails.vistrails.basic:String)',
-             {'optional': True})]
+             {'optional': True}),
+            ('memmap_columns', '(org.vistrails.vistrails.basic:Boolean)',
+             {'optional': True, 'defaults': "['False']"})]
     _output_ports = [
             ('column_count', '(org.vistrails.vistrails.basic:Integer)'),
             ('column_names', '(org.vistrails.vistrails.basic:List)'),
@@ -203,10 +326,14 @@ class CSVFile(Table):
         skip_lines = self.get_input('skip_lines')
         dialect = self.force_get_input('dialect', None)
         sniff_header = self.get_input('sniff_header')
+        memmap_dir = None
+        if self.get_input('memmap_columns') and get_numpy(False) is not None:
+            memmap_dir = self.interpreter.filePool.create_directory(
+                    prefix='vt_csv').name
 
         try:
             table = CSVTable(csv_file, header_present, delimiter, skip_lines,
-                             dialect, sniff_header)
+                             dialect, sniff_header, memmap_dir)
         except InternalModuleError, e:
             e.raise_module_error(self)
 
@@ -321,6 +448,81 @@ class CSVTestCase(unittest.TestCase):
                          ['col moutarde', '4', 'not a number', '7'])
 
 
+class TestCSVColumnStore(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix='vt_test_csv_')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def write(self, contents):
+        filename = os.path.join(self.directory, 'table.csv')
+        with open(filename, 'wb') as fp:
+            fp.write(contents)
+        return filename
+
+    def test_chunks(self):
+        """Reads a file spanning several chunks.
+        """
+        filename = self.write(''.join('%d,%d.5,r%d\n' % (i, i, i)
+                                      for i in xrange(25)))
+        old_chunk, CSVColumnStore.CHUNK_ROWS = CSVColumnStore.CHUNK_ROWS, 10
+        try:
+            table = CSVTable(filename, False, ',', use_sniffer=False)
+            self.assertEqual(table.rows, 25)
+            self.assertEqual(table.get_column(2)[:3], ['r0', 'r1', 'r2'])
+            self.assertEqual(list(table.get_column(1, True)[-2:]),
+                             [23.5, 24.5])
+        finally:
+            CSVColumnStore.CHUNK_ROWS = old_chunk
+
+    def test_short_rows(self):
+        """Only columns missing from some rows are invalid.
+        """
+        filename = self.write('a,b,c\n1,2,3\n4,5\n6,7,8\n')
+        table = CSVTable(filename, True, ',', use_sniffer=False)
+        self.assertEqual(table.rows, 3)
+        self.assertEqual(table.get_column(1), ['2', '5', '7'])
+        with self.assertRaises(ValueError) as cm:
+            table.get_column(2)
+        self.assertIn("only 2 fields on line 2", cm.exception.message)
+
+    def test_memmap(self):
+        """Spills numeric columns to memory-mapped files.
+        """
+        import numpy
+
+        filename = self.write('x;y\n1;2\n3;4.25\n')
+        table = CSVTable(filename, True, ';', use_sniffer=False,
+                         memmap_dir=self.directory)
+        column = table.get_column(1, True)
+        self.assertIsInstance(column, numpy.memmap)
+        self.assertEqual(list(column), [2.0, 4.25])
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    'column_1.npy')))
+        self.assertIs(table.get_column(1, True), column)
+        del column
+        # the text of the columns is spilled too
+        self.assertEqual(table.get_column(0), ['1', '3'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    'column_0.txt')))
+
+    def test_packed_values(self):
+        """Keeps empty and quoted values through the packed buffers.
+        """
+        filename = self.write('a,b\n,"x\ny"\n"1,2",\n')
+        old_chunk, CSVColumnStore.CHUNK_ROWS = CSVColumnStore.CHUNK_ROWS, 1
+        try:
+            table = CSVTable(filename, True, ',', use_sniffer=False)
+            self.assertEqual(table.get_column(0), ['', '1,2'])
+            self.assertEqual(table.get_column(1), ['x\ny', ''])
+            self.assertIs(table.get_column(1), table.get_column(1))
+        finally:
+            CSVColumnStore.CHUNK_ROWS = old_chunk
+
+
 class TestCountlines(unittest.TestCase):
     def test_countlines(self):
         # Simple